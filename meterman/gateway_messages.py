@@ -16,9 +16,12 @@ to better support simulation and testing.
 #  IMPORTS
 # ==============================================================================================================================================================
 
+import time
 import arrow
+from array import array
 from enum import Enum
 from collections import namedtuple
+from itertools import accumulate, chain, islice, repeat
 from random import randint
 
 # ==============================================================================================================================================================
@@ -336,7 +339,7 @@ def get_gateway_snapshot_msg():
 
 
 def gateway_snapshot_msg(gateway_id, when_booted, free_ram, time, log_level, encrypt_key, network_id, tx_power):
-    return get_message_str(SMSG_GWSNAP_DEFN, header={'gateway_id': gateway_id, 'when_booted': when_booted, 'free_ram': free_ram, 'time': time,
+    return get_message_str(SMSG_GWSNAP_DEFN, header={'gateway_id': gateway_id, 'when_booted': when_booted, 'free_ram': free_ram, 'gateway_time': time,
                 'log_level': log_level, 'encrypt_key': encrypt_key, 'network_id': network_id, 'tx_power': tx_power})
 
 
@@ -344,12 +347,12 @@ def set_gw_inst_tmp_rate_msg(node_id, tmp_poll_rate, tmp_poll_period):
     return get_message_str(SMSG_SETGITR_DEFN, header={'node_id': node_id, 'tmp_poll_rate': tmp_poll_rate, 'tmp_poll_period': tmp_poll_period})
 
 
-def set_gateway_inst_tmp_rate_ack_msg():
-    return get_message_str(SMSG_SETGITR_ACK_DEFN)
+def set_gateway_inst_tmp_rate_ack_msg(node_id):
+    return get_message_str(SMSG_SETGITR_ACK_DEFN, header={'node_id': node_id})
 
 
-def set_gateway_inst_tmp_rate_nack_msg():
-    return get_message_str(SMSG_SETGITR_NACK_DEFN)
+def set_gateway_inst_tmp_rate_nack_msg(node_id):
+    return get_message_str(SMSG_SETGITR_NACK_DEFN, header={'node_id': node_id})
 
 
 def get_node_snapshot_msg(node_id):
@@ -357,25 +360,26 @@ def get_node_snapshot_msg(node_id):
 
 
 def node_snapshot_msg(node_id, batt_voltage, up_time,sleep_time, free_ram, last_seen, last_clock_drift, meter_interval, meter_impulses_per_kwh, last_meter_entry_finish,
-                      last_meter_value, puck_led_rate, puck_led_time,last_rssi_at_gateway):
+                      last_meter_value, puck_led_rate, puck_led_time,last_rssi_at_gateway, last_rms_current=0):
     return get_message_str(SMSG_NODESNAP_DEFN, detail_recs=[{'node_id': node_id, 'batt_voltage': batt_voltage, 'up_time': up_time, 'sleep_time': sleep_time,
-                             'free_ram': free_ram, 'last_seen': last_seen, 'last_clock_drift': last_clock_drift, 'meter_interval': meter_interval, 'meter_impulses_per_kwh': meter_impulses_per_kwh,
-                             'last_meter_entry_finish': last_meter_entry_finish, 'last_meter_value': last_meter_value, 'puck_led_rate': puck_led_rate,
+                             'free_ram': free_ram, 'when_last_seen': last_seen, 'last_clock_drift': last_clock_drift, 'meter_interval': meter_interval, 'meter_impulses_per_kwh': meter_impulses_per_kwh,
+                             'last_meter_entry_finish': last_meter_entry_finish, 'last_meter_value': last_meter_value, 'last_rms_current': last_rms_current, 'puck_led_rate': puck_led_rate,
                              'puck_led_time': puck_led_time, 'last_rssi_at_gateway': last_rssi_at_gateway}])
 
 
-def get_node_snapshot_nack_msg():
-    return get_message_str(SMSG_GETNODESNAP_NACK_DEFN)
+def get_node_snapshot_nack_msg(node_id):
+    return get_message_str(SMSG_GETNODESNAP_NACK_DEFN, header={'node_id': node_id})
 
 
 def meter_update_no_irms_msg(node_id, start_timestamp, start_meter_value, meter_entries):
-    # meter entries is list of detail record tuples
+    # meter entries is list of detail record tuples, start timestamp and meter value are those of the last entry sent before them
     entry_list = []
 
     for entry in meter_entries:
-            entry_list.append({'entry_interval_len': entry.entry_interval_len, 'entry_value': entry.entry_value})
+            entry_list.append({'entry_interval_length': entry.entry_interval_length, 'entry_value': entry.entry_value})
 
-    return get_message_str(SMSG_MTRUPDATE_NO_IRMS_DEFN, header={'node_id': node_id, 'start_timestamp': start_timestamp, 'start_meter_value': start_meter_value}, detail_recs=entry_list)
+    return get_message_str(SMSG_MTRUPDATE_NO_IRMS_DEFN, header={'node_id': node_id, 'last_entry_finish_time': start_timestamp,
+                                                                'last_entry_meter_value': start_meter_value}, detail_recs=entry_list)
 
 
 def meter_update_with_irms_msg(node_id, start_timestamp, start_meter_value, meter_entries):
@@ -383,9 +387,10 @@ def meter_update_with_irms_msg(node_id, start_timestamp, start_meter_value, mete
     entry_list = []
 
     for entry in meter_entries:
-            entry_list.append({'entry_interval_len': entry.entry_interval_len, 'entry_value': entry.entry_value, 'spot_rms_current': entry.spot_rms_current})
+            entry_list.append({'entry_interval_length': entry.entry_interval_length, 'entry_value': entry.entry_value, 'spot_rms_current': entry.spot_rms_current})
 
-    return get_message_str(SMSG_MTRUPDATE_WITH_IRMS_DEFN, header={'node_id': node_id, 'start_timestamp': start_timestamp, 'start_meter_value': start_meter_value}, detail_recs=entry_list)
+    return get_message_str(SMSG_MTRUPDATE_WITH_IRMS_DEFN, header={'node_id': node_id, 'last_entry_finish_time': start_timestamp,
+                                                                  'last_entry_meter_value': start_meter_value}, detail_recs=entry_list)
 
 
 def meter_rebase_msg(node_id, entry_timestamp, meter_value):
@@ -396,36 +401,36 @@ def set_node_meter_value_msg(node_id, new_meter_value):
     return get_message_str(SMSG_SETMTRVAL_DEFN, header={'node_id': node_id, 'new_meter_value': new_meter_value})
 
 
-def set_node_meter_value_ack_msg():
-    return get_message_str(SMSG_SETMTRVAL_ACK_DEFN)
+def set_node_meter_value_ack_msg(node_id):
+    return get_message_str(SMSG_SETMTRVAL_ACK_DEFN, header={'node_id': node_id})
 
 
-def set_node_meter_value_nack_msg():
-    return get_message_str(SMSG_SETMTRVAL_NACK_DEFN)
+def set_node_meter_value_nack_msg(node_id):
+    return get_message_str(SMSG_SETMTRVAL_NACK_DEFN, header={'node_id': node_id})
 
 
 def set_node_meter_interval_msg(node_id, new_meter_interval):
     return get_message_str(SMSG_SETMTRINT_DEFN, header={'node_id': node_id, 'new_meter_interval': new_meter_interval})
 
 
-def set_node_meter_interval_ack_msg():
-    return get_message_str(SMSG_SETMTRINT_ACK_DEFN)
+def set_node_meter_interval_ack_msg(node_id):
+    return get_message_str(SMSG_SETMTRINT_ACK_DEFN, header={'node_id': node_id})
 
 
-def set_node_meter_interval_nack_msg():
-    return get_message_str(SMSG_SETMTRINT_NACK_DEFN)
+def set_node_meter_interval_nack_msg(node_id):
+    return get_message_str(SMSG_SETMTRINT_NACK_DEFN, header={'node_id': node_id})
 
 
 def set_node_puck_led_msg(node_id, new_puck_led_rate, new_puck_led_time):
     return get_message_str(SMSG_SETPLED_DEFN, header={'node_id': node_id, 'new_puck_led_rate': new_puck_led_rate, 'new_puck_led_time': new_puck_led_time})
 
 
-def set_node_puck_led_ack_msg():
-    return get_message_str(SMSG_SETPLED_ACK_DEFN)
+def set_node_puck_led_ack_msg(node_id):
+    return get_message_str(SMSG_SETPLED_ACK_DEFN, header={'node_id': node_id})
 
 
-def set_node_puck_led_nack_msg():
-    return get_message_str(SMSG_SETPLED_NACK_DEFN)
+def set_node_puck_led_nack_msg(node_id):
+    return get_message_str(SMSG_SETPLED_NACK_DEFN, header={'node_id': node_id})
 
 
 def meter_node_dark_msg(node_id, last_seen):
@@ -448,7 +453,7 @@ def get_random_meter_update_msg(node_id, start_time=None, start_value=0, interva
         num_elements = randint(1, 7)
         for i in range (1, num_elements):
             entry_value = randint(entry_min, entry_max)
-            meter_entries.append({'entry_interval_len': interval, 'entry_value': entry_value})
+            meter_entries.append(SMSG_MTRUPDATE_NO_IRMS_DEFN['obj_detail_defn'](interval, entry_value))
         return meter_update_no_irms_msg(node_id, start_time, start_value, meter_entries)
 
 
@@ -475,6 +480,9 @@ def get_random_gateway_event_msg(node_id):
 def register_message_defn(message_defn):
     '''
     Adds message definition to dict of definitions, with namedtuples for object header and detail items.
+
+    Also precomputes the record layout used by get_message_obj: header record length and positions of kept (non-skip) attributes within it,
+    and the same for the repeating detail record.  The header record is layout positions 1..(first detail - 1), i.e. after the message type.
     '''
 
     tmp_header_defn = []
@@ -489,6 +497,14 @@ def register_message_defn(message_defn):
     message_defn['obj_header_defn'] = namedtuple('Header', tmp_header_defn)
     message_defn['obj_detail_defn'] = namedtuple('Detail', tmp_detail_defn)
 
+    attrib_types = message_defn['smsg_attrib_type']
+    detail_start_pos = attrib_types.index(A_DETAIL) if A_DETAIL in attrib_types else len(attrib_types)
+    message_defn['obj_header_len'] = detail_start_pos - 1
+    message_defn['obj_header_slots'] = [i - 1 for i in range(1, detail_start_pos) if attrib_types[i] == A_HEADER]
+    message_defn['obj_detail_len'] = len(attrib_types) - detail_start_pos
+    message_defn['obj_detail_slots'] = [i - detail_start_pos for i in range(detail_start_pos, len(attrib_types)) if attrib_types[i] == A_DETAIL]
+    message_defn['obj_detail_keep_all'] = len(message_defn['obj_detail_slots']) == message_defn['obj_detail_len']
+
     message_definitions[message_defn['smsg_type']] = message_defn
 
 
@@ -503,9 +519,9 @@ def get_message_str(message_defn, header=None, detail_recs=None):
             if message_defn['smsg_attrib_type'][i].startswith(A_HEADER):
                 if i > 1:
                     message_str += SMSG_FS
-                if attr_name is 'rmsg_type':
+                if attr_name == 'rmsg_type':
                     message_str += message_defn['rmsg_type']
-                elif attr_name is not 'smsg_type':
+                elif attr_name != 'smsg_type':
                     message_str += str(header[attr_name])
 
     if detail_recs is not None:
@@ -544,8 +560,14 @@ def get_attrib_defn_idx(message_type, msg_attrib_pos):
         return attrib_defn_pos
 
 
-def get_message_obj(message_str, gateway_uuid, gateway_id, network_id):
-    when_received = arrow.utcnow().timestamp
+def get_message_obj(message_str, gateway_uuid, gateway_id, network_id, when_received=None):
+    '''
+    Returns message object (dict) for message string: message type and receipt details, plus a namedtuple per record keyed as
+    HEADER_<record position> or DETAIL_<record position>, with record counts.  when_received defaults to now (UTC epoch), or may be given
+    e.g. when replaying captured messages.
+    '''
+    if when_received is None:
+        when_received = int(time.time())
 
     # remove message rx/tx prefix
     message_str = message_str.replace(SMSG_RX_PREFIX, '')
@@ -553,6 +575,52 @@ def get_message_obj(message_str, gateway_uuid, gateway_id, network_id):
     # split into records (will be at least 2)
     msg_in_records = list(filter(None, message_str.split(SMSG_RS)))
 
+    if len(msg_in_records) == 0 or SMSG_FS in msg_in_records[0]:
+        return get_message_obj_by_attrib(msg_in_records, gateway_uuid, gateway_id, network_id, when_received)
+
+    message_type = msg_in_records[0]
+    message_defn = message_definitions[message_type]
+    header_len = message_defn['obj_header_len']
+    detail_len = message_defn['obj_detail_len']
+
+    transfer_obj = {'header_count': 0, 'detail_count': 0, 'message_type': message_type, 'when_received': when_received,
+                    'gateway_uuid': gateway_uuid, 'gateway_id': gateway_id, 'network_id': network_id}
+
+    # records aligned with layout (one header record, then whole detail records) are built positionally from precomputed slots
+    rec_pos = 1
+    if header_len > 0 and len(msg_in_records) > 1:
+        record_attribs = msg_in_records[1].split(SMSG_FS)
+        if len(record_attribs) != header_len:
+            return get_message_obj_by_attrib(msg_in_records, gateway_uuid, gateway_id, network_id, when_received)
+        transfer_obj['HEADER_1'] = message_defn['obj_header_defn']._make([record_attribs[i] for i in message_defn['obj_header_slots']])
+        transfer_obj['header_count'] = 1
+        rec_pos = 2
+
+    if rec_pos < len(msg_in_records):
+        detail_defn = message_defn['obj_detail_defn']
+        detail_slots = message_defn['obj_detail_slots']
+        detail_keep_all = message_defn['obj_detail_keep_all']
+        detail_objs = []
+        for msg_in_record in msg_in_records[rec_pos:]:
+            record_attribs = msg_in_record.split(SMSG_FS)
+            if len(record_attribs) != detail_len:
+                return get_message_obj_by_attrib(msg_in_records, gateway_uuid, gateway_id, network_id, when_received)
+            detail_objs.append(detail_defn._make(record_attribs if detail_keep_all else [record_attribs[i] for i in detail_slots]))
+
+        for detail_obj in detail_objs:
+            transfer_obj[A_DETAIL + '_' + str(rec_pos)] = detail_obj
+            rec_pos += 1
+        transfer_obj['detail_count'] = len(detail_objs)
+
+    return transfer_obj
+
+
+def get_message_obj_by_attrib(msg_in_records, gateway_uuid, gateway_id, network_id, when_received):
+    '''
+    Builds message object by walking every attribute and resolving its layout position with get_attrib_defn_idx.  Handles records that are
+    not aligned with the message layout; get_message_obj uses this only for those.
+    '''
+
     header_defn = None
     detail_defn = None
     message_defn = None
@@ -616,6 +684,52 @@ def get_message_obj(message_str, gateway_uuid, gateway_id, network_id):
     return transfer_obj
 
 
+# Columns of meter entries decoded from meter update messages, one element per entry
+MeterUpdateColumns = namedtuple('MeterUpdateColumns', ['node_ids', 'when_starts', 'entry_intervals', 'entry_values', 'meter_values',
+                                                       'spot_rms_currents'])
+
+
+def get_meter_update_columns(message_strs):
+    '''
+    Decodes one or many MUP_/MUPC message strings (e.g. a buffer of serial lines) into MeterUpdateColumns of typed arrays, one element per
+    meter entry: node id, entry start time, interval length, interval value, meter value and spot RMS current (NaN for MUP_).  Start times
+    and meter values are running sums from each message's header, as in MeterDeviceManager.proc_meter_update, computed per message with
+    itertools.accumulate rather than per entry.  Lines that are not meter updates, or have no entries, are skipped.  Raises ValueError for
+    a malformed meter update.
+    '''
+    if isinstance(message_strs, str):
+        message_strs = message_strs.splitlines()
+
+    columns = MeterUpdateColumns(array('H'), array('q'), array('q'), array('q'), array('q'), array('d'))
+
+    for message_str in message_strs:
+        msg_in_records = list(filter(None, message_str.strip().replace(SMSG_RX_PREFIX, '').split(SMSG_RS)))
+        if len(msg_in_records) < 3 or msg_in_records[0] not in (SMSG_MTRUPDATE_NO_IRMS_DEFN['smsg_type'], SMSG_MTRUPDATE_WITH_IRMS_DEFN['smsg_type']):
+            continue
+
+        node_id, rmsg_type, last_entry_finish_time, last_entry_meter_value = msg_in_records[1].split(SMSG_FS)
+        detail_len = message_definitions[msg_in_records[0]]['obj_detail_len']
+        detail_attribs = SMSG_FS.join(msg_in_records[2:]).split(SMSG_FS)
+        if len(detail_attribs) % detail_len != 0:
+            raise ValueError('Meter update has incomplete entries: {0}'.format(message_str))
+
+        entry_intervals = array('q', map(int, detail_attribs[0::detail_len]))
+        entry_values = array('q', map(int, detail_attribs[1::detail_len]))
+        entry_count = len(entry_intervals)
+
+        columns.node_ids.extend(repeat(int(node_id), entry_count))
+        columns.when_starts.extend(islice(accumulate(chain((int(last_entry_finish_time) + 1,), entry_intervals)), 1, None))
+        columns.entry_intervals.extend(entry_intervals)
+        columns.entry_values.extend(entry_values)
+        columns.meter_values.extend(islice(accumulate(chain((int(last_entry_meter_value),), entry_values)), 1, None))
+        if detail_len > 2:
+            columns.spot_rms_currents.extend(map(float, detail_attribs[2::detail_len]))
+        else:
+            columns.spot_rms_currents.extend(repeat(float('nan'), entry_count))
+
+    return columns
+
+
 register_message_defn(SMSG_GETTIME_DEFN)
 register_message_defn(SMSG_SETTIME_DEFN)
 register_message_defn(SMSG_SETTIME_ACK_DEFN)
@@ -0,0 +1,309 @@
+'''
+
+================================================================================================================================================================
+meter_analytics.py
+=====================
+
+Optional analytical store for long-range meter entry queries (consumption per day, month or year, and load percentiles, for a node or
+all nodes): finalized months of meter entries exported to a Parquet file each, in a directory beside the main DB file (e.g.
+meterman_data_analytics/meter_entry_201801.parquet), and queried in-process by DuckDB.  Needs the duckdb package.  Without it,
+ANALYTICS_AVAILABLE is False, MeterDataManager creates no store, and all queries run on SQLite.
+
+    - A month is finalized once it ended ANALYTICS_SETTLE_SECS ago, as late entries and corrections mostly land within days.  Finalized
+      months are exported a month per step by meter_db_maint, oldest first, with all their entries (from the DB, shards and archive).
+    - Exported months are recorded in a manifest, with a fingerprint of their daily rollups (see meter_db).  Any change to a month's
+      entries changes its rollups, so a month whose fingerprint no longer matches is stale: queries covering it run on SQLite, and
+      maintenance exports it again.
+    - MeterDataManager routes a query to the store when its range is at least ANALYTICS_MIN_RANGE_SECS and every month it covers (and the
+      month before, for the rise of the first entries) is exported and fresh.  Otherwise it runs on SQLite through the get_entries_*
+      functions here, with the same results.
+
+Consumption is as for rollups: the rise in meter value of each normal entry from the node's normal entry before it (in order of start,
+then entry type), with rebases setting the meter value the next entry rises from.  The entry before is looked for back to the start of
+the month before time_from.  Load is the average power of a normal meter update, entry_value * 3600 / duration (W, for Wh entries).
+
+Run by MeterDataManager when 'analytics_export' is set in the [Database] config section.
+
+================================================================================================================================================================
+
+'''
+
+import calendar
+import json
+import os
+import threading
+import time
+from itertools import groupby
+from operator import itemgetter
+
+import pandas as pd
+
+from meterman import meter_db as db
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+ANALYTICS_AVAILABLE = duckdb is not None
+ANALYTICS_DIR_FORMAT = '{0}_analytics'          # main DB file root
+ANALYTICS_FILE_FORMAT = 'meter_entry_{0}.parquet'   # month (YYYYMM)
+ANALYTICS_MANIFEST_FILE = 'manifest.json'
+ANALYTICS_SETTLE_SECS = 7 * 86400
+ANALYTICS_MIN_RANGE_SECS = 31 * 86400
+ANALYTICS_PERIODS = ('day', 'month', 'year')
+DEF_LOAD_PERCENTILES = (50, 95, 99)
+LOAD_ENTRY_TYPES = (db.EntryType.METER_UPDATE.value, db.EntryType.METER_UPDATE_SYNTH.value)
+
+
+def get_period_start(period, timestamp):
+    # start of the UTC day, month or year holding timestamp
+    if period == 'day':
+        return timestamp - (timestamp % 86400)
+    if period == 'month':
+        return db.get_shard_month_start(db.get_shard_month(timestamp))
+    return calendar.timegm((time.gmtime(timestamp).tm_year, 1, 1, 0, 0, 0))
+
+
+def get_lookback_from(time_from):
+    # start of the month before time_from's, from which entries are read for the rise of the first entries from time_from
+    if time_from is None:
+        return None
+    return db.get_shard_month_start(db.add_shard_months(db.get_shard_month(time_from), -1))
+
+
+def get_percentile(sorted_values, percentile):
+    # linear interpolation between closest ranks, as DuckDB quantile_cont
+    pos = (len(sorted_values) - 1) * percentile / 100
+    lower = int(pos)
+    if lower + 1 >= len(sorted_values):
+        return float(sorted_values[lower])
+    return sorted_values[lower] + ((sorted_values[lower + 1] - sorted_values[lower]) * (pos - lower))
+
+
+def get_entries_period_consumption(entries, period, time_from=None):
+    # Consumption and sample count per node per period, as a list of dicts in order of node and period start, of normal entries (as
+    # MeterEntry, in order of start) starting from time_from.  Entries before time_from are only risen from.
+    node_states = {}        # last meter value of each node
+    buckets = {}
+    for when_start, start_entries in groupby(entries, key=itemgetter(3)):
+        for entry in sorted(start_entries, key=itemgetter(0, 5)):
+            last_meter_value = node_states.get(entry.node_uuid)
+            node_states[entry.node_uuid] = entry.meter_value
+            if entry.entry_type in db.REBASE_ENTRY_TYPES or (time_from is not None and when_start < time_from):
+                continue
+            bucket = buckets.setdefault((entry.node_uuid, get_period_start(period, when_start)), [0, 0])
+            bucket[0] += (entry.meter_value - last_meter_value) if last_meter_value is not None else 0
+            bucket[1] += 1
+    return [{'node_uuid': node_uuid, 'period_start': period_start, 'consumption': consumption, 'sample_count': sample_count}
+            for (node_uuid, period_start), (consumption, sample_count) in sorted(buckets.items())]
+
+
+def get_entries_load_percentiles(entries, percentiles=DEF_LOAD_PERCENTILES):
+    # Load percentiles (W) and sample count per node, as a list of dicts in order of node (with a 'load_p<percentile>' key for each), of
+    # normal entries (as MeterEntry)
+    node_loads = {}
+    for entry in entries:
+        if entry.entry_type in LOAD_ENTRY_TYPES and entry.duration > 0:
+            node_loads.setdefault(entry.node_uuid, []).append(entry.entry_value * 3600 / entry.duration)
+    results = []
+    for node_uuid, loads in sorted(node_loads.items()):
+        loads.sort()
+        result = {'node_uuid': node_uuid, 'sample_count': len(loads)}
+        for percentile in percentiles:
+            result['load_p{0}'.format(percentile)] = get_percentile(loads, percentile)
+        results.append(result)
+    return results
+
+
+class MeterAnalytics:
+    """
+    Parquet store of a DB's finalized months of meter entries, exported and queried through an in-memory DuckDB connection (a cursor of
+    it per call, so from any thread).
+
+    """
+
+    def __init__(self, db_mgr):
+        if not ANALYTICS_AVAILABLE:
+            raise ImportError('meter analytics needs the duckdb package')
+        if db_mgr.db_uri == ':memory:':
+            raise ValueError('meter analytics needs a DB file')
+        self.db_mgr = db_mgr
+        self.analytics_path = ANALYTICS_DIR_FORMAT.format(os.path.splitext(db_mgr.db_uri)[0])
+        os.makedirs(self.analytics_path, exist_ok=True)
+        self.connection = duckdb.connect(':memory:')
+        self.manifest_lock = threading.Lock()
+        self.manifest = self.load_manifest()    # {month: {'rows': entries, 'fingerprint': see get_month_fingerprint, 'exported': time}}
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def get_file(self, month):
+        return os.path.join(self.analytics_path, ANALYTICS_FILE_FORMAT.format(month))
+
+
+    def load_manifest(self):
+        manifest_file = os.path.join(self.analytics_path, ANALYTICS_MANIFEST_FILE)
+        if not os.path.isfile(manifest_file):
+            return {}
+        with open(manifest_file, 'r') as manifest_in:
+            return {int(month): export for month, export in json.load(manifest_in).items()}
+
+
+    def save_manifest(self):
+        # replaced whole, so never left half written (call under manifest_lock)
+        manifest_file = os.path.join(self.analytics_path, ANALYTICS_MANIFEST_FILE)
+        with open(manifest_file + '.tmp', 'w') as manifest_out:
+            json.dump({str(month): export for month, export in self.manifest.items()}, manifest_out)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+
+    def get_month_fingerprint(self, month):
+        # (buckets, consumption, samples, min and max entry values) summed over daily rollups of all nodes for month, an index seek per node
+        month_from = db.get_shard_month_start(month)
+        month_to = db.get_shard_month_start(db.add_shard_months(month, 1))
+        fingerprint = [0, 0, 0, 0, 0]
+        with self.db_mgr.read_connection() as connection:
+            node_uuid = connection.execute('SELECT MIN(node_uuid) FROM meter_rollup').fetchone()[0]
+            while node_uuid is not None:
+                row = connection.execute('SELECT COUNT(*), SUM(consumption), SUM(sample_count), SUM(min_entry_value), SUM(max_entry_value) '
+                                         'FROM meter_rollup WHERE node_uuid = ? AND bucket_type = ? AND bucket_start >= ? AND bucket_start < ?',
+                                         (node_uuid, db.RollupBucket.DAY.value, month_from, month_to)).fetchone()
+                fingerprint = [total + (value or 0) for total, value in zip(fingerprint, row)]
+                node_uuid = connection.execute('SELECT MIN(node_uuid) FROM meter_rollup WHERE node_uuid > ?', (node_uuid,)).fetchone()[0]
+        return fingerprint
+
+
+    def is_fresh(self, month):
+        # whether month is exported, and its entries unchanged since (never, without rollups to tell)
+        export = self.manifest.get(month)
+        return export is not None and self.db_mgr.rollups and export['fingerprint'] == self.get_month_fingerprint(month)
+
+
+    def get_export_months(self, now=None):
+        # finalized months, from that of the first meter entry
+        now = time.time() if now is None else now
+        with self.db_mgr.read_connection() as connection:
+            first_when_starts = [self.db_mgr.get_first_when_start(connection)]
+        if self.db_mgr.archive_range is not None:
+            first_when_starts.append(self.db_mgr.archive_range[0])
+        first_when_starts = [when_start for when_start in first_when_starts if when_start is not None]
+        if len(first_when_starts) == 0:
+            return []
+        months = []
+        month = db.get_shard_month(min(first_when_starts))
+        while db.get_shard_month_start(db.add_shard_months(month, 1)) <= now - ANALYTICS_SETTLE_SECS:
+            months.append(month)
+            month = db.add_shard_months(month, 1)
+        return months
+
+
+    def export_month(self, month):
+        # Writes month's meter entries to its Parquet file (none if it has none) and records it in the manifest.  The fingerprint is taken
+        # first, so a change while exporting leaves the month stale.  Returns number of entries exported.
+        fingerprint = self.get_month_fingerprint(month)
+        entries = list(self.db_mgr.iter_node_meter_entries(time_from=db.get_shard_month_start(month),
+                                                           time_to=db.get_shard_month_start(db.add_shard_months(month, 1)) - 1))
+        month_file = self.get_file(month)
+        if len(entries) > 0:
+            cursor = self.connection.cursor()
+            try:
+                cursor.register('month_entries', pd.DataFrame.from_records(entries, columns=db.METER_ENTRY_COLUMNS))
+                cursor.execute("COPY (SELECT * FROM month_entries ORDER BY node_uuid, when_start) TO '{0}' (FORMAT PARQUET, COMPRESSION ZSTD)".format(
+                    (month_file + '.tmp').replace("'", "''")))
+            finally:
+                cursor.close()
+            os.replace(month_file + '.tmp', month_file)
+        elif os.path.isfile(month_file):
+            os.remove(month_file)
+
+        with self.manifest_lock:
+            self.manifest[month] = {'rows': len(entries), 'fingerprint': fingerprint, 'exported': int(time.time())}
+            self.save_manifest()
+        return len(entries)
+
+
+    def export_next(self, now=None, skip_months=()):
+        # Exports the first finalized month (but skip_months) not exported or stale, as a step of maintenance.  Returns (month, entries), or
+        # None if none.  Without rollups, nothing is exported, as nothing would be fresh.
+        if not self.db_mgr.rollups:
+            return None
+        for month in self.get_export_months(now):
+            if month not in skip_months and not self.is_fresh(month):
+                return month, self.export_month(month)
+        return None
+
+
+    def is_covered(self, time_from, time_to):
+        # whether a query from time_from to time_to should run on the store (see module doc)
+        if time_from is None or time_to is None or time_to - time_from + 1 < ANALYTICS_MIN_RANGE_SECS:
+            return False
+        month = db.get_shard_month(time_from)
+        month_to = db.get_shard_month(time_to)
+        lookback_month = db.add_shard_months(month, -1)
+        if lookback_month in self.manifest and not self.is_fresh(lookback_month):
+            return False
+        while month <= month_to:
+            if not self.is_fresh(month):
+                return False
+            month = db.add_shard_months(month, 1)
+        return True
+
+
+    def get_source(self, time_from, time_to):
+        # read_parquet() of exported months with entries from time_from to time_to
+        with self.manifest_lock:
+            exports = sorted(self.manifest.items())
+        month_files = ["'{0}'".format(self.get_file(month).replace("'", "''")) for month, export in exports
+                       if export['rows'] > 0 and db.get_shard_month(time_from) <= month <= db.get_shard_month(time_to)]
+        return 'read_parquet([{0}])'.format(', '.join(month_files)) if len(month_files) > 0 else None
+
+
+    def query(self, cmd, params):
+        cursor = self.connection.cursor()
+        try:
+            return cursor.execute(cmd, params).fetchall()
+        finally:
+            cursor.close()
+
+
+    def get_period_consumption(self, node_uuid, period, time_from, time_to):
+        # as get_entries_period_consumption, of node's (or all nodes') normal entries from time_from to time_to
+        source = self.get_source(get_lookback_from(time_from), time_to)
+        if source is None:
+            return []
+        node_cmd = ' AND node_uuid = ?' if node_uuid is not None else ''
+        node_params = [node_uuid] if node_uuid is not None else []
+        rebase_types = ', '.join("'{0}'".format(entry_type) for entry_type in db.REBASE_ENTRY_TYPES)
+        rows = self.query("SELECT node_uuid, CAST(epoch(date_trunc('{0}', epoch_ms(when_start * 1000))) AS BIGINT) AS period_start, ".format(period) +
+                          'SUM(CASE WHEN is_rebase THEN 0 ELSE rise END), SUM(CASE WHEN is_rebase THEN 0 ELSE 1 END) '
+                          'FROM (SELECT node_uuid, when_start, entry_type IN ({0}) AS is_rebase, '
+                          'COALESCE(meter_value - LAG(meter_value) OVER (PARTITION BY node_uuid ORDER BY when_start, entry_type), 0) AS rise '
+                          'FROM {1} WHERE rec_status = ? AND when_start <= ?{2}) WHERE when_start >= ? '
+                          'GROUP BY node_uuid, period_start HAVING SUM(CASE WHEN is_rebase THEN 0 ELSE 1 END) > 0 '
+                          'ORDER BY node_uuid, period_start'.format(rebase_types, source, node_cmd),
+                          [db.RecStatus.NORMAL.value, time_to] + node_params + [time_from])
+        return [{'node_uuid': row[0], 'period_start': row[1], 'consumption': row[2], 'sample_count': row[3]} for row in rows]
+
+
+    def get_load_percentiles(self, node_uuid, time_from, time_to, percentiles=DEF_LOAD_PERCENTILES):
+        # as get_entries_load_percentiles, of node's (or all nodes') normal entries from time_from to time_to
+        source = self.get_source(time_from, time_to)
+        if source is None:
+            return []
+        node_cmd = ' AND node_uuid = ?' if node_uuid is not None else ''
+        node_params = [node_uuid] if node_uuid is not None else []
+        rows = self.query('SELECT node_uuid, COUNT(*), quantile_cont(entry_value * 3600.0 / duration, [{0}]) FROM {1} '
+                          'WHERE rec_status = ? AND entry_type IN ({2}) AND duration > 0 AND when_start >= ? AND when_start <= ?{3} '
+                          'GROUP BY node_uuid ORDER BY node_uuid'.format(', '.join(repr(float(percentile) / 100) for percentile in percentiles), source,
+                                                                         ', '.join(['?'] * len(LOAD_ENTRY_TYPES)), node_cmd),
+                          [db.RecStatus.NORMAL.value] + list(LOAD_ENTRY_TYPES) + [time_from, time_to] + node_params)
+        results = []
+        for row in rows:
+            result = {'node_uuid': row[0], 'sample_count': row[1]}
+            for percentile, load in zip(percentiles, row[2]):
+                result['load_p{0}'.format(percentile)] = load
+            results.append(result)
+        return results
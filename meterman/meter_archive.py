@@ -0,0 +1,151 @@
+'''
+
+================================================================================================================================================================
+meter_archive.py
+=====================
+
+Cold archive storage for historic meter entries: compressed columnar blocks of one node's entries for one UTC day, appended to a file
+per month beside the main DB file (e.g. meterman_data_archive_201801.mar) and read through a memory map.  Blocks are located by the
+meter_archive_block table of the main DB, kept by meter_db, which also routes queries to them (see meter_db ARCHIVE_*).
+
+A block holds its entries (tuples in meter_db.METER_ENTRY_COLUMNS order, less node_uuid) as columns, zlib compressed:
+
+    - Text columns (when_start_raw_nonce, entry_type, rec_status) as a dictionary of the block's distinct values, then a code per entry.
+    - when_start as deltas from the previous entry (the first from the day start), when_start_raw as its difference from when_start,
+      duration and meter_value as deltas from the previous entry, and entry_value as is.  Regular intervals and steady meters give runs
+      of small or zero values, which compress to a few bytes per entry.
+
+Archive files are only appended to.  A block replaced (re-archived with later entries for its day) or restored to the DB for editing is
+left in place, unreferenced, until its month's file is dropped by retention.
+
+================================================================================================================================================================
+
+'''
+
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from itertools import accumulate, chain, islice
+
+ARCHIVE_FILE_FORMAT = '{0}_archive_{1}.mar'     # main DB file root, month (YYYYMM)
+ARCHIVE_COMPRESS_LEVEL = 9
+TEXT_SEPARATOR = '\x1f'             # between values of a text column's dictionary
+TEXT_COLUMN_SEPARATOR = '\x1e'      # between text columns' dictionaries
+
+
+def get_column_array(typecode, values):
+    # array of values in little-endian byte order, as stored
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def get_deltas(values, first_base=0):
+    last_value = first_base
+    deltas = []
+    for value in values:
+        deltas.append(value - last_value)
+        last_value = value
+    return deltas
+
+
+def encode_block(entries, day_start):
+    # compressed block of entries (in METER_ENTRY_COLUMNS order, one node, in order of start), all starting in the day from day_start
+    when_start_raws, nonces, when_starts, durations, entry_types, entry_values, meter_values, rec_statuses = zip(*(entry[1:] for entry in entries))
+
+    text_dicts = []
+    text_codes = array('H')
+    for text_values in (nonces, entry_types, rec_statuses):
+        text_dict = {}
+        text_codes.extend(get_column_array('H', (text_dict.setdefault(value, len(text_dict)) for value in text_values)))
+        text_dicts.append(TEXT_SEPARATOR.join(text_dict))
+    text_header = TEXT_COLUMN_SEPARATOR.join(text_dicts).encode()
+
+    int_columns = array('q')
+    for values in (get_deltas(when_starts, day_start), [raw - when_start for raw, when_start in zip(when_start_raws, when_starts)],
+                   get_deltas(durations), entry_values, get_deltas(meter_values)):
+        int_columns.extend(get_column_array('q', values))
+    return zlib.compress(struct.pack('<I', len(text_header)) + text_header + int_columns.tobytes() + text_codes.tobytes(), ARCHIVE_COMPRESS_LEVEL)
+
+
+def decode_block(block, entry_count, node_uuid, day_start):
+    # entries (as tuples in METER_ENTRY_COLUMNS order) of a block from encode_block
+    payload = zlib.decompress(block)
+    text_length = struct.unpack_from('<I', payload)[0]
+    text_dicts = [text_dict.split(TEXT_SEPARATOR) for text_dict in payload[4:4 + text_length].decode().split(TEXT_COLUMN_SEPARATOR)]
+    int_columns = get_column_array('q', ())
+    int_columns.frombytes(payload[4 + text_length:4 + text_length + (entry_count * 40)])
+    text_codes = get_column_array('H', ())
+    text_codes.frombytes(payload[4 + text_length + (entry_count * 40):])
+    if sys.byteorder == 'big':
+        int_columns.byteswap()
+        text_codes.byteswap()
+
+    when_starts = list(islice(accumulate(chain((day_start,), int_columns[0:entry_count])), 1, None))
+    when_start_raws = [when_start + offset for when_start, offset in zip(when_starts, int_columns[entry_count:entry_count * 2])]
+    durations = accumulate(int_columns[entry_count * 2:entry_count * 3])
+    meter_values = accumulate(int_columns[entry_count * 4:entry_count * 5])
+    nonces, entry_types, rec_statuses = [[text_dict[code] for code in text_codes[i * entry_count:(i + 1) * entry_count]]
+                                         for i, text_dict in enumerate(text_dicts)]
+    return list(zip([node_uuid] * entry_count, when_start_raws, nonces, when_starts, durations, entry_types, int_columns[entry_count * 3:entry_count * 4],
+                    meter_values, rec_statuses))
+
+
+class MeterArchive:
+    """
+    Archive files of a DB: appends blocks on the writer and reads them, from any thread, through a memory map of each file.
+
+    """
+
+    def __init__(self, db_file):
+        self.db_root = os.path.splitext(db_file)[0]
+        self.file_maps = {}             # memory map of each month's file read so far, remapped when a block is beyond it
+        self.map_lock = threading.Lock()
+
+
+    def get_file(self, month):
+        return ARCHIVE_FILE_FORMAT.format(self.db_root, month)
+
+
+    def find_months(self):
+        month_pos = len(ARCHIVE_FILE_FORMAT.format(self.db_root, '')) - len(os.path.splitext(ARCHIVE_FILE_FORMAT)[1])
+        archive_files = glob.glob(ARCHIVE_FILE_FORMAT.format(glob.escape(self.db_root), '[0-9]' * 6))
+        return sorted(int(archive_file[month_pos:month_pos + 6]) for archive_file in archive_files)
+
+
+    def append_block(self, month, block):
+        # appends block to month's file, synced so it is on disk before the DB refers to it.  Returns its offset.
+        with open(self.get_file(month), 'ab') as archive_file:
+            offset = archive_file.tell()
+            archive_file.write(block)
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        return offset
+
+
+    def read_block(self, month, offset, length):
+        file_map = self.file_maps.get(month)
+        if file_map is None or offset + length > len(file_map):
+            with self.map_lock:
+                with open(self.get_file(month), 'rb') as archive_file:
+                    file_map = self.file_maps[month] = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return file_map[offset:offset + length]
+
+
+    def drop_month(self, month):
+        with self.map_lock:
+            self.file_maps.pop(month, None)
+        if os.path.isfile(self.get_file(month)):
+            os.remove(self.get_file(month))
+
+
+    def close(self):
+        # maps are released as readers finish with them
+        with self.map_lock:
+            self.file_maps = {}
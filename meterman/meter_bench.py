@@ -0,0 +1,1056 @@
+'''
+
+================================================================================================================================================================
+Meter Benchmarks
+=====================
+
+Command line script that measures throughput of meterman's hot paths without hardware.  Serial links to gateways are simulated with pseudo-terminals,
+so this runs on Linux/macOS only.
+
+Run with --help for more info, e.g.:
+
+    python -m meterman.meter_bench serial_rx --rx_mode event --lines 20000
+
+The 'suite' benchmark runs the ingest, storage and query hot paths and writes comparable JSON results (throughput metrics, higher is better),
+optionally comparing them with a recorded baseline and exiting non-zero on regressions, e.g.:
+
+    python -m meterman.meter_bench suite --json /temp/bench.json --baseline meterman/bench_baseline.json
+
+Baselines are host-specific, so record one on the target host (e.g. a Pi) with --json and compare later runs on that host against it.
+
+================================================================================================================================================================
+
+'''
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import shutil
+import sys
+import threading
+import tty
+from array import array
+from base64 import b64encode
+from itertools import accumulate, chain, islice, repeat
+from time import sleep, monotonic, time
+
+from meterman import app_base as base
+from meterman import gateway_messages as gmsg
+from meterman import meter_data_manager as mdata_mgr
+from meterman import meter_db as db
+from meterman import meter_db_writer as mdb_writer
+from meterman import meter_device_gateway as gway
+from meterman import meter_device_manager as mdev_mgr
+
+BENCH_NETWORK_ID = '0.0.1.1'
+BENCH_GATEWAY_ID = '1'
+BENCH_SERIAL_BAUD = 115200
+BENCH_TIMEOUT_SECS = 120
+BENCH_SUITE_SECS = 1.0              # min duration of each suite measurement
+BENCH_SUITE_REPEATS = 5             # rounds per suite measurement, best is kept
+BENCH_DB_NODES = 10                 # nodes over which suite DB rows are spread
+BENCH_DB_INTERVAL = 60
+BENCH_DB_WRITE_BATCH = 30           # entries per write_meter_entries call, as for a full meter update message
+BENCH_DB_FILL_CHUNK = 100000
+BENCH_SHARD_MONTHS = 24            # months over which db_shard rows are spread
+BENCH_DB_REBASE_EVERY = 10000       # a rebase entry every n entries per node, so consumption queries take the rebase paths
+BENCH_API_USER = 'bench_user'
+BENCH_API_PASSWORD = 'bench_password'
+BENCH_BASELINE_TOLERANCE = 0.25     # fraction below baseline at which a metric is reported as a regression
+
+benchmarks = {}
+
+
+def register_benchmark(name, bench_func, help_text):
+    benchmarks[name] = {'func': bench_func, 'help': help_text}
+
+
+def get_bench_mup_line(node_id, seq):
+    # meter update line as sent by gateway, with sequence number carried as the meter value
+    return 'G>S:MUP_;{0},MUP_,{1},{2};15,1;15,5;15,2;16,3\r\n'.format(node_id, 1496842913 + (seq * 60), seq)
+
+
+def open_bench_pty():
+    # returns (master_fd, slave_path) for a raw pseudo-terminal pair
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    return master_fd, slave_fd, os.ttyname(slave_fd)
+
+
+def get_bench_gateway(serial_port, rx_mode, gateway_id=BENCH_GATEWAY_ID):
+    gateway = gway.MeterDeviceGateway(None, BENCH_NETWORK_ID, gateway_id, label='Bench Gateway', serial_port=serial_port,
+                                      serial_baud=BENCH_SERIAL_BAUD, log_file=os.devnull, serial_rx_mode=rx_mode, rx_msg_queue=queue.Queue())
+    gateway.logger.setLevel(logging.WARNING)
+    return gateway
+
+
+def bench_serial_rx(args):
+    # Measures the ceiling on lines per second read, parsed and dispatched by a gateway for a given rx mode.  The PTY has no baud limit so the
+    # result is bound by the reader itself; the wire ceiling for a real UART at the configured baud is shown for comparison.
+    master_fd, slave_fd, slave_path = open_bench_pty()
+    gateway = get_bench_gateway(slave_path, args.rx_mode)
+
+    lines = [get_bench_mup_line(2, seq).encode('latin1') for seq in range(args.lines)]
+    avg_line_len = sum(len(line) for line in lines) / len(lines)
+
+    time_start = monotonic()
+    for line in lines:
+        os.write(master_fd, line)
+
+    while gateway.rx_line_count < args.lines and monotonic() - time_start < BENCH_TIMEOUT_SECS:
+        sleep(0.001)
+    elapsed = monotonic() - time_start
+
+    gateway.serial_conn.close()
+    os.close(master_fd)
+    os.close(slave_fd)
+
+    print('serial_rx: mode={0}, lines={1}/{2}, secs={3:.3f}, lines/sec={4:.0f}'.format(
+        args.rx_mode, gateway.rx_line_count, args.lines, elapsed, gateway.rx_line_count / elapsed))
+    print('serial_rx: wire ceiling at {0} baud with {1:.0f} byte lines = {2:.0f} lines/sec'.format(
+        BENCH_SERIAL_BAUD, avg_line_len, BENCH_SERIAL_BAUD / 10 / avg_line_len))
+
+
+BENCH_PARSE_MSGS = {
+    'MUP_': 'G>S:MUP_;2,MUP_,1496842913,18829393;15,1;15,5;15,2;16,3;15,0;15,1;15,4;15,2',
+    'MUPC': 'G>S:MUPC;2,MUPC,1496842913,18829393;15,1,10.2;15,5,10.7;15,2,10.1;16,3,10.4;15,0,9.8;15,1,9.9;15,4,10.6;15,2,10.0',
+    'NOSNAP': 'G>S:NOSNAP;' + ';'.join('{0},4500,15000,20000,600,1496842913,500,5,1000,1496842913,3050,0.1,100,1000,-70'.format(node_id)
+                                      for node_id in range(2, 6))
+}
+
+
+def parse_message_obj_by_attrib(message_str, gateway_uuid, gateway_id, network_id):
+    # attribute-by-attribute parse as done before precompiled layouts, for comparison
+    msg_in_records = list(filter(None, message_str.replace(gmsg.SMSG_RX_PREFIX, '').split(gmsg.SMSG_RS)))
+    return gmsg.get_message_obj_by_attrib(msg_in_records, gateway_uuid, gateway_id, network_id, 0)
+
+
+def bench_msg_parse(args):
+    # Messages/sec parsed into message objects by the attribute-by-attribute parser and by the precompiled layout parser, per message type.
+    for msg_type, message_str in BENCH_PARSE_MSGS.items():
+        results = []
+        for parse_func in (parse_message_obj_by_attrib, gmsg.get_message_obj):
+            time_start = monotonic()
+            for i in range(args.lines):
+                parse_func(message_str, None, BENCH_GATEWAY_ID, BENCH_NETWORK_ID)
+            results.append(args.lines / (monotonic() - time_start))
+
+        print('msg_parse: type={0}, msgs={1}, by attrib msgs/sec={2:.0f}, precompiled msgs/sec={3:.0f}, speedup={4:.1f}x'.format(
+            msg_type, args.lines, results[0], results[1], results[1] / results[0]))
+
+
+register_benchmark('msg_parse', bench_msg_parse, 'Messages/sec for gateway message parser.')
+
+
+def decode_meter_update_entries(message_strs):
+    # per-entry decode as done by get_message_obj and MeterDeviceManager.proc_meter_update, for comparison
+    meter_entries_out = []
+    for message_str in message_strs:
+        msg_obj = gmsg.get_message_obj(message_str, None, BENCH_GATEWAY_ID, BENCH_NETWORK_ID)
+        when_start = int(msg_obj['HEADER_1'].last_entry_finish_time) + 1
+        meter_value = int(msg_obj['HEADER_1'].last_entry_meter_value)
+        for key, entry in msg_obj.items():
+            if key.startswith(gmsg.A_DETAIL):
+                entry_out = entry._asdict()
+                when_start += int(entry.entry_interval_length)
+                entry_out['when_start'] = when_start
+                meter_value += int(entry.entry_value)
+                entry_out['meter_value'] = meter_value
+                meter_entries_out.append(entry_out)
+    return meter_entries_out
+
+
+def bench_mup_decode(args):
+    # Entries/sec decoded from a buffer of meter update lines into per-entry dicts, and into typed columns with get_meter_update_columns.
+    message_strs = [BENCH_PARSE_MSGS['MUP_']] * args.lines
+
+    time_start = monotonic()
+    meter_entries = decode_meter_update_entries(message_strs)
+    dicts_elapsed = monotonic() - time_start
+
+    time_start = monotonic()
+    columns = gmsg.get_meter_update_columns(message_strs)
+    columns_elapsed = monotonic() - time_start
+
+    print('mup_decode: msgs={0}, entries={1}, dicts entries/sec={2:.0f}, columns entries/sec={3:.0f}, speedup={4:.1f}x'.format(
+        args.lines, len(columns.when_starts), len(meter_entries) / dicts_elapsed, len(columns.when_starts) / columns_elapsed,
+        dicts_elapsed / columns_elapsed))
+
+
+register_benchmark('mup_decode', bench_mup_decode, 'Entries/sec for meter update decode to dicts vs columns.')
+
+
+def bench_db_write(args):
+    # Entries/sec stored by write_meter_entry (one INSERT and commit per entry) and by write_meter_entries (one prepared executemany and
+    # commit per meter update of BENCH_DB_WRITE_BATCH entries), in a fresh DB on the temp path.
+    base.log_level = 'WARNING'
+    results = []
+    for batch_size in (1, BENCH_DB_WRITE_BATCH):
+        db_file = base.temp_path + '/meter_bench_write.db'
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull)
+        db_mgr.logger.setLevel(logging.WARNING)
+        entry_rows = [(get_bench_node_uuid(0), base.MIN_TIME + (i * BENCH_DB_INTERVAL), 'AA', base.MIN_TIME + (i * BENCH_DB_INTERVAL),
+                       db.EntryType.METER_UPDATE.value, 5, BENCH_DB_INTERVAL, i * 5, db.RecStatus.NORMAL.value) for i in range(args.lines)]
+
+        time_start = monotonic()
+        if batch_size == 1:
+            for entry_row in entry_rows:
+                db_mgr.write_meter_entry(*entry_row)
+        else:
+            for i in range(0, len(entry_rows), batch_size):
+                db_mgr.write_meter_entries(entry_rows[i:i + batch_size])
+        results.append(len(entry_rows) / (monotonic() - time_start))
+
+        assert db_mgr.get_node_meter_entries_count() == len(entry_rows)
+        db_mgr.conn_close()
+        os.remove(db_file)
+
+    print('db_write: entries={0}, per entry entries/sec={1:.0f}, per message ({2} entries) entries/sec={3:.0f}, speedup={4:.1f}x'.format(
+        args.lines, results[0], BENCH_DB_WRITE_BATCH, results[1], results[1] / results[0]))
+
+
+register_benchmark('db_write', bench_db_write, 'Entries/sec stored per entry vs per meter update batch.')
+
+
+register_benchmark('serial_rx', bench_serial_rx, 'Lines/sec ceiling for gateway serial reader.')
+
+
+def bench_serial_tx(args):
+    # Queues a burst of snapshot polls followed by one time sync, then measures how long the burst takes to drain, the number of writes
+    # needed, and how long the time sync waited behind the polls.
+    master_fd, slave_fd, slave_path = open_bench_pty()
+    gateway = get_bench_gateway(slave_path, args.rx_mode)
+
+    time_start = monotonic()
+    for node_id in range(args.lines):
+        gateway.get_node_snapshot(node_id + 2)
+    gateway.set_gateway_time()
+
+    # read what the gateway would receive
+    rx_data = b''
+    time_sync_wait = None
+    while rx_data.count(b'\n') <= args.lines and monotonic() - time_start < BENCH_TIMEOUT_SECS:
+        rx_data += os.read(master_fd, 4096)
+        if time_sync_wait is None and b'STIME' in rx_data:
+            time_sync_wait = monotonic() - time_start
+    elapsed = monotonic() - time_start
+    sleep(0.01)     # let serial thread finish updating its counters
+    tx_stats = gateway.get_tx_queue_stats()
+
+    gateway.serial_conn.close()
+    os.close(master_fd)
+    os.close(slave_fd)
+
+    print('serial_tx: msgs={0}, writes={1}, secs={2:.3f}, msgs/sec={3:.1f}, time sync wait={4:.3f}s, avg wait={5:.3f}s, max wait={6:.3f}s'.format(
+        tx_stats['msg_count'], tx_stats['write_count'], elapsed, tx_stats['msg_count'] / elapsed, time_sync_wait, tx_stats['wait_avg'],
+        tx_stats['wait_max']))
+
+
+register_benchmark('serial_tx', bench_serial_tx, 'Drain time and write batching for a burst of gateway commands.')
+
+
+def get_percentile(values, pct):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_gateways(args):
+    # Drives N simulated gateways over PTYs at a fixed line rate each and reports CPU use and latency from serial write to dispatch in
+    # MeterDeviceManager, for the threaded or asyncio device engine.
+    ptys = [open_bench_pty() for i in range(args.gateways)]
+    gateway_configs = [{'network_id': BENCH_NETWORK_ID, 'gateway_id': str(i + 1), 'label': 'Bench Gateway', 'serial_port': slave_path,
+                        'serial_baud': BENCH_SERIAL_BAUD, 'serial_rx_mode': args.rx_mode} for i, (master_fd, slave_fd, slave_path) in enumerate(ptys)]
+    dev_mgr = mdev_mgr.MeterDeviceManager(None, gateway_configs, log_file=os.devnull, device_engine=args.engine)
+    dev_mgr.logger.setLevel(logging.WARNING)
+    for gateway in dev_mgr.gateways.values():
+        gateway['gw_obj'].logger.setLevel(logging.WARNING)
+
+    # time dispatch of each message, keyed by gateway and sequence number carried as meter value
+    send_times = {}
+    latencies = []
+    dispatch_message = dev_mgr.dispatch_message
+
+    def timed_dispatch_message(msg_obj):
+        latencies.append(monotonic() - send_times[(msg_obj['gateway_id'], int(msg_obj['HEADER_1'].last_entry_meter_value))])
+        dispatch_message(msg_obj)
+
+    dev_mgr.dispatch_message = timed_dispatch_message
+
+    def run_device_proc():
+        while True:
+            dev_mgr.proc_device_messages()
+
+    device_thread = threading.Thread(target=dev_mgr.async_engine.run if dev_mgr.async_engine is not None else run_device_proc)
+    device_thread.daemon = True
+    device_thread.start()
+    sleep(0.5)
+
+    lines_total = args.gateways * args.rate * args.secs
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    time_start = monotonic()
+    for seq in range(args.rate * args.secs):
+        for i, (master_fd, slave_fd, slave_path) in enumerate(ptys):
+            send_times[(str(i + 1), seq)] = monotonic()
+            os.write(master_fd, get_bench_mup_line(2, seq).encode('latin1'))
+        sleep(max(0.0, time_start + ((seq + 1) / args.rate) - monotonic()))
+
+    while len(latencies) < lines_total and monotonic() - time_start < args.secs + BENCH_TIMEOUT_SECS:
+        sleep(0.01)
+    elapsed = monotonic() - time_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_secs = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+
+    print('gateways: engine={0}, gateways={1}, lines={2}/{3}, secs={4:.2f}, cpu={5:.1f}%, latency ms p50={6:.2f} p99={7:.2f} max={8:.2f}'.format(
+        args.engine, args.gateways, len(latencies), lines_total, elapsed, 100 * cpu_secs / elapsed, 1000 * get_percentile(latencies, 50),
+        1000 * get_percentile(latencies, 99), 1000 * max(latencies or [0])))
+
+
+register_benchmark('gateways', bench_gateways, 'CPU and latency for N simulated gateways over PTYs.')
+
+
+# ----------------------------------------------------------------------------------------------------------------------------------------------------------
+#  BENCHMARK SUITE
+# ----------------------------------------------------------------------------------------------------------------------------------------------------------
+# Suite benchmarks return a dict of throughput metrics (name ending in '_per_sec') for a results dict keyed '<benchmark>.<metric>'.
+
+suite_benchmarks = {}
+
+
+def register_suite_benchmark(name, bench_func):
+    suite_benchmarks[name] = bench_func
+
+
+def get_ops_per_sec(op_func, min_secs=BENCH_SUITE_SECS, repeats=BENCH_SUITE_REPEATS):
+    # runs op_func repeatedly for at least min_secs over a number of rounds, returns calls per second of the best round (least disturbed by
+    # other load on the host)
+    best_ops_per_sec = 0.0
+    for i in range(repeats):
+        count = 0
+        time_start = monotonic()
+        while monotonic() - time_start < min_secs / repeats:
+            op_func()
+            count += 1
+        best_ops_per_sec = max(best_ops_per_sec, count / (monotonic() - time_start))
+    return best_ops_per_sec
+
+
+def get_bench_node_uuid(node_idx):
+    return BENCH_NETWORK_ID + '.' + str(node_idx + 2)
+
+
+def get_bench_db_file(rows):
+    return base.temp_path + '/meter_bench_{0}.db'.format(rows)
+
+
+def get_bench_db(rows):
+    # returns DBManager for a fresh suite DB of the given number of meter entries, spread over BENCH_DB_NODES nodes, filled in bulk
+    db_file = get_bench_db_file(rows)
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull)
+    db_mgr.logger.setLevel(logging.WARNING)
+
+    rows_per_node = rows // BENCH_DB_NODES
+    for node_idx in range(BENCH_DB_NODES):
+        node_uuid = get_bench_node_uuid(node_idx)
+        for chunk_start in range(0, rows_per_node, BENCH_DB_FILL_CHUNK):
+            chunk_rows = range(chunk_start, min(rows_per_node, chunk_start + BENCH_DB_FILL_CHUNK))
+            when_starts = array('q', (base.MIN_TIME + (i * BENCH_DB_INTERVAL) for i in chunk_rows))
+            meter_values = array('q', (i * 5 for i in chunk_rows))
+            db_mgr.write_meter_entry_columns(repeat(node_uuid), when_starts, repeat('AA'), db.EntryType.METER_UPDATE.value, repeat(5),
+                                             repeat(BENCH_DB_INTERVAL), meter_values, db.RecStatus.NORMAL.value)
+        for i in range(BENCH_DB_REBASE_EVERY, rows_per_node, BENCH_DB_REBASE_EVERY):
+            db_mgr.write_meter_entry(node_uuid, base.MIN_TIME + (i * BENCH_DB_INTERVAL), 'RB', base.MIN_TIME + (i * BENCH_DB_INTERVAL),
+                                     db.EntryType.METER_REBASE.value, 0, 0, i * 5, db.RecStatus.NORMAL.value)
+    return db_mgr
+
+
+def suite_msg_parse(args):
+    return {'{0}.msgs_per_sec'.format(msg_type): get_ops_per_sec(lambda: gmsg.get_message_obj(message_str, None, BENCH_GATEWAY_ID, BENCH_NETWORK_ID))
+            for msg_type, message_str in BENCH_PARSE_MSGS.items()}
+
+
+register_suite_benchmark('msg_parse', suite_msg_parse)
+
+
+def suite_proc_meter_update(args):
+    dev_mgr = mdev_mgr.MeterDeviceManager(None, log_file=os.devnull, with_gateways=False)
+    dev_mgr.logger.setLevel(logging.WARNING)
+    msg_obj = gmsg.get_message_obj(BENCH_PARSE_MSGS['MUP_'], None, BENCH_GATEWAY_ID, BENCH_NETWORK_ID)
+    msg_obj['gateway_uuid'] = BENCH_NETWORK_ID + '.' + BENCH_GATEWAY_ID
+    msgs_per_sec = get_ops_per_sec(lambda: dev_mgr.proc_meter_update(msg_obj, False))
+    return {'msgs_per_sec': msgs_per_sec, 'entries_per_sec': msgs_per_sec * msg_obj['detail_count']}
+
+
+register_suite_benchmark('proc_meter_update', suite_proc_meter_update)
+
+
+def suite_db(args):
+    # write, then query, throughput against DBs of each size
+    results = {}
+    for rows in args.sizes:
+        db_mgr = get_bench_db(rows)
+        data_mgr = mdata_mgr.MeterDataManager(db_file=get_bench_db_file(rows), log_file=os.devnull)
+        node_uuid = get_bench_node_uuid(0)
+        time_last = base.MIN_TIME + ((rows // BENCH_DB_NODES) * BENCH_DB_INTERVAL)
+        write_time = [time_last]
+
+        def write_meter_entry():
+            write_time[0] += BENCH_DB_INTERVAL
+            db_mgr.write_meter_entry(node_uuid, write_time[0], 'WR', write_time[0], db.EntryType.METER_UPDATE.value, 5, BENCH_DB_INTERVAL,
+                                     write_time[0], db.RecStatus.NORMAL.value)
+
+        def write_meter_entries():
+            write_time[0] += BENCH_DB_INTERVAL * BENCH_DB_WRITE_BATCH
+            db_mgr.write_meter_entries([(node_uuid, write_time[0] + (i * BENCH_DB_INTERVAL), 'WR', write_time[0] + (i * BENCH_DB_INTERVAL),
+                                         db.EntryType.METER_UPDATE.value, 5, BENCH_DB_INTERVAL, write_time[0], db.RecStatus.NORMAL.value)
+                                        for i in range(BENCH_DB_WRITE_BATCH)])
+
+        # last day of entries, and all entries for node
+        results['{0}.get_node_meter_entries.day.queries_per_sec'.format(rows)] = get_ops_per_sec(
+            lambda: db_mgr.get_node_meter_entries(node_uuid, time_from=max(base.MIN_TIME, time_last - 86400), time_to=time_last, limit_count=1440))
+        results['{0}.get_meter_consumption.day.queries_per_sec'.format(rows)] = get_ops_per_sec(
+            lambda: data_mgr.get_meter_consumption(node_uuid, time_from=max(base.MIN_TIME, time_last - 86400), time_to=time_last))
+        results['{0}.get_meter_consumption.all.queries_per_sec'.format(rows)] = get_ops_per_sec(
+            lambda: data_mgr.get_meter_consumption(node_uuid))
+        # writes last, as they add entries for node
+        results['{0}.write_meter_entry.rows_per_sec'.format(rows)] = get_ops_per_sec(write_meter_entry)
+        results['{0}.write_meter_entries.rows_per_sec'.format(rows)] = get_ops_per_sec(write_meter_entries) * BENCH_DB_WRITE_BATCH
+
+        data_mgr.close_db()
+        db_mgr.conn_close()
+        os.remove(get_bench_db_file(rows))
+    return results
+
+
+register_suite_benchmark('db', suite_db)
+
+
+class BenchMeterMan:
+    # minimal MeterMan for API benchmarks
+
+    def __init__(self, data_mgr):
+        self.data_mgr = data_mgr
+
+
+def suite_rest_api(args):
+    # main read endpoints through Flask's test client, against the smallest suite DB
+    from meterman import meter_man_api
+
+    rows = min(args.sizes)
+    get_bench_db(rows).conn_close()
+    data_mgr = mdata_mgr.MeterDataManager(db_file=get_bench_db_file(rows), log_file=os.devnull)
+    meter_man_api.ApiCtrl(BenchMeterMan(data_mgr), user=BENCH_API_USER, password=BENCH_API_PASSWORD, log_file=os.devnull)
+    meter_man_api.logger.setLevel(logging.WARNING)
+
+    client = meter_man_api.app.test_client()
+    headers = {'Authorization': 'Basic ' + b64encode('{0}:{1}'.format(BENCH_API_USER, BENCH_API_PASSWORD).encode('latin1')).decode('latin1')}
+    node_uuid = get_bench_node_uuid(0)
+    time_last = base.MIN_TIME + ((rows // BENCH_DB_NODES) * BENCH_DB_INTERVAL)
+    endpoints = {'meterentries': '/meterentries/{0}?item_limit=100'.format(node_uuid),
+                 'meterconsumption': '/meterconsumption/{0}?time_from={1}&time_to={2}'.format(node_uuid, max(base.MIN_TIME, time_last - 86400), time_last),
+                 'nodesnapshots': '/nodesnapshots/all', 'gatewaysnapshots': '/gatewaysnapshots/all', 'nodeevents': '/nodeevents/all'}
+
+    results = {}
+    for name, url in endpoints.items():
+        # empty JSON body, as recent flask_restful reqparse reads JSON by default and rejects GETs without a JSON content type
+        response = client.get(url, headers=headers, json={})
+        if response.status_code != 200:
+            raise RuntimeError('{0} returned {1}: {2}'.format(url, response.status_code, response.data))
+        results['{0}.requests_per_sec'.format(name)] = get_ops_per_sec(lambda: client.get(url, headers=headers, json={}))
+
+    data_mgr.close_db()
+    os.remove(get_bench_db_file(rows))
+    return results
+
+
+register_suite_benchmark('rest_api', suite_rest_api)
+
+
+def compare_bench_results(results, baseline, tolerance):
+    # prints each metric against baseline, returns names of metrics more than tolerance below baseline
+    regressions = []
+    for name, value in sorted(results.items()):
+        baseline_value = baseline.get(name)
+        if baseline_value is None or baseline_value == 0:
+            print('  {0}: {1:.1f} (no baseline)'.format(name, value))
+            continue
+        ratio = value / baseline_value
+        is_regression = ratio < 1.0 - tolerance
+        print('  {0}: {1:.1f} vs {2:.1f} ({3:+.0f}%){4}'.format(name, value, baseline_value, 100 * (ratio - 1.0), '  REGRESSION' if is_regression else ''))
+        if is_regression:
+            regressions.append(name)
+    return regressions
+
+
+def bench_suite(args):
+    # Runs suite benchmarks (all, or those named by --only), writing JSON results to --json and comparing with --baseline if given.
+    base.log_level = 'WARNING'      # loggers are (re)configured at this level as managers are created
+    results = {}
+    for name, bench_func in suite_benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        time_start = monotonic()
+        try:
+            for metric, value in bench_func(args).items():
+                results[name + '.' + metric] = value
+            print('suite: {0} done in {1:.1f}s'.format(name, monotonic() - time_start), flush=True)
+        except ImportError as err:
+            print('suite: {0} skipped, {1}'.format(name, err))
+
+    bench_run = {'meta': {'when': int(time()), 'host': platform.node(), 'machine': platform.machine(), 'python': platform.python_version(),
+                          'sizes': args.sizes},
+                 'results': results}
+
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(bench_run, json_file, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline_run = json.load(baseline_file)
+        print('suite: compared with baseline from {0} ({1}, python {2}):'.format(baseline_run['meta']['host'], baseline_run['meta']['machine'],
+                                                                               baseline_run['meta']['python']))
+        regressions = compare_bench_results(results, baseline_run['results'], args.tolerance)
+    else:
+        compare_bench_results(results, {}, args.tolerance)
+
+    if len(regressions) > 0:
+        print('suite: {0} regression(s): {1}'.format(len(regressions), ', '.join(regressions)))
+        sys.exit(1)
+
+
+register_benchmark('suite', bench_suite, 'Ingest, storage and query benchmark suite with JSON results and baseline comparison.')
+
+
+def bench_db_read_load(args):
+    # Latency of meter update writes (BENCH_DB_WRITE_BATCH entries each, at --rate per sec) into a DB of the largest --sizes, alone and while
+    # --readers threads run large meter entry queries (as for /meterentries/all?item_limit=100000), reading on the writer connection
+    # (read_pool_size=0, as before WAL and read pools) and from the read-only pool.
+    base.log_level = 'WARNING'
+    rows = max(args.sizes)
+    get_bench_db(rows).conn_close()
+    write_node_uuid = get_bench_node_uuid(0)
+    read_node_uuid = get_bench_node_uuid(1)
+    write_time = [base.MIN_TIME + ((rows // BENCH_DB_NODES) * BENCH_DB_INTERVAL)]
+
+    for read_pool_size in (0, db.DB_READ_POOL_SIZE):
+        db_mgr = db.DBManager(db_file=get_bench_db_file(rows), log_file=os.devnull, read_pool_size=read_pool_size)
+
+        for readers in (0, args.readers):
+            is_reading = [True]
+            read_counts = [0] * readers
+
+            def run_reader(reader_idx):
+                while is_reading[0]:
+                    db_mgr.get_node_meter_entries(read_node_uuid, limit_count=100000)
+                    read_counts[reader_idx] += 1
+
+            reader_threads = [threading.Thread(target=run_reader, args=(i,)) for i in range(readers)]
+            for reader_thread in reader_threads:
+                reader_thread.start()
+
+            latencies = []
+            time_start = monotonic()
+            for seq in range(args.rate * args.secs):
+                write_time[0] += BENCH_DB_INTERVAL * BENCH_DB_WRITE_BATCH
+                entry_rows = [(write_node_uuid, write_time[0] + (i * BENCH_DB_INTERVAL), 'WR', write_time[0] + (i * BENCH_DB_INTERVAL),
+                               db.EntryType.METER_UPDATE.value, 5, BENCH_DB_INTERVAL, write_time[0], db.RecStatus.NORMAL.value)
+                              for i in range(BENCH_DB_WRITE_BATCH)]
+                write_start = monotonic()
+                db_mgr.write_meter_entries(entry_rows)
+                latencies.append(monotonic() - write_start)
+                sleep(max(0.0, time_start + ((seq + 1) / args.rate) - monotonic()))
+            elapsed = monotonic() - time_start
+
+            is_reading[0] = False
+            for reader_thread in reader_threads:
+                reader_thread.join()
+
+            print('db_read_load: rows={0}, read_pool_size={1}, readers={2}, writes={3}, write p50={4:.1f}ms, p99={5:.1f}ms, max={6:.1f}ms, '
+                  'reads/sec={7:.1f}'.format(rows, read_pool_size, readers, len(latencies), 1000 * get_percentile(latencies, 50),
+                                             1000 * get_percentile(latencies, 99), 1000 * max(latencies), sum(read_counts) / elapsed), flush=True)
+
+        db_mgr.conn_close()
+    os.remove(get_bench_db_file(rows))
+
+
+register_benchmark('db_read_load', bench_db_read_load, 'Meter update write latency with and without parallel API-style reads.')
+
+
+def get_bytes_written():
+    # bytes written by this process (Linux only, else None)
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            for line in io_file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def bench_db_writer(args):
+    # Ingest of meter updates (2 entries each, one node per --gateways, at --rate per sec per node for --secs) through
+    # MeterDataManager.proc_meter_update, writing synchronously (a commit per message) and through the write-behind DBWriter (default flush
+    # settings).  Reports time in proc_meter_update, commits and bytes written per entry.
+    base.log_level = 'WARNING'
+    db_file = base.temp_path + '/meter_bench_writer.db'
+
+    for is_write_behind in (False, True):
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        data_mgr = mdata_mgr.MeterDataManager(db_file=db_file, log_file=os.devnull)
+        if is_write_behind:
+            data_mgr.db_writer = mdb_writer.DBWriter(data_mgr.db_mgr, log_file=os.devnull)
+            data_mgr.ingest_db = data_mgr.db_writer
+
+        latencies = []
+        entry_count = 0
+        bytes_start = get_bytes_written()
+        time_start = monotonic()
+        for seq in range(args.rate * args.secs):
+            for node_idx in range(args.gateways):
+                when_start = base.MIN_TIME + (seq * 60)
+                meter_entries = [{'when_start': when_start + (i * 30), 'entry_value': 5, 'entry_interval_length': 30,
+                                  'meter_value': (seq * 10) + (i * 5)} for i in range(2)]
+                call_start = monotonic()
+                data_mgr.proc_meter_update(get_bench_node_uuid(node_idx), meter_entries)
+                latencies.append(monotonic() - call_start)
+                entry_count += len(meter_entries)
+            sleep(max(0.0, time_start + ((seq + 1) / args.rate) - monotonic()))
+
+        commit_count = len(latencies)
+        if is_write_behind:
+            data_mgr.db_writer.close()
+            commit_count = data_mgr.db_writer.get_stats()['flush_count']
+        bytes_end = get_bytes_written()
+        assert data_mgr.db_mgr.get_node_meter_entries_count() == entry_count
+        data_mgr.close_db()
+
+        print('db_writer: write_behind={0}, entries={1}, proc_meter_update p50={2:.2f}ms, p99={3:.2f}ms, max={4:.2f}ms, commits={5}, '
+              'entries/commit={6:.1f}, bytes written/entry={7}'.format(
+                is_write_behind, entry_count, 1000 * get_percentile(latencies, 50), 1000 * get_percentile(latencies, 99), 1000 * max(latencies),
+                commit_count, entry_count / commit_count, '{0:.0f}'.format((bytes_end - bytes_start) / entry_count) if bytes_start is not None else 'n/a'),
+              flush=True)
+    os.remove(db_file)
+
+
+register_benchmark('db_writer', bench_db_writer, 'Ingest latency, commits and bytes written per entry, synchronous vs write-behind.')
+
+
+def bench_db_shard(args):
+    # Meter entries of the largest --sizes, spread over BENCH_SHARD_MONTHS months for BENCH_DB_NODES nodes, stored unsharded and in monthly
+    # shards.  Reports DB open time, a day's entries for a node in the last month and in an unbounded query, and
+    # retention of the older half of the months (DELETE, vs dropping shard files).
+    base.log_level = 'WARNING'
+    rows = max(args.sizes)
+    db_file = base.temp_path + '/meter_bench_shard.db'
+    rows_per_node = rows // BENCH_DB_NODES
+    interval = (BENCH_SHARD_MONTHS * 30 * 86400) // rows_per_node
+    time_first = db.get_shard_month_start(db.get_shard_month(base.MIN_TIME))
+    time_last = time_first + (rows_per_node * interval)
+    time_retain = db.get_shard_month_start(db.add_shard_months(db.get_shard_month(time_first), BENCH_SHARD_MONTHS // 2))
+    node_uuid = get_bench_node_uuid(0)
+
+    for shard_by_month in (False, True):
+        for shard_file in glob.glob(db_file[:-3] + '*'):
+            os.remove(shard_file)
+        db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull, shard_by_month=shard_by_month)
+        for node_idx in range(BENCH_DB_NODES):
+            for chunk_start in range(0, rows_per_node, BENCH_DB_FILL_CHUNK):
+                chunk_rows = range(chunk_start, min(rows_per_node, chunk_start + BENCH_DB_FILL_CHUNK))
+                db_mgr.write_meter_entry_columns(repeat(get_bench_node_uuid(node_idx)), array('q', (time_first + (i * interval) for i in chunk_rows)),
+                                                 repeat('AA'), db.EntryType.METER_UPDATE.value, repeat(5), repeat(interval),
+                                                 array('q', (i * 5 for i in chunk_rows)), db.RecStatus.NORMAL.value)
+        db_mgr.conn_close()
+
+        time_start = monotonic()
+        db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull, shard_by_month=shard_by_month)
+        open_secs = monotonic() - time_start
+        day_per_sec = get_ops_per_sec(lambda: db_mgr.get_node_meter_entries(node_uuid, time_from=time_last - 86400, time_to=time_last,
+                                                                            limit_count=None))
+        latest_per_sec = get_ops_per_sec(lambda: db_mgr.get_node_meter_entries(node_uuid, limit_count=86400 // interval))
+
+        time_start = monotonic()
+        if shard_by_month:
+            db_mgr.drop_meter_entry_shards(time_retain)
+        else:
+            with db_mgr.write_lock:
+                db_mgr.connection.execute('DELETE FROM meter_entry WHERE when_start < ?', (time_retain,))
+                db_mgr.connection.commit()
+        retention_secs = monotonic() - time_start
+        entry_count = db_mgr.get_node_meter_entries_count()
+        db_mgr.conn_close()
+
+        print('db_shard: shard_by_month={0}, rows={1}, months={2}, open={3:.3f}s, day query={4:.1f}/s, latest day query={5:.1f}/s, '
+              'retention of {6} months={7:.3f}s, rows kept={8}'.format(shard_by_month, rows, BENCH_SHARD_MONTHS, open_secs, day_per_sec,
+                                                                        latest_per_sec, BENCH_SHARD_MONTHS // 2, retention_secs, entry_count), flush=True)
+
+    for shard_file in glob.glob(db_file[:-3] + '*'):
+        os.remove(shard_file)
+
+
+register_benchmark('db_shard', bench_db_shard, 'DB open, query and retention times for unsharded vs monthly sharded meter entries.')
+
+
+def bench_db_rollup(args):
+    # A year of 15 minute meter entries for one node, then daily consumption for the year as dashboards ask for it: get_meter_consumption
+    # per day, vs one read of daily rollups.  Also reports the cost of keeping rollups on ingest, and of rebuilding them.
+    base.log_level = 'WARNING'
+    db_file = base.temp_path + '/meter_bench_rollup.db'
+    interval = 900
+    days = 365
+    rows = days * 86400 // interval
+    time_first = db.get_shard_month_start(db.get_shard_month(base.MIN_TIME))
+    node_uuid = get_bench_node_uuid(0)
+
+    for rollups in (False, True):
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        data_mgr = mdata_mgr.MeterDataManager(db_file=db_file)
+        data_mgr.db_mgr.rollups = rollups
+        time_start = monotonic()
+        for chunk_start in range(0, rows, BENCH_DB_FILL_CHUNK):
+            chunk_rows = range(chunk_start, min(rows, chunk_start + BENCH_DB_FILL_CHUNK))
+            data_mgr.db_mgr.write_meter_entry_columns(repeat(node_uuid), array('q', (time_first + (i * interval) for i in chunk_rows)),
+                                                      repeat('AA'), db.EntryType.METER_UPDATE.value, repeat(5), repeat(interval),
+                                                      array('q', (i * 5 for i in chunk_rows)), db.RecStatus.NORMAL.value)
+        fill_secs = monotonic() - time_start
+
+        time_start = monotonic()
+        if rollups:
+            data_mgr.get_meter_rollups(node_uuid, db.RollupBucket.DAY, time_first, time_first + (days * 86400) - 1)
+        else:
+            for day in range(days):
+                data_mgr.get_meter_consumption(node_uuid, time_first + (day * 86400), time_first + ((day + 1) * 86400) - 1)
+        query_secs = monotonic() - time_start
+
+        rebuild_secs = 0.0
+        if rollups:
+            time_start = monotonic()
+            data_mgr.db_mgr.rebuild_rollups(node_uuid)
+            rebuild_secs = monotonic() - time_start
+        data_mgr.close_db()
+
+        print('db_rollup: rollups={0}, rows={1}, fill={2:.2f}s, {3} days consumption={4:.3f}s, rebuild={5:.2f}s'.format(
+            rollups, rows, fill_secs, days, query_secs, rebuild_secs), flush=True)
+
+    os.remove(db_file)
+
+
+register_benchmark('db_rollup', bench_db_rollup, 'Daily consumption for a year per day query vs from rollups, and rollup ingest and rebuild cost.')
+
+
+def get_db_files_size(db_file, pattern='*'):
+    # bytes of DB file with its shards (checkpointed, e.g. by do_vacuum) and archive files
+    return sum(os.path.getsize(file) for file in glob.glob(db_file[:-3] + pattern) if not file.endswith(('-wal', '-shm')))
+
+
+def bench_db_archive(args):
+    # Meter entries of the largest --sizes, at 15 sec intervals for BENCH_DB_NODES nodes, in monthly shards, then moved to the archive.
+    # Reports storage per entry (in the DB, the size it loses when the entries are archived and it is vacuumed), and a full-range read of a
+    # node's entries (as for plots) and its consumption, in meter_entry vs archived.
+    base.log_level = 'WARNING'
+    rows = max(args.sizes)
+    db_file = base.temp_path + '/meter_bench_archive.db'
+    rows_per_node = rows // BENCH_DB_NODES
+    interval = 15
+    time_first = db.get_shard_month_start(db.get_shard_month(base.MIN_TIME))
+    node_uuid = get_bench_node_uuid(0)
+
+    for archive_file in glob.glob(db_file[:-3] + '*'):
+        os.remove(archive_file)
+    db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull, shard_by_month=True)
+    for node_idx in range(BENCH_DB_NODES):
+        load = random.Random(node_idx)
+        meter_value = 0
+        for chunk_start in range(0, rows_per_node, BENCH_DB_FILL_CHUNK):
+            chunk_rows = range(chunk_start, min(rows_per_node, chunk_start + BENCH_DB_FILL_CHUNK))
+            entry_values = array('q', (load.randint(0, 40) for i in chunk_rows))
+            meter_values = array('q', islice(accumulate(chain((meter_value,), entry_values)), 1, None))
+            meter_value = meter_values[-1]
+            db_mgr.write_meter_entry_columns(repeat(get_bench_node_uuid(node_idx)), array('q', (time_first + (i * interval) for i in chunk_rows)),
+                                             repeat(db.get_entry_nonce(db.EntryType.METER_UPDATE.value)), db.EntryType.METER_UPDATE.value, entry_values, repeat(interval),
+                                             meter_values, db.RecStatus.NORMAL.value)
+    db_mgr.do_vacuum()
+    db_mgr.conn_close()
+    db_size = get_db_files_size(db_file)
+
+    results = []
+    for is_archived in (False, True):
+        db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull, shard_by_month=True)
+        archive_secs = 0.0
+        if is_archived:
+            time_start = monotonic()
+            while db_mgr.archive_meter_entries(time_first + (rows_per_node * interval) + 86400) is not None:
+                pass
+            archive_secs = monotonic() - time_start
+            db_mgr.do_vacuum()
+
+        time_start = monotonic()
+        entry_count = sum(1 for entry in db_mgr.iter_node_meter_entries(node_uuid))
+        scan_secs = monotonic() - time_start
+        time_start = monotonic()
+        first_mup, last_mup = db_mgr.get_first_mup(node_uuid), db_mgr.get_last_mup(node_uuid, None, None)
+        consumption_secs = monotonic() - time_start
+        db_mgr.conn_close()
+
+        results.append((is_archived, archive_secs, get_db_files_size(db_file), entry_count, scan_secs, consumption_secs,
+                        last_mup['meter_value'] - first_mup['meter_value']))
+
+    # entries' storage in the DB is what it loses when they are archived
+    archive_size = get_db_files_size(db_file, '_archive_*')
+    entry_sizes = (db_size - (results[1][2] - archive_size), archive_size)
+    for (is_archived, archive_secs, total_size, entry_count, scan_secs, consumption_secs, consumption), entry_size in zip(results, entry_sizes):
+        print('db_archive: archived={0}, rows={1}, archive={2:.2f}s, total size={3:.1f}MB, entry storage={4:.1f}B/entry, node scan of {5} '
+              'entries={6:.3f}s, consumption={7:.4f}s ({8})'.format(is_archived, rows, archive_secs, total_size / 1048576, entry_size / rows,
+                                                                     entry_count, scan_secs, consumption_secs, consumption), flush=True)
+
+    for archive_file in glob.glob(db_file[:-3] + '*'):
+        os.remove(archive_file)
+
+
+register_benchmark('db_archive', bench_db_archive, 'Storage per entry and full-range node reads for meter entries in the DB vs the cold archive.')
+
+
+def bench_db_lift(args):
+    # A correction at the start of the largest --sizes 15 minute meter entries of one node, lifting all later entries by 100: one
+    # update_meter_entry per entry (as upsert_synth_meter_updates lift_later did), vs shift_meter_values a window per transaction (as
+    # lift_meter_values does).  Reports total secs, and the longest a single call held the writer from ingest.
+    base.log_level = 'WARNING'
+    rows = max(args.sizes)
+    db_file = base.temp_path + '/meter_bench_lift.db'
+    interval = 900
+    node_uuid = get_bench_node_uuid(0)
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    data_mgr = mdata_mgr.MeterDataManager(db_file=db_file, log_file=os.devnull)
+    db_mgr = data_mgr.db_mgr
+    db_mgr.write_meter_entry_columns(repeat(node_uuid), array('q', (base.MIN_TIME + (i * interval) for i in range(rows))),
+                                     repeat(db.get_entry_nonce(db.EntryType.METER_UPDATE.value)), db.EntryType.METER_UPDATE.value, repeat(5),
+                                     repeat(interval), array('q', (i * 5 for i in range(rows))), db.RecStatus.NORMAL.value)
+    time_from = base.MIN_TIME + interval
+    time_to = base.MIN_TIME + ((rows - 1) * interval)
+
+    for is_set_based in (False, True):
+        call_secs = []
+        time_start = monotonic()
+        if is_set_based:
+            window_from = time_from
+            while True:
+                call_start = monotonic()
+                step = db_mgr.shift_meter_values(node_uuid, window_from, time_to, 100)
+                call_secs.append(monotonic() - call_start)
+                if step is None:
+                    break
+                window_from = step[0] + 1
+        else:
+            for entry in data_mgr.get_meter_entries(node_uuid=node_uuid, time_from=time_from, rec_status=db.RecStatus.NORMAL.value, limit_count=None):
+                call_start = monotonic()
+                db_mgr.update_meter_entry(node_uuid, when_start_raw=entry['when_start_raw'], when_start_raw_nonce=entry['when_start_raw_nonce'],
+                                          new_meter_value=entry['meter_value'] + 100, new_entry_value=None, new_rec_status=None, new_duration=None,
+                                          new_entry_type=None, new_when_start=None)
+                call_secs.append(monotonic() - call_start)
+        lift_secs = monotonic() - time_start
+        print('db_lift: set_based={0}, rows={1}, transactions={2}, secs={3:.2f}, longest writer hold={4:.1f}ms'.format(
+            is_set_based, rows - 1, len(call_secs), lift_secs, max(call_secs) * 1000), flush=True)
+
+    data_mgr.close_db()
+    os.remove(db_file)
+
+
+register_benchmark('db_lift', bench_db_lift, 'Lifting meter values of later entries after a correction, per entry vs a window per transaction.')
+
+
+def bench_db_snapshot(args):
+    # The largest --sizes node snapshots of BENCH_DB_NODES nodes polled every 15 minutes, with most fields steady, as full rows
+    # (NODE_SNAPSHOT_KEYFRAME_ROWS=1, every row a keyframe) vs keyframes and delta rows.  Reports DB bytes per snapshot (vacuumed), bytes
+    # written per snapshot, and secs to read each node's latest snapshot and each node's snapshots for a day.
+    base.log_level = 'WARNING'
+    rows = max(args.sizes)
+    db_file = base.temp_path + '/meter_bench_snapshot.db'
+    node_rows = rows // BENCH_DB_NODES
+    time_start = base.MIN_TIME
+    keyframe_rows = db.NODE_SNAPSHOT_KEYFRAME_ROWS
+
+    for is_delta in (False, True):
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        db.NODE_SNAPSHOT_KEYFRAME_ROWS = keyframe_rows if is_delta else 1
+        db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull)
+        node_uuids = [get_bench_node_uuid(node_idx) for node_idx in range(BENCH_DB_NODES)]
+        bytes_start = get_bytes_written()
+        write_start = monotonic()
+        for i in range(node_rows):
+            when_received = time_start + (i * 900)
+            for node_idx, node_uuid in enumerate(node_uuids):
+                db_mgr.write_node_snapshot(node_uuid, when_received, '0.0.1.1', node_idx + 2, 1, 4000 - (i // 500), i * 900, 900, 700,
+                                           when_received - 5, random.randint(-1, 1), 15, 1000, when_received - 20, i * 5, 0.0, 100, 50,
+                                           -56 - random.randint(0, 1), db.RecStatus.NORMAL.value)
+        write_secs = monotonic() - write_start
+        bytes_end = get_bytes_written()
+        db_mgr.do_vacuum()
+        db_bytes = get_db_files_size(db_file)
+
+        read_start = monotonic()
+        for node_uuid in node_uuids:
+            db_mgr.get_node_snapshots(node_uuid)
+        latest_secs = monotonic() - read_start
+        read_start = monotonic()
+        day_from = time_start + ((node_rows // 2) * 900)
+        for node_uuid in node_uuids:
+            db_mgr.get_node_snapshots(node_uuid, time_from=day_from, time_to=day_from + 86399, limit_count=None)
+        day_secs = monotonic() - read_start
+        db_mgr.conn_close()
+        print('db_snapshot: delta={0}, rows={1}, db bytes/row={2:.1f}, written bytes/row={3}, write secs={4:.2f}, latest reads={5:.1f}ms, '
+              'day reads={6:.1f}ms'.format(is_delta, node_rows * BENCH_DB_NODES, db_bytes / (node_rows * BENCH_DB_NODES),
+                                           '{0:.1f}'.format((bytes_end - bytes_start) / (node_rows * BENCH_DB_NODES)) if bytes_start is not None else 'n/a',
+                                           write_secs, latest_secs * 1000, day_secs * 1000), flush=True)
+
+    db.NODE_SNAPSHOT_KEYFRAME_ROWS = keyframe_rows
+    os.remove(db_file)
+
+
+register_benchmark('db_snapshot', bench_db_snapshot, 'Node snapshot storage, write bytes and read times, as full rows vs keyframes and delta rows.')
+
+
+def bench_db_analytics(args):
+    # Long-range queries over a suite DB of the largest --sizes meter entries (all months finalized): monthly consumption and load
+    # percentiles of all nodes over the whole range, on SQLite vs the DuckDB analytical store (see meter_analytics).  Reports export secs
+    # and bytes, and the best of BENCH_SUITE_REPEATS query times on each.
+    from meterman import meter_analytics
+    base.log_level = 'WARNING'
+    if not meter_analytics.ANALYTICS_AVAILABLE:
+        print('db_analytics: skipped, the duckdb package is not installed')
+        return
+    rows = max(args.sizes)
+    db_mgr = get_bench_db(rows)
+    store = meter_analytics.MeterAnalytics(db_mgr)
+    time_from = base.MIN_TIME
+    time_to = base.MIN_TIME + ((rows // BENCH_DB_NODES) * BENCH_DB_INTERVAL) - 1
+
+    export_start = monotonic()
+    while store.export_next() is not None:
+        pass
+    print('db_analytics: rows={0}, months={1}, export secs={2:.2f}, db bytes={3}, parquet bytes={4}'.format(
+        rows, len(store.manifest), monotonic() - export_start, get_db_files_size(get_bench_db_file(rows)),
+        sum(os.path.getsize(month_file) for month_file in glob.glob(os.path.join(store.analytics_path, '*.parquet')))), flush=True)
+
+    queries = {'month_consumption': (
+                   lambda: meter_analytics.get_entries_period_consumption(db_mgr.iter_node_meter_entries(
+                       rec_status=db.RecStatus.NORMAL.value, time_from=meter_analytics.get_lookback_from(time_from), time_to=time_to), 'month', time_from),
+                   lambda: store.get_period_consumption(None, 'month', time_from, time_to)),
+               'load_percentiles': (
+                   lambda: meter_analytics.get_entries_load_percentiles(db_mgr.iter_node_meter_entries(
+                       rec_status=db.RecStatus.NORMAL.value, time_from=time_from, time_to=time_to)),
+                   lambda: store.get_load_percentiles(None, time_from, time_to))}
+    for name, (sqlite_func, store_func) in queries.items():
+        query_secs = []
+        for query_func in (sqlite_func, store_func):
+            best_secs = None
+            for i in range(BENCH_SUITE_REPEATS):
+                time_start = monotonic()
+                query_func()
+                best_secs = min(best_secs or float('inf'), monotonic() - time_start)
+            query_secs.append(best_secs)
+        print('db_analytics: {0}, covered={1}, sqlite={2:.1f}ms, duckdb={3:.1f}ms, speedup={4:.1f}x'.format(
+            name, store.is_covered(time_from, time_to), query_secs[0] * 1000, query_secs[1] * 1000, query_secs[0] / query_secs[1]), flush=True)
+
+    store.close()
+    db_mgr.conn_close()
+    shutil.rmtree(store.analytics_path)
+    os.remove(get_bench_db_file(rows))
+
+
+register_benchmark('db_analytics', bench_db_analytics, 'Long-range consumption and load percentile queries on SQLite vs the DuckDB analytical store.')
+
+
+def read_rss_child(db_file, node_uuid, item_count, is_streamed, result_queue):
+    # in a fresh interpreter (see bench_db_read_rss): reads item_count entries as the meterentries API does, to JSON, and reports
+    # (peak RSS before read, peak RSS after, JSON bytes, secs)
+    from meterman import meter_man_api
+    base.log_level = 'WARNING'
+    data_mgr = mdata_mgr.MeterDataManager(db_file=db_file, log_file=os.devnull)
+    request_args = {'node_uuid': node_uuid, 'item_limit': item_count, 'time_from': None, 'time_to': None}
+    rss_start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    time_start = monotonic()
+    if is_streamed:
+        json_bytes = sum(len(chunk) for chunk in meter_man_api.stream_json_result(
+            request_args, 'meter_entries', (entry._asdict() for entry in data_mgr.iter_meter_entries(node_uuid, limit_count=item_count))))
+    else:
+        json_bytes = len(json.dumps({'request': request_args, 'result': {'meter_entries': data_mgr.get_meter_entries(node_uuid, limit_count=item_count)}},
+                                    sort_keys=True))
+    result_queue.put((rss_start_kb, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, json_bytes, monotonic() - time_start))
+    data_mgr.close_db()
+
+
+def bench_db_read_rss(args):
+    # Peak RSS of a meterentries API read of the largest --sizes entries (at most MAX_REQ_ITEMS) for one node, read all at once (fetchall,
+    # dicts, one JSON document) vs streamed (iter_meter_entries, JSON a chunk at a time).  Each in a fresh interpreter, as peak RSS only rises.
+    from meterman import meter_man_api
+    base.log_level = 'WARNING'
+    item_count = min(max(args.sizes), meter_man_api.MAX_REQ_ITEMS)
+    db_file = base.temp_path + '/meter_bench_read_rss.db'
+    node_uuid = get_bench_node_uuid(0)
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    db_mgr = db.DBManager(db_file=db_file, log_file=os.devnull)
+    db_mgr.write_meter_entry_columns(repeat(node_uuid), array('q', (base.MIN_TIME + (i * BENCH_DB_INTERVAL) for i in range(item_count))), repeat('AA'),
+                                     db.EntryType.METER_UPDATE.value, repeat(5), repeat(BENCH_DB_INTERVAL), array('q', (i * 5 for i in range(item_count))),
+                                     db.RecStatus.NORMAL.value)
+    db_mgr.conn_close()
+
+    mp_context = multiprocessing.get_context('spawn')
+    for is_streamed in (False, True):
+        result_queue = mp_context.Queue()
+        child = mp_context.Process(target=read_rss_child, args=(db_file, node_uuid, item_count, is_streamed, result_queue))
+        child.start()
+        rss_start_kb, rss_peak_kb, json_bytes, secs = result_queue.get()
+        child.join()
+        print('db_read_rss: streamed={0}, items={1}, json={2:.1f}MB, secs={3:.2f}, peak RSS={4:.1f}MB, increase for read={5:.1f}MB'.format(
+            is_streamed, item_count, json_bytes / 1048576, secs, rss_peak_kb / 1024, (rss_peak_kb - rss_start_kb) / 1024), flush=True)
+
+    os.remove(db_file)
+
+
+register_benchmark('db_read_rss', bench_db_read_rss, 'Peak RSS of a large meterentries API read, all at once vs streamed.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs meterman throughput benchmarks without hardware.")
+    parser.add_argument("benchmark", help="Benchmark to run, one of: " + ', '.join(
+        '{0} ({1})'.format(name, bench['help']) for name, bench in benchmarks.items()), choices=list(benchmarks.keys()))
+    parser.add_argument("--rx_mode", help="Serial rx mode for gateway, one of: event, poll.  Defaults to event.", type=str, default='event')
+    parser.add_argument("--lines", help="Number of serial lines to send.  Defaults to 20000.", type=int, default=20000)
+    parser.add_argument("--engine", help="Device engine, one of: thread, asyncio.  Defaults to thread.", type=str, default='thread')
+    parser.add_argument("--gateways", help="Number of simulated gateways.  Defaults to 8.", type=int, default=8)
+    parser.add_argument("--rate", help="Lines per second sent to each gateway.  Defaults to 20.", type=int, default=20)
+    parser.add_argument("--secs", help="Duration of rate-based benchmarks.  Defaults to 10.", type=int, default=10)
+    parser.add_argument("--readers", help="Number of reader threads for db_read_load.  Defaults to 4.", type=int, default=4)
+    parser.add_argument("--sizes", help="Comma-separated DB sizes in rows for suite DB benchmarks.  Defaults to 1000,100000 (add 10000000 "
+                        "for a full run).", type=lambda sizes: [int(size) for size in sizes.split(',')], default=[1000, 100000])
+    parser.add_argument("--only", help="Comma-separated suite benchmarks to run, from: " + ', '.join(suite_benchmarks.keys()) +
+                        ".  Defaults to all.", type=lambda names: names.split(','), default=None)
+    parser.add_argument("--json", help="File to write suite results to as JSON.", type=str, default=None)
+    parser.add_argument("--baseline", help="Suite results JSON file to compare with.", type=str, default=None)
+    parser.add_argument("--tolerance", help="Fraction below baseline reported as a regression.  Defaults to {0}.".format(BENCH_BASELINE_TOLERANCE),
+                        type=float, default=BENCH_BASELINE_TOLERANCE)
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark]['func'](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,14 +11,65 @@ TODO: rename to reflect broader than meter data
 '''
 
 
+import threading
+from contextlib import closing
+from time import monotonic, time
+
 from meterman import meter_db as db, app_base as base
+from meterman import meter_analytics
+from meterman import meter_db_maint as db_maint
+from meterman import meter_db_writer as db_writer
+from meterman import meter_metrics as metrics
 
 
 class MeterDataManager:
 
     def __init__(self, db_file=base.db_file, log_file=base.log_file):
         self.logger = base.get_logger(logger_name='data_mgr', log_file=log_file)
-        self.db_mgr = db.DBManager(db_file=db_file, log_file=log_file)
+        db_config = None
+        if base.config is not None and base.config.has_section('Database'):
+            db_config = base.config['Database']
+
+        shard_by_month = db_config is not None and db_config.getboolean('shard_by_month', fallback=False)
+        rollup_tz = db_config.get('rollup_local_tz', fallback='') if db_config is not None else ''
+        self.db_mgr = db.DBManager(db_file=db_file, log_file=log_file, shard_by_month=shard_by_month, rollup_tz=rollup_tz if rollup_tz != '' else None)
+
+        # retention of sharded meter entries: the current month and meter_retention_months before it are kept (0 keeps all)
+        retention_months = db_config.getint('meter_retention_months', fallback=0) if db_config is not None else 0
+        if shard_by_month and retention_months > 0:
+            self.db_mgr.drop_meter_entry_shards(db.get_shard_month_start(db.add_shard_months(db.get_shard_month(time()), -retention_months)))
+
+        # ingest writes (from devices) go to db_writer if write-behind is configured, else straight to the DB
+        self.db_writer = None
+
+        if db_config is not None and db_config.getboolean('write_behind', fallback=False):
+            self.db_writer = db_writer.DBWriter(self.db_mgr, flush_ms=db_config.getint('write_flush_ms', fallback=db_writer.DEF_FLUSH_MS),
+                                                flush_rows=db_config.getint('write_flush_rows', fallback=db_writer.DEF_FLUSH_ROWS),
+                                                log_file=log_file)
+        self.ingest_db = self.db_writer if self.db_writer is not None else self.db_mgr
+
+        # analytical store of finalized months for long-range queries (see meter_analytics), if configured and duckdb is installed
+        self.analytics = None
+        if db_config is not None and db_config.getboolean('analytics_export', fallback=False):
+            if meter_analytics.ANALYTICS_AVAILABLE:
+                self.analytics = meter_analytics.MeterAnalytics(self.db_mgr)
+            else:
+                self.logger.warn('analytics_export is set but the duckdb package is not installed, so analytics queries run on SQLite')
+
+        # background maintenance (see meter_db_maint): downsampling, archiving and analytics export of aged meter entries if configured,
+        # and incremental vacuum
+        self.db_maint = None
+        if db_config is not None and db_config.getint('maint_interval_mins', fallback=db_maint.DEF_INTERVAL_MINS) > 0:
+            self.db_maint = db_maint.DBMaintainer(self.db_mgr, raw_days=db_config.getint('downsample_raw_days', fallback=0),
+                                                  fine_months=db_config.getint('downsample_5min_months', fallback=0),
+                                                  interval_mins=db_config.getint('maint_interval_mins', fallback=db_maint.DEF_INTERVAL_MINS),
+                                                  archive_months=db_config.getint('archive_months', fallback=0),
+                                                  analytics=self.analytics, log_file=log_file)
+
+        # meter value lifts (see lift_meter_values): status of the latest per node, and threads of those in the background
+        self.lift_status = {}
+        self.lift_threads = []
+        self.lift_stop_event = threading.Event()
 
         self.do_ev_file = False
         ev_file_config = None
@@ -33,6 +84,15 @@ class MeterDataManager:
 
 
     def close_db(self):
+        self.lift_stop_event.set()      # background lifts stop after their current window
+        for lift_thread in self.lift_threads:
+            lift_thread.join()
+        if self.db_maint is not None:
+            self.db_maint.close()
+        if self.analytics is not None:
+            self.analytics.close()
+        if self.db_writer is not None:
+            self.db_writer.close()      # commits queued writes
         self.db_mgr.conn_close()
         self.db_mgr = None
 
@@ -48,7 +108,7 @@ class MeterDataManager:
 
 
     def proc_gateway_snapshot(self, gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram, gateway_time, log_level, tx_power):
-        self.db_mgr.write_gateway_snapshot(gateway_uuid, int(when_received), network_id, int(gateway_id), int(when_booted), int(free_ram), int(gateway_time), log_level,
+        self.ingest_db.write_gateway_snapshot(gateway_uuid, int(when_received), network_id, int(gateway_id), int(when_booted), int(free_ram), int(gateway_time), log_level,
                           int(tx_power), db.RecStatus.NORMAL.value)
         if self.do_ev_file and (not self.ev_log_meter_only):
             self.ev_logger.info("{},{},{},{},{},{},{},{},{},{}".format(
@@ -71,7 +131,7 @@ class MeterDataManager:
     def proc_node_snapshot(self, node_uuid, when_received, network_id, node_id, gateway_id, batt_voltage_mv, up_time, sleep_time, free_ram, when_last_seen,
                            last_clock_drift, meter_interval, meter_impulses_per_kwh, last_meter_entry_finish, last_meter_value, last_rms_current, puck_led_rate, puck_led_time,
                            last_rssi_at_gateway):
-        self.db_mgr.write_node_snapshot(node_uuid, int(when_received), network_id, int(node_id), int(gateway_id), int(batt_voltage_mv), int(up_time),
+        self.ingest_db.write_node_snapshot(node_uuid, int(when_received), network_id, int(node_id), int(gateway_id), int(batt_voltage_mv), int(up_time),
                                         int(sleep_time), int(free_ram), int(when_last_seen), int(last_clock_drift), int(meter_interval), int(meter_impulses_per_kwh), int(last_meter_entry_finish),
                                         int(last_meter_value), float(last_rms_current), int(puck_led_rate), int(puck_led_time), int(last_rssi_at_gateway), db.RecStatus.NORMAL.value)
         if self.do_ev_file and (not self.ev_log_meter_only):
@@ -85,6 +145,16 @@ class MeterDataManager:
         return self.dictlist_from_rows(self.db_mgr.get_node_meter_entries(node_uuid, entry_type, rec_status, time_from, time_to, limit_count))
 
 
+    def iter_meter_entries(self, node_uuid=None, entry_type=None, rec_status=None, time_from=None, time_to=None, limit_count=None):
+        # as get_meter_entries, but yields meter_db.MeterEntry tuples as read (use ._asdict() for a dict), for large reads
+        return self.db_mgr.iter_node_meter_entries(node_uuid, entry_type, rec_status, time_from, time_to, limit_count)
+
+
+    def get_meter_rollups(self, node_uuid, bucket_type=db.RollupBucket.DAY, time_from=None, time_to=None):
+        # consumption per hour/day bucket starting from time_from to time_to, from rollups (see meter_db)
+        return self.dictlist_from_rows(self.db_mgr.get_meter_rollups(node_uuid, bucket_type, time_from, time_to))
+
+
     def get_meter_consumption(self, node_uuid, time_from=None, time_to=None):
         # Get min/max rebase entries within interval, treat consumption BETWEEN these as authoritative and count it.
         # Then add any actual observed consumption (i.e. watt-hours from MeterNode 'reads') prior to the first and last rebase
@@ -146,53 +216,175 @@ class MeterDataManager:
         return {'meter_consumption': meter_consumption, 'calc_breakdown': calc_breakdown}
 
 
-    def proc_meter_update(self, node_uuid, meter_entries):
-        for entry in meter_entries:
-            timestamp_nonce = base.get_nonce()
+    def get_meter_period_consumption(self, node_uuid=None, period='month', time_from=None, time_to=None):
+        # Consumption per UTC day, month or year of node (or each node) from time_from to time_to, from the analytical store for long
+        # ranges it holds, else from SQLite (see meter_analytics)
+        if period not in meter_analytics.ANALYTICS_PERIODS:
+            raise ValueError('Invalid period: {0}'.format(period))
+        if self.analytics is not None and self.analytics.is_covered(time_from, time_to):
+            return self.analytics.get_period_consumption(node_uuid, period, time_from, time_to)
+        entries = self.db_mgr.iter_node_meter_entries(node_uuid, rec_status=db.RecStatus.NORMAL.value, time_from=meter_analytics.get_lookback_from(time_from),
+                                                      time_to=time_to)
+        return meter_analytics.get_entries_period_consumption(entries, period, time_from)
+
+
+    def get_meter_load_percentiles(self, node_uuid=None, time_from=None, time_to=None, percentiles=meter_analytics.DEF_LOAD_PERCENTILES):
+        # load percentiles of node (or each node) from time_from to time_to, routed as get_meter_period_consumption
+        if any(not 0 <= percentile <= 100 for percentile in percentiles):
+            raise ValueError('Invalid percentiles: {0}'.format(percentiles))
+        if self.analytics is not None and self.analytics.is_covered(time_from, time_to):
+            return self.analytics.get_load_percentiles(node_uuid, time_from, time_to, percentiles)
+        entries = self.db_mgr.iter_node_meter_entries(node_uuid, rec_status=db.RecStatus.NORMAL.value, time_from=time_from, time_to=time_to)
+        return meter_analytics.get_entries_load_percentiles(entries, percentiles)
+
+
+    def proc_meter_update(self, node_uuid, meter_entries, trace=None):
+        # trace is message's ingest trace dict (see meter_metrics), if any, to record DB write start and commit (set by db_writer when its
+        # batch is committed, if write-behind)
+
+        # keyed by start and type (see meter_db ENTRY_NONCE_FORMAT), so entries already received are skipped
+        timestamp_nonce = db.get_entry_nonce(db.EntryType.METER_UPDATE.value)
+        entry_rows = [(node_uuid, int(entry['when_start']), timestamp_nonce, int(entry['when_start']), db.EntryType.METER_UPDATE.value,
+                       int(entry['entry_value']), int(entry['entry_interval_length']), int(entry['meter_value']), db.RecStatus.NORMAL.value)
+                      for entry in meter_entries]
+        if self.db_writer is not None:
+            self.db_writer.write_meter_entries(entry_rows, trace)
+        else:
+            if trace is not None:
+                trace[metrics.TRACE_DB_WRITE_START] = monotonic()
+            self.db_mgr.write_meter_entries(entry_rows)
+            if trace is not None:
+                trace[metrics.TRACE_DB_COMMIT] = monotonic()
+
+        if self.do_ev_file:
+            for entry_row in entry_rows:
+                self.ev_logger.info("{},{},{},{},{},{},{},{},{},{}".format('MTRUPDATE', *entry_row))
 
-            self.db_mgr.write_meter_entry(node_uuid, int(entry['when_start']), timestamp_nonce, int(entry['when_start']), db.EntryType.METER_UPDATE.value,
-                                          int(entry['entry_value']), int(entry['entry_interval_length']), int(entry['meter_value']), db.RecStatus.NORMAL.value)
-            if self.do_ev_file:
-                self.ev_logger.info("{},{},{},{},{},{},{},{},{},{}".format('MTRUPDATE', node_uuid, int(entry['when_start']), timestamp_nonce, int(entry['when_start']), db.EntryType.METER_UPDATE.value,
-                                          int(entry['entry_value']), int(entry['entry_interval_length']), int(entry['meter_value']), db.RecStatus.NORMAL.value))
+
+    def proc_meter_update_columns(self, node_uuids, columns):
+        # as proc_meter_update, for entries decoded by gateway_messages.get_meter_update_columns with node_uuids aligned to entries
+        timestamp_nonces = [db.get_entry_nonce(db.EntryType.METER_UPDATE.value)] * len(node_uuids)
+
+        self.ingest_db.write_meter_entry_columns(node_uuids, columns.when_starts, timestamp_nonces, db.EntryType.METER_UPDATE.value, columns.entry_values,
+                                              columns.entry_intervals, columns.meter_values, db.RecStatus.NORMAL.value)
+        if self.do_ev_file:
+            for node_uuid, when_start, timestamp_nonce, entry_value, duration, meter_value in zip(
+                    node_uuids, columns.when_starts, timestamp_nonces, columns.entry_values, columns.entry_intervals, columns.meter_values):
+                self.ev_logger.info("{},{},{},{},{},{},{},{},{},{}".format('MTRUPDATE', node_uuid, when_start, timestamp_nonce, when_start,
+                                    db.EntryType.METER_UPDATE.value, entry_value, duration, meter_value, db.RecStatus.NORMAL.value))
 
 
     def proc_meter_rebase(self, node_uuid, entry_timestamp, meter_value):
         #TODO: handle more intelligently, implement definitive master - consider that meter node cannot be reached in realtime
         #meter wins except for reboot, rollover? metervalue as utterly notional except to track accuracy vs smart meter? What really matters is use in time period...
-        timestamp_nonce = base.get_nonce()
-        self.db_mgr.write_meter_entry(node_uuid, int(entry_timestamp), timestamp_nonce, int(entry_timestamp), db.EntryType.METER_REBASE.value, 0, 0, int(meter_value), db.RecStatus.NORMAL.value)
+        timestamp_nonce = db.get_entry_nonce(db.EntryType.METER_REBASE.value)
+        self.ingest_db.write_meter_entry(node_uuid, int(entry_timestamp), timestamp_nonce, int(entry_timestamp), db.EntryType.METER_REBASE.value, 0, 0, int(meter_value), db.RecStatus.NORMAL.value)
         if self.do_ev_file:
             self.ev_logger.info("{},{},{},{},{},{},{}".format('MTRREBASE', int(entry_timestamp), timestamp_nonce, int(entry_timestamp), db.EntryType.METER_REBASE.value, int(meter_value), db.RecStatus.NORMAL.value))
 
 
     def proc_node_event(self, node_uuid, timestamp, event_type, details=None):
-        self.db_mgr.write_node_event(node_uuid, timestamp, event_type, details)
+        self.ingest_db.write_node_event(node_uuid, timestamp, event_type, details)
+
+
+    def flush_ingest_writes(self):
+        # commits queued ingest writes, so that changes made through the API apply to all entries received so far
+        if self.db_writer is not None:
+            self.db_writer.flush()
 
 
     def delete_meter_entries_in_range(self, node_uuid, time_from, time_to, entry_type=None, rec_status=None):
         # mark as deleted (do not purge)
+        self.flush_ingest_writes()
         self.db_mgr.update_meter_entries_in_range(node_uuid, time_from, time_to, entry_type=entry_type, rec_status=rec_status, new_rec_status=db.RecStatus.DELETED)
 
 
-    def upsert_synth_meter_updates(self, node_uuid, overwrite_time_from, overwrite_time_to, meter_entries, rebase_first=True, lift_later=False):
-        self.delete_meter_entries_in_range(node_uuid, overwrite_time_from, overwrite_time_to, entry_type=db.EntryType.METER_UPDATE)
-        self.delete_meter_entries_in_range(node_uuid, overwrite_time_from, overwrite_time_to, entry_type=db.EntryType.METER_UPDATE_SYNTH)
-        if rebase_first:
-            timestamp_nonce = base.get_nonce()
-            self.db_mgr.write_meter_entry(node_uuid, int(meter_entries[0]['when_start']), timestamp_nonce, int(meter_entries[0]['when_start']), db.EntryType.METER_REBASE_SYNTH.value, 0, 0,
-                                          int(meter_entries[0]['meter_value']), db.RecStatus.NORMAL.value)
-
-        for entry in meter_entries:
-            timestamp_nonce = base.get_nonce()
-            self.db_mgr.write_meter_entry(node_uuid, int(entry['when_start']), timestamp_nonce, int(entry['when_start']), db.EntryType.METER_UPDATE_SYNTH.value,
-                                          int(entry['entry_value']), int(entry['entry_interval_length']), int(entry['meter_value']), db.RecStatus.NORMAL.value)
+    def upsert_synth_meter_updates(self, node_uuid, overwrite_time_from, overwrite_time_to, meter_entries, rebase_first=True, lift_later=False,
+                                   lift_background=False):
+        # As one transaction, so the node's rollups are refreshed once, at its commit.  With lift_later, later entries are then lifted to
+        # continue from the last of meter_entries (see lift_meter_values), in the background with lift_background.  Returns the lift's
+        # status, or None.
+        self.flush_ingest_writes()
+        with self.db_mgr.group_commit():
+            self.db_mgr.update_meter_entries_in_range(node_uuid, overwrite_time_from, overwrite_time_to, entry_type=db.EntryType.METER_UPDATE,
+                                                      new_rec_status=db.RecStatus.DELETED)
+            self.db_mgr.update_meter_entries_in_range(node_uuid, overwrite_time_from, overwrite_time_to, entry_type=db.EntryType.METER_UPDATE_SYNTH,
+                                                      new_rec_status=db.RecStatus.DELETED)
+            if rebase_first:
+                timestamp_nonce = db.get_entry_nonce(db.EntryType.METER_REBASE_SYNTH.value)
+                self.db_mgr.write_meter_entry(node_uuid, int(meter_entries[0]['when_start']), timestamp_nonce, int(meter_entries[0]['when_start']), db.EntryType.METER_REBASE_SYNTH.value, 0, 0,
+                                              int(meter_entries[0]['meter_value']), db.RecStatus.NORMAL.value, replace=True)
+
+            # synthetic entries replace any written before at the same start (marked deleted above)
+            timestamp_nonce = db.get_entry_nonce(db.EntryType.METER_UPDATE_SYNTH.value)
+            for entry in meter_entries:
+                self.db_mgr.write_meter_entry(node_uuid, int(entry['when_start']), timestamp_nonce, int(entry['when_start']), db.EntryType.METER_UPDATE_SYNTH.value,
+                                              int(entry['entry_value']), int(entry['entry_interval_length']), int(entry['meter_value']), db.RecStatus.NORMAL.value,
+                                              replace=True)
 
         if lift_later:
-            new_meter_value = meter_entries[-1]['meter_value']
-            later_entries = self.get_meter_entries(node_uuid=node_uuid, time_from=(meter_entries[-1]['when_start'] + 1), rec_status=db.RecStatus.NORMAL.value, limit_count=None)
-            for entry in later_entries:
-                new_meter_value += entry['entry_value']
-                self.db_mgr.update_meter_entry(node_uuid, when_start_raw=entry['when_start_raw'], when_start_raw_nonce=entry['when_start_raw_nonce'],
-                                               new_meter_value=new_meter_value, new_entry_value=None, new_rec_status=None, new_duration=None, new_entry_type=None,
-                                               new_when_start=None)
\ No newline at end of file
+            return self.lift_meter_values(node_uuid, int(meter_entries[-1]['when_start']), int(meter_entries[-1]['meter_value']), background=lift_background)
+        return None
+
+
+    def lift_meter_values(self, node_uuid, time_after, meter_value, background=False):
+        # Lifts node's normal entries starting after time_after to continue from meter_value: shifts their meter values by the difference
+        # between meter_value and that the first of them rose from, a window per transaction (see meter_db shift_meter_values).  Entries
+        # written after the call are left as they are.  In a thread with background, else before returning.  Returns the lift's status
+        # (see get_lift_status), or None if there are no entries to lift.
+        self.flush_ingest_writes()
+        with closing(self.db_mgr.iter_node_meter_entries(node_uuid, rec_status=db.RecStatus.NORMAL.value, time_from=time_after + 1)) as entries:
+            first_entry = next(entries, None)
+        with closing(self.db_mgr.iter_node_meter_entries(node_uuid, rec_status=db.RecStatus.NORMAL.value, time_from=time_after + 1,
+                                                         limit_count=1)) as entries:
+            last_entry = next(entries, None)
+        if first_entry is None or last_entry is None:
+            return None
+
+        status = {'node_uuid': node_uuid, 'time_from': first_entry.when_start, 'time_to': last_entry.when_start,
+                  'shift': meter_value + first_entry.entry_value - first_entry.meter_value, 'time_done': None, 'entry_count': 0, 'state': 'running'}
+        self.lift_status[node_uuid] = status
+        if not background:
+            self.run_lift(status)
+            return dict(status)
+
+        self.lift_threads = [lift_thread for lift_thread in self.lift_threads if lift_thread.is_alive()]
+        lift_thread = threading.Thread(target=self.run_lift, args=(status,), name='lift_later')
+        lift_thread.daemon = True
+        lift_thread.start()
+        self.lift_threads.append(lift_thread)
+        return dict(status)
+
+
+    def run_lift(self, status):
+        # runs a lift from lift_meter_values a window at a time, keeping its progress in status
+        time_start = monotonic()
+        time_from = status['time_from']
+        try:
+            while status['shift'] != 0 and not self.lift_stop_event.is_set():
+                step = self.db_mgr.shift_meter_values(status['node_uuid'], time_from, status['time_to'], status['shift'])
+                if step is None:
+                    break
+                time_from = step[0] + 1
+                status['time_done'] = step[0]
+                status['entry_count'] += step[1]
+
+            if self.lift_stop_event.is_set():
+                status['state'] = 'stopped'
+            else:
+                with closing(self.db_mgr.iter_node_meter_entries(status['node_uuid'], rec_status=db.RecStatus.NORMAL.value, time_from=time_from,
+                                                                 time_to=status['time_to'], limit_count=1)) as entries:
+                    is_left = status['shift'] != 0 and next(entries, None) is not None
+                status['state'] = 'failed' if is_left else 'done'      # if failed, shift_meter_values logged why
+        except Exception as err:
+            status['state'] = 'failed'
+            self.logger.error('Failed to lift meter values of node {0} from {1}: {2}'.format(status['node_uuid'], time_from, err))
+        self.logger.info('Lift of meter values of node {0} from {1} to {2} by {3}: {4}, {5} entries to {6} in {7:.1f}s'.format(
+            status['node_uuid'], status['time_from'], status['time_to'], status['shift'], status['state'], status['entry_count'], status['time_done'],
+            monotonic() - time_start))
+
+
+    def get_lift_status(self, node_uuid=None):
+        # Status of the latest lift of node (or of each node): dicts of node_uuid, time_from and time_to of the entries lifted, shift,
+        # time_done (start of the last window lifted), entry_count lifted so far and state (running, done, stopped or failed).
+        return [dict(status) for status_node_uuid, status in sorted(self.lift_status.items()) if node_uuid is None or status_node_uuid == node_uuid]
@@ -9,10 +9,93 @@ TODO: rename
 
 '''
 
+import calendar
+import glob
+import heapq
+import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from enum import Enum
+from itertools import chain, islice, repeat
+from operator import itemgetter
+from urllib.request import pathname2url
+
+import arrow
 
 from meterman import app_base as base
+from meterman import meter_archive
+from meterman import meter_db_migrations as db_migrations
+
+# Connection settings.  The DB is in WAL mode so readers (e.g. REST API requests) do not block the writer (ingest) or each other.
+DB_SYNCHRONOUS = 'NORMAL'           # with WAL, commits are not fsynced (only checkpoints are) - a power cut may lose the last commits only
+DB_CACHE_SIZE_KB = 8192             # page cache per connection
+DB_MMAP_SIZE = 67108864             # bytes of DB file memory-mapped per connection
+DB_BUSY_TIMEOUT_SECS = 10
+DB_READ_POOL_SIZE = 4               # read-only connections shared by get_* calls, 0 to read on the writer connection
+DB_FETCH_ROWS = 1000                # rows fetched at a time by iter_* calls
+
+# Vacuum.  DB files are created with incremental auto vacuum, so pages freed by deletes are kept on a free list until incremental_vacuum
+# returns them to the file system, a slice at a time (see meter_db_maint).  A full VACUUM rewrites whole files, so is only run on demand
+# (meter_db_admin vacuum), which also switches files created before incremental auto vacuum to it.
+DB_AUTO_VACUUM = 'INCREMENTAL'
+DB_ANALYSIS_LIMIT = 1000            # rows of each index sampled by ANALYZE (via PRAGMA optimize), to keep it quick on large tables
+DB_ANALYSIS_LIMIT_VERSION = (3, 32, 0)  # SQLite before this ignores analysis_limit, so optimize is skipped rather than ANALYZE whole tables
+
+# Meter entry shards.  With shard_by_month, meter entries are kept in a file per month of when_start (UTC) beside the main DB file, e.g.
+# meterman_data_meter_201801.db, rather than in the main file's meter_entry table.  Shards are ATTACHed to each connection as queries
+# need them, so a query for a time range reads only the shards overlapping it, and retention deletes whole shard files (see
+# drop_meter_entry_shards).  A transaction spanning shards is committed per shard file, so is not atomic across months.
+DB_SHARD_FILE_FORMAT = '{0}_meter_{1}{2}'   # main DB file root, shard month (YYYYMM), main DB file extension
+DB_SHARD_MAX_ATTACHED = 8           # shards attached per connection at once (SQLite allows 10 by default), least recently used are detached
+MAIN_METER_ENTRY_TABLE = 'main.meter_entry'
+
+# Rollups.  meter_rollup holds consumption per node per hour and day (UTC), and per local day if a time zone is given, kept up to date as
+# entries are written (see write_meter_entries and refresh_rollups).  Consumption is the rise in meter value over normal entries in order of
+# start, with a rebase setting the meter value the next entry rises from (so the jump to a rebase is not consumption).  An entry's rise is
+# counted in the bucket it starts in, so buckets of a range sum to its consumption.
+ROLLUP_HOUR_SECS = 3600
+ROLLUP_DAY_SECS = 86400
+
+# Downsampling.  Under a retention policy (see meter_db_maint), normal meter entries older than a tier's age are merged, per run of
+# consecutive entries of the same type in a bucket of the tier's length (UTC aligned), into the run's first entry, with entry_value and
+# duration summed over the run and the meter value of its last entry; the rest of the run is deleted.  Rebases are kept and end runs, so
+# meter values, and consumption over whole buckets, are unchanged.  Aggregates replace entries in place, so queries (e.g.
+# get_node_meter_entries, get_meter_consumption) read the coarsest resolution kept for each part of their range without routing.  A node's
+# first normal entry is kept, as the rest rise from it.  Entries other than normal (e.g. deleted) are kept as they are.  Rollups of the
+# range are refreshed (their sample counts and entry value ranges change, consumption does not).
+DOWNSAMPLE_5MIN_SECS = 300
+DOWNSAMPLE_HOUR_SECS = 3600
+DOWNSAMPLE_WINDOW_SECS = 86400      # entries per node downsampled in one transaction
+DOWNSAMPLE_PARAM_FORMAT = 'downsample_{0}_to'   # sys_param holding time to which entries are downsampled to buckets of {0} seconds
+
+# Bulk meter value corrections (shift_meter_values, e.g. lifting entries after a synthetic upload to continue from it) update a node's
+# entries a window at a time, each window one UPDATE per table and one transaction, so a correction over years of entries neither holds
+# the writer from ingest nor reads entries one by one.
+CORRECTION_WINDOW_SECS = 7 * 86400  # entries per node shifted in one transaction
+
+# Archive.  Under a retention policy (see meter_db_maint), meter entries older than a given age are moved from meter_entry to the cold
+# archive (see meter_archive): a compressed block per node per UTC day, located by meter_archive_block, whose masks of the block's entry
+# types and record statuses let queries skip blocks without the entries they want.  Meter entry queries (get_node_meter_entries,
+# iter_node_meter_entries, counts, first/last entries and so consumption, rollup rebuilds) read archived days as well as meter_entry,
+# merged in order of start.  Archived entries are not changed in place: edits and deletes move the days they touch back to meter_entry
+# first (see restore_archived_entries), and later runs archive them again.  Entries written late for an archived day are merged into its
+# block when archived.  Downsampling and migration backfills see only meter_entry, so entries should be archived after being downsampled.
+# Retention of shards (drop_meter_entry_shards) drops archive files of the same months.
+ARCHIVE_DAY_SECS = 86400
+
+
+# Node snapshots.  Most fields of a node's snapshots (polled every NODE_UPDATE_INTERVAL_SECS) change little or never, so node_snapshot
+# holds a keyframe (all fields) every NODE_SNAPSHOT_KEYFRAME_ROWS snapshots of a node, and delta rows between: NULL for a field unchanged
+# since the node's snapshot before, else the change of an integer field, or the new value of others (NODE_SNAPSHOT_ABSOLUTE_COLUMNS).
+# get_node_snapshots reconstructs rows a keyframe's run at a time.  A snapshot written out of order is a keyframe, and so is rewritten
+# the one after it.  So is a snapshot with a NULL field or after one, as NULL in a delta row means unchanged.  Snapshots from before
+# this (schema version 4) are moved from node_snapshot_full by the migration's backfill.
+NODE_SNAPSHOT_KEYFRAME_ROWS = 96    # a day at 15 minute polls
+NODE_SNAPSHOT_ABSOLUTE_COLUMNS = ('network_id', 'last_rms_current', 'rec_status')
 
 
 # Database Record Statuses
@@ -28,12 +111,135 @@ class EntryType(Enum):
     METER_UPDATE_SYNTH = 'MUPS'
     METER_REBASE_SYNTH = 'MREBS'
 
+REBASE_ENTRY_TYPES = (EntryType.METER_REBASE.value, EntryType.METER_REBASE_SYNTH.value)
+
+# Meter entry nonces (when_start_raw_nonce, the last column of the key) are derived from the entry: its type, and a sequence number among
+# entries of the node with the same start and type (0, but for entries migrated from random nonces - see meter_db_migrations
+# DeriveEntryNonces).  An entry received again, e.g. a meter update resent by a gateway, so has the key it was first written with, and is
+# skipped by INSERT OR IGNORE without a read to look for it.  Synthetic entries replace those written before them at the same start.
+ENTRY_NONCE_FORMAT = '{0}.{1}'      # entry type, sequence
+
+
+def get_entry_nonce(entry_type, seq=0):
+    return ENTRY_NONCE_FORMAT.format(entry_type, seq)
+
+
+# Rollup Bucket Types
+class RollupBucket(Enum):
+    HOUR = 'H'
+    DAY = 'D'
+    LOCAL_DAY = 'LD'
+
+# Meter entry as yielded by iter_node_meter_entries: a tuple with named fields, lighter than sqlite3.Row or a dict per row
+METER_ENTRY_COLUMNS = ('node_uuid', 'when_start_raw', 'when_start_raw_nonce', 'when_start', 'duration', 'entry_type', 'entry_value', 'meter_value',
+                       'rec_status')
+MeterEntry = namedtuple('MeterEntry', METER_ENTRY_COLUMNS)
+
+
+def get_write_entry(entry):
+    # meter entry in METER_ENTRY_COLUMNS order (e.g. decoded from the archive) in the order of write_meter_entries (entry_type, entry_value,
+    # duration)
+    return tuple(entry[:4]) + (entry[5], entry[6], entry[4]) + tuple(entry[7:])
+
+
+class NamedRow:
+    # mixin for a namedtuple that also reads as a sqlite3.Row (by column name, and keys()), for rows not read straight from a table
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key) if isinstance(key, str) else tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self._fields)
+
+
+class MeterEntryRow(NamedRow, MeterEntry):
+    # archived entries, returned among rows of meter_entry
+    __slots__ = ()
+
+# Node snapshots, as returned by get_node_snapshots (reconstructed, see NODE_SNAPSHOT_*)
+NODE_SNAPSHOT_COLUMNS = ('node_uuid', 'when_received', 'network_id', 'node_id', 'gateway_id', 'batt_voltage_mv', 'up_time', 'sleep_time', 'free_ram',
+                         'when_last_seen', 'last_clock_drift', 'meter_interval', 'meter_impulses_per_kwh', 'last_meter_entry_finish', 'last_meter_value',
+                         'last_rms_current', 'puck_led_rate', 'puck_led_time', 'last_rssi_at_gateway', 'rec_status')
+NodeSnapshot = namedtuple('NodeSnapshot', NODE_SNAPSHOT_COLUMNS)
+
+
+class NodeSnapshotRow(NamedRow, NodeSnapshot):
+    __slots__ = ()
+
 # Node Event Types
 class NodeEventType(Enum):
     BOOT = 'BOOT'
     DARK = 'DARK'
     LOW_BATT = 'LBATT'
 
+# bits of meter_archive_block masks for each entry type and record status
+ARCHIVE_ENTRY_TYPE_BITS = {entry_type.value: 1 << i for i, entry_type in enumerate(EntryType)}
+ARCHIVE_REC_STATUS_BITS = {rec_status.value: 1 << i for i, rec_status in enumerate(RecStatus)}
+
+
+def get_archive_mask(values, value_bits):
+    # mask of values (or of all bits if any are not in value_bits)
+    mask = 0
+    for value in values:
+        mask |= value_bits.get(value, -1)
+    return mask
+
+
+def get_shard_month(timestamp):
+    # month of shard holding meter entries starting at timestamp, as YYYYMM
+    when = time.gmtime(timestamp)
+    return (when.tm_year * 100) + when.tm_mon
+
+
+def add_shard_months(month, months):
+    month_idx = ((month // 100) * 12) + (month % 100) - 1 + months
+    return ((month_idx // 12) * 100) + (month_idx % 12) + 1
+
+
+def get_shard_month_start(month):
+    return calendar.timegm((month // 100, month % 100, 1, 0, 0, 0))
+
+
+def get_shard_schema(month):
+    return 'meter_{0}'.format(month)
+
+
+def get_read_uri(db_file):
+    return 'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(db_file)))
+
+
+def get_union_cmd(table_cmd, tables):
+    # table_cmd, with {0} for the meter_entry table, for each of tables as one compound SELECT
+    return ' UNION ALL '.join(table_cmd.format(table) for table in tables)
+
+
+NODE_SNAPSHOT_ABSOLUTE_FLAGS = [column in NODE_SNAPSHOT_ABSOLUTE_COLUMNS for column in NODE_SNAPSHOT_COLUMNS[2:]]
+
+
+def get_node_snapshot_delta(values, last_values):
+    # delta row values (see NODE_SNAPSHOT_*) of a snapshot's values (columns after the key), from those of the node's snapshot before it
+    return tuple(None if value == last_value else (value if is_absolute else value - last_value)
+                 for value, last_value, is_absolute in zip(values, last_values, NODE_SNAPSHOT_ABSOLUTE_FLAGS))
+
+
+def apply_node_snapshot_delta(delta, last_values):
+    return tuple(last_value if value is None else (value if is_absolute else last_value + value)
+                 for value, last_value, is_absolute in zip(delta, last_values, NODE_SNAPSHOT_ABSOLUTE_FLAGS))
+
+
+def get_meter_entry_where(node_uuid=None, entry_type=None, rec_status=None, time_from=None, time_to=None):
+    # WHERE clause and its params for meter_entry queries, empty if no conditions given
+    conditions = []
+    params = []
+    for column, operator, value in [('node_uuid', '=', node_uuid), ('entry_type', '=', entry_type), ('rec_status', '=', rec_status),
+                                    ('when_start', '>=', time_from), ('when_start', '<=', time_to)]:
+        if value is not None:
+            conditions.append('{0} {1} ?'.format(column, operator))
+            params.append(value)
+    return (' WHERE ' + ' AND '.join(conditions)) if len(conditions) > 0 else '', params
+
+
 # noinspection SqlDialectInspection
 class DBManager:
     """
@@ -43,329 +249,838 @@ class DBManager:
 
 
     def do_vacuum(self):
-        self.connection.isolation_level = None
-        self.connection.execute("VACUUM")
-        self.connection.isolation_level = ""
+        # Full VACUUM and ANALYZE of the main file and each meter entry shard, switching any without incremental auto vacuum to it.  Holds
+        # the writer until done, and needs free space for a copy of the largest file.
+        with self.write_lock:
+            self.connection.commit()
+            self.connection.isolation_level = None
+            try:
+                for schema in self.get_file_schemas():
+                    self.connection.execute('PRAGMA {0}.auto_vacuum = {1}'.format(schema, DB_AUTO_VACUUM))
+                    self.connection.execute('VACUUM {0}'.format(schema))
+                    self.connection.execute('ANALYZE {0}'.format(schema))
+                    self.logger.info('Vacuumed {0}'.format(schema))
+            finally:
+                self.connection.isolation_level = ""
 
 
-    def __init__(self, db_file=base.db_file, log_file=base.log_file):
+    def __init__(self, db_file=base.db_file, log_file=base.log_file, read_pool_size=DB_READ_POOL_SIZE, shard_by_month=False, rollups=True,
+                 rollup_tz=None, read_only=False):
+        # read_only opens the DB files read-only, without creating or migrating the schema, e.g. for meter_db_admin migrate --dry_run
 
         try:
             self.logger = base.get_logger(logger_name='db_mgr', log_file=log_file)
             self.db_uri = db_file
-            self.connection = sqlite3.connect(db_file, check_same_thread=False)       # TODO: ensure access thread-safe
-            self.connection.row_factory = sqlite3.Row
+            self.read_only = read_only and db_file != ':memory:'
+            # one writer connection, shared by threads under write_lock.  Reads use a pool of read-only connections (see read_connection).
+            self.write_lock = threading.RLock()
+            self.read_pool_size = 0 if db_file == ':memory:' else read_pool_size
+            self.read_pool = queue.LifoQueue()
+            self.read_conn_count = 0
+            self.read_pool_lock = threading.Lock()
+            self.group_commit_depth = 0
+            self.group_commit_thread = None
+            self.last_commit_time = time.monotonic()     # of last write, for maintenance to find idle periods
+            self.shard_by_month = shard_by_month and db_file != ':memory:'
+            self.shard_months = ()          # months of existing shards, in order (replaced, not changed, so readers can use it unlocked)
+            self.conn_shards = {}           # months of shards attached to each connection, least recently used first
+            self.rollups = rollups
+            self.rollup_tz = rollup_tz      # time zone of local day buckets, e.g. 'Australia/Sydney', None for none
+            self.local_day_range = (0, 0)   # last local day bucket found, as (start, end)
+            self.rollup_state = {}          # (when_start, meter_value) of latest normal entry of each node rolled up, loaded as needed
+            self.node_snapshot_state = {}   # see get_node_snapshot_state, loaded as needed
+            self.rollup_dirty = {}          # [time_from, time_to] of each node changed other than by appends, to refresh at commit
+            self.archive = meter_archive.MeterArchive(db_file) if db_file != ':memory:' else None
+            self.archive_range = None       # (start of first archived day, end of last), None if none, for queries to skip the archive
+            self.conn_open()
 
             cursor = self.connection.cursor()
 
             cursor.execute('SELECT sqlite_version()')
             self.db_version = cursor.fetchone()
             self.logger.info('Connected to sqlite DB.  Version is: {0}.  File: {1}'.format(self.db_version, self.db_uri))
-
-            cursor.execute('CREATE TABLE IF NOT EXISTS meter_entry ('
-                            'node_uuid data_type TEXT NOT NULL, '
-                            'when_start_raw data_type INTEGER NOT NULL, '
-                            'when_start_raw_nonce data_type TEXT NOT NULL, '
-                            'when_start data_type INTEGER NOT NULL, '
-                            'duration data_type INTEGER NOT NULL, '
-                            'entry_type data_type TEXT NOT NULL, '
-                            'entry_value data_type INTEGER NOT NULL, '
-                            'meter_value data_type INTEGER NOT NULL, '
-                            'rec_status data_type TEXT NOT NULL, '
-                            'PRIMARY KEY (node_uuid, when_start_raw, when_start_raw_nonce)) WITHOUT ROWID')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_meter_entry_node_uuid ON meter_entry (node_uuid)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_meter_entry_when_start ON meter_entry (when_start)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_meter_entry_entry_type ON meter_entry (entry_type)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_meter_entry_rec_status ON meter_entry (rec_status)')
-
-            cursor.execute('CREATE TABLE IF NOT EXISTS gateway_snapshot ('
-                           'gateway_uuid data_type TEXT NOT NULL, '
-                           'when_received data_type INTEGER NOT NULL, '
-                           'network_id data_type TEXT NOT NULL, '
-                           'gateway_id data_type INTEGER NOT NULL, '
-                           'when_booted data_type INTEGER NOT NULL, '
-                           'free_ram data_type INTEGER NOT NULL, '
-                           'gateway_time data_type INTEGER NOT NULL, '
-                           'log_level data_type TEXT NOT NULL, '
-                           'tx_power data_type INTEGER NOT NULL, '
-                           'rec_status data_type TEXT NOT NULL, '
-                           'PRIMARY KEY (gateway_uuid, when_received)) WITHOUT ROWID')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_gateway_snapshot_uuid ON gateway_snapshot (gateway_uuid)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_gateway_snapshot_when_received ON gateway_snapshot (when_received)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_gateway_snapshot_rec_status ON gateway_snapshot (rec_status)')
-
-            cursor.execute('CREATE TABLE IF NOT EXISTS node_snapshot ('
-                           'node_uuid data_type TEXT NOT NULL, '
-                           'when_received data_type INTEGER NOT NULL, '
-                           'network_id data_type TEXT NOT NULL, '
-                           'node_id data_type INTEGER NOT NULL, '
-                           'gateway_id data_type INTEGER NOT NULL, '
-                           'batt_voltage_mv data_type INTEGER NOT NULL, '
-                           'up_time data_type INTEGER NOT NULL, '
-                           'sleep_time data_type INTEGER NOT NULL, '
-                           'free_ram data_type INTEGER NOT NULL, '
-                           'when_last_seen data_type INTEGER NOT NULL, '
-                           'last_clock_drift data_type INTEGER NOT NULL, '
-                           'meter_interval data_type INTEGER NOT NULL, '
-                           'meter_impulses_per_kwh data_type INTEGER NOT NULL, '
-                           'last_meter_entry_finish data_type INTEGER NOT NULL, '
-                           'last_meter_value data_type INTEGER NOT NULL, '
-                           'last_rms_current data_type REAL NOT NULL, '
-                           'puck_led_rate data_type INTEGER NOT NULL, '
-                           'puck_led_time data_type INTEGER NOT NULL, '
-                           'last_rssi_at_gateway data_type INTEGER NOT NULL, '
-                           'rec_status data_type TEXT NOT NULL, '
-                           'PRIMARY KEY (node_uuid, when_received)) WITHOUT ROWID')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_snapshot_uuid ON node_snapshot (node_uuid)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_snapshot_when_received ON node_snapshot (when_received)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_snapshot_network_id ON node_snapshot (network_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_snapshot_rec_status ON node_snapshot (rec_status)')
-
-            cursor.execute('CREATE TABLE IF NOT EXISTS node_event ('
-                            'event_id data_type INTEGER PRIMARY KEY, '
-                            'node_uuid data_type TEXT NOT NULL, '
-                            'timestamp data_type INT NOT NULL, '
-                            'event_type  data_type TEXT NOT NULL, '
-                            'details data_type TEXT NOT NULL)')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_event_node_uuid ON node_event (node_uuid)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_event_timestamp ON node_event (timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_event_event_type ON node_event (event_type)')
-
-            cursor.execute('CREATE TABLE IF NOT EXISTS sys_param ('
-                           'name data_type TEXT NOT NULL, '
-                           'value data_type TEXT NOT NULL, '
-                           'PRIMARY KEY (name)) WITHOUT ROWID')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sys_param_name ON sys_param (name)')
-
-            cursor.execute('CREATE TABLE IF NOT EXISTS user ('
-                           'username data_type TEXT NOT NULL, '
-                           'password data_type TEXT NOT NULL, '
-                           'permissions data_type TEXT NOT NULL, '            
-                           'PRIMARY KEY (username)) WITHOUT ROWID')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_username ON user (username)')
-
-            self.connection.commit()
+            if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                self.logger.warn('DB file predates incremental vacuum, so free pages are reused but never released.  Run meter_db_admin '
+                                 'vacuum once, with meterman stopped, to switch it')
+            if sqlite3.sqlite_version_info < DB_ANALYSIS_LIMIT_VERSION:
+                self.logger.info('SQLite is older than {0}, so background maintenance does not refresh query planner statistics.  Run '
+                                 'meter_db_admin vacuum to refresh them'.format('.'.join(str(part) for part in DB_ANALYSIS_LIMIT_VERSION)))
+
+            if not self.read_only:
+                self.create_base_schema(cursor)
+                self.connection.commit()
             cursor.close()
 
-            self.do_vacuum()
+            # schema changes since the base schema (see meter_db_migrations), unless only reporting them.  Before moving entries to
+            # shards, which are created up to date.
+            if self.shard_by_month:
+                self.shard_months = tuple(self.find_shard_months())
+            if not self.read_only:
+                db_migrations.migrate(self)
+                if self.shard_by_month:
+                    self.move_meter_entries_to_shards()
+            self.load_archive_range()
 
         except sqlite3.Error as err:
             self.logger.info('sqlite3 Error: {0}'.format(err))
 
 
-    def conn_open(self):
-        self.connection = sqlite3.connect(self.db_uri)
-        self.connection.row_factory = sqlite3.Row
-
-    def conn_close(self):
-        self.connection.commit()  # redundant, just in case
-        self.connection.close()
-
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.conn_close()   # redundant, just in case
-
-
-    def write_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status):
-        try:
+    def create_base_schema(self, cursor):
+        # base schema (see meter_db_migrations), created if not there, with indexes replaced since dropped
+        cursor.execute('DROP INDEX IF EXISTS idx_meter_entry_node_uuid')
+        cursor.execute('DROP INDEX IF EXISTS idx_meter_entry_entry_type')
+        cursor.execute('DROP INDEX IF EXISTS idx_meter_entry_rec_status')
+        self.create_meter_entry_table(cursor, 'main')     # unsharded, or entries to move to shards
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS meter_rollup ('
+                       'node_uuid data_type TEXT NOT NULL, '
+                       'bucket_type data_type TEXT NOT NULL, '
+                       'bucket_start data_type INTEGER NOT NULL, '
+                       'consumption data_type INTEGER NOT NULL, '
+                       'sample_count data_type INTEGER NOT NULL, '
+                       'min_entry_value data_type INTEGER NOT NULL, '
+                       'max_entry_value data_type INTEGER NOT NULL, '
+                       'PRIMARY KEY (node_uuid, bucket_type, bucket_start)) WITHOUT ROWID')
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS gateway_snapshot ('
+                       'gateway_uuid data_type TEXT NOT NULL, '
+                       'when_received data_type INTEGER NOT NULL, '
+                       'network_id data_type TEXT NOT NULL, '
+                       'gateway_id data_type INTEGER NOT NULL, '
+                       'when_booted data_type INTEGER NOT NULL, '
+                       'free_ram data_type INTEGER NOT NULL, '
+                       'gateway_time data_type INTEGER NOT NULL, '
+                       'log_level data_type TEXT NOT NULL, '
+                       'tx_power data_type INTEGER NOT NULL, '
+                       'rec_status data_type TEXT NOT NULL, '
+                       'PRIMARY KEY (gateway_uuid, when_received)) WITHOUT ROWID')
+
+        cursor.execute('DROP INDEX IF EXISTS idx_gateway_snapshot_uuid')    # primary key prefix
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_gateway_snapshot_when_received ON gateway_snapshot (when_received)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_gateway_snapshot_rec_status ON gateway_snapshot (rec_status)')
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS node_snapshot ('
+                       'node_uuid data_type TEXT NOT NULL, '
+                       'when_received data_type INTEGER NOT NULL, '
+                       'network_id data_type TEXT NOT NULL, '
+                       'node_id data_type INTEGER NOT NULL, '
+                       'gateway_id data_type INTEGER NOT NULL, '
+                       'batt_voltage_mv data_type INTEGER NOT NULL, '
+                       'up_time data_type INTEGER NOT NULL, '
+                       'sleep_time data_type INTEGER NOT NULL, '
+                       'free_ram data_type INTEGER NOT NULL, '
+                       'when_last_seen data_type INTEGER NOT NULL, '
+                       'last_clock_drift data_type INTEGER NOT NULL, '
+                       'meter_interval data_type INTEGER NOT NULL, '
+                       'meter_impulses_per_kwh data_type INTEGER NOT NULL, '
+                       'last_meter_entry_finish data_type INTEGER NOT NULL, '
+                       'last_meter_value data_type INTEGER NOT NULL, '
+                       'last_rms_current data_type REAL NOT NULL, '
+                       'puck_led_rate data_type INTEGER NOT NULL, '
+                       'puck_led_time data_type INTEGER NOT NULL, '
+                       'last_rssi_at_gateway data_type INTEGER NOT NULL, '
+                       'rec_status data_type TEXT NOT NULL, '
+                       'PRIMARY KEY (node_uuid, when_received)) WITHOUT ROWID')
+
+        cursor.execute('DROP INDEX IF EXISTS idx_node_snapshot_uuid')       # primary key prefix
+        # snapshots are read a node at a time, and delta rows leave network_id and rec_status NULL (see NODE_SNAPSHOT_*), so they are
+        # filtered on them once reconstructed
+        cursor.execute('DROP INDEX IF EXISTS idx_node_snapshot_when_received')
+        cursor.execute('DROP INDEX IF EXISTS idx_node_snapshot_network_id')
+        cursor.execute('DROP INDEX IF EXISTS idx_node_snapshot_rec_status')
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS node_event ('
+                        'event_id data_type INTEGER PRIMARY KEY, '
+                        'node_uuid data_type TEXT NOT NULL, '
+                        'timestamp data_type INT NOT NULL, '
+                        'event_type  data_type TEXT NOT NULL, '
+                        'details data_type TEXT NOT NULL)')
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_event_node_uuid ON node_event (node_uuid)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_event_timestamp ON node_event (timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_node_event_event_type ON node_event (event_type)')
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS sys_param ('
+                       'name data_type TEXT NOT NULL, '
+                       'value data_type TEXT NOT NULL, '
+                       'PRIMARY KEY (name)) WITHOUT ROWID')
+
+        cursor.execute('DROP INDEX IF EXISTS idx_sys_param_name')           # primary key
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS user ('
+                       'username data_type TEXT NOT NULL, '
+                       'password data_type TEXT NOT NULL, '
+                       'permissions data_type TEXT NOT NULL, '            
+                       'PRIMARY KEY (username)) WITHOUT ROWID')
+
+        cursor.execute('DROP INDEX IF EXISTS idx_user_username')            # primary key
+
+
+    def create_meter_entry_table(self, cursor, schema):
+        cursor.execute('CREATE TABLE IF NOT EXISTS {0}.meter_entry ('
+                        'node_uuid data_type TEXT NOT NULL, '
+                        'when_start_raw data_type INTEGER NOT NULL, '
+                        'when_start_raw_nonce data_type TEXT NOT NULL, '
+                        'when_start data_type INTEGER NOT NULL, '
+                        'duration data_type INTEGER NOT NULL, '
+                        'entry_type data_type TEXT NOT NULL, '
+                        'entry_value data_type INTEGER NOT NULL, '
+                        'meter_value data_type INTEGER NOT NULL, '
+                        'rec_status data_type TEXT NOT NULL, '
+                        'PRIMARY KEY (node_uuid, when_start_raw, when_start_raw_nonce)) WITHOUT ROWID'.format(schema))
+
+        # indexes follow query shapes: by node, status and type, ordered/ranged by start (e.g. first/last MUP); by node ordered/ranged by
+        # start (entries for node); and by start (entries for all nodes).  Replaces single-column indexes, of which node_uuid duplicates
+        # the primary key prefix and entry_type/rec_status are too unselective to be used.
+        cursor.execute('CREATE INDEX IF NOT EXISTS {0}.idx_meter_entry_node_status_type_start ON meter_entry (node_uuid, rec_status, entry_type, '
+                       'when_start)'.format(schema))
+        cursor.execute('CREATE INDEX IF NOT EXISTS {0}.idx_meter_entry_node_start ON meter_entry (node_uuid, when_start)'.format(schema))
+        cursor.execute('CREATE INDEX IF NOT EXISTS {0}.idx_meter_entry_when_start ON meter_entry (when_start)'.format(schema))
+
+
+    def get_shard_file(self, month):
+        db_root, db_ext = os.path.splitext(self.db_uri)
+        return DB_SHARD_FILE_FORMAT.format(db_root, month, db_ext)
+
+
+    def find_shard_months(self):
+        db_root, db_ext = os.path.splitext(self.db_uri)
+        month_pos = len(DB_SHARD_FILE_FORMAT.format(db_root, '', ''))
+        shard_files = glob.glob(DB_SHARD_FILE_FORMAT.format(glob.escape(db_root), '[0-9]' * 6, glob.escape(db_ext)))
+        return sorted(int(shard_file[month_pos:month_pos + 6]) for shard_file in shard_files)
+
+
+    def attach_shard(self, connection, month):
+        # Attaches shard of month to connection if not already, detaching the least recently used if DB_SHARD_MAX_ATTACHED are.  On the
+        # writer, creates the shard if it does not exist.  Returns its meter_entry table.  ATTACH and DETACH can't be run in a transaction,
+        # so writes so far are committed first (a group commit spanning a new month is committed in two parts).
+        attached_months = self.conn_shards.setdefault(connection, OrderedDict())
+        schema = get_shard_schema(month)
+        if month in attached_months:
+            attached_months.move_to_end(month)
+            return schema + '.meter_entry'
+
+        if connection.in_transaction:
+            connection.commit()
+        while len(attached_months) >= DB_SHARD_MAX_ATTACHED:
+            self.detach_shard(connection, next(iter(attached_months)))
+
+        shard_file = self.get_shard_file(month)
+        if connection is self.connection and not self.read_only:
+            connection.execute('ATTACH DATABASE ? AS {0}'.format(schema), (shard_file,))
+            if month not in self.shard_months:
+                connection.execute('PRAGMA {0}.auto_vacuum = {1}'.format(schema, DB_AUTO_VACUUM))
+                connection.execute('PRAGMA {0}.journal_mode = WAL'.format(schema))
+                cursor = connection.cursor()
+                self.create_meter_entry_table(cursor, schema)
+                connection.commit()
+                cursor.close()
+                db_migrations.migrate_shard(self, schema)
+                self.shard_months = tuple(sorted(self.shard_months + (month,)))
+                self.logger.info('Created meter entry shard {0}'.format(shard_file))
+        else:
+            connection.execute('ATTACH DATABASE ? AS {0}'.format(schema), (get_read_uri(shard_file),))
+        connection.execute('PRAGMA {0}.synchronous = {1}'.format(schema, DB_SYNCHRONOUS))
+        attached_months[month] = None
+        return schema + '.meter_entry'
+
+
+    def detach_shard(self, connection, month):
+        if connection.in_transaction:
+            connection.commit()
+        connection.execute('DETACH DATABASE {0}'.format(get_shard_schema(month)))
+        del self.conn_shards[connection][month]
+
+
+    def get_meter_entry_tables(self, connection, time_from=None, time_to=None, newest_first=False):
+        # Yields lists of meter_entry tables on connection holding entries from time_from to time_to (either None for unbounded), oldest
+        # first unless newest_first, each list attached together and to be queried before taking the next.  Unsharded, the one table.
+        if not self.shard_by_month:
+            yield [MAIN_METER_ENTRY_TABLE]
+            return
+
+        shard_months = self.shard_months
+        for month in [month for month in self.conn_shards.get(connection, {}) if month not in shard_months]:
+            self.detach_shard(connection, month)        # dropped since attached
+
+        month_from = get_shard_month(time_from) if time_from is not None else 0
+        month_to = get_shard_month(time_to) if time_to is not None else 999999
+        months = [month for month in shard_months if month_from <= month <= month_to]
+        if newest_first:
+            months.reverse()
+        for i in range(0, len(months), DB_SHARD_MAX_ATTACHED):
+            yield [self.attach_shard(connection, month) for month in months[i:i + DB_SHARD_MAX_ATTACHED]]
+
+
+    def get_write_table(self, when_start):
+        # meter_entry table for an entry starting at when_start, on the writer (call under write_lock)
+        if not self.shard_by_month:
+            return MAIN_METER_ENTRY_TABLE
+        return self.attach_shard(self.connection, get_shard_month(when_start))
+
+
+    def find_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce):
+        # (meter_entry table, when_start) of entry with primary key, on the writer (call under write_lock), or (None, None) if not found.
+        # Sharded, tries the shard for when_start_raw first, as entries start there unless moved by update_meter_entry.  An archived entry
+        # is restored to meter_entry (without committing), to be changed there.
+        for is_restored in (False, True):
+            if is_restored and not self.restore_archived_entry(node_uuid, when_start_raw, when_start_raw_nonce):
+                break
+            tables = [MAIN_METER_ENTRY_TABLE]
+            if self.shard_by_month:
+                raw_month = get_shard_month(when_start_raw)
+                tables = (self.attach_shard(self.connection, month) for month in sorted(self.shard_months, key=lambda shard_month: shard_month != raw_month))
+
+            for table in tables:
+                rows = self.connection.execute('SELECT when_start FROM {0} WHERE node_uuid = ? AND when_start_raw = ? AND when_start_raw_nonce = ?'.format(table),
+                                               (node_uuid, when_start_raw, when_start_raw_nonce)).fetchall()
+                if len(rows) > 0:
+                    return table, rows[0][0]
+        return None, None
+
+
+    def move_meter_entries_to_shards(self):
+        # moves any entries in the main file's meter_entry table (e.g. from before sharding) to shards, committing a month at a time
+        with self.write_lock:
             cursor = self.connection.cursor()
-            cmd = 'INSERT INTO meter_entry (node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status)' \
-                  ' VALUES ("{0}", {1}, "{2}", {3}, "{4}", {5}, {6}, {7}, "{8}")' \
-                .format(node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status)
-            cursor.execute(cmd)
-            self.logger.debug('Inserted meter_entry record for PRIMARY KEY [{0},{1},{2}] entry_value={3}, meter_value={4}'.format(
-                node_uuid, when_start_raw, when_start_raw_nonce, entry_value, meter_value))
-            self.connection.commit()
+            while True:
+                when_start = cursor.execute('SELECT MIN(when_start) FROM main.meter_entry').fetchone()[0]
+                if when_start is None:
+                    break
+                month = get_shard_month(when_start)
+                table = self.attach_shard(self.connection, month)
+                month_range = (get_shard_month_start(month), get_shard_month_start(add_shard_months(month, 1)) - 1)
+                cursor.execute('INSERT OR IGNORE INTO {0} SELECT * FROM main.meter_entry WHERE when_start >= ? AND when_start <= ?'.format(table),
+                               month_range)
+                cursor.execute('DELETE FROM main.meter_entry WHERE when_start >= ? AND when_start <= ?', month_range)
+                self.connection.commit()
+                self.logger.info('Moved {0} meter entries to shard {1}'.format(cursor.rowcount, self.get_shard_file(month)))
             cursor.close()
 
-        except sqlite3.IntegrityError:
-            self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0},{1},{2}]'.format(node_uuid, when_start_raw, when_start_raw_nonce))
-
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
-
-
-    def update_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce, new_when_start, new_entry_type, new_entry_value, new_duration, new_meter_value, new_rec_status):
-        try:
 
-            if node_uuid is None or when_start_raw is None or when_start_raw_nonce is None:
-                raise ValueError('Primary key not given.  Got of node_uuid={0), when_start_raw={1}, when_start_raw_nonce={2}.'.format(node_uuid, when_start_raw, when_start_raw_nonce))
+    def drop_meter_entry_shards(self, time_before):
+        # Retention for sharded meter entries: deletes shards, and archive files, of months that end by time_before.  Returns months of
+        # shards dropped.  Readers detach dropped shards on their next query.
+        if not self.shard_by_month:
+            self.logger.warn('Meter entries are not sharded, so no shards to drop')
+            return []
+
+        with self.write_lock:
+            drop_months = [month for month in self.shard_months if month < get_shard_month(time_before)]
+            self.shard_months = tuple(month for month in self.shard_months if month not in drop_months)
+            for month in drop_months:
+                if month in self.conn_shards.get(self.connection, {}):
+                    self.detach_shard(self.connection, month)
+                shard_file = self.get_shard_file(month)
+                for file in [shard_file, shard_file + '-wal', shard_file + '-shm']:
+                    if os.path.isfile(file):
+                        os.remove(file)
+                self.logger.info('Dropped meter entry shard {0}'.format(shard_file))
+
+            if self.archive is not None:
+                if self.is_archived():
+                    self.connection.execute('DELETE FROM meter_archive_block WHERE day_start < ?', (get_shard_month_start(get_shard_month(time_before)),))
+                    self.commit()
+                for month in self.archive.find_months():
+                    if month < get_shard_month(time_before):
+                        self.archive.drop_month(month)
+                        self.logger.info('Dropped meter entry archive {0}'.format(self.archive.get_file(month)))
+            return drop_months
+
+
+    def get_file_schemas(self):
+        # yields schemas of main file and each meter entry shard on the writer (call under write_lock), attaching each shard as it is taken
+        yield 'main'
+        if self.shard_by_month:
+            for month in self.shard_months:
+                yield self.attach_shard(self.connection, month).split('.')[0]
+
+
+    def get_idle_secs(self):
+        # seconds since the last commit on the writer
+        return time.monotonic() - self.last_commit_time
+
+
+    def incremental_vacuum(self, max_pages):
+        # Releases up to max_pages free pages to the file system, from the first of the main file and shards (oldest first) that has any.
+        # Returns number of pages released, 0 if there were none to release.
+        with self.write_lock:
+            if self.connection.in_transaction:
+                return 0        # within a group commit
+            for schema in self.get_file_schemas():
+                free_pages = self.connection.execute('PRAGMA {0}.freelist_count'.format(schema)).fetchone()[0]
+                if free_pages > 0:
+                    self.connection.executescript('PRAGMA {0}.incremental_vacuum({1})'.format(schema, max_pages))   # steps to done, unlike execute
+                    return free_pages - self.connection.execute('PRAGMA {0}.freelist_count'.format(schema)).fetchone()[0]
+            return 0
+
+
+    def optimize(self):
+        # PRAGMA optimize on the writer, which runs ANALYZE (limited to DB_ANALYSIS_LIMIT rows per index) on tables whose statistics are
+        # missing or out of date.  Skipped before DB_ANALYSIS_LIMIT_VERSION, where ANALYZE would read whole tables holding the writer.
+        if sqlite3.sqlite_version_info < DB_ANALYSIS_LIMIT_VERSION:
+            return
+        with self.write_lock:
+            if self.connection.in_transaction:
+                return
+            self.connection.execute('PRAGMA analysis_limit = {0}'.format(DB_ANALYSIS_LIMIT))
+            self.connection.execute('PRAGMA optimize')
+
+
+    def set_conn_pragmas(self, connection):
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA synchronous = {0}'.format(DB_SYNCHRONOUS))
+        connection.execute('PRAGMA cache_size = -{0}'.format(DB_CACHE_SIZE_KB))
+        connection.execute('PRAGMA mmap_size = {0}'.format(DB_MMAP_SIZE))
 
-            if new_when_start is None and new_entry_type is None and new_entry_value is None and new_duration is None and\
-                    new_meter_value is None and new_rec_status is None:
-                raise ValueError('No update columns given.')
 
-            # Build SQL update command...
-            cmd = 'UPDATE meter_entry SET '
-
-            if new_when_start is not None:
-                cmd += 'when_start = {},'.format(new_when_start)
-            if new_entry_type is not None:
-                cmd += 'entry_type = "{}",'.format(new_entry_type)
-            if new_entry_value is not None:
-                cmd += 'entry_value = {},'.format(new_entry_value)
-            if new_duration is not None:
-                cmd += 'duration = {},'.format(new_duration)
-            if new_meter_value is not None:
-                cmd += 'meter_value = {},'.format(new_meter_value)
-            if new_rec_status is not None:
-                cmd += 'rec_status = "{}",'.format(new_rec_status)
-
-            cmd = cmd[:-1] + ' '      # replace trailing comma with space
-
-            cmd += 'WHERE node_uuid = "{0}" AND when_start_raw = {1} AND when_start_raw_nonce = "{2}"'.format(
-                node_uuid, when_start_raw, when_start_raw_nonce
-                )
+    def conn_open(self):
+        if self.read_only:
+            self.connection = sqlite3.connect(get_read_uri(self.db_uri), uri=True, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_SECS)
+        else:
+            self.connection = sqlite3.connect(self.db_uri, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_SECS)
+            self.connection.execute('PRAGMA auto_vacuum = {0}'.format(DB_AUTO_VACUUM))     # new files only, see do_vacuum
+            self.connection.execute('PRAGMA journal_mode = WAL')
+        self.set_conn_pragmas(self.connection)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            self.logger.debug('Updated meter_entry record for PRIMARY KEY [{0},{1},{2}]'.format(node_uuid, when_start_raw, when_start_raw_nonce))
-            self.connection.commit()
-            cursor.close()
 
-        except ValueError as err:
-            self.logger.warn('Value Error: {0}'.format(err))
+    def conn_close(self):
+        while True:
+            try:
+                self.read_pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self.read_conn_count = 0
+        self.conn_shards = {}
+        if self.archive is not None:
+            self.archive.close()
 
-        except sqlite3.IntegrityError as err:
-            self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
+        self.connection.commit()  # redundant, just in case
+        self.connection.close()
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
 
+    def commit(self):
+        # commits writes on writer connection, unless within group_commit(), which commits once at its end
+        if self.group_commit_depth == 0:
+            self.refresh_rollups()
+            self.connection.commit()
+            self.last_commit_time = time.monotonic()
+
+
+    def rollback(self):
+        if self.group_commit_depth == 0:
+            self.connection.rollback()
+
+
+    @contextmanager
+    def group_commit(self):
+        # Holds the writer for a group of write_* calls and commits them as one transaction (e.g. for meter_db_writer.DBWriter).  A write
+        # that fails is skipped as it would be outside the group; the others are still committed.  Reads by the same thread within the
+        # group are on the writer, so see its writes.
+        with self.write_lock:
+            self.group_commit_depth += 1
+            self.group_commit_thread = threading.get_ident()
+            try:
+                yield self
+            finally:
+                self.group_commit_depth -= 1
+                if self.group_commit_depth == 0:
+                    self.group_commit_thread = None
+                    self.refresh_rollups()
+                    self.connection.commit()
+                    self.last_commit_time = time.monotonic()
+
+
+    @contextmanager
+    def read_connection(self):
+        # Lends a read-only connection from the pool, opening one if fewer than read_pool_size are open, else waiting for one to be
+        # returned.  Connections are not tied to threads, so a request thread may use any of them.  With no pool, or within a group_commit by
+        # the same thread, lends the writer.
+        if self.read_pool_size == 0 or self.group_commit_thread == threading.get_ident():
+            with self.write_lock:
+                yield self.connection
+            return
 
-    def update_meter_entries_in_range(self, node_uuid, when_start_from, when_start_to, entry_type=None, rec_status=None, new_entry_type=None, new_duration=None, new_rec_status=None):
         try:
-            # Build SQL update command...
-            cmd = 'UPDATE meter_entry SET '
+            connection = self.read_pool.get_nowait()
+        except queue.Empty:
+            with self.read_pool_lock:
+                is_new_conn = self.read_conn_count < self.read_pool_size
+                if is_new_conn:
+                    self.read_conn_count += 1
+            if is_new_conn:
+                try:
+                    connection = sqlite3.connect(get_read_uri(self.db_uri), uri=True, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_SECS)
+                    self.set_conn_pragmas(connection)
+                except sqlite3.Error:
+                    with self.read_pool_lock:
+                        self.read_conn_count -= 1
+                    raise
+            else:
+                connection = self.read_pool.get()
 
-            if new_entry_type is not None:
-                cmd += 'entry_type = "{}",'.format(new_entry_type.value)
-            if new_duration is not None:
-                cmd += 'duration = {},'.format(new_duration)
-            if new_rec_status is not None:
-                cmd += 'rec_status = "{}",'.format(new_rec_status.value)
+        try:
+            yield connection
+        finally:
+            self.read_pool.put(connection)
 
-            cmd = cmd[:-1] + ' '      # replace trailing comma with space
 
-            cmd += 'WHERE node_uuid = "{}" AND when_start >= {} AND when_start <= {} AND '.format(
-                node_uuid, when_start_from, when_start_to
-                )
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn_close()   # redundant, just in case
 
-            if entry_type is not None:
-                cmd += 'entry_type = "{}" AND '.format(entry_type.value)
-            if rec_status is not None:
-                cmd += 'rec_status = "{}" AND '.format(rec_status.value)
 
-            if cmd.endswith('AND '):
-                cmd = cmd[:-4] + ' '  # replace trailing "AND " with space
+    def write_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status,
+                          replace=False):
+        # With replace, an existing entry with the same key is overwritten (INSERT OR REPLACE), e.g. by a synthetic entry written again.
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                cmd = 'INSERT {0}INTO {1} (node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, ' \
+                      'rec_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format('OR REPLACE ' if replace else '', self.get_write_table(when_start))
+                meter_entry = (node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status)
+                # a replaced entry may already be rolled up, so its range is refreshed rather than appended to
+                append_entries, other_entries = self.split_rollup_appends([meter_entry]) if self.rollups and not replace else ([], [meter_entry])
+                cursor.execute(cmd, meter_entry)
+                self.write_rollup_appends(append_entries)
+                if len(other_entries) > 0 and (rec_status == RecStatus.NORMAL.value or replace):
+                    self.mark_rollups_dirty(node_uuid, when_start, when_start)
+                self.logger.debug('Inserted meter_entry record for PRIMARY KEY [{0},{1},{2}] entry_value={3}, meter_value={4}'.format(
+                    node_uuid, when_start_raw, when_start_raw_nonce, entry_value, meter_value))
+                self.commit()
+                cursor.close()
+
+            except sqlite3.IntegrityError:
+                self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0},{1},{2}]'.format(node_uuid, when_start_raw, when_start_raw_nonce))
+
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
+
+
+    def write_meter_entries(self, meter_entries):
+        # Inserts meter entries, each a sequence of (node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value,
+        # duration, meter_value, rec_status), as one prepared statement and one transaction.  Entries whose key already exists are skipped
+        # rather than failing the batch.  Returns number of entries skipped, or None on error.  Sharded, one statement per month.
+        #
+        # With rollups, entries after the latest of their node are inserted and added to its rollup buckets; others are inserted first and,
+        # if any were new (not all skipped), their range is refreshed at commit.
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                if self.rollups:
+                    append_entries, other_entries = self.split_rollup_appends(list(meter_entries))
+                    entry_count, inserted_count = self.insert_meter_entries(cursor, other_entries)
+                    if inserted_count > 0:
+                        for entry in other_entries:
+                            if entry[8] == RecStatus.NORMAL.value:
+                                self.mark_rollups_dirty(entry[0], entry[3], entry[3])
+                    append_count, append_inserted_count = self.insert_meter_entries(cursor, append_entries)
+                    self.write_rollup_appends(append_entries)
+                    entry_count += append_count
+                    inserted_count += append_inserted_count
+                else:
+                    entry_count, inserted_count = self.insert_meter_entries(cursor, meter_entries)
+                self.commit()
+                cursor.close()
+                rejected_count = entry_count - inserted_count
+                self.logger.debug('Inserted {0} meter_entry records'.format(inserted_count))
+                if rejected_count > 0:
+                    self.logger.warn('Skipped {0} of {1} meter_entry records as already in PRIMARY KEY'.format(rejected_count, entry_count))
+                return rejected_count
+
+            except sqlite3.Error as err:
+                self.rollback()
+                self.rollup_state = {}
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
+                return None
+
+
+    def insert_meter_entries(self, cursor, meter_entries):
+        # INSERT OR IGNORE of meter entries (as for write_meter_entries) on the writer, one statement per shard.  Returns (number of
+        # entries, number inserted).
+        changes_before = self.connection.total_changes
+        cmd = 'INSERT OR IGNORE INTO {0} (node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, ' \
+              'meter_value, rec_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+        entry_count = [0]
+
+        def count_entries(entries):
+            for entry in entries:
+                entry_count[0] += 1
+                yield entry
+
+        if self.shard_by_month:
+            month_entries = {}
+            for entry in meter_entries:
+                month_entries.setdefault(get_shard_month(entry[3]), []).append(entry)
+            for month, entries in sorted(month_entries.items()):
+                cursor.executemany(cmd.format(self.attach_shard(self.connection, month)), count_entries(entries))
+        else:
+            cursor.executemany(cmd.format(MAIN_METER_ENTRY_TABLE), count_entries(meter_entries))
+        return entry_count[0], self.connection.total_changes - changes_before
+
+
+    def write_meter_entry_columns(self, node_uuids, when_starts, when_start_nonces, entry_type, entry_values, durations, meter_values, rec_status):
+        # Inserts meter entries from parallel column sequences (e.g. arrays from gateway_messages.get_meter_update_columns) via
+        # write_meter_entries, with when_start_raw = when_start.  Returns number of entries skipped as already existing.
+        return self.write_meter_entries(zip(node_uuids, when_starts, when_start_nonces, when_starts, repeat(entry_type), entry_values, durations,
+                                            meter_values, repeat(rec_status)))
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            self.logger.debug('Updated meter_entries for node {} between {} and {}'.format(node_uuid, when_start_from, when_start_to))
-            self.connection.commit()
-            cursor.close()
 
-        except ValueError as err:
-            self.logger.warn('Value Error: {0}'.format(err))
+    def update_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce, new_when_start, new_entry_type, new_entry_value, new_duration, new_meter_value, new_rec_status):
+        with self.write_lock:
+            try:
+
+                if node_uuid is None or when_start_raw is None or when_start_raw_nonce is None:
+                    raise ValueError('Primary key not given.  Got of node_uuid={0), when_start_raw={1}, when_start_raw_nonce={2}.'.format(node_uuid, when_start_raw, when_start_raw_nonce))
+
+                if new_when_start is None and new_entry_type is None and new_entry_value is None and new_duration is None and\
+                        new_meter_value is None and new_rec_status is None:
+                    raise ValueError('No update columns given.')
+
+                table, when_start = self.find_meter_entry(node_uuid, when_start_raw, when_start_raw_nonce)
+                if table is None:
+                    self.logger.debug('No meter_entry record for PRIMARY KEY [{0},{1},{2}] to update'.format(node_uuid, when_start_raw, when_start_raw_nonce))
+                    return
+                self.mark_rollups_dirty(node_uuid, min(when_start, new_when_start or when_start), max(when_start, new_when_start or when_start))
+
+                # Build SQL update command...
+                cmd = 'UPDATE ' + table + ' SET '
+
+                if new_when_start is not None:
+                    cmd += 'when_start = {},'.format(new_when_start)
+                if new_entry_type is not None:
+                    cmd += 'entry_type = "{}",'.format(new_entry_type)
+                if new_entry_value is not None:
+                    cmd += 'entry_value = {},'.format(new_entry_value)
+                if new_duration is not None:
+                    cmd += 'duration = {},'.format(new_duration)
+                if new_meter_value is not None:
+                    cmd += 'meter_value = {},'.format(new_meter_value)
+                if new_rec_status is not None:
+                    cmd += 'rec_status = "{}",'.format(new_rec_status)
+
+                cmd = cmd[:-1] + ' '      # replace trailing comma with space
+
+                cmd += 'WHERE node_uuid = "{0}" AND when_start_raw = {1} AND when_start_raw_nonce = "{2}"'.format(
+                    node_uuid, when_start_raw, when_start_raw_nonce
+                    )
+
+                cursor = self.connection.cursor()
+                cursor.execute(cmd)
+                self.logger.debug('Updated meter_entry record for PRIMARY KEY [{0},{1},{2}]'.format(node_uuid, when_start_raw, when_start_raw_nonce))
+
+                # sharded, an entry whose start moves to another month moves to that month's shard
+                new_table = table if new_when_start is None else self.get_write_table(new_when_start)
+                if new_table != table:
+                    key_cmd = ' WHERE node_uuid = ? AND when_start_raw = ? AND when_start_raw_nonce = ?'
+                    cursor.execute('INSERT INTO {0} SELECT * FROM {1}'.format(new_table, table) + key_cmd, (node_uuid, when_start_raw, when_start_raw_nonce))
+                    cursor.execute('DELETE FROM {0}'.format(table) + key_cmd, (node_uuid, when_start_raw, when_start_raw_nonce))
+                self.commit()
+                cursor.close()
+
+            except ValueError as err:
+                self.logger.warn('Value Error: {0}'.format(err))
+
+            except sqlite3.IntegrityError as err:
+                self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
+
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
-        except sqlite3.IntegrityError as err:
-            self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+    def update_meter_entries_in_range(self, node_uuid, when_start_from, when_start_to, entry_type=None, rec_status=None, new_entry_type=None, new_duration=None, new_rec_status=None):
+        with self.write_lock:
+            try:
+                set_cmds = []
+                set_params = []
+                for column, value in [('entry_type', new_entry_type.value if new_entry_type is not None else None), ('duration', new_duration),
+                                      ('rec_status', new_rec_status.value if new_rec_status is not None else None)]:
+                    if value is not None:
+                        set_cmds.append('{0} = ?'.format(column))
+                        set_params.append(value)
+                if len(set_cmds) == 0:
+                    raise ValueError('No update columns given.')
+
+                where_cmd, where_params = get_meter_entry_where(node_uuid, entry_type.value if entry_type is not None else None,
+                                                                rec_status.value if rec_status is not None else None, when_start_from, when_start_to)
+                cmd = 'UPDATE {0} SET ' + ', '.join(set_cmds) + where_cmd
+
+                self.restore_archived_entries(node_uuid, when_start_from, when_start_to)
+                cursor = self.connection.cursor()
+                for tables in self.get_meter_entry_tables(self.connection, when_start_from, when_start_to):
+                    for table in tables:
+                        cursor.execute(cmd.format(table), set_params + where_params)
+                self.mark_rollups_dirty(node_uuid, when_start_from, when_start_to)
+                self.logger.debug('Updated meter_entries for node {} between {} and {}'.format(node_uuid, when_start_from, when_start_to))
+                self.commit()
+                cursor.close()
+
+            except ValueError as err:
+                self.logger.warn('Value Error: {0}'.format(err))
+
+            except sqlite3.IntegrityError as err:
+                self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
+
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
+
+
+    def shift_meter_values(self, node_uuid, time_from, time_to, shift):
+        # Adds shift to the meter_value of node's normal entries starting from time_from to time_to, for the CORRECTION_WINDOW_SECS from
+        # the first of them, as one transaction (see CORRECTION_WINDOW_SECS).  Archived days in the window are restored to meter_entry
+        # first.  Returns (time shifted to, number of entries shifted), or None if there are none left to shift.
+        with self.write_lock:
+            try:
+                window_from = self.get_first_when_start(self.connection, time_from, node_uuid)
+                if self.is_archived(time_from, time_to):
+                    block_rows = self.get_archive_blocks(self.connection, node_uuid, rec_status=RecStatus.NORMAL.value, time_from=time_from,
+                                                         time_to=time_to)
+                    if len(block_rows) > 0:
+                        block_from = max(time_from, block_rows[0]['day_start'])
+                        window_from = block_from if window_from is None else min(window_from, block_from)
+                if window_from is None or window_from > time_to:
+                    return None
+                window_to = min(window_from + CORRECTION_WINDOW_SECS - 1, time_to)
+
+                self.restore_archived_entries(node_uuid, window_from, window_to)
+                where_cmd, where_params = get_meter_entry_where(node_uuid, rec_status=RecStatus.NORMAL.value, time_from=window_from, time_to=window_to)
+                shifted_count = 0
+                for tables in self.get_meter_entry_tables(self.connection, window_from, window_to):
+                    for table in tables:
+                        shifted_count += self.connection.execute('UPDATE {0} SET meter_value = meter_value + ?'.format(table) + where_cmd,
+                                                                 [shift] + where_params).rowcount
+                self.mark_rollups_dirty(node_uuid, window_from, window_to)
+                self.commit()
+                self.logger.debug('Shifted meter_value of {0} meter entries of node {1} between {2} and {3} by {4}'.format(
+                    shifted_count, node_uuid, window_from, window_to, shift))
+                return window_to, shifted_count
+
+            except sqlite3.Error as err:
+                self.rollback()
+                self.logger.warn('Failed to shift meter values of node {0} from {1}.  sqlite3 Error: {2}'.format(node_uuid, time_from, err))
+                return None
 
 
     def get_node_meter_entries_count(self, node_uuid=None, entry_type=None, rec_status=None):
-        cmd = 'SELECT COUNT(*) FROM meter_entry'
-
-        if any(param is not None for param in [node_uuid, entry_type, rec_status]):
-            cmd += ' WHERE '
-        if node_uuid is not None:
-            cmd += 'node_uuid = "{}" AND '.format(node_uuid)
-        if entry_type is not None:
-            cmd += 'entry_type = "{}" AND '.format(entry_type)
-        if rec_status is not None:
-            cmd += 'rec_status = "{}" AND '.format(rec_status)
-
-        if cmd.endswith('AND '):
-            cmd = cmd[:-4] + ' '  # replace trailing "AND " with space
-        cursor = self.connection.cursor()
-        cursor.execute(cmd)
-        count = cursor.fetchall()
-        cursor.close()
-        return count[0][0]
+        where_cmd, params = get_meter_entry_where(node_uuid, entry_type, rec_status)
+        count = 0
+        with self.read_connection() as connection:
+            for tables in self.get_meter_entry_tables(connection):
+                rows = connection.execute(get_union_cmd('SELECT COUNT(*) FROM {0}' + where_cmd, tables), params * len(tables)).fetchall()
+                count += sum(row[0] for row in rows)
+            if self.is_archived():
+                if entry_type is None and rec_status is None:
+                    count += sum(block_row['entry_count'] for block_row in self.get_archive_blocks(connection, node_uuid))
+                else:
+                    count += sum(1 for entry in self.iter_archived_entries(connection, node_uuid, [entry_type] if entry_type is not None else None, rec_status))
+        return count
 
 
     def get_node_meter_entries(self, node_uuid=None, entry_type=None, rec_status=None, time_from=None, time_to=None,
                                limit_count=1000):
+        # Entries in order of start, or the latest limit_count in reverse order.  Sharded, shards are read in that order until the limit is
+        # reached.
         try:
-            # Build SQL update command...
-            cmd = 'SELECT * FROM meter_entry'
-
-            if any(param is not None for param in [node_uuid, entry_type, rec_status]):
-                cmd += ' WHERE '
-            if node_uuid is not None:
-                cmd += 'node_uuid = "{}" AND '.format(node_uuid)
-            if entry_type is not None:
-                cmd += 'entry_type = "{}" AND '.format(entry_type)
-            if rec_status is not None:
-                cmd += 'rec_status = "{}" AND '.format(rec_status)
-            if time_from is not None:
-                cmd += 'when_start >= {} AND '.format(time_from)
-            if time_to is not None:
-                cmd += 'when_start <= {} AND '.format(time_to)
-
-            if cmd.endswith('AND '):
-                cmd = cmd[:-4] + ' '  # replace trailing "AND " with space
+            where_cmd, params = get_meter_entry_where(node_uuid, entry_type, rec_status, time_from, time_to)
+            rows = []
+            with self.read_connection() as connection:
+                for tables in self.get_meter_entry_tables(connection, time_from, time_to, newest_first=limit_count is not None):
+                    cmd = get_union_cmd('SELECT * FROM {0}' + where_cmd, tables) + ' ORDER BY when_start'
+                    if limit_count is not None:
+                        cmd += ' DESC LIMIT {0}'.format(limit_count - len(rows))
+                    rows += connection.execute(cmd, params * len(tables)).fetchall()
+                    if limit_count is not None and len(rows) >= limit_count:
+                        break
+                if self.is_archived(time_from, time_to):
+                    archived_entries = self.iter_archived_entries(connection, node_uuid, [entry_type] if entry_type is not None else None, rec_status,
+                                                                  time_from, time_to, newest_first=limit_count is not None)
+                    rows = list(islice(heapq.merge(rows, archived_entries, key=itemgetter('when_start'), reverse=limit_count is not None), limit_count))
+            return rows
 
-            cmd += 'ORDER BY when_start'
+        except sqlite3.Error as err:
+            self.logger.warn('sqlite3 Error: {0}'.format(err))
 
-            if limit_count is not None:
-                cmd += ' DESC LIMIT {0}'.format(limit_count)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchall()
-            cursor.close()
-            return rows
+    def iter_node_meter_entries(self, node_uuid=None, entry_type=None, rec_status=None, time_from=None, time_to=None, limit_count=None):
+        # As get_node_meter_entries, but yields MeterEntry tuples as they are read, DB_FETCH_ROWS at a time (or a day's archive blocks at
+        # a time), so large reads are never held in memory.  Holds a read connection (and so a WAL read transaction) until the iterator is
+        # exhausted or closed.
+        try:
+            with self.read_connection() as connection:
+                entries = self.iter_table_meter_entries(connection, node_uuid, entry_type, rec_status, time_from, time_to, limit_count)
+                if self.is_archived(time_from, time_to):
+                    archived_entries = self.iter_archived_entries(connection, node_uuid, [entry_type] if entry_type is not None else None, rec_status,
+                                                                  time_from, time_to, newest_first=limit_count is not None)
+                    entries = islice(heapq.merge(entries, archived_entries, key=itemgetter(3), reverse=limit_count is not None), limit_count)
+                yield from entries
 
         except sqlite3.Error as err:
             self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
+    def iter_table_meter_entries(self, connection, node_uuid, entry_type, rec_status, time_from, time_to, limit_count):
+        # iter_node_meter_entries of meter_entry tables only, on connection
+        where_cmd, params = get_meter_entry_where(node_uuid, entry_type, rec_status, time_from, time_to)
+        row_count = 0
+        for tables in self.get_meter_entry_tables(connection, time_from, time_to, newest_first=limit_count is not None):
+            cmd = get_union_cmd('SELECT {0} FROM {{0}}'.format(', '.join(METER_ENTRY_COLUMNS)) + where_cmd, tables) + ' ORDER BY when_start'
+            if limit_count is not None:
+                cmd += ' DESC LIMIT {0}'.format(limit_count - row_count)
+            cursor = connection.cursor()
+            cursor.row_factory = None
+            cursor.execute(cmd, params * len(tables))
+            try:
+                while True:
+                    rows = cursor.fetchmany(DB_FETCH_ROWS)
+                    if len(rows) == 0:
+                        break
+                    row_count += len(rows)
+                    yield from map(MeterEntry._make, rows)
+            finally:
+                cursor.close()
+            if limit_count is not None and row_count >= limit_count:
+                break
+
+
     def get_meter_entry(self, node_uuid, is_rebase=False, is_first=True, time_from=None, time_to=None):
+        # First or last normal meter update (or rebase) for node, real or synthesised, optionally in range.  Each of the two entry types is
+        # found by an index seek on idx_meter_entry_node_status_type_start, then the earlier/later of the two is returned.  Sharded, shards
+        # are searched from the first/last until one has an entry.
         try:
-            # Build SQL update command...
-            min_max = 'min' if is_first else 'max'
+            min_max = 'ASC' if is_first else 'DESC'
             entry_types = [EntryType.METER_REBASE, EntryType.METER_REBASE_SYNTH] if is_rebase \
                             else [EntryType.METER_UPDATE, EntryType.METER_UPDATE_SYNTH]
-            cmd = 'SELECT * FROM meter_entry ' \
-                  'WHERE when_start = ' \
-                  '(SELECT {}(when_start) FROM meter_entry ' \
-                  'WHERE node_uuid="{}" AND entry_type IN ("{}","{}") AND ' \
-                    'rec_status="{}" AND'.format(min_max, node_uuid, entry_types[0].value, entry_types[1].value, RecStatus.NORMAL.value)
-
+            type_cmd = 'SELECT * FROM (SELECT * FROM {0} WHERE node_uuid = ? AND rec_status = ? AND entry_type = ?'
+            time_params = []
             if time_from is not None:
-                cmd += ' when_start >= {} AND'.format(time_from)
+                type_cmd += ' AND when_start >= ?'
+                time_params.append(time_from)
             if time_to is not None:
-                cmd += ' when_start <= {} AND'.format(time_to)
-            if cmd.endswith(' AND'):
-                cmd = cmd[:-4]  # replace trailing " AND"
-
-            min_max = 'ASC' if is_first else 'DESC'
-            cmd += ') AND entry_type IN ("{}","{}") ORDER BY when_start {} LIMIT 1'.format(entry_types[0].value, entry_types[1].value, min_max)
-
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchone()
-            cursor.close()
-            return rows
+                type_cmd += ' AND when_start <= ?'
+                time_params.append(time_to)
+            type_cmd += ' ORDER BY when_start {0} LIMIT 1)'.format(min_max)
+
+            with self.read_connection() as connection:
+                row = None
+                for tables in self.get_meter_entry_tables(connection, time_from, time_to, newest_first=not is_first):
+                    cmd = get_union_cmd(type_cmd, [table for table in tables for entry_type in entry_types]) + \
+                          ' ORDER BY when_start {0} LIMIT 1'.format(min_max)
+                    params = []
+                    for table in tables:
+                        for entry_type in entry_types:
+                            params += [node_uuid, RecStatus.NORMAL.value, entry_type.value] + time_params
+                    rows = connection.execute(cmd, params).fetchall()
+                    if len(rows) > 0:
+                        row = rows[0]
+                        break
+
+                # archived days may hold an earlier/later entry, found in the first/last block with one of the entry types
+                if self.is_archived(time_from, time_to):
+                    archived_entry = next(self.iter_archived_entries(connection, node_uuid, [entry_type.value for entry_type in entry_types],
+                                                                     RecStatus.NORMAL.value, time_from, time_to, newest_first=not is_first), None)
+                    if archived_entry is not None and (row is None or (archived_entry.when_start < row['when_start'] if is_first else
+                                                                       archived_entry.when_start > row['when_start'])):
+                        row = archived_entry
+            return row
 
         except sqlite3.Error as err:
             self.logger.warn('sqlite3 Error: {0}'.format(err))
@@ -388,64 +1103,582 @@ class DBManager:
 
 
     def purge_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce):
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute('DELETE FROM meter_entry WHERE node_uuid = "{0}" AND when_start_raw = {1} AND when_start_raw_nonce = "{2}"'.format(
-                node_uuid, when_start_raw, when_start_raw_nonce
-            ))
-            cursor.close()
-
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+        with self.write_lock:
+            try:
+                table, when_start = self.find_meter_entry(node_uuid, when_start_raw, when_start_raw_nonce)
+                if table is None:
+                    return
+                self.mark_rollups_dirty(node_uuid, when_start, when_start)
+                cursor = self.connection.cursor()
+                cursor.execute('DELETE FROM {0} WHERE node_uuid = ? AND when_start_raw = ? AND when_start_raw_nonce = ?'.format(table),
+                               (node_uuid, when_start_raw, when_start_raw_nonce))
+                self.commit()
+                cursor.close()
+
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def purge_meter_entries_in_range(self, node_uuid, time_from, time_to, entry_type=None):
-        try:
-            cmd = 'DELETE FROM meter_entry ' \
-                  'WHERE node_uuid = {} AND when_start >= {} AND when_start <= {}'
+        with self.write_lock:
+            try:
+                cmd = 'DELETE FROM {0} WHERE node_uuid = ? AND when_start >= ? AND when_start <= ?'
+                params = [node_uuid, time_from, time_to]
 
-            if entry_type is not None:
-                cmd += ' AND entry_type == {}'.format(entry_type.value)
+                if entry_type is not None:
+                    cmd += ' AND entry_type = ?'
+                    params.append(entry_type.value)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            cursor.close()
-            self.logger.info('Deleted meter entries for node {} from {} to {} with type {}'.format(node_uuid, time_from, time_to, entry_type))
+                self.restore_archived_entries(node_uuid, time_from, time_to)
+                cursor = self.connection.cursor()
+                for tables in self.get_meter_entry_tables(self.connection, time_from, time_to):
+                    for table in tables:
+                        cursor.execute(cmd.format(table), params)
+                self.mark_rollups_dirty(node_uuid, time_from, time_to)
+                self.commit()
+                cursor.close()
+                self.logger.info('Deleted meter entries for node {} from {} to {} with type {}'.format(node_uuid, time_from, time_to, entry_type))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def delete_all_meter_entries(self, node_uuid):
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                for tables in self.get_meter_entry_tables(self.connection):
+                    for table in tables:
+                        cursor.execute('DELETE FROM {0} WHERE node_uuid = ?'.format(table), (node_uuid,))
+                if self.is_archived():
+                    cursor.execute('DELETE FROM meter_archive_block WHERE node_uuid = ?', (node_uuid,))
+                cursor.execute('DELETE FROM meter_rollup WHERE node_uuid = ?', (node_uuid,))
+                self.rollup_state.pop(node_uuid, None)
+                self.rollup_dirty.pop(node_uuid, None)
+                self.commit()
+                cursor.close()
+                self.logger.info('Deleted all meter entries for node {0}'.format(node_uuid))
+
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
+
+
+    def get_rollup_buckets(self, when_start):
+        # (bucket type, bucket start) of each rollup bucket holding entries starting at when_start
+        buckets = [(RollupBucket.HOUR.value, when_start - (when_start % ROLLUP_HOUR_SECS)),
+                   (RollupBucket.DAY.value, when_start - (when_start % ROLLUP_DAY_SECS))]
+        if self.rollup_tz is not None:
+            buckets.append((RollupBucket.LOCAL_DAY.value, self.get_local_day_range(when_start)[0]))
+        return buckets
+
+
+    def get_local_day_range(self, timestamp):
+        # (start, end) of day in rollup_tz holding timestamp, the last found being kept as entries mostly fall in the same day
+        day_start, day_end = self.local_day_range
+        if not day_start <= timestamp < day_end:
+            local_day = arrow.get(timestamp).to(self.rollup_tz).floor('day')
+            self.local_day_range = (local_day.timestamp, local_day.shift(days=1).timestamp)
+        return self.local_day_range
+
+
+    def get_rollup_bucket_range(self, bucket_type, timestamp):
+        # (start, end) of bucket_type bucket holding timestamp
+        if bucket_type == RollupBucket.LOCAL_DAY.value:
+            return self.get_local_day_range(timestamp)
+        bucket_secs = ROLLUP_HOUR_SECS if bucket_type == RollupBucket.HOUR.value else ROLLUP_DAY_SECS
+        return timestamp - (timestamp % bucket_secs), timestamp - (timestamp % bucket_secs) + bucket_secs
+
+
+    def get_rollup_neighbour(self, node_uuid, when_start=None, is_after=False):
+        # (when_start, meter_value) of node's last normal entry starting before when_start (or at all, if None), or first after, on the writer
+        cmd = 'SELECT when_start, meter_value, entry_type FROM {0} WHERE node_uuid = ? AND rec_status = ?'
+        params = [node_uuid, RecStatus.NORMAL.value]
+        if when_start is not None:
+            cmd += ' AND when_start > ?' if is_after else ' AND when_start < ?'
+            params.append(when_start)
+        order = 'ASC' if is_after else 'DESC'
+
+        neighbours = []
+        for tables in self.get_meter_entry_tables(self.connection, when_start if is_after else None, None if is_after else when_start,
+                                                  newest_first=not is_after):
+            rows = self.connection.execute(get_union_cmd(cmd, tables) + ' ORDER BY when_start {0}, entry_type {0} LIMIT 1'.format(order),
+                                           params * len(tables)).fetchall()
+            if len(rows) > 0:
+                neighbours.append((rows[0][0], rows[0]['entry_type'], rows[0][1]))
+                break
+
+        if when_start is None:
+            archive_from, archive_to = None, None
+        else:
+            archive_from, archive_to = (when_start + 1, None) if is_after else (None, when_start - 1)
+        archived_entry = next(self.iter_archived_entries(self.connection, node_uuid, rec_status=RecStatus.NORMAL.value, time_from=archive_from,
+                                                         time_to=archive_to, newest_first=not is_after), None)
+        if archived_entry is not None:
+            neighbours.append((archived_entry.when_start, archived_entry.entry_type, archived_entry.meter_value))
+        if len(neighbours) == 0:
+            return None
+        neighbour = min(neighbours) if is_after else max(neighbours)
+        return neighbour[0], neighbour[2]
+
+
+    def get_rollup_state(self, node_uuid):
+        state = self.rollup_state.get(node_uuid)
+        if state is None:
+            state = self.rollup_state[node_uuid] = self.get_rollup_neighbour(node_uuid) or (None, None)
+        return state
+
+
+    def split_rollup_appends(self, meter_entries):
+        # Splits meter entries (as for write_meter_entries) into (normal entries starting after the latest rolled up entry of their node,
+        # in order of node and start; all others).  Same-start rebases are taken to precede updates, as in entry_type order.
+        append_entries = []
+        other_entries = []
+        last_when_starts = {}
+        for entry in sorted(meter_entries, key=lambda entry: (entry[0], entry[3], entry[4])):
+            if entry[8] == RecStatus.NORMAL.value:
+                last_when_start = last_when_starts.get(entry[0])
+                if last_when_start is None:
+                    last_when_start = self.get_rollup_state(entry[0])[0]
+                if last_when_start is None or entry[3] > last_when_start:
+                    append_entries.append(entry)
+                    last_when_starts[entry[0]] = entry[3]
+                    continue
+            other_entries.append(entry)
+        return append_entries, other_entries
+
+
+    def add_rollup_entry(self, buckets, when_start, entry_type, entry_value, meter_value, last_meter_value):
+        # adds entry to buckets, a dict of [consumption, sample_count, min_entry_value, max_entry_value] by (bucket type, bucket start),
+        # given meter value of the entry before it.  Returns meter value for the next entry to rise from.
+        if entry_type in REBASE_ENTRY_TYPES:
+            return meter_value
+        consumption = (meter_value - last_meter_value) if last_meter_value is not None else 0
+        for bucket in self.get_rollup_buckets(when_start):
+            bucket_values = buckets.get(bucket)
+            if bucket_values is None:
+                buckets[bucket] = [consumption, 1, entry_value, entry_value]
+            else:
+                bucket_values[0] += consumption
+                bucket_values[1] += 1
+                bucket_values[2] = min(bucket_values[2], entry_value)
+                bucket_values[3] = max(bucket_values[3], entry_value)
+        return meter_value
+
+
+    def write_rollup_appends(self, append_entries):
+        # Adds entries from split_rollup_appends to their buckets, on the writer (call under write_lock).  Existing buckets are updated, then
+        # new ones inserted (rather than with an UPSERT, which needs SQLite 3.24).
+        node_buckets = {}
+        for node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status in append_entries:
+            buckets = node_buckets.setdefault(node_uuid, {})
+            meter_value = self.add_rollup_entry(buckets, when_start, entry_type, entry_value, meter_value, self.get_rollup_state(node_uuid)[1])
+            self.rollup_state[node_uuid] = (when_start, meter_value)
+
+        for node_uuid, buckets in node_buckets.items():
+            self.connection.executemany('UPDATE meter_rollup SET consumption = consumption + ?, sample_count = sample_count + ?, '
+                                        'min_entry_value = MIN(min_entry_value, ?), max_entry_value = MAX(max_entry_value, ?) '
+                                        'WHERE node_uuid = ? AND bucket_type = ? AND bucket_start = ?',
+                                        [tuple(bucket_values) + (node_uuid,) + bucket for bucket, bucket_values in buckets.items()])
+            self.connection.executemany('INSERT OR IGNORE INTO meter_rollup (node_uuid, bucket_type, bucket_start, consumption, sample_count, '
+                                        'min_entry_value, max_entry_value) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        [(node_uuid,) + bucket + tuple(bucket_values) for bucket, bucket_values in buckets.items()])
+
+
+    def mark_rollups_dirty(self, node_uuid, time_from, time_to):
+        # notes node's entries from time_from to time_to (either None for unbounded) as changed, for refresh_rollups at commit
+        if not self.rollups:
+            return
+        dirty_range = self.rollup_dirty.get(node_uuid)
+        if dirty_range is None:
+            self.rollup_dirty[node_uuid] = [time_from, time_to]
+        else:
+            dirty_range[0] = None if dirty_range[0] is None or time_from is None else min(dirty_range[0], time_from)
+            dirty_range[1] = None if dirty_range[1] is None or time_to is None else max(dirty_range[1], time_to)
+
+
+    def refresh_rollups(self):
+        # rebuilds rollups of ranges noted by mark_rollups_dirty, before commit
+        if len(self.rollup_dirty) == 0:
+            return
+        rollup_dirty = self.rollup_dirty
+        self.rollup_dirty = {}
+        for node_uuid, (time_from, time_to) in rollup_dirty.items():
+            try:
+                self.rebuild_node_rollups(node_uuid, time_from, time_to)
+            except sqlite3.Error as err:
+                self.logger.warn('Failed to refresh rollups of node {0} from {1} to {2}.  sqlite3 Error: {3}'.format(node_uuid, time_from, time_to, err))
+
+
+    def rebuild_node_rollups(self, node_uuid, time_from=None, time_to=None):
+        # Rebuilds node's rollup buckets overlapping time_from to time_to (either None for unbounded) from its entries, on the writer (call
+        # under write_lock).  Includes the bucket of the first entry after time_to, whose consumption rises from the entries before it.
+        if time_to is not None:
+            next_entry = self.get_rollup_neighbour(node_uuid, time_to, is_after=True)
+            if next_entry is not None:
+                time_to = next_entry[0]
+
+        bucket_ranges = {}
+        for bucket_type, bucket_start in self.get_rollup_buckets(time_from if time_from is not None else 0):
+            bucket_ranges[bucket_type] = (self.get_rollup_bucket_range(bucket_type, time_from)[0] if time_from is not None else None,
+                                          self.get_rollup_bucket_range(bucket_type, time_to)[1] if time_to is not None else None)
+
+        # read whole buckets of every type, from the meter value of the entry before
+        read_from = min(bucket_range[0] for bucket_range in bucket_ranges.values()) if time_from is not None else None
+        read_to = max(bucket_range[1] for bucket_range in bucket_ranges.values()) - 1 if time_to is not None else None
+        last_meter_value = None
+        if read_from is not None:
+            last_meter_value = (self.get_rollup_neighbour(node_uuid, read_from) or (None, None))[1]
+
+        buckets = {}
+        where_cmd, params = get_meter_entry_where(node_uuid, rec_status=RecStatus.NORMAL.value, time_from=read_from, time_to=read_to)
+        cmd = 'SELECT when_start, entry_type, entry_value, meter_value FROM {0}' + where_cmd
+        rows = chain.from_iterable(self.connection.execute(get_union_cmd(cmd, tables) + ' ORDER BY when_start, entry_type', params * len(tables))
+                                   for tables in self.get_meter_entry_tables(self.connection, read_from, read_to))
+        if self.is_archived(read_from, read_to):
+            rows = heapq.merge(rows, ((entry.when_start, entry.entry_type, entry.entry_value, entry.meter_value) for entry in self.iter_archived_entries(
+                self.connection, node_uuid, rec_status=RecStatus.NORMAL.value, time_from=read_from, time_to=read_to)), key=itemgetter(0, 1))
+        for when_start, entry_type, entry_value, meter_value in rows:
+            last_meter_value = self.add_rollup_entry(buckets, when_start, entry_type, entry_value, meter_value, last_meter_value)
+
+        bucket_rows = []
+        for bucket_type, (bucket_from, bucket_to) in bucket_ranges.items():
+            cmd = 'DELETE FROM meter_rollup WHERE node_uuid = ? AND bucket_type = ?'
+            params = [node_uuid, bucket_type]
+            if bucket_from is not None:
+                cmd += ' AND bucket_start >= ?'
+                params.append(bucket_from)
+            if bucket_to is not None:
+                cmd += ' AND bucket_start < ?'
+                params.append(bucket_to)
+            self.connection.execute(cmd, params)
+            bucket_rows += [(node_uuid, bucket_type, bucket_start) + tuple(bucket_values)
+                            for (row_bucket_type, bucket_start), bucket_values in sorted(buckets.items()) if row_bucket_type == bucket_type and
+                            (bucket_from is None or bucket_start >= bucket_from) and (bucket_to is None or bucket_start < bucket_to)]
+        self.connection.executemany('INSERT INTO meter_rollup (node_uuid, bucket_type, bucket_start, consumption, sample_count, min_entry_value, '
+                                    'max_entry_value) VALUES (?, ?, ?, ?, ?, ?, ?)', bucket_rows)
+        self.rollup_state.pop(node_uuid, None)
+
+
+    def rebuild_rollups(self, node_uuid=None):
+        # Rebuilds all rollups of node (or of all nodes) from their entries, e.g. for entries written before rollups, or after changing
+        # rollup_tz.  Commits per node.  Returns number of nodes rebuilt.
+        with self.write_lock:
+            if node_uuid is not None:
+                node_uuids = {node_uuid}
+            else:
+                node_uuids = set()
+                for tables in self.get_meter_entry_tables(self.connection):
+                    node_uuids.update(row[0] for row in self.connection.execute(
+                        ' UNION '.join('SELECT DISTINCT node_uuid FROM {0}'.format(table) for table in tables)).fetchall())
+                if self.is_archived():
+                    node_uuids.update(row[0] for row in self.connection.execute('SELECT DISTINCT node_uuid FROM meter_archive_block').fetchall())
+                self.connection.execute('DELETE FROM meter_rollup')
+
+            for rebuild_node_uuid in sorted(node_uuids):
+                self.rebuild_node_rollups(rebuild_node_uuid)
+                self.commit()
+                self.logger.info('Rebuilt rollups of node {0}'.format(rebuild_node_uuid))
+            return len(node_uuids)
+
+
+    def get_meter_rollups(self, node_uuid, bucket_type=RollupBucket.DAY, time_from=None, time_to=None):
+        # node's rollup buckets of bucket_type starting from time_from to time_to, in order of start
         try:
-            cursor = self.connection.cursor()
-            cursor.execute('DELETE FROM meter_entry WHERE node_uuid = "{0}"'.format(node_uuid))
-            cursor.close()
-            self.logger.info('Deleted all meter entries for node {0}'.format(node_uuid))
+            cmd = 'SELECT * FROM meter_rollup WHERE node_uuid = ? AND bucket_type = ?'
+            params = [node_uuid, bucket_type.value]
+            if time_from is not None:
+                cmd += ' AND bucket_start >= ?'
+                params.append(time_from)
+            if time_to is not None:
+                cmd += ' AND bucket_start <= ?'
+                params.append(time_to)
+            cmd += ' ORDER BY bucket_start'
+
+            with self.read_connection() as connection:
+                rows = connection.execute(cmd, params).fetchall()
+            return rows
 
         except sqlite3.Error as err:
             self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
-    def write_gateway_snapshot(self, gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram,
-                               gateway_time, log_level, tx_power, rec_status):
-        try:
-            cursor = self.connection.cursor()
-            cmd = 'INSERT INTO gateway_snapshot (gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram, \
-                        gateway_time, log_level, tx_power, rec_status)' \
-                  ' VALUES ("{0}", {1}, "{2}", {3}, {4}, {5}, {6}, "{7}", {8}, "{9}")' \
-                .format(gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram,
-                        gateway_time, log_level, tx_power, rec_status)
-            cursor.execute(cmd)
-            self.logger.debug('Inserted gateway_snapshot record for PRIMARY KEY [{0},{1}]'.format(gateway_uuid, when_received))
-            self.connection.commit()
-            cursor.close()
+    def get_first_when_start(self, connection, time_from=None, node_uuid=None):
+        # start of first meter entry (of node, if given) starting from time_from (None for any), or None if no entries
+        where_cmd, params = get_meter_entry_where(node_uuid, time_from=time_from)
+        for tables in self.get_meter_entry_tables(connection, time_from):
+            cmd = get_union_cmd('SELECT MIN(when_start) FROM {0}' + where_cmd, tables)
+            when_starts = [row[0] for row in connection.execute(cmd, params * len(tables)).fetchall() if row[0] is not None]
+            if len(when_starts) > 0:
+                return min(when_starts)
+        return None
+
+
+    def get_window_node_uuids(self, window_from, window_to):
+        # nodes with meter entries starting from window_from to before window_to, on the writer (call under write_lock)
+        node_uuids = set()
+        for tables in self.get_meter_entry_tables(self.connection, window_from, window_to - 1):
+            node_uuids.update(row[0] for row in self.connection.execute(' UNION '.join(
+                'SELECT DISTINCT node_uuid FROM {0} WHERE when_start >= ? AND when_start < ?'.format(table) for table in tables),
+                [window_from, window_to] * len(tables)).fetchall())
+        return node_uuids
+
+
+    def downsample_meter_entries(self, bucket_secs, time_before):
+        # Downsamples (see DOWNSAMPLE_*) meter entries starting before time_before to buckets of bucket_secs, for the next window of
+        # DOWNSAMPLE_WINDOW_SECS after that downsampled by the last call (kept in sys_param), committing per node so ingest waits for one
+        # node's window at most.  Returns (time downsampled to, number of entries removed), or None if done to time_before.  Entries
+        # written since into windows already done are left as they are.
+        param_name = DOWNSAMPLE_PARAM_FORMAT.format(bucket_secs)
+        time_before -= time_before % bucket_secs
+        with self.write_lock:
+            rows = self.connection.execute('SELECT value FROM sys_param WHERE name = ?', (param_name,)).fetchall()
+            window_from = self.get_first_when_start(self.connection, int(rows[0][0]) if len(rows) > 0 else None)
+            if window_from is None or window_from >= time_before:
+                return None
+            window_from -= window_from % DOWNSAMPLE_WINDOW_SECS
+            window_to = min(window_from + DOWNSAMPLE_WINDOW_SECS, time_before)
+            node_uuids = self.get_window_node_uuids(window_from, window_to)
+
+        removed_count = 0
+        for node_uuid in sorted(node_uuids):
+            with self.write_lock:
+                try:
+                    removed_count += self.downsample_node_meter_entries(node_uuid, bucket_secs, window_from, window_to)
+                    self.commit()
+                except sqlite3.Error as err:
+                    self.rollback()
+                    self.logger.warn('Failed to downsample meter entries of node {0} from {1} to {2}.  sqlite3 Error: {3}'.format(
+                        node_uuid, window_from, window_to, err))
+
+        with self.write_lock:
+            self.connection.execute('INSERT OR REPLACE INTO sys_param (name, value) VALUES (?, ?)', (param_name, window_to))
+            self.commit()
+        self.logger.debug('Downsampled meter entries from {0} to {1} to {2}s, removing {3}'.format(window_from, window_to, bucket_secs, removed_count))
+        return window_to, removed_count
+
+
+    def downsample_node_meter_entries(self, node_uuid, bucket_secs, time_from, time_to):
+        # Downsamples node's entries starting from time_from to before time_to (bucket aligned) on the writer (call under write_lock),
+        # without committing, and marks their rollups to refresh at commit.  Returns number of entries removed.  The node's first normal
+        # entry is kept as it is, as it has no entry before it to rise from, so a run merged into it would lose the rises within it.
+        removed_count = 0
+        has_prior = self.get_rollup_neighbour(node_uuid, time_from) is not None
+        for tables in self.get_meter_entry_tables(self.connection, time_from, time_to - 1):
+            for table in tables:
+                runs = []
+                last_run_key = None
+                for row in self.connection.execute('SELECT when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value '
+                                                   'FROM {0} WHERE node_uuid = ? AND rec_status = ? AND when_start >= ? AND when_start < ? '
+                                                   'ORDER BY when_start, entry_type'.format(table),
+                                                   (node_uuid, RecStatus.NORMAL.value, time_from, time_to)):
+                    run_key = (row['when_start'] - (row['when_start'] % bucket_secs), row['entry_type'])
+                    if not has_prior:
+                        has_prior = True
+                        continue
+                    if row['entry_type'] in REBASE_ENTRY_TYPES:
+                        last_run_key = None
+                        continue
+                    if run_key != last_run_key:
+                        runs.append([])
+                        last_run_key = run_key
+                    runs[-1].append(row)
+
+                key_cmd = ' WHERE node_uuid = ? AND when_start_raw = ? AND when_start_raw_nonce = ?'
+                runs = [run for run in runs if len(run) > 1]
+                self.connection.executemany('UPDATE {0} SET entry_value = ?, duration = ?, meter_value = ?'.format(table) + key_cmd,
+                                            [(sum(row['entry_value'] for row in run), sum(row['duration'] for row in run), run[-1]['meter_value'],
+                                              node_uuid, run[0]['when_start_raw'], run[0]['when_start_raw_nonce']) for run in runs])
+                delete_keys = [(node_uuid, row['when_start_raw'], row['when_start_raw_nonce']) for run in runs for row in run[1:]]
+                self.connection.executemany('DELETE FROM {0}'.format(table) + key_cmd, delete_keys)
+                removed_count += len(delete_keys)
+        self.rollup_state.pop(node_uuid, None)
+        if removed_count > 0:
+            self.mark_rollups_dirty(node_uuid, time_from, time_to - 1)
+        return removed_count
+
+
+    def load_archive_range(self):
+        with self.write_lock:
+            try:
+                row = self.connection.execute('SELECT MIN(day_start), MAX(day_start) FROM meter_archive_block').fetchone()
+                self.archive_range = (row[0], row[1] + ARCHIVE_DAY_SECS) if row[0] is not None else None
+            except sqlite3.Error:
+                self.archive_range = None       # not migrated (see meter_db_admin migrate --dry_run)
+
+
+    def is_archived(self, time_from=None, time_to=None):
+        # whether archived days may hold entries starting from time_from to time_to (either None for unbounded)
+        archive_range = self.archive_range
+        return archive_range is not None and (time_from is None or time_from < archive_range[1]) and (time_to is None or time_to >= archive_range[0])
+
+
+    def get_archive_blocks(self, connection, node_uuid=None, entry_types=None, rec_status=None, time_from=None, time_to=None, newest_first=False):
+        # meter_archive_block rows of node (or all nodes) for days overlapping time_from to time_to that may hold entries of entry_types
+        # (None for any) and rec_status, in order of day
+        conditions = []
+        params = []
+        if node_uuid is not None:
+            conditions.append('node_uuid = ?')
+            params.append(node_uuid)
+        if time_from is not None:
+            conditions.append('day_start > ?')
+            params.append(time_from - ARCHIVE_DAY_SECS)
+        if time_to is not None:
+            conditions.append('day_start <= ?')
+            params.append(time_to)
+        if entry_types is not None:
+            conditions.append('entry_type_mask & ? != 0')
+            params.append(get_archive_mask(entry_types, ARCHIVE_ENTRY_TYPE_BITS))
+        if rec_status is not None:
+            conditions.append('rec_status_mask & ? != 0')
+            params.append(get_archive_mask([rec_status], ARCHIVE_REC_STATUS_BITS))
+        cmd = 'SELECT * FROM meter_archive_block' + ((' WHERE ' + ' AND '.join(conditions)) if len(conditions) > 0 else '')
+        return connection.execute(cmd + ' ORDER BY day_start {0}, node_uuid'.format('DESC' if newest_first else 'ASC'), params).fetchall()
+
+
+    def read_archive_block(self, block_row):
+        # entries (as tuples in METER_ENTRY_COLUMNS order) of a meter_archive_block row's block
+        return meter_archive.decode_block(self.archive.read_block(block_row['archive_month'], block_row['block_offset'], block_row['block_length']),
+                                          block_row['entry_count'], block_row['node_uuid'], block_row['day_start'])
+
+
+    def iter_archived_entries(self, connection, node_uuid=None, entry_types=None, rec_status=None, time_from=None, time_to=None, newest_first=False):
+        # Yields archived entries (as MeterEntryRow) of node (or all nodes), of entry_types (None for any) and rec_status, starting from
+        # time_from to time_to, in order of start and type, or reverse order if newest_first.  Decodes a day's blocks at a time, so a
+        # caller taking the first few entries reads only the first day.
+        if self.archive is None or not self.is_archived(time_from, time_to):
+            return
+
+        day_blocks = []
+        for block_row in self.get_archive_blocks(connection, node_uuid, entry_types, rec_status, time_from, time_to, newest_first) + [None]:
+            if len(day_blocks) > 0 and (block_row is None or block_row['day_start'] != day_blocks[0]['day_start']):
+                entries = [entry for day_block in day_blocks for entry in self.read_archive_block(day_block)
+                           if (entry_types is None or entry[5] in entry_types) and (rec_status is None or entry[8] == rec_status) and
+                           (time_from is None or entry[3] >= time_from) and (time_to is None or entry[3] <= time_to)]
+                entries.sort(key=itemgetter(3, 5), reverse=newest_first)
+                yield from map(MeterEntryRow._make, entries)
+                day_blocks = []
+            day_blocks.append(block_row)
+
+
+    def archive_meter_entries(self, time_before):
+        # Archives meter entries starting before time_before (day aligned), for the first day with entries in meter_entry, committing per
+        # node so ingest waits for one node's day at most.  Returns (time archived to, number of entries archived), or None if there are
+        # none left to archive (or archiving a node failed, to be retried by a later call).
+        if self.archive is None:
+            self.logger.warn('DB is in memory, so has no archive')
+            return None
+
+        time_before -= time_before % ARCHIVE_DAY_SECS
+        with self.write_lock:
+            day_start = self.get_first_when_start(self.connection)
+            if day_start is None or day_start >= time_before:
+                return None
+            day_start -= day_start % ARCHIVE_DAY_SECS
+            node_uuids = self.get_window_node_uuids(day_start, day_start + ARCHIVE_DAY_SECS)
+
+        archived_count = 0
+        for node_uuid in sorted(node_uuids):
+            with self.write_lock:
+                try:
+                    archived_count += self.archive_node_meter_entries(node_uuid, day_start)
+                    self.commit()
+                    self.archive_range = (min(self.archive_range[0], day_start), max(self.archive_range[1], day_start + ARCHIVE_DAY_SECS)) \
+                        if self.archive_range is not None else (day_start, day_start + ARCHIVE_DAY_SECS)
+                except (sqlite3.Error, OSError) as err:
+                    self.rollback()
+                    self.logger.warn('Failed to archive meter entries of node {0} for day from {1}.  Error: {2}'.format(node_uuid, day_start, err))
+                    return None
+
+        self.logger.debug('Archived {0} meter entries for day from {1}'.format(archived_count, day_start))
+        return day_start + ARCHIVE_DAY_SECS, archived_count
+
+
+    def archive_node_meter_entries(self, node_uuid, day_start):
+        # Moves node's entries in meter_entry for the day from day_start to its archive block, merged with any already archived, on the
+        # writer (call under write_lock) without committing.  Returns number of entries moved.
+        day_end = day_start + ARCHIVE_DAY_SECS
+        entry_cmd = 'SELECT {0} FROM {{0}} WHERE node_uuid = ? AND when_start >= ? AND when_start < ?'.format(', '.join(METER_ENTRY_COLUMNS))
+        tables = sum(self.get_meter_entry_tables(self.connection, day_start, day_end - 1), [])
+        entries = []
+        for table in tables:
+            entries += [tuple(row) for row in self.connection.execute(entry_cmd.format(table), (node_uuid, day_start, day_end)).fetchall()]
+        if len(entries) == 0:
+            return 0
+        moved_count = len(entries)
+
+        block_rows = self.connection.execute('SELECT * FROM meter_archive_block WHERE node_uuid = ? AND day_start = ?', (node_uuid, day_start)).fetchall()
+        if len(block_rows) > 0:
+            # an entry received again after its day was archived is in both, once
+            entry_keys = set(entry[:3] for entry in entries)
+            entries += [entry for entry in self.read_archive_block(block_rows[0]) if entry[:3] not in entry_keys]
+        entries.sort(key=itemgetter(3, 5))
+
+        archive_month = get_shard_month(day_start)
+        block = meter_archive.encode_block(entries, day_start)
+        block_offset = self.archive.append_block(archive_month, block)
+        self.connection.execute('INSERT OR REPLACE INTO meter_archive_block (node_uuid, day_start, archive_month, block_offset, block_length, '
+                                'entry_count, entry_type_mask, rec_status_mask) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (node_uuid, day_start, archive_month, block_offset, len(block), len(entries),
+                                 get_archive_mask(set(entry[5] for entry in entries), ARCHIVE_ENTRY_TYPE_BITS),
+                                 get_archive_mask(set(entry[8] for entry in entries), ARCHIVE_REC_STATUS_BITS)))
+        for table in tables:
+            self.connection.execute('DELETE FROM {0} WHERE node_uuid = ? AND when_start >= ? AND when_start < ?'.format(table), (node_uuid, day_start, day_end))
+        return moved_count
+
+
+    def restore_archived_entries(self, node_uuid=None, time_from=None, time_to=None):
+        # Moves archived days of node (or all nodes) overlapping time_from to time_to (either None for unbounded) back to meter_entry, e.g.
+        # to change them, on the writer (call under write_lock) without committing.  Returns number of entries restored.
+        if self.archive is None or not self.is_archived(time_from, time_to):
+            return 0
+
+        restored_count = 0
+        cursor = self.connection.cursor()
+        for block_row in self.get_archive_blocks(self.connection, node_uuid, time_from=time_from, time_to=time_to):
+            entries = self.read_archive_block(block_row)
+            self.get_write_table(block_row['day_start'])     # attached first, as attaching commits
+            cursor.execute('DELETE FROM meter_archive_block WHERE node_uuid = ? AND day_start = ?', (block_row['node_uuid'], block_row['day_start']))
+            restored_count += self.insert_meter_entries(cursor, [get_write_entry(entry) for entry in entries])[1]
+        cursor.close()
+        if restored_count > 0:
+            self.logger.debug('Restored {0} archived meter entries of node {1} from {2} to {3}'.format(restored_count, node_uuid, time_from, time_to))
+        return restored_count
 
-        except sqlite3.IntegrityError:
-            self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0},{1}]'.format(gateway_uuid, when_received))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+    def restore_archived_entry(self, node_uuid, when_start_raw, when_start_raw_nonce):
+        # Moves the archived day holding node's entry with primary key (if any) back to meter_entry, as restore_archived_entries.  Tries
+        # the day of when_start_raw first, as entries start then unless moved.  Returns whether found.
+        if self.archive is None or not self.is_archived():
+            return False
+        raw_day_start = when_start_raw - (when_start_raw % ARCHIVE_DAY_SECS)
+        for block_row in sorted(self.get_archive_blocks(self.connection, node_uuid), key=lambda block_row: block_row['day_start'] != raw_day_start):
+            if any(entry[1] == when_start_raw and entry[2] == when_start_raw_nonce for entry in self.read_archive_block(block_row)):
+                self.restore_archived_entries(node_uuid, block_row['day_start'], block_row['day_start'] + ARCHIVE_DAY_SECS - 1)
+                return True
+        return False
+
+
+    def write_gateway_snapshot(self, gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram,
+                               gateway_time, log_level, tx_power, rec_status):
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                cmd = 'INSERT INTO gateway_snapshot (gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram, \
+                            gateway_time, log_level, tx_power, rec_status)' \
+                      ' VALUES ("{0}", {1}, "{2}", {3}, {4}, {5}, {6}, "{7}", {8}, "{9}")' \
+                    .format(gateway_uuid, when_received, network_id, gateway_id, when_booted, free_ram,
+                            gateway_time, log_level, tx_power, rec_status)
+                cursor.execute(cmd)
+                self.logger.debug('Inserted gateway_snapshot record for PRIMARY KEY [{0},{1}]'.format(gateway_uuid, when_received))
+                self.commit()
+                cursor.close()
+
+            except sqlite3.IntegrityError:
+                self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0},{1}]'.format(gateway_uuid, when_received))
+
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def get_gateway_snapshots(self, gateway_uuid=None, time_from=None, time_to=None, rec_status=None, limit_count=1):
@@ -478,10 +1711,8 @@ class DBManager:
             if limit_count is not None:
                 cmd += ' ORDER BY when_received DESC LIMIT {0}'.format(limit_count)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchall()
-            cursor.close()
+            with self.read_connection() as connection:
+                rows = connection.execute(cmd).fetchall()
             return rows
 
         except sqlite3.Error as err:
@@ -490,78 +1721,152 @@ class DBManager:
 
     def write_node_snapshot(self, node_uuid, when_received, network_id, node_id, gateway_id, batt_voltage_mv, up_time, sleep_time, free_ram, when_last_seen, last_clock_drift,
                             meter_interval, meter_impulses_per_kwh, last_meter_entry_finish, last_meter_value, last_rms_current, puck_led_rate, puck_led_time, last_rssi_at_gateway, rec_status):
-        try:
-            cursor = self.connection.cursor()
-            cmd = 'INSERT INTO node_snapshot (node_uuid, when_received, network_id, node_id, gateway_id, batt_voltage_mv, up_time, sleep_time, free_ram, when_last_seen, ' \
-                                                'last_clock_drift, meter_interval, meter_impulses_per_kwh, last_meter_entry_finish, last_meter_value, last_rms_current, puck_led_rate,  puck_led_time, ' \
-                                                'last_rssi_at_gateway, rec_status) ' \
-                                                'VALUES ("{0}", {1}, "{2}", {3}, {4}, {5}, {6}, {7}, {8}, {9}, {10}, {11}, {12}, {13}, {14}, {15}, {16}, {17}, {18}, "{19}")'.format(
-                                                        node_uuid, when_received, network_id, node_id, gateway_id, batt_voltage_mv, up_time, sleep_time, free_ram,
-                                                        when_last_seen, last_clock_drift, meter_interval, meter_impulses_per_kwh, last_meter_entry_finish, last_meter_value, last_rms_current, puck_led_rate,
-                                                        puck_led_time, last_rssi_at_gateway, rec_status)
-            cursor.execute(cmd)
-            self.logger.debug('Inserted node_snapshot record for PRIMARY KEY [{0},{1}]'.format(node_uuid, when_received))
-            self.connection.commit()
-            cursor.close()
+        # as a keyframe or delta row (see NODE_SNAPSHOT_*)
+        values = (network_id, node_id, gateway_id, batt_voltage_mv, up_time, sleep_time, free_ram, when_last_seen, last_clock_drift, meter_interval,
+                  meter_impulses_per_kwh, last_meter_entry_finish, last_meter_value, last_rms_current, puck_led_rate, puck_led_time, last_rssi_at_gateway, rec_status)
+        with self.write_lock:
+            try:
+                state = self.get_node_snapshot_state(node_uuid)
+                is_out_of_order = state is not None and when_received < state[0]
+                is_keyframe = (state is None or is_out_of_order or state[2] >= NODE_SNAPSHOT_KEYFRAME_ROWS
+                               or None in values or None in state[1])
+                next_snapshot = self.get_next_node_snapshot(node_uuid, when_received) if is_out_of_order else None
+
+                self.connection.execute('INSERT INTO node_snapshot ({0}, is_keyframe) VALUES ({1})'.format(
+                    ', '.join(NODE_SNAPSHOT_COLUMNS), ', '.join(['?'] * (len(NODE_SNAPSHOT_COLUMNS) + 1))),
+                    (node_uuid, when_received) + (values if is_keyframe else get_node_snapshot_delta(values, state[1])) + (int(is_keyframe),))
+                if next_snapshot is not None:
+                    # the snapshot after it was a delta from the one before it, so now holds all its fields
+                    self.connection.execute('UPDATE node_snapshot SET {0}, is_keyframe = 1 WHERE node_uuid = ? AND when_received = ?'.format(
+                        ', '.join('{0} = ?'.format(column) for column in NODE_SNAPSHOT_COLUMNS[2:])), next_snapshot[2:] + next_snapshot[:2])
+                elif not is_out_of_order:
+                    self.node_snapshot_state[node_uuid] = (when_received, values, 1 if is_keyframe else state[2] + 1)
+                self.logger.debug('Inserted node_snapshot record for PRIMARY KEY [{0},{1}]'.format(node_uuid, when_received))
+                self.commit()
+
+            except sqlite3.IntegrityError:
+                self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0},{1}]'.format(node_uuid, when_received))
+
+            except sqlite3.Error as err:
+                self.node_snapshot_state.pop(node_uuid, None)
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
+
+
+    def get_node_snapshot_state(self, node_uuid):
+        # (when received, values, snapshots since keyframe) of node's latest snapshot, or None if it has none, on the writer (call under
+        # write_lock)
+        state = self.node_snapshot_state.get(node_uuid)
+        if state is None:
+            snapshots = self.read_node_snapshot_run(self.connection, node_uuid)[1]
+            if len(snapshots) > 0:
+                state = self.node_snapshot_state[node_uuid] = (snapshots[-1].when_received, tuple(snapshots[-1][2:]), len(snapshots))
+        return state
+
+
+    def get_next_node_snapshot(self, node_uuid, when_received):
+        # node's first snapshot received after when_received, or None, on the writer (call under write_lock)
+        rows = self.connection.execute('SELECT MIN(when_received) FROM node_snapshot WHERE node_uuid = ? AND when_received > ?',
+                                       (node_uuid, when_received)).fetchall()
+        if rows[0][0] is None:
+            return None
+        return self.read_node_snapshot_run(self.connection, node_uuid, rows[0][0])[1][-1]
+
+
+    def read_node_snapshot_run(self, connection, node_uuid, run_to=None):
+        # (keyframe when received, snapshots) of node's snapshots from the last keyframe received at or before run_to (None for the latest)
+        # to run_to, reconstructed (as NodeSnapshotRow), in order.  (None, []) if there are none.
+        time_cmd = ' AND when_received <= ?' if run_to is not None else ''
+        time_params = (run_to,) if run_to is not None else ()
+        keyframe_from = connection.execute('SELECT MAX(when_received) FROM node_snapshot WHERE node_uuid = ? AND is_keyframe = 1' + time_cmd,
+                                           (node_uuid,) + time_params).fetchone()[0]
+        if keyframe_from is None:
+            return None, []
+
+        cursor = connection.cursor()
+        cursor.row_factory = None
+        cursor.execute('SELECT {0}, is_keyframe FROM node_snapshot WHERE node_uuid = ? AND when_received >= ?'.format(', '.join(NODE_SNAPSHOT_COLUMNS)) +
+                       time_cmd + ' ORDER BY when_received', (node_uuid, keyframe_from) + time_params)
+        snapshots = []
+        values = None
+        for row in cursor:
+            values = row[2:-1] if row[-1] else apply_node_snapshot_delta(row[2:-1], values)
+            snapshots.append(NodeSnapshotRow(row[0], row[1], *values))
+        cursor.close()
+        return keyframe_from, snapshots
 
-        except sqlite3.IntegrityError:
-            self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0},{1}]'.format(node_uuid, when_received))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+    def get_snapshot_node_uuids(self, connection):
+        # nodes with snapshots, an index seek each
+        node_uuids = []
+        node_uuid = connection.execute('SELECT MIN(node_uuid) FROM node_snapshot').fetchone()[0]
+        while node_uuid is not None:
+            node_uuids.append(node_uuid)
+            node_uuid = connection.execute('SELECT MIN(node_uuid) FROM node_snapshot WHERE node_uuid > ?', (node_uuid,)).fetchone()[0]
+        return node_uuids
 
 
     def get_node_snapshots(self, node_uuid=None, network_id=None, time_from=None, time_to=None, rec_status=None, limit_count=1):
+        # Snapshots of node (or all nodes) received from time_from to time_to, as NodeSnapshotRow: the latest limit_count newest first, or
+        # all in order of node and time.  Each node's are reconstructed (see NODE_SNAPSHOT_*) a keyframe's run at a time, from the latest,
+        # until there are limit_count or the runs reach time_from.  Snapshots not yet moved by the schema version 4 backfill are read from
+        # node_snapshot_full as they are.
+        def is_match(snapshot):
+            return (time_from is None or snapshot.when_received >= time_from) and (network_id is None or snapshot.network_id == network_id) and \
+                   (rec_status is None or snapshot.rec_status == rec_status)
 
         try:
-            # Build SQL update command...
-            cmd = 'SELECT * FROM node_snapshot'
-
-            if any(param is not None for param in [node_uuid, network_id, rec_status]):
-                cmd += ' WHERE '
-            if node_uuid is not None:
-                cmd += 'node_uuid = "{}" AND '.format(node_uuid)
-            if time_from is not None:
-                cmd += 'when_received >= {} AND '.format(time_from)
-            if time_to is not None:
-                cmd += 'when_received <= {} AND '.format(time_to)
-            if network_id is not None:
-                cmd += 'network_id = {} AND '.format(network_id)
-            if rec_status is not None:
-                cmd += 'rec_status = "{}" AND '.format(rec_status)
-
-            if cmd.endswith('AND '):
-                cmd = cmd[:-4] + ' '  # replace trailing "AND " with space
+            snapshots = []
+            with self.read_connection() as connection:
+                for snapshot_node_uuid in [node_uuid] if node_uuid is not None else self.get_snapshot_node_uuids(connection):
+                    node_snapshots = []
+                    run_to = time_to
+                    while limit_count is None or len(node_snapshots) < limit_count:
+                        keyframe_from, run_snapshots = self.read_node_snapshot_run(connection, snapshot_node_uuid, run_to)
+                        node_snapshots = [snapshot for snapshot in run_snapshots if is_match(snapshot)] + node_snapshots
+                        if keyframe_from is None or (time_from is not None and keyframe_from <= time_from):
+                            break
+                        run_to = keyframe_from - 1
+                    snapshots += node_snapshots[-limit_count:] if limit_count is not None else node_snapshots
+
+                if len(connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'node_snapshot_full'").fetchall()) > 0:
+                    conditions = []
+                    params = []
+                    for column, operator, value in [('node_uuid', '=', node_uuid), ('network_id', '=', network_id), ('rec_status', '=', rec_status),
+                                                    ('when_received', '>=', time_from), ('when_received', '<=', time_to)]:
+                        if value is not None:
+                            conditions.append('{0} {1} ?'.format(column, operator))
+                            params.append(value)
+                    cmd = 'SELECT {0} FROM node_snapshot_full'.format(', '.join(NODE_SNAPSHOT_COLUMNS)) + \
+                          ((' WHERE ' + ' AND '.join(conditions)) if len(conditions) > 0 else '')
+                    if limit_count is not None:
+                        cmd += ' ORDER BY when_received DESC LIMIT {0}'.format(limit_count)
+                    snapshots += [NodeSnapshotRow(*row) for row in connection.execute(cmd, params).fetchall()]
 
             if limit_count is not None:
-                cmd += ' ORDER BY when_received DESC LIMIT {0}'.format(limit_count)
-
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchall()
-            cursor.close()
-            return rows
+                return sorted(snapshots, key=itemgetter(1), reverse=True)[:limit_count]
+            return sorted(snapshots, key=itemgetter(0, 1))
 
         except sqlite3.Error as err:
             self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def write_node_event(self, node_uuid, timestamp, event_type, details):
-        try:
-            cursor = self.connection.cursor()
-            cmd = 'INSERT INTO node_event (node_uuid, timestamp, event_type, details)' \
-                  ' VALUES ("{0}", {1}, "{2}", "{3}")' \
-                .format(node_uuid, timestamp, event_type, details)
-            cursor.execute(cmd)
-            self.logger.debug('Inserted node_event record with node={0}, event type={1}'.format(node_uuid, event_type))
-            self.connection.commit()
-            cursor.close()
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                cmd = 'INSERT INTO node_event (node_uuid, timestamp, event_type, details)' \
+                      ' VALUES ("{0}", {1}, "{2}", "{3}")' \
+                    .format(node_uuid, timestamp, event_type, details)
+                cursor.execute(cmd)
+                self.logger.debug('Inserted node_event record with node={0}, event type={1}'.format(node_uuid, event_type))
+                self.commit()
+                cursor.close()
 
-        except sqlite3.IntegrityError:
-            self.logger.warn('ERROR: ID already exists in PRIMARY KEY ')
+            except sqlite3.IntegrityError:
+                self.logger.warn('ERROR: ID already exists in PRIMARY KEY ')
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def get_node_events(self, node_uuid=None, time_from=None, time_to=None, event_type=None, limit_count=1):
@@ -586,10 +1891,8 @@ class DBManager:
             if limit_count is not None:
                 cmd += ' ORDER BY timestamp DESC LIMIT {0}'.format(limit_count)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchall()
-            cursor.close()
+            with self.read_connection() as connection:
+                rows = connection.execute(cmd).fetchall()
             return rows
 
         except sqlite3.Error as err:
@@ -597,21 +1900,22 @@ class DBManager:
 
 
     def write_sys_param(self, name, value):
-        try:
-            cursor = self.connection.cursor()
-            cmd = 'INSERT INTO sys_param (name, value)' \
-                  ' VALUES ("{0}", {1})' \
-                .format(name, value)
-            cursor.execute(cmd)
-            self.logger.debug('Inserted sys_param record with name={0}, value={1}'.format(name, value))
-            self.connection.commit()
-            cursor.close()
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                cmd = 'INSERT INTO sys_param (name, value)' \
+                      ' VALUES ("{0}", {1})' \
+                    .format(name, value)
+                cursor.execute(cmd)
+                self.logger.debug('Inserted sys_param record with name={0}, value={1}'.format(name, value))
+                self.commit()
+                cursor.close()
 
-        except sqlite3.IntegrityError:
-            self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0}]'.format(name))
+            except sqlite3.IntegrityError:
+                self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0}]'.format(name))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def get_sys_param(self, name):
@@ -623,10 +1927,8 @@ class DBManager:
         try:
             # Build SQL update command...
             cmd = 'SELECT * FROM sys_param WHERE name = "{}"'.format(name)
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchall()
-            cursor.close()
+            with self.read_connection() as connection:
+                rows = connection.execute(cmd).fetchall()
             return rows
 
         except sqlite3.Error as err:
@@ -634,46 +1936,48 @@ class DBManager:
 
 
     def update_sys_param(self, name, value):
-        try:
+        with self.write_lock:
+            try:
 
-            if name is None or value is None:
-                raise ValueError('Invalid sys_param update.  Got of name={0), value={1}.'.format(name, value))
+                if name is None or value is None:
+                    raise ValueError('Invalid sys_param update.  Got of name={0), value={1}.'.format(name, value))
 
-            # Build SQL update command...
-            cmd = 'UPDATE sys_param SET value = {0} WHERE name = "{1}"'.format(value, name)
+                # Build SQL update command...
+                cmd = 'UPDATE sys_param SET value = {0} WHERE name = "{1}"'.format(value, name)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            self.logger.debug('Updated sys_param record for PRIMARY KEY [{0}]'.format(name))
-            self.connection.commit()
-            cursor.close()
+                cursor = self.connection.cursor()
+                cursor.execute(cmd)
+                self.logger.debug('Updated sys_param record for PRIMARY KEY [{0}]'.format(name))
+                self.commit()
+                cursor.close()
 
-        except ValueError as err:
-            self.logger.warn('Value Error: {0}'.format(err))
+            except ValueError as err:
+                self.logger.warn('Value Error: {0}'.format(err))
 
-        except sqlite3.IntegrityError as err:
-            self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
+            except sqlite3.IntegrityError as err:
+                self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def write_user(self, username, password, permissions):
-        try:
-            cursor = self.connection.cursor()
-            cmd = 'INSERT INTO user (username, password, permissions)' \
-                  ' VALUES ("{0}", {1}, {2})' \
-                .format(username, password, permissions)
-            cursor.execute(cmd)
-            self.logger.debug('Inserted user record with username={0}'.format(username))
-            self.connection.commit()
-            cursor.close()
+        with self.write_lock:
+            try:
+                cursor = self.connection.cursor()
+                cmd = 'INSERT INTO user (username, password, permissions)' \
+                      ' VALUES ("{0}", {1}, {2})' \
+                    .format(username, password, permissions)
+                cursor.execute(cmd)
+                self.logger.debug('Inserted user record with username={0}'.format(username))
+                self.commit()
+                cursor.close()
 
-        except sqlite3.IntegrityError:
-            self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0}]'.format(username))
+            except sqlite3.IntegrityError:
+                self.logger.warn('ERROR: ID already exists in PRIMARY KEY [{0}]'.format(username))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
 
 
     def get_user(self, username):
@@ -685,10 +1989,8 @@ class DBManager:
         try:
             # Build SQL update command...
             cmd = 'SELECT * FROM user WHERE username = "{}"'.format(username)
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            rows = cursor.fetchall()
-            cursor.close()
+            with self.read_connection() as connection:
+                rows = connection.execute(cmd).fetchall()
             return rows
 
         except sqlite3.Error as err:
@@ -696,36 +1998,37 @@ class DBManager:
 
 
     def update_user(self, username, password, permissions):
-        try:
+        with self.write_lock:
+            try:
 
-            if username is None or (password is None and permissions is None):
-                raise ValueError('Invalid user update for username={0)'.format(username))
+                if username is None or (password is None and permissions is None):
+                    raise ValueError('Invalid user update for username={0)'.format(username))
 
-            # Build SQL update command...
-            cmd = 'UPDATE user SET '
+                # Build SQL update command...
+                cmd = 'UPDATE user SET '
 
-            if password is not None:
-                cmd += 'password = {0}'.format(password) + ' AND '
+                if password is not None:
+                    cmd += 'password = {0}'.format(password) + ' AND '
 
-            if permissions is not None:
-                cmd += 'permissions = {0}'.format(permissions) + ' AND '
+                if permissions is not None:
+                    cmd += 'permissions = {0}'.format(permissions) + ' AND '
 
-            if cmd.endswith('AND '):
-                cmd = cmd[:-4] + ' '  # replace trailing "AND " with space
+                if cmd.endswith('AND '):
+                    cmd = cmd[:-4] + ' '  # replace trailing "AND " with space
 
-            cmd += 'WHERE username = "{0}"'.format(username)
+                cmd += 'WHERE username = "{0}"'.format(username)
 
-            cursor = self.connection.cursor()
-            cursor.execute(cmd)
-            self.logger.debug('Updated user record for PRIMARY KEY [{0}]'.format(username))
-            self.connection.commit()
-            cursor.close()
+                cursor = self.connection.cursor()
+                cursor.execute(cmd)
+                self.logger.debug('Updated user record for PRIMARY KEY [{0}]'.format(username))
+                self.commit()
+                cursor.close()
 
-        except ValueError as err:
-            self.logger.warn('Value Error: {0}'.format(err))
+            except ValueError as err:
+                self.logger.warn('Value Error: {0}'.format(err))
 
-        except sqlite3.IntegrityError as err:
-            self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
+            except sqlite3.IntegrityError as err:
+                self.logger.warn('sqlite3 IntegrityError: {0}'.format(err))
 
-        except sqlite3.Error as err:
-            self.logger.warn('sqlite3 Error: {0}'.format(err))
+            except sqlite3.Error as err:
+                self.logger.warn('sqlite3 Error: {0}'.format(err))
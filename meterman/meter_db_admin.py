@@ -0,0 +1,96 @@
+'''
+
+================================================================================================================================================================
+Meter DB Admin
+=====================
+
+Command line script for database maintenance that is too slow or too disruptive to run as part of meterman's own startup.  Run it while
+meterman is stopped, with the --shard_by_month and --local_tz settings of meterman's [Database] config.
+
+Commands:
+
+    rebuild_rollups     Rebuilds hourly and daily consumption rollups (see meter_db) from meter entries, for one node or all.  Needed once for
+                        entries written before rollups existed, or after changing the rollup time zone.
+    migrate             Applies pending schema migrations (see meter_db_migrations), then runs their backfills to completion.  With
+                        --dry_run, opens the DB read-only and only reports files and rows each would change.  meterman applies migrations
+                        itself on startup and runs backfills in the background, so this is for doing it in advance, or seeing what an
+                        upgrade will do.
+    vacuum              Full VACUUM and ANALYZE of the DB and its meter entry shards, releasing all free space.  Also switches files
+                        created before incremental auto vacuum to it, so that background maintenance can release free space from them.
+                        Rewrites every file, so needs free space for a copy of the largest.
+
+Run with --help for more info, e.g.:
+
+    python -m meterman.meter_db_admin rebuild_rollups --db_file ~/meterman/meterman_data.db --shard_by_month --local_tz Australia/Sydney
+
+================================================================================================================================================================
+
+'''
+
+import argparse
+from time import monotonic
+
+from meterman import app_base as base
+from meterman import meter_db as db
+from meterman import meter_db_migrations as db_migrations
+
+
+def rebuild_rollups(db_mgr, args):
+    time_start = monotonic()
+    node_count = db_mgr.rebuild_rollups(args.node)
+    print('rebuild_rollups: nodes={0}, secs={1:.2f}'.format(node_count, monotonic() - time_start))
+
+
+def migrate(db_mgr, args):
+    time_start = monotonic()
+    if not args.dry_run:
+        # pending migrations were applied by DBManager on opening
+        row_count = 0
+        while True:
+            chunk_rows = db_migrations.run_backfill_chunk(db_mgr, args.chunk_rows)
+            if chunk_rows is None:
+                break
+            row_count += chunk_rows
+        print('migrate: version={0}, backfilled rows={1}, secs={2:.2f}'.format(db_migrations.get_schema_version(db_mgr), row_count,
+                                                                               monotonic() - time_start))
+        return
+
+    report = db_migrations.get_migration_report(db_mgr, args.chunk_rows)
+    print('migrate: dry run, version={0}, {1} pending'.format(db_migrations.get_schema_version(db_mgr), len(report)))
+    for version, description, file_count, backfill_rows, backfill_chunks in report:
+        print('  {0}: {1} - files={2}, backfill rows={3}, chunks={4}'.format(version, description, file_count, backfill_rows, backfill_chunks))
+
+
+def vacuum(db_mgr, args):
+    time_start = monotonic()
+    db_mgr.do_vacuum()
+    print('vacuum: secs={0:.2f}'.format(monotonic() - time_start))
+
+
+commands = {'rebuild_rollups': rebuild_rollups, 'migrate': migrate, 'vacuum': vacuum}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs database maintenance commands on a meterman database.")
+    parser.add_argument("command", help="Command to run, one of: " + ', '.join(commands.keys()), choices=list(commands.keys()))
+    parser.add_argument("--db_file", help="Database file.  Defaults to " + base.db_file, type=str, default=base.db_file)
+    parser.add_argument("--log_file", help="Log file.  Defaults to " + base.log_file, type=str, default=base.log_file)
+    parser.add_argument("--log_level", help="Log level.  Defaults to INFO.", type=str, default='INFO')
+    parser.add_argument("--shard_by_month", help="Meter entries are in monthly shards, as for shard_by_month config.", action='store_true')
+    parser.add_argument("--local_tz", help="Time zone of local day rollups, as for rollup_local_tz config.  Defaults to none.", type=str,
+                        default=None)
+    parser.add_argument("--node", help="Node UUID to run command for.  Defaults to all nodes.", type=str, default=None)
+    parser.add_argument("--dry_run", help="Report what migrate would do, without changing the DB.", action='store_true')
+    parser.add_argument("--chunk_rows", help="Rows per migration backfill transaction.  Defaults to " + str(db_migrations.BACKFILL_CHUNK_ROWS),
+                        type=int, default=db_migrations.BACKFILL_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    base.log_level = args.log_level.upper()
+    db_mgr = db.DBManager(db_file=args.db_file, log_file=args.log_file, shard_by_month=args.shard_by_month, rollup_tz=args.local_tz,
+                          read_only=args.dry_run)
+    commands[args.command](db_mgr, args)
+    db_mgr.conn_close()
+
+
+if __name__ == '__main__':
+    main()
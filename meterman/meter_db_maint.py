@@ -0,0 +1,198 @@
+'''
+
+================================================================================================================================================================
+meter_db_maint.py
+=====================
+
+Background DB maintenance: a DBMaintainer thread runs maintenance tasks every interval_mins, in steps small enough that ingest (which
+shares the DB writer) waits for one step at most.
+
+Tasks, in order:
+
+    - Backfills of schema migrations (see meter_db_migrations), a chunk of BACKFILL_CHUNK_ROWS rows per step.
+    - Downsampling of aged meter entries (see meter_db DOWNSAMPLE_*): entries older than raw_days days are downsampled to 5 minute
+      buckets, and those older than 5min_months months before the current one to hourly buckets.  Each step is one node's entries for a
+      day, and the thread pauses between steps.
+    - Archiving of meter entries starting in months before the archive_months before the current one (see meter_db ARCHIVE_*), a day at
+      a time, likewise.
+    - Export of finalized months of meter entries to the analytical store (see meter_analytics), if given, a month at a time, likewise.
+    - Once the DB is idle (no commits for idle_secs): incremental vacuum of free pages (see meter_db DB_AUTO_VACUUM), VACUUM_SLICE_PAGES
+      at a time while it stays idle, then PRAGMA optimize to refresh query planner statistics.  If the DB is not idle within the interval,
+      they wait for the next.
+
+Run by MeterDataManager when the [Database] config section is present, every 'maint_interval_mins' (0 disables), with downsampling
+selected by 'downsample_raw_days' (0 disables) and 'downsample_5min_months' (0 keeps 5 minute buckets), archiving by
+'archive_months' (0 disables), and analytics export by 'analytics_export'.
+
+================================================================================================================================================================
+
+'''
+
+import threading
+from time import monotonic, time
+
+from meterman import app_base as base
+from meterman import meter_db as db
+from meterman import meter_db_migrations as db_migrations
+
+DEF_INTERVAL_MINS = 60
+DEF_IDLE_SECS = 5               # since the last commit, for the DB to be idle
+STEP_PAUSE_SECS = 0.05          # between steps, for ingest to take the writer
+VACUUM_SLICE_PAGES = 256        # free pages released per step (1MB of 4KB pages)
+
+
+class DBMaintainer:
+
+    def __init__(self, db_mgr, raw_days=0, fine_months=0, interval_mins=DEF_INTERVAL_MINS, idle_secs=DEF_IDLE_SECS, archive_months=0,
+                 analytics=None, log_file=base.log_file):
+        self.logger = base.get_logger(logger_name='db_maint', log_file=log_file)
+        self.db_mgr = db_mgr
+        self.raw_days = raw_days
+        self.fine_months = fine_months
+        self.archive_months = archive_months
+        self.analytics = analytics
+        self.interval_secs = interval_mins * 60
+        self.idle_secs = idle_secs
+        self.stop_event = threading.Event()
+
+        self.run_thread = threading.Thread(target=self.run, name='db_maint')
+        self.run_thread.daemon = True
+        self.run_thread.start()
+        self.logger.info('Started DB maintenance with raw_days={0}, 5min_months={1}, archive_months={2}, analytics={3}, interval_mins={4}'.format(
+            raw_days, fine_months, archive_months, analytics is not None, interval_mins))
+
+
+    def close(self):
+        # stops after the current step
+        self.stop_event.set()
+        self.run_thread.join()
+
+
+    def run(self):
+        while not self.stop_event.is_set():
+            run_deadline = monotonic() + self.interval_secs
+            try:
+                self.run_backfills()
+                self.run_downsampling()
+                self.run_archiving()
+                self.run_analytics_export()
+                self.run_idle_maintenance(run_deadline)
+            except Exception as err:
+                self.logger.error('Failed to run DB maintenance: {0}'.format(err))
+            self.stop_event.wait(max(0.0, run_deadline - monotonic()))
+
+
+    def run_backfills(self):
+        # runs pending migration backfills a chunk at a time.  Returns number of rows done.
+        row_count = 0
+        time_start = monotonic()
+        while not self.stop_event.is_set():
+            chunk_rows = db_migrations.run_backfill_chunk(self.db_mgr)
+            if chunk_rows is None:
+                break
+            row_count += chunk_rows
+            self.stop_event.wait(STEP_PAUSE_SECS)
+        if row_count > 0:
+            self.logger.info('Backfilled {0} rows for migrations in {1:.1f}s'.format(row_count, monotonic() - time_start))
+        return row_count
+
+
+    def get_downsample_tiers(self, now=None):
+        # (bucket seconds, time before which entries are downsampled to them) of each tier, finest first
+        if self.raw_days <= 0:
+            return []
+        now = time() if now is None else now
+        raw_before = int(now) - (self.raw_days * 86400)
+        tiers = [(db.DOWNSAMPLE_5MIN_SECS, raw_before)]
+        if self.fine_months > 0:
+            fine_before = db.get_shard_month_start(db.add_shard_months(db.get_shard_month(now), -self.fine_months))
+            tiers.append((db.DOWNSAMPLE_HOUR_SECS, min(fine_before, raw_before)))
+        return tiers
+
+
+    def run_downsampling(self, now=None):
+        # downsamples each tier up to its age, a step at a time.  Returns number of entries removed.
+        removed_count = 0
+        for bucket_secs, time_before in self.get_downsample_tiers(now):
+            time_start = monotonic()
+            tier_removed_count = 0
+            while not self.stop_event.is_set():
+                step = self.db_mgr.downsample_meter_entries(bucket_secs, time_before)
+                if step is None:
+                    break
+                tier_removed_count += step[1]
+                self.stop_event.wait(STEP_PAUSE_SECS)
+            if tier_removed_count > 0:
+                self.logger.info('Downsampled meter entries before {0} to {1}s buckets, removing {2} in {3:.1f}s'.format(
+                    time_before, bucket_secs, tier_removed_count, monotonic() - time_start))
+            removed_count += tier_removed_count
+        return removed_count
+
+
+    def run_archiving(self, now=None):
+        # archives entries before archive_months before the current month, a step at a time.  Returns number of entries archived.
+        if self.archive_months <= 0:
+            return 0
+        now = time() if now is None else now
+        time_before = db.get_shard_month_start(db.add_shard_months(db.get_shard_month(now), -self.archive_months))
+        archived_count = 0
+        time_start = monotonic()
+        while not self.stop_event.is_set():
+            step = self.db_mgr.archive_meter_entries(time_before)
+            if step is None:
+                break
+            archived_count += step[1]
+            self.stop_event.wait(STEP_PAUSE_SECS)
+        if archived_count > 0:
+            self.logger.info('Archived {0} meter entries before {1} in {2:.1f}s'.format(archived_count, time_before, monotonic() - time_start))
+        return archived_count
+
+
+    def run_analytics_export(self, now=None):
+        # exports finalized months not exported or stale to the analytical store, a month at a time.  Returns number of entries exported.
+        if self.analytics is None:
+            return 0
+        exported_count = 0
+        exported_months = set()     # each once per run, should one change while exported
+        time_start = monotonic()
+        while not self.stop_event.is_set():
+            step = self.analytics.export_next(now, exported_months)
+            if step is None:
+                break
+            exported_months.add(step[0])
+            exported_count += step[1]
+            self.stop_event.wait(STEP_PAUSE_SECS)
+        if exported_count > 0:
+            self.logger.info('Exported {0} meter entries to the analytical store in {1:.1f}s'.format(exported_count, monotonic() - time_start))
+        return exported_count
+
+
+    def wait_for_idle(self, deadline):
+        # waits until the DB has been idle for idle_secs, returns False if not by deadline (or stopping)
+        while not self.stop_event.is_set():
+            idle_secs = self.db_mgr.get_idle_secs()
+            if idle_secs >= self.idle_secs:
+                return True
+            wait_secs = self.idle_secs - idle_secs
+            if monotonic() + wait_secs > deadline:
+                return False
+            self.stop_event.wait(wait_secs)
+        return False
+
+
+    def run_idle_maintenance(self, deadline):
+        # incremental vacuum a slice at a time then PRAGMA optimize, each once the DB is idle.  Returns number of pages released.
+        released_pages = 0
+        time_start = monotonic()
+        while self.wait_for_idle(deadline):
+            slice_pages = self.db_mgr.incremental_vacuum(VACUUM_SLICE_PAGES)
+            if slice_pages == 0:
+                break
+            released_pages += slice_pages
+            self.stop_event.wait(STEP_PAUSE_SECS)
+        if released_pages > 0:
+            self.logger.info('Released {0} free DB pages in {1:.1f}s'.format(released_pages, monotonic() - time_start))
+
+        if self.wait_for_idle(deadline):
+            self.db_mgr.optimize()
+        return released_pages
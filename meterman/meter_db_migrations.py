@@ -0,0 +1,357 @@
+'''
+
+================================================================================================================================================================
+meter_db_migrations.py
+=====================
+
+Versioned schema migrations for meterman DB files, tracked by each file's PRAGMA user_version.
+
+DBManager creates the base schema (version SCHEMA_BASE_VERSION) with CREATE ... IF NOT EXISTS, then calls migrate() to apply each
+migration in MIGRATIONS above the file's version, in order.  Files from before versioning (version 0) have the base schema.  Meter entry shards have their own version and are migrated as
+they are found or created.  A migration has:
+
+    - migrate_main(): schema changes to the main file, e.g. ALTER TABLE, CREATE INDEX.  Run with the version update as one transaction,
+      on DBManager init, so they should be quick (SQLite's ADD COLUMN is, whatever the table size).
+    - migrate_shard(): schema changes to each meter entry shard, likewise.  Unsharded, meter_entry is in the main file, so a migration of
+      it changes main.meter_entry in migrate_main too.
+    - A backfill (optional): data changes too slow for one transaction on a large DB, run online a chunk at a time after the schema
+      changes, by meter_db_maint (in the background, while ingest runs) or meter_db_admin migrate.  Progress is kept in sys_param, so a
+      backfill resumes after a restart.  Setting backfill_meter_set gives a backfill of all meter entries, in order of start; otherwise
+      override backfill_chunk() and estimate_backfill().  Code writing new rows must set what the backfill sets, as it only covers rows
+      written before it passes them.
+
+Migrations are plain SQL rather than using meter_db constants, so they keep doing what they did when written.  get_migration_report()
+(meter_db_admin migrate --dry_run) reports files and rows each pending migration and backfill would change.
+
+To add a migration, subclass Migration with the next version and append an instance to MIGRATIONS.  Never change or remove one that has
+been released.
+
+================================================================================================================================================================
+
+'''
+
+import sqlite3
+
+SCHEMA_BASE_VERSION = 1
+BACKFILL_CHUNK_ROWS = 5000
+BACKFILL_PARAM_FORMAT = 'migration_{0}_backfill'    # sys_param holding backfill progress of migration version {0}
+BACKFILL_DONE = 'done'
+
+
+class Migration:
+    version = None
+    description = ''
+    backfill_meter_set = None       # SET clause of a backfill of all meter entries, e.g. 'new_col = entry_value * 2'
+
+    def migrate_main(self, db_mgr, cursor):
+        pass
+
+
+    def migrate_shard(self, db_mgr, cursor, schema):
+        pass
+
+
+    def has_backfill(self):
+        return self.backfill_meter_set is not None
+
+
+    def backfill_chunk(self, db_mgr, chunk_rows):
+        # backfills up to about chunk_rows rows after those done so far, committed as one transaction.  Returns rows done, 0 when finished.
+        return backfill_meter_entries(db_mgr, self, self.backfill_meter_set, chunk_rows)
+
+
+    def estimate_backfill(self, db_mgr):
+        # rows left to backfill
+        return count_meter_entries_after(db_mgr, get_backfill_progress(db_mgr, self))
+
+
+class AddMeterArchive(Migration):
+    version = 2
+    description = 'Add meter_archive_block, the index of archived meter entry blocks'
+
+    def migrate_main(self, db_mgr, cursor):
+        cursor.execute('CREATE TABLE IF NOT EXISTS main.meter_archive_block ('
+                       'node_uuid data_type TEXT NOT NULL, '
+                       'day_start data_type INTEGER NOT NULL, '
+                       'archive_month data_type INTEGER NOT NULL, '
+                       'block_offset data_type INTEGER NOT NULL, '
+                       'block_length data_type INTEGER NOT NULL, '
+                       'entry_count data_type INTEGER NOT NULL, '
+                       'entry_type_mask data_type INTEGER NOT NULL, '
+                       'rec_status_mask data_type INTEGER NOT NULL, '
+                       'PRIMARY KEY (node_uuid, day_start)) WITHOUT ROWID')
+        cursor.execute('CREATE INDEX IF NOT EXISTS main.idx_meter_archive_block_day_start ON meter_archive_block (day_start)')
+
+
+class DeriveEntryNonces(Migration):
+    version = 3
+    description = 'Derive meter entry nonces from entry type and sequence, so entries received again are skipped'
+
+    def has_backfill(self):
+        return True
+
+
+    def backfill_chunk(self, db_mgr, chunk_rows):
+        # Gives entries with random nonces (two letters, from before this migration) the nonce '<entry type>.<sequence>', with the lowest
+        # sequence not taken by another entry of the node with the same start, so entries written more than once stay distinct.
+        # Archived entries keep their nonces.
+        with db_mgr.write_lock:
+            chunk = get_backfill_chunk(db_mgr, self, chunk_rows)
+            if chunk is None:
+                return 0
+            table, time_from, time_to = chunk
+            connection = db_mgr.connection
+            rows = connection.execute('SELECT node_uuid, when_start_raw, when_start_raw_nonce, entry_type FROM {0} WHERE when_start >= ? AND '
+                                      'when_start <= ? ORDER BY node_uuid, when_start_raw, entry_type, when_start_raw_nonce'.format(table),
+                                      (time_from, time_to)).fetchall()
+            key_nonces = {}
+            for node_uuid, when_start_raw, nonce, entry_type in rows:
+                if '.' in nonce:
+                    continue
+                taken_nonces = key_nonces.get((node_uuid, when_start_raw))
+                if taken_nonces is None:
+                    taken_nonces = key_nonces[(node_uuid, when_start_raw)] = set(
+                        row[0] for row in connection.execute('SELECT when_start_raw_nonce FROM {0} WHERE node_uuid = ? AND when_start_raw = ?'.format(table),
+                                                             (node_uuid, when_start_raw)))
+                seq = 0
+                while '{0}.{1}'.format(entry_type, seq) in taken_nonces:
+                    seq += 1
+                new_nonce = '{0}.{1}'.format(entry_type, seq)
+                taken_nonces.add(new_nonce)
+                connection.execute('UPDATE {0} SET when_start_raw_nonce = ? WHERE node_uuid = ? AND when_start_raw = ? AND when_start_raw_nonce = ?'.format(table),
+                                   (new_nonce, node_uuid, when_start_raw, nonce))
+            set_backfill_progress(db_mgr, self, time_to)
+            db_mgr.commit()
+            return len(rows)
+
+
+class DeltaNodeSnapshots(Migration):
+    version = 4
+    description = 'Store node snapshots as keyframes and delta rows of changed fields'
+    keyframe_rows = 96
+    absolute_columns = ('network_id', 'last_rms_current', 'rec_status')
+    columns = ('node_uuid', 'when_received', 'network_id', 'node_id', 'gateway_id', 'batt_voltage_mv', 'up_time', 'sleep_time', 'free_ram',
+               'when_last_seen', 'last_clock_drift', 'meter_interval', 'meter_impulses_per_kwh', 'last_meter_entry_finish', 'last_meter_value',
+               'last_rms_current', 'puck_led_rate', 'puck_led_time', 'last_rssi_at_gateway', 'rec_status')
+
+    def migrate_main(self, db_mgr, cursor):
+        # existing snapshots are kept in node_snapshot_full, for the backfill to move
+        for index_name in ('idx_node_snapshot_when_received', 'idx_node_snapshot_network_id', 'idx_node_snapshot_rec_status'):
+            cursor.execute('DROP INDEX IF EXISTS main.{0}'.format(index_name))
+        if cursor.execute('SELECT EXISTS (SELECT 1 FROM main.node_snapshot)').fetchone()[0]:
+            cursor.execute('ALTER TABLE main.node_snapshot RENAME TO node_snapshot_full')
+        else:
+            cursor.execute('DROP TABLE main.node_snapshot')
+        cursor.execute('CREATE TABLE main.node_snapshot (node_uuid TEXT NOT NULL, when_received INTEGER NOT NULL, network_id TEXT, node_id INTEGER, '
+                       'gateway_id INTEGER, batt_voltage_mv INTEGER, up_time INTEGER, sleep_time INTEGER, free_ram INTEGER, when_last_seen INTEGER, '
+                       'last_clock_drift INTEGER, meter_interval INTEGER, meter_impulses_per_kwh INTEGER, last_meter_entry_finish INTEGER, '
+                       'last_meter_value INTEGER, last_rms_current REAL, puck_led_rate INTEGER, puck_led_time INTEGER, last_rssi_at_gateway INTEGER, '
+                       'rec_status TEXT, is_keyframe INTEGER NOT NULL, PRIMARY KEY (node_uuid, when_received)) WITHOUT ROWID')
+
+
+    def has_backfill(self):
+        return True
+
+
+    def backfill_chunk(self, db_mgr, chunk_rows):
+        # Moves the first chunk_rows snapshots of node_snapshot_full (in order of node and time) to node_snapshot, each node's starting
+        # with a keyframe, then one every keyframe_rows or with a NULL field or after one, and delta rows between (as meter_db
+        # NODE_SNAPSHOT_*).  Drops node_snapshot_full once empty.
+        with db_mgr.write_lock:
+            connection = db_mgr.connection
+            if len(connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'node_snapshot_full'").fetchall()) == 0:
+                return 0
+            rows = connection.execute('SELECT {0} FROM node_snapshot_full ORDER BY node_uuid, when_received LIMIT ?'.format(', '.join(self.columns)),
+                                      (chunk_rows,)).fetchall()
+            if len(rows) == 0:
+                connection.execute('DROP TABLE node_snapshot_full')
+                db_mgr.commit()
+                return 0
+
+            is_absolute = [column in self.absolute_columns for column in self.columns[2:]]
+            new_rows = []
+            last_values = None
+            run_rows = 0
+            for row in rows:
+                values = tuple(row[2:])
+                if len(new_rows) == 0 or row[0] != new_rows[-1][0] or run_rows >= self.keyframe_rows or None in values or None in last_values:
+                    new_rows.append(tuple(row[:2]) + values + (1,))
+                    run_rows = 1
+                else:
+                    new_rows.append(tuple(row[:2]) + tuple(None if value == last_value else (value if absolute else value - last_value)
+                                                           for value, last_value, absolute in zip(values, last_values, is_absolute)) + (0,))
+                    run_rows += 1
+                last_values = values
+            connection.executemany('INSERT OR IGNORE INTO node_snapshot ({0}, is_keyframe) VALUES ({1})'.format(
+                ', '.join(self.columns), ', '.join(['?'] * (len(self.columns) + 1))), new_rows)
+            connection.execute('DELETE FROM node_snapshot_full WHERE node_uuid < ? OR (node_uuid = ? AND when_received <= ?)',
+                               (rows[-1][0], rows[-1][0], rows[-1][1]))
+            db_mgr.node_snapshot_state = {}
+            db_mgr.commit()
+            return len(rows)
+
+
+    def estimate_backfill(self, db_mgr):
+        # before the migration is applied, all snapshots are to move
+        with db_mgr.write_lock:
+            if get_schema_version(db_mgr) < self.version:
+                return db_mgr.connection.execute('SELECT COUNT(*) FROM node_snapshot').fetchone()[0]
+            if len(db_mgr.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'node_snapshot_full'").fetchall()) == 0:
+                return 0
+            return db_mgr.connection.execute('SELECT COUNT(*) FROM node_snapshot_full').fetchone()[0]
+
+
+MIGRATIONS = [AddMeterArchive(), DeriveEntryNonces(), DeltaNodeSnapshots()]
+
+
+def get_schema_version(db_mgr, schema='main'):
+    return db_mgr.connection.execute('PRAGMA {0}.user_version'.format(schema)).fetchone()[0]
+
+
+def apply_migration(db_mgr, migration, schema):
+    # runs migration's schema changes to schema and sets its version, as one transaction
+    cursor = db_mgr.connection.cursor()
+    try:
+        if db_mgr.connection.in_transaction:
+            db_mgr.connection.commit()
+        cursor.execute('BEGIN')
+        if schema == 'main':
+            migration.migrate_main(db_mgr, cursor)
+        else:
+            migration.migrate_shard(db_mgr, cursor, schema)
+        cursor.execute('PRAGMA {0}.user_version = {1}'.format(schema, migration.version))
+        db_mgr.connection.commit()
+    except sqlite3.Error:
+        db_mgr.connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    db_mgr.logger.info('Migrated {0} to version {1}: {2}'.format(schema, migration.version, migration.description))
+
+
+def get_pending_migrations(db_mgr, schema='main', migrations=None):
+    version = get_schema_version(db_mgr, schema)
+    return [migration for migration in sorted(MIGRATIONS if migrations is None else migrations, key=lambda migration: migration.version)
+            if migration.version > version]
+
+
+def set_base_version(db_mgr, schema='main'):
+    # for a file with the base schema, created now or before versioning
+    if get_schema_version(db_mgr, schema) == 0:
+        db_mgr.connection.execute('PRAGMA {0}.user_version = {1}'.format(schema, SCHEMA_BASE_VERSION))
+
+
+def migrate_shard(db_mgr, schema, migrations=None):
+    # brings meter entry shard attached as schema up to date, on the writer (call under write_lock)
+    set_base_version(db_mgr, schema)
+    for migration in get_pending_migrations(db_mgr, schema, migrations):
+        apply_migration(db_mgr, migration, schema)
+
+
+def migrate(db_mgr, migrations=None):
+    # Applies pending schema changes to main file then each shard.  Backfills are left to run_backfill_chunk.  Returns number of
+    # migrations applied to main file.
+    with db_mgr.write_lock:
+        set_base_version(db_mgr)
+        pending_migrations = get_pending_migrations(db_mgr, 'main', migrations)
+        for migration in pending_migrations:
+            apply_migration(db_mgr, migration, 'main')
+        for schema in db_mgr.get_file_schemas():
+            if schema != 'main':
+                migrate_shard(db_mgr, schema, migrations)
+        return len(pending_migrations)
+
+
+def get_backfill_progress(db_mgr, migration):
+    rows = db_mgr.connection.execute('SELECT value FROM sys_param WHERE name = ?', (BACKFILL_PARAM_FORMAT.format(migration.version),)).fetchall()
+    return rows[0][0] if len(rows) > 0 else None
+
+
+def set_backfill_progress(db_mgr, migration, progress):
+    # on the writer (call under write_lock), without committing
+    db_mgr.connection.execute('INSERT OR REPLACE INTO sys_param (name, value) VALUES (?, ?)', (BACKFILL_PARAM_FORMAT.format(migration.version), progress))
+
+
+def get_pending_backfills(db_mgr, migrations=None):
+    # migrations applied to main file whose backfill has not finished, in order
+    version = get_schema_version(db_mgr)
+    return [migration for migration in sorted(MIGRATIONS if migrations is None else migrations, key=lambda migration: migration.version)
+            if migration.version <= version and migration.has_backfill() and get_backfill_progress(db_mgr, migration) != BACKFILL_DONE]
+
+
+def run_backfill_chunk(db_mgr, chunk_rows=BACKFILL_CHUNK_ROWS, migrations=None):
+    # Runs a chunk of the first pending backfill, committed as one transaction so ingest waits for one chunk at most.  Returns rows done,
+    # or None if no backfills are pending.
+    with db_mgr.write_lock:
+        pending_backfills = get_pending_backfills(db_mgr, migrations)
+        if len(pending_backfills) == 0:
+            return None
+        migration = pending_backfills[0]
+        row_count = migration.backfill_chunk(db_mgr, chunk_rows)
+        if row_count == 0:
+            set_backfill_progress(db_mgr, migration, BACKFILL_DONE)
+            db_mgr.commit()
+            db_mgr.logger.info('Finished backfill of migration {0}: {1}'.format(migration.version, migration.description))
+        return row_count
+
+
+def get_backfill_chunk(db_mgr, migration, chunk_rows):
+    # (meter entry table, start from, start to) of the next chunk of a backfill of meter entries: those starting after the start reached by
+    # the last chunk, up to that of the chunk_rows'th (or to the end of the shard).  None when finished.  Call under write_lock.
+    progress = get_backfill_progress(db_mgr, migration)
+    time_from = int(progress) + 1 if progress is not None else 0
+    for tables in db_mgr.get_meter_entry_tables(db_mgr.connection, time_from):
+        for table in tables:
+            rows = db_mgr.connection.execute('SELECT when_start FROM {0} WHERE when_start >= ? ORDER BY when_start LIMIT 1 OFFSET ?'.format(table),
+                                             (time_from, chunk_rows - 1)).fetchall()
+            if len(rows) == 0:
+                rows = db_mgr.connection.execute('SELECT MAX(when_start) FROM {0} WHERE when_start >= ?'.format(table), (time_from,)).fetchall()
+            time_to = rows[0][0]
+            if time_to is not None:
+                return table, time_from, time_to
+    return None
+
+
+def backfill_meter_entries(db_mgr, migration, set_cmd, chunk_rows, set_params=()):
+    # Backfill chunk for meter entries: UPDATE ... SET set_cmd on the entries of the next chunk (see get_backfill_chunk), committing
+    # progress with it.  Returns entries updated, 0 when finished.
+    with db_mgr.write_lock:
+        chunk = get_backfill_chunk(db_mgr, migration, chunk_rows)
+        if chunk is None:
+            return 0
+        table, time_from, time_to = chunk
+        cursor = db_mgr.connection.execute('UPDATE {0} SET {1} WHERE when_start >= ? AND when_start <= ?'.format(table, set_cmd),
+                                           tuple(set_params) + (time_from, time_to))
+        set_backfill_progress(db_mgr, migration, time_to)
+        db_mgr.commit()
+        return cursor.rowcount
+
+
+def count_meter_entries_after(db_mgr, progress):
+    if progress == BACKFILL_DONE:
+        return 0
+    time_from = int(progress) + 1 if progress is not None else 0
+    row_count = 0
+    with db_mgr.write_lock:
+        for tables in db_mgr.get_meter_entry_tables(db_mgr.connection, time_from):
+            for table in tables:
+                row_count += db_mgr.connection.execute('SELECT COUNT(*) FROM {0} WHERE when_start >= ?'.format(table), (time_from,)).fetchone()[0]
+    return row_count
+
+
+def get_migration_report(db_mgr, chunk_rows=BACKFILL_CHUNK_ROWS, migrations=None):
+    # Dry run: (version, description, files to change, rows to backfill, backfill chunks) of each pending migration, and of each applied
+    # migration whose backfill is unfinished (files 0).  Changes nothing.
+    with db_mgr.write_lock:
+        schema_versions = [get_schema_version(db_mgr, schema) for schema in db_mgr.get_file_schemas()]
+        report = []
+        for migration in get_pending_backfills(db_mgr, migrations):
+            backfill_rows = migration.estimate_backfill(db_mgr)
+            report.append((migration.version, migration.description, 0, backfill_rows, -(-backfill_rows // chunk_rows)))
+
+        main_pending = get_pending_migrations(db_mgr, 'main', migrations)
+        for migration in main_pending:
+            file_count = sum(1 for version in schema_versions if migration.version > version)
+            backfill_rows = migration.estimate_backfill(db_mgr) if migration.has_backfill() else 0
+            report.append((migration.version, migration.description, file_count, backfill_rows, -(-backfill_rows // chunk_rows)))
+        return report
@@ -0,0 +1,239 @@
+'''
+
+================================================================================================================================================================
+meter_db_writer.py
+=====================
+
+Write-behind for ingest: MeterDataManager queues meter entries, snapshots and node events on a DBWriter instead of writing them to the DB
+itself, so device message processing never waits on a commit (slow on SD cards).  A writer thread takes queued writes in arrival order and
+commits them together as one transaction once write_flush_rows rows are queued or the oldest has waited write_flush_ms, whichever comes first.
+Consecutive meter entry writes are merged into one executemany.
+
+Selected with 'write_behind = true' in the [Database] config section.
+
+Behaviour on shutdown and failure:
+
+    - close() (called by MeterDataManager.close_db, and at exit by MeterMan) stops taking writes, commits everything queued before it and
+      waits for the writer thread.  Writes made after close go straight to the DB.
+    - If the process is killed, queued writes not yet committed are lost - at most write_flush_ms of ingest, or write_flush_rows rows.
+      Committed transactions are as durable as any DB commit (see meter_db.DB_SYNCHRONOUS).
+    - A write that fails (e.g. an existing key) is logged and skipped, as when written directly; the rest of its transaction is committed.
+    - If the DB stalls, the queue holds up to DEF_MAX_QUEUED_WRITES writes, after which writers block (back-pressure on ingest).
+    - Reads (e.g. REST API) see queued writes once they are committed, so may lag ingest by up to write_flush_ms.  flush() commits
+      everything queued so far and waits for it.
+
+Flush sizes and latencies are kept in get_stats() and the db_* metrics in meter_metrics.  A meter entry write may carry its message's ingest
+trace, whose DB write start and commit points are set (and db_write stage recorded) when its batch is committed.
+
+================================================================================================================================================================
+
+'''
+
+import queue
+import threading
+from time import monotonic
+
+from meterman import app_base as base
+from meterman import meter_metrics as metrics
+
+DEF_FLUSH_MS = 1000
+DEF_FLUSH_ROWS = 500
+DEF_MAX_QUEUED_WRITES = 100000
+FLUSH_WAIT_SECS = 30
+
+WRITE_METER_ENTRIES = 'write_meter_entries'
+WRITE_FLUSH = 'flush'           # control writes, for flush() and close()
+WRITE_CLOSE = 'close'
+
+
+class DBWriter:
+
+    def __init__(self, db_mgr, flush_ms=DEF_FLUSH_MS, flush_rows=DEF_FLUSH_ROWS, max_queued_writes=DEF_MAX_QUEUED_WRITES, log_file=base.log_file):
+        self.logger = base.get_logger(logger_name='db_writer', log_file=log_file)
+        self.db_mgr = db_mgr
+        self.flush_secs = flush_ms / 1000
+        self.flush_rows = flush_rows
+        self.write_queue = queue.Queue(maxsize=max_queued_writes)   # of (DBManager write function name, args, rows, monotonic time queued, trace)
+        self.queued_rows = 0
+        self.is_closed = False
+        self.stats = {'flush_count': 0, 'rows_written': 0, 'last_flush_rows': 0, 'max_flush_rows': 0, 'last_flush_secs': 0.0,
+                      'max_flush_secs': 0.0, 'max_lag_secs': 0.0}
+        self.stats_lock = threading.Lock()
+
+        self.run_thread = threading.Thread(target=self.run, name='db_writer')
+        self.run_thread.daemon = True      # close() drains it on orderly shutdown
+        self.run_thread.start()
+        self.logger.info('Started DB writer with flush_ms={0}, flush_rows={1}'.format(flush_ms, flush_rows))
+
+
+    def queue_write(self, write_func, args, rows, trace=None):
+        if self.is_closed:
+            self.logger.warn('DB writer closed, writing {0} directly'.format(write_func))
+            if trace is not None:
+                trace[metrics.TRACE_DB_WRITE_START] = monotonic()
+            result = getattr(self.db_mgr, write_func)(*args)
+            if trace is not None:
+                trace[metrics.TRACE_DB_COMMIT] = monotonic()
+            return result
+
+        when_queued = monotonic()
+        if trace is not None:
+            trace[metrics.TRACE_DB_QUEUED] = when_queued
+        self.write_queue.put((write_func, args, rows, when_queued, trace))
+        with self.stats_lock:
+            self.queued_rows += rows
+
+
+    # write functions as for DBManager, but queued and without return values
+
+    def write_meter_entries(self, meter_entries, trace=None):
+        # trace is the ingest trace dict (see meter_metrics) of the message the entries are from, if any
+        meter_entries = list(meter_entries)
+        self.queue_write(WRITE_METER_ENTRIES, (meter_entries,), len(meter_entries), trace)
+
+
+    def write_meter_entry(self, node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status):
+        self.write_meter_entries([(node_uuid, when_start_raw, when_start_raw_nonce, when_start, entry_type, entry_value, duration, meter_value,
+                                   rec_status)])
+
+
+    def write_meter_entry_columns(self, node_uuids, when_starts, when_start_nonces, entry_type, entry_values, durations, meter_values, rec_status):
+        self.write_meter_entries((node_uuid, when_start, when_start_nonce, when_start, entry_type, entry_value, duration, meter_value, rec_status)
+                                 for node_uuid, when_start, when_start_nonce, entry_value, duration, meter_value in
+                                 zip(node_uuids, when_starts, when_start_nonces, entry_values, durations, meter_values))
+
+
+    def write_gateway_snapshot(self, *args):
+        self.queue_write('write_gateway_snapshot', args, 1)
+
+
+    def write_node_snapshot(self, *args):
+        self.queue_write('write_node_snapshot', args, 1)
+
+
+    def write_node_event(self, *args):
+        self.queue_write('write_node_event', args, 1)
+
+
+    def flush(self, timeout=FLUSH_WAIT_SECS):
+        # commits everything queued so far, returns True once committed (False on timeout)
+        if self.is_closed:
+            return True
+        flushed_event = threading.Event()
+        self.write_queue.put((WRITE_FLUSH, flushed_event, 0, monotonic(), None))
+        return flushed_event.wait(timeout)
+
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.write_queue.put((WRITE_CLOSE, None, 0, monotonic(), None))
+        self.run_thread.join()
+        self.logger.info('Closed DB writer after {0} flushes of {1} rows'.format(self.stats['flush_count'], self.stats['rows_written']))
+
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+            stats['queued_rows'] = self.queued_rows
+        stats['avg_flush_rows'] = stats['rows_written'] / stats['flush_count'] if stats['flush_count'] > 0 else 0.0
+        return stats
+
+
+    def run(self):
+        # takes writes until a batch is full, the first write of the batch has waited flush_secs, or a flush/close is requested, then commits
+        is_closing = False
+        while not is_closing:
+            batch = []
+            batch_rows = 0
+            flushed_events = []
+            write = self.write_queue.get()      # wait for first write of batch
+            flush_deadline = write[3] + self.flush_secs
+
+            while True:
+                write_func, args, rows, when_queued, trace = write
+                if write_func == WRITE_FLUSH:
+                    flushed_events.append(args)
+                    break
+                elif write_func == WRITE_CLOSE:
+                    is_closing = True
+                    break
+                batch.append(write)
+                batch_rows += rows
+                if batch_rows >= self.flush_rows:
+                    break
+                try:
+                    write = self.write_queue.get(timeout=max(0.0, flush_deadline - monotonic()))
+                except queue.Empty:
+                    break
+
+            if len(batch) > 0:
+                try:
+                    self.flush_batch(batch, batch_rows)
+                except Exception as err:
+                    self.logger.error('Failed to write batch of {0} rows: {1}'.format(batch_rows, err))
+            for flushed_event in flushed_events:
+                flushed_event.set()
+
+        # writes queued by threads racing close()
+        batch = []
+        while True:
+            try:
+                write = self.write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if write[0] not in (WRITE_FLUSH, WRITE_CLOSE):
+                batch.append(write)
+        if len(batch) > 0:
+            batch_rows = sum(write[2] for write in batch)
+            try:
+                self.flush_batch(batch, batch_rows)
+            except Exception as err:
+                self.logger.error('Failed to write batch of {0} rows on close: {1}'.format(batch_rows, err))
+
+
+    def flush_batch(self, batch, batch_rows):
+        time_start = monotonic()
+        try:
+            with self.db_mgr.group_commit():
+                meter_entries = []
+                for write_func, args, rows, when_queued, trace in batch:
+                    if write_func == WRITE_METER_ENTRIES:
+                        meter_entries.extend(args[0])
+                        continue
+                    if len(meter_entries) > 0:
+                        self.db_mgr.write_meter_entries(meter_entries)
+                        meter_entries = []
+                    getattr(self.db_mgr, write_func)(*args)
+                if len(meter_entries) > 0:
+                    self.db_mgr.write_meter_entries(meter_entries)
+        finally:
+            # no longer queued, whether committed or (if failed) dropped by run
+            with self.stats_lock:
+                self.queued_rows -= batch_rows
+                queued_rows = self.queued_rows
+            metrics.db_write_queue_rows.set(queued_rows)
+        time_committed = monotonic()
+
+        flush_secs = time_committed - time_start
+        max_lag_secs = time_committed - batch[0][3]
+        with self.stats_lock:
+            self.stats['flush_count'] += 1
+            self.stats['rows_written'] += batch_rows
+            self.stats['last_flush_rows'] = batch_rows
+            self.stats['max_flush_rows'] = max(self.stats['max_flush_rows'], batch_rows)
+            self.stats['last_flush_secs'] = flush_secs
+            self.stats['max_flush_secs'] = max(self.stats['max_flush_secs'], flush_secs)
+            self.stats['max_lag_secs'] = max(self.stats['max_lag_secs'], max_lag_secs)
+
+        metrics.db_flushes_total.inc()
+        metrics.db_flush_rows.observe(batch_rows)
+        metrics.db_flush_seconds.observe(flush_secs)
+        for write_func, args, rows, when_queued, trace in batch:
+            metrics.db_write_lag_seconds.observe(time_committed - when_queued)
+            if trace is not None:
+                trace[metrics.TRACE_DB_WRITE_START] = time_start
+                trace[metrics.TRACE_DB_COMMIT] = time_committed
+                metrics.observe_trace(trace, ('db_write',))
+        self.logger.debug('Committed {0} rows from {1} writes in {2:.3f}s'.format(batch_rows, len(batch), flush_secs))
@@ -0,0 +1,130 @@
+'''
+
+================================================================================================================================================================
+meter_device_async.py
+=====================
+
+Asyncio runtime that drives every gateway of a MeterDeviceManager from a single event loop, as an alternative to one polling thread per gateway
+plus the manager loop in MeterMan.main.  Intended for hosts with many gateways (e.g. 8-16 on USB-serial adapters).
+
+Each gateway's serial fd is registered with the loop as a reader.  On wakeup the reader callback drains every complete line waiting and hands them
+to a parser coroutine, which decodes them through the gateway's message handlers.  Handlers queue message objects on the manager's receive queue
+(an asyncio.Queue in this mode), and a dispatcher coroutine passes them into MeterDeviceManager.dispatch_message().  Outbound commands stay on each
+gateway's thread-safe priority queue and are written by a per-gateway coroutine, so the REST API can still queue commands from its own thread.
+
+Selected with 'device_engine = asyncio' in the [App] config section; the threaded model ('device_engine = thread') remains the default.
+Requires selectable serial fds (POSIX).
+
+================================================================================================================================================================
+
+'''
+
+import asyncio
+from time import monotonic
+
+import serial
+
+from meterman import app_base as base
+from meterman import meter_device_gateway as gway
+
+TX_SERVICE_SECS = 0.05          # period at which each gateway's outbound queue is serviced
+GATEWAY_TASK_SECS = 0.5         # period at which periodic gateway tasks (time sync, snapshots, sim meters) run
+
+
+class AsyncDeviceEngine:
+
+    def __init__(self, device_mgr, log_file=base.log_file):
+        self.device_mgr = device_mgr
+        self.logger = base.get_logger(logger_name='device_engine', log_file=log_file)
+        self.loop = None
+        self.rx_line_queue = None
+        self.stop_future = None
+
+
+    def get_gateways(self):
+        return [gateway['gw_obj'] for gateway in self.device_mgr.gateways.values()]
+
+
+    def on_serial_readable(self, gateway):
+        # called by event loop when a gateway's serial fd is readable
+        lines = gateway.read_serial_lines()
+        if len(lines) > 0:
+            self.rx_line_queue.put_nowait((gateway, lines, monotonic()))
+
+
+    async def proc_rx_lines(self):
+        # parses lines from all gateways in arrival order, gateway handlers queue resulting message objects for dispatch
+        while True:
+            gateway, lines, when_read = await self.rx_line_queue.get()
+            for line in lines:
+                gateway.proc_serial_line(line, when_read)
+
+
+    async def dispatch_messages(self):
+        while True:
+            msg_obj = await self.device_mgr.rx_msg_queue.get()
+            self.device_mgr.dispatch_message(msg_obj)
+
+
+    async def tx_serial_msgs(self, gateway):
+        while gateway.serial_conn.isOpen():
+            try:
+                gateway.tx_serial_msgs()
+            except serial.serialutil.SerialException as err:
+                self.logger.warn('Serial exception writing to gateway {0}: {1}'.format(gateway.uuid, err))
+            await asyncio.sleep(TX_SERVICE_SECS)
+
+
+    async def proc_gateway_tasks(self):
+        while True:
+            try:
+                self.device_mgr.proc_gateway_tasks()
+            except Exception as err:
+                self.logger.error('Error running gateway tasks: {0}'.format(err))
+            await asyncio.sleep(GATEWAY_TASK_SECS)
+
+
+    async def run_async(self):
+        self.stop_future = self.loop.create_future()
+        self.rx_line_queue = asyncio.Queue()
+
+        # swap the manager's thread queue for one owned by this loop; gateways put to it from reader callbacks in the loop thread
+        rx_msg_queue = asyncio.Queue(maxsize=gway.RX_MSG_QUEUE_SIZE)
+        self.device_mgr.rx_msg_queue = rx_msg_queue
+
+        tasks = [asyncio.ensure_future(self.proc_rx_lines()), asyncio.ensure_future(self.dispatch_messages()),
+                 asyncio.ensure_future(self.proc_gateway_tasks())]
+
+        for gateway in self.get_gateways():
+            if gateway.serial_rx_fd is None:
+                raise ValueError('Gateway {0} has no selectable serial fd, use device_engine = thread'.format(gateway.uuid))
+            gateway.rx_msg_queue = rx_msg_queue
+            self.loop.add_reader(gateway.serial_rx_fd, self.on_serial_readable, gateway)
+            tasks.append(asyncio.ensure_future(self.tx_serial_msgs(gateway)))
+            self.logger.info('Registered gateway {0} on {1} with event loop'.format(gateway.uuid, gateway.serial_port))
+
+        try:
+            await self.stop_future
+        finally:
+            for gateway in self.get_gateways():
+                self.loop.remove_reader(gateway.serial_rx_fd)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    def run(self):
+        # runs event loop in calling thread until stop() is called
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.logger.info('Starting async device engine for {0} gateway(s)'.format(len(self.device_mgr.gateways)))
+        try:
+            self.loop.run_until_complete(self.run_async())
+        finally:
+            self.loop.close()
+
+
+    def stop(self):
+        # thread-safe
+        if self.loop is not None and self.stop_future is not None:
+            self.loop.call_soon_threadsafe(lambda: self.stop_future.done() or self.stop_future.set_result(None))
@@ -27,12 +27,17 @@ for metering electricity consumption, this is likely to weaken the attempts made
 #  IMPORTS
 # ==============================================================================================================================================================
 
+import asyncio
+import itertools
+import queue
+import select
 import threading
-from enum import Enum
-from time import sleep
+from enum import Enum, IntEnum
+from time import sleep, monotonic
 
 import arrow
 from meterman import gateway_messages as gmsg
+from meterman import meter_metrics as metrics
 import serial
 
 from meterman import app_base as base
@@ -46,7 +51,29 @@ DEF_SERIAL_BAUD = 115200
 
 A_UNKNOWN = 'UNKNOWN'
 
-PURGE_RX_MSG_AGE_SECS = 600
+RX_MSG_QUEUE_SIZE = 20000      # max parsed messages held for meter device manager; newest are dropped beyond this
+
+POLL_LOOP_SECS = 0.5            # loop period for SerialRxMode.POLL
+EVENT_WAIT_SECS = 0.1           # max wait on serial fd for SerialRxMode.EVENT before servicing TX and housekeeping
+SERIAL_RX_MAX_PARTIAL = 4096    # discard an unterminated line if it grows beyond this many bytes
+
+# Serial Receive Modes
+#   POLL reads at most one line per loop pass, sleeping between passes.
+#   EVENT waits on the serial fd (or wakes on data) and drains every complete line waiting in the buffer per wakeup.
+class SerialRxMode(Enum):
+    POLL = 'poll'
+    EVENT = 'event'
+
+DEF_SERIAL_RX_MODE = SerialRxMode.EVENT
+
+DEF_SERIAL_TX_RATE = 4.0                # max messages per second written to gateway
+DEF_GATEWAY_RX_BUFFER_BYTES = 64        # gateway's serial input buffer; queued messages that fit within this are sent in one write
+
+# Serial Transmit Priorities - lower values are sent first, messages of equal priority are sent in the order queued
+class TxPriority(IntEnum):
+    TIME_SYNC = 0
+    USER_CTRL = 1
+    SNAPSHOT = 2
 
 # Device Statuses
 class DeviceStatus(Enum):
@@ -67,7 +94,9 @@ class DeviceStatus(Enum):
 
 class MeterDeviceGateway:
 
-    def __init__(self, meter_device_manager, network_id, gateway_id, label='Gateway', serial_port=DEF_SERIAL_PORT, serial_baud=DEF_SERIAL_BAUD, log_file=base.log_file):
+    def __init__(self, meter_device_manager, network_id, gateway_id, label='Gateway', serial_port=DEF_SERIAL_PORT, serial_baud=DEF_SERIAL_BAUD, log_file=base.log_file,
+                 serial_rx_mode=DEF_SERIAL_RX_MODE, serial_tx_rate=DEF_SERIAL_TX_RATE, gateway_rx_buffer_bytes=DEF_GATEWAY_RX_BUFFER_BYTES,
+                 rx_msg_queue=None, start_serial_thread=True):
         self.meter_device_manager = meter_device_manager
         self.label = label
         self.state = DeviceStatus.INIT
@@ -107,15 +136,35 @@ class MeterDeviceGateway:
 
         self.serial_port = serial_port
         self.serial_baud = serial_baud
+        self.serial_rx_mode = SerialRxMode(serial_rx_mode)
         self.serial_conn = serial.Serial(serial_port, serial_baud, timeout=1, write_timeout=1)
-        self.logger.info('Started connection to gateway ' + self.uuid + ' on ' + serial_port + ' at ' + serial_baud + ' baud')
-        self.serial_tx_msg_buffer = []
-        self.serial_rx_msg_objects = {}
+        self.serial_rx_fd = self.serial_conn.fileno() if hasattr(self.serial_conn, 'fileno') else None
+        self.logger.info('Started connection to gateway ' + self.uuid + ' on ' + serial_port + ' at ' + str(serial_baud) + ' baud, rx mode is ' +
+                         self.serial_rx_mode.value)
+        self.serial_tx_queue = queue.PriorityQueue()
+        self.serial_tx_seq = itertools.count()
+        self.serial_tx_rate = float(serial_tx_rate)
+        self.serial_tx_burst = max(1.0, self.serial_tx_rate)
+        self.serial_tx_tokens = self.serial_tx_burst
+        self.serial_tx_last_refill = monotonic()
+        self.gateway_rx_buffer_bytes = int(gateway_rx_buffer_bytes)
+        self.tx_msg_count = 0
+        self.tx_write_count = 0
+        self.tx_wait_total = 0.0
+        self.tx_wait_max = 0.0
+        self.tx_wait_last = 0.0
+        # parsed messages are handed to the meter device manager through a FIFO, which may be shared by several gateways
+        self.rx_msg_queue = rx_msg_queue if rx_msg_queue is not None else queue.Queue(maxsize=RX_MSG_QUEUE_SIZE)
+        self.serial_rx_partial = b''
         self.rx_msg_objects_seq = 0
+        self.rx_line_count = 0
 
-        self.serial_thread = threading.Thread(target=self.proc_serial_msg)
-        self.serial_thread.daemon = True  # Daemonize thread
-        self.serial_thread.start()  # Start the execution
+        # without a serial thread, the gateway is driven by an external event loop (see meter_device_async)
+        self.serial_thread = None
+        if start_serial_thread:
+            self.serial_thread = threading.Thread(target=self.proc_serial_msg)
+            self.serial_thread.daemon = True  # Daemonize thread
+            self.serial_thread.start()  # Start the execution
 
 
     def register_msg_proc_func(self, message_definition):
@@ -129,7 +178,7 @@ class MeterDeviceGateway:
 
     def get_gateway_snapshot(self):
         #  Requests a dump of the gateway's state.
-        self.tx_serial_msg(gmsg.get_gateway_snapshot_msg())
+        self.tx_serial_msg(gmsg.get_gateway_snapshot_msg(), TxPriority.SNAPSHOT)
 
 
     def set_gateway_inst_tmp_rate(self, node_id, tmp_poll_rate, tmp_poll_period):
@@ -139,12 +188,12 @@ class MeterDeviceGateway:
 
     def get_node_snapshot(self, node_id=254):
         #  Requests a dump of a node's state from the Gateway.
-        self.tx_serial_msg(gmsg.get_node_snapshot_msg(node_id))
+        self.tx_serial_msg(gmsg.get_node_snapshot_msg(node_id), TxPriority.SNAPSHOT)
 
 
     def set_gateway_time(self):
         # Sends request to gateway to set time to server's local time as Unix UTC Epoch.
-        self.tx_serial_msg(gmsg.set_gateway_time_msg(arrow.utcnow().timestamp))
+        self.tx_serial_msg(gmsg.set_gateway_time_msg(arrow.utcnow().timestamp), TxPriority.TIME_SYNC)
 
 
     def set_node_gw_inst_tmp_rate(self, node_id, tmp_ginr_poll_rate, tmp_ginr_poll_time):
@@ -177,15 +226,16 @@ class MeterDeviceGateway:
     # ----------------------------------------------------------------------------------------------------------------------------------------------------------
 
     def serial_rx_msg_buffer_add(self, msg_obj):
+        # queue message object for meter device manager, tagged with a per-gateway sequence number
         self.rx_msg_objects_seq += 1
+        msg_obj['rx_seq'] = self.rx_msg_objects_seq
         msg_obj['network_id'] = self.network_id
         msg_obj['gateway_id'] = self.gateway_id
-        self.serial_rx_msg_objects[str(arrow.utcnow().timestamp) + '/' + str(self.rx_msg_objects_seq)] = msg_obj    # '/' is < 9
-
-
-    def serial_rx_msg_buffer_purge(self, secs_old):
-        purge_before = str(arrow.utcnow().shift(seconds=-secs_old).timestamp)
-        self.serial_rx_msg_objects = {key: val for key, val in self.serial_rx_msg_objects.items() if key < purge_before}
+        try:
+            self.rx_msg_queue.put_nowait(msg_obj)
+        except (queue.Full, asyncio.QueueFull):
+            metrics.rx_msg_queue_dropped_total.inc((self.uuid,))
+            self.logger.warn('Receive queue full, dropped {0} message #{1}'.format(msg_obj['message_type'], msg_obj['rx_seq']))
 
 
     def proc_msg_gtime(self, msg_obj):
@@ -301,24 +351,84 @@ class MeterDeviceGateway:
         self.serial_rx_msg_buffer_add(msg_obj)
 
 
-    def tx_serial_msg(self, message):
+    def tx_serial_msg(self, message, priority=TxPriority.USER_CTRL):
+        # queues message for the serial thread.  Thread-safe.
         message = gmsg.SMSG_TX_PREFIX + message + '\r\n'
-        self.serial_tx_msg_buffer.append(message)
+        self.serial_tx_queue.put((priority, next(self.serial_tx_seq), monotonic(), message))
 
 
-    def rx_serial_msg(self):
+    def tx_serial_msgs(self):
+        # Writes queued messages in priority order, subject to the tx rate.  Consecutive messages that together fit the gateway's input
+        # buffer go out in a single write.  Returns number of messages written.
+        now = monotonic()
+        self.serial_tx_tokens = min(self.serial_tx_burst, self.serial_tx_tokens + (now - self.serial_tx_last_refill) * self.serial_tx_rate)
+        self.serial_tx_last_refill = now
+
+        tx_batch = []
+        tx_batch_len = 0
+        while self.serial_tx_tokens >= 1:
+            try:
+                tx_item = self.serial_tx_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            tx_msg = tx_item[3]
+            if len(tx_batch) > 0 and tx_batch_len + len(tx_msg) > self.gateway_rx_buffer_bytes:
+                self.serial_tx_queue.put(tx_item)      # keeps original priority and sequence, so goes first in next batch
+                break
+
+            tx_batch.append(tx_msg)
+            tx_batch_len += len(tx_msg)
+            self.serial_tx_tokens -= 1
+            self.tx_wait_last = now - tx_item[2]
+            self.tx_wait_total += self.tx_wait_last
+            self.tx_wait_max = max(self.tx_wait_max, self.tx_wait_last)
+
+        if len(tx_batch) > 0:
+            self.serial_conn.write(''.join(tx_batch).encode('utf-8'))
+            self.tx_msg_count += len(tx_batch)
+            self.tx_write_count += 1
+            for tx_msg in tx_batch:
+                self.logger.debug("Wrote serial data: " + tx_msg.strip('\r\n'))
+
+        return len(tx_batch)
+
+
+    def get_tx_queue_stats(self):
+        # snapshot of outbound queue depth and queue wait times (secs)
+        return {'depth': self.serial_tx_queue.qsize(), 'msg_count': self.tx_msg_count, 'write_count': self.tx_write_count,
+                'wait_last': self.tx_wait_last, 'wait_max': self.tx_wait_max,
+                'wait_avg': self.tx_wait_total / self.tx_msg_count if self.tx_msg_count > 0 else 0.0}
+
+
+    def proc_serial_line(self, serial_line, when_read=None):
+        # decode a single raw line read from serial and dispatch it if it is a message from the gateway.  when_read is monotonic time of
+        # serial read, for tracing (defaults to now).
         try:
-            if self.serial_conn.inWaiting() > 0:
-                serial_in = self.serial_conn.readline().strip().decode("latin1")
+            if when_read is None:
+                when_read = monotonic()
+            serial_in = serial_line.strip().decode("latin1")
+            self.rx_line_count += 1
+
+            if serial_in.startswith(gmsg.SMSG_RX_PREFIX):
+                self.logger.debug('Got serial data: %s', serial_in)
+                self.last_seen = arrow.utcnow().timestamp
+                # inbound serial line is a message, so drop prefix and convert it from CSV to message object
+                msg_obj = gmsg.get_message_obj(serial_in, self.uuid, self.gateway_id, self.network_id)
+                msg_obj['trace'] = {metrics.TRACE_SERIAL_READ: when_read, metrics.TRACE_PARSED: monotonic()}
+
+                # pass object to appropriate processor function using dictionary mapping
+                getattr(self, self.message_proc_functions[msg_obj['message_type']])(msg_obj)
+
+        except Exception as err:
+            self.logger.error('Error receiving serial message: {0}'.format(err))
 
-                if serial_in.startswith(gmsg.SMSG_RX_PREFIX):
-                    self.logger.debug('Got serial data: %s', serial_in)
-                    self.last_seen = arrow.utcnow().timestamp
-                    # inbound serial line is a message, so drop prefix and convert it from CSV to message object
-                    msg_obj = gmsg.get_message_obj(serial_in, self.uuid, self.gateway_id, self.network_id)
 
-                    # pass object to appropriate processor function using dictionary mapping
-                    getattr(self, self.message_proc_functions[msg_obj['message_type']])(msg_obj)
+    def rx_serial_msg(self):
+        # reads and dispatches at most one line (SerialRxMode.POLL)
+        try:
+            if self.serial_conn.inWaiting() > 0:
+                self.proc_serial_line(self.serial_conn.readline())
 
         except serial.serialutil.SerialTimeoutException as err:
             self.logger.debug('Serial timeout: {0}'.format(err))
@@ -330,25 +440,64 @@ class MeterDeviceGateway:
             self.logger.error('Error receiving serial message: {0}'.format(err))
 
 
+    def read_serial_lines(self):
+        # reads everything waiting in the serial buffer and returns the complete lines, holding any trailing partial line for the next read
+        lines = []
+        try:
+            waiting = self.serial_conn.inWaiting()
+            if waiting > 0:
+                lines = (self.serial_rx_partial + self.serial_conn.read(waiting)).split(b'\n')
+                self.serial_rx_partial = lines.pop()
+                if len(self.serial_rx_partial) > SERIAL_RX_MAX_PARTIAL:
+                    self.logger.warn('Discarding {0} bytes of unterminated serial data'.format(len(self.serial_rx_partial)))
+                    self.serial_rx_partial = b''
+
+        except serial.serialutil.SerialTimeoutException as err:
+            self.logger.debug('Serial timeout: {0}'.format(err))
+
+        except serial.serialutil.SerialException as err:
+            self.logger.warn('Serial exception: {0}'.format(err))
+
+        return lines
+
+
+    def rx_serial_msgs(self):
+        # reads and dispatches every complete line waiting in the serial buffer (SerialRxMode.EVENT).  Returns number of lines dispatched.
+        lines = self.read_serial_lines()
+        when_read = monotonic()
+        for line in lines:
+            self.proc_serial_line(line, when_read)
+
+        return len(lines)
+
+
+    def wait_serial_rx(self, timeout):
+        # blocks until serial data is waiting or timeout elapses, returning True if there is data to read
+        if self.serial_rx_fd is not None:
+            readable, _, _ = select.select([self.serial_rx_fd], [], [], timeout)
+            return len(readable) > 0
+        else:
+            # no selectable fd on this platform, block on a single byte read instead
+            self.serial_conn.timeout = timeout
+            first_byte = self.serial_conn.read(1)
+            self.serial_rx_partial += first_byte
+            return len(first_byte) > 0
+
+
     def proc_serial_msg(self):
-        loop_count = 0
         while self.serial_conn.isOpen():
             try:
                 # read and dispatch inbound lines from serial buffer to appropriate handler
+                if self.serial_rx_mode is SerialRxMode.EVENT:
+                    if self.wait_serial_rx(EVENT_WAIT_SECS):
+                        self.rx_serial_msgs()
+                else:
+                    self.rx_serial_msg()
 
-                loop_count = loop_count + 1 if loop_count < 60 else 1
-
-                self.rx_serial_msg()
-
-                if len(self.serial_tx_msg_buffer) > 0:
-                    tx_msg = self.serial_tx_msg_buffer.pop(0)
-                    self.serial_conn.write(tx_msg.encode('utf-8'))
-                    self.logger.debug("Wrote serial data: " + tx_msg.strip('\r\n'))
-
-                if loop_count % 30 == 0:
-                    self.serial_rx_msg_buffer_purge(PURGE_RX_MSG_AGE_SECS)
+                self.tx_serial_msgs()
 
-                sleep(0.5)
+                if self.serial_rx_mode is SerialRxMode.POLL:
+                    sleep(POLL_LOOP_SECS)
 
 
             except (KeyboardInterrupt, SystemExit):
@@ -357,4 +506,5 @@ class MeterDeviceGateway:
                 break
 
             except Exception as err:
-                self.logger.error('Error processing serial message: {0}'.format(err))
+                if self.serial_conn.isOpen():
+                    self.logger.error('Error processing serial message: {0}'.format(err))
@@ -11,26 +11,48 @@ TODO: allow for change of gateway address while running - currently binds by ser
 
 '''
 
+import math
+import queue
+
 from meterman import app_base as base
 import arrow
 from meterman import gateway_messages as gmsg
 from meterman import meter_device_gateway as gway
+from meterman import meter_device_async as gway_async
+from meterman import meter_metrics as metrics
 from random import randint
 
 NODE_UPDATE_INTERVAL_SECS = 900
 GATEWAY_TIME_SYNC_INTERVAL_SECS = 600
+DEVICE_PROC_WAIT_SECS = 0.5     # max wait for a gateway message before running periodic gateway tasks
+DEVICE_PROC_MAX_BATCH = 1000    # max messages dispatched per pass, so periodic gateway tasks still run under sustained load
+
+# Device Engines - how gateways are driven.  THREAD uses a serial thread per gateway with MeterMan.main dispatching, ASYNCIO drives all
+# gateways and dispatch from one event loop (see meter_device_async).
+DEVICE_ENGINE_THREAD = 'thread'
+DEVICE_ENGINE_ASYNCIO = 'asyncio'
 
 class MeterDeviceManager:
 
-    def __init__(self, meter_man, gateway_config_oride=None, log_file=base.log_file):
+    def __init__(self, meter_man, gateway_config_oride=None, log_file=base.log_file, device_engine=None, with_gateways=True):
         self.logger = base.get_logger(logger_name='device_mgr', log_file=log_file)
 
         self.gateways = {}
-
-        if gateway_config_oride:
-            # used for testing, single gateway
+        self.rx_msg_queue = queue.Queue(maxsize=gway.RX_MSG_QUEUE_SIZE)     # shared by all gateways
+
+        if device_engine is None:
+            device_engine = base.config['App'].get('device_engine', DEVICE_ENGINE_THREAD) if base.config is not None else DEVICE_ENGINE_THREAD
+        if device_engine not in [DEVICE_ENGINE_THREAD, DEVICE_ENGINE_ASYNCIO]:
+            raise ValueError('Invalid device engine: {0}'.format(device_engine))
+        self.device_engine = device_engine
+
+        if not with_gateways:
+            # no gateways or simulated meters, messages are passed in with dispatch_message() (e.g. replay of captured traffic)
+            gateway_configs = []
+        elif gateway_config_oride:
+            # used for testing, single gateway or list of gateways
             # dict - e.g. {'network_id': '9.9.9.99', 'gateway_id': '1', 'label': 'Test Gateway', 'serial_port': '/dev/ttys001', 'serial_baud': '9600'}
-            gateway_configs = [gateway_config_oride]
+            gateway_configs = gateway_config_oride if isinstance(gateway_config_oride, list) else [gateway_config_oride]
         else:
             gateway_configs = [x for x in base.config.sections() if x.startswith('Gateway')]
 
@@ -45,17 +67,21 @@ class MeterDeviceManager:
                 self, network_id=gw_config['network_id'], gateway_id=gw_config['gateway_id'],
                 label=gw_config['label'],
                 serial_port=gw_config['serial_port'], serial_baud=gw_config['serial_baud'],
-                log_file=log_file)
-            self.gateways[gateway_uuid]['last_rx_msg_obj'] = ''
+                log_file=log_file, serial_rx_mode=gw_config.get('serial_rx_mode', gway.DEF_SERIAL_RX_MODE.value),
+                serial_tx_rate=gw_config.get('serial_tx_rate', gway.DEF_SERIAL_TX_RATE),
+                gateway_rx_buffer_bytes=gw_config.get('gateway_rx_buffer_bytes', gway.DEF_GATEWAY_RX_BUFFER_BYTES),
+                rx_msg_queue=self.rx_msg_queue, start_serial_thread=(device_engine == DEVICE_ENGINE_THREAD))
             self.gateways[gateway_uuid]['last_snap_time'] = 0
             self.gateways[gateway_uuid]['last_clock_sync_time'] = 0
             self.gateways[gateway_uuid]['sim_meters'] = {}
 
+        self.async_engine = gway_async.AsyncDeviceEngine(self, log_file=log_file) if device_engine == DEVICE_ENGINE_ASYNCIO else None
+
         self.meters = {}
 
         self.meter_man = meter_man  # may be set to None to support testing
 
-        if not gateway_config_oride:
+        if with_gateways and not gateway_config_oride:
             meter_sim_configs = [x for x in base.config.sections() if x.startswith('SimMeter')]
             for meter_sim in meter_sim_configs:
                 meter_sim_config = base.config[meter_sim]
@@ -107,6 +133,7 @@ class MeterDeviceManager:
                 meter_entries_out.append(entry_out)
 
         last_entry = meter_entries_out[-1]
+        metrics.meter_entries_total.inc(amount=len(meter_entries_in))
 
         self.meters[node_uuid]['when_last_meter_entry'] = last_entry['when_start']
         self.meters[node_uuid]['last_meter_value'] = last_entry['meter_value']
@@ -114,12 +141,36 @@ class MeterDeviceManager:
             self.meters[node_uuid]['last_rms_current'] = last_entry['spot_rms_current']
 
         if self.meter_man is not None:
-            self.meter_man.proc_meter_update(node_uuid, meter_entries_out)
+            self.meter_man.proc_meter_update(node_uuid, meter_entries_out, trace=msg_obj.get('trace'))
 
         self.logger.info("Got meter update from node " + node_uuid + ".  Last entry was at " +
                          self.uts_to_str(last_entry['when_start']) + ' value: ' + str(last_entry['meter_value']) + 'Wh')
 
 
+    def proc_meter_update_columns(self, network_id, gateway_uuid, columns):
+        # Batch alternative to proc_meter_update for entries decoded by gateway_messages.get_meter_update_columns, e.g. from a buffer of
+        # many meter update lines.  Columns are passed through to storage as-is.
+        if len(columns.node_ids) == 0:
+            return
+
+        last_entry_idxs = {node_id: i for i, node_id in enumerate(columns.node_ids)}
+        node_uuids = {node_id: self.get_node_uuid(network_id, str(node_id)) for node_id in last_entry_idxs}
+
+        for node_id, i in last_entry_idxs.items():
+            node_uuid = node_uuids[node_id]
+            self.ensure_node_exists(node_uuid, str(node_id), gateway_uuid)
+            self.meters[node_uuid]['when_last_meter_entry'] = columns.when_starts[i]
+            self.meters[node_uuid]['last_meter_value'] = columns.meter_values[i]
+            if not math.isnan(columns.spot_rms_currents[i]):     # MUPC
+                self.meters[node_uuid]['last_rms_current'] = columns.spot_rms_currents[i]
+
+        metrics.meter_entries_total.inc(amount=len(columns.node_ids))
+        if self.meter_man is not None:
+            self.meter_man.proc_meter_update_columns([node_uuids[node_id] for node_id in columns.node_ids], columns)
+
+        self.logger.info("Got {0} meter entries for {1} node(s)".format(len(columns.node_ids), len(node_uuids)))
+
+
     def proc_meter_rebase(self, msg_obj):
         node_id = msg_obj['HEADER_1'].node_id
         node_uuid = self.get_node_uuid(msg_obj['network_id'], node_id)
@@ -188,34 +239,50 @@ class MeterDeviceManager:
         self.logger.info("Got general-purpose message from node: " + node_uuid + " - " + rec.message)
 
 
-    def proc_device_messages(self):
+    def dispatch_message(self, new_msg):
+        metrics.set_trace_point(new_msg, metrics.TRACE_DEQUEUED)
+        try:
+            if new_msg['message_type'] == gmsg.SMSG_MTRUPDATE_NO_IRMS_DEFN['smsg_type']:
+                self.proc_meter_update(new_msg, False)
+            elif new_msg['message_type'] == gmsg.SMSG_MTRUPDATE_WITH_IRMS_DEFN['smsg_type']:
+                self.proc_meter_update(new_msg, True)
+            elif new_msg['message_type'] == gmsg.SMSG_MTRREBASE_DEFN['smsg_type']:
+                self.proc_meter_rebase(new_msg)
+            elif new_msg['message_type'] == gmsg.SMSG_GWSNAP_DEFN['smsg_type']:
+                self.proc_gateway_snapshot(new_msg)
+            elif new_msg['message_type'] == gmsg.SMSG_NODESNAP_DEFN['smsg_type']:
+                self.proc_node_snapshot(new_msg)
+            elif new_msg['message_type'] == gmsg.SMSG_NODEDARK_DEFN['smsg_type']:
+                self.proc_node_dark(new_msg)
+            elif new_msg['message_type'] == gmsg.SMSG_GPMSG_DEFN['smsg_type']:
+                self.proc_gp_msg(new_msg)
+            else:
+                self.logger.warn("Got unknown message object: " + str(new_msg))
+        except Exception as err:
+            self.logger.error("Failed to process message object: " + str(new_msg) + "... " + str(err))
+
+        metrics.messages_total.inc((new_msg['message_type'],))
+        if 'trace' in new_msg:
+            metrics.set_trace_point(new_msg, metrics.TRACE_DISPATCHED)
+            metrics.observe_trace(new_msg['trace'])
+
+
+    def proc_device_messages(self, wait_secs=DEVICE_PROC_WAIT_SECS):
+        # Blocks until gateways queue a message (or wait_secs elapses), then dispatches queued messages in arrival order and runs
+        # periodic gateway tasks.
+        try:
+            self.dispatch_message(self.rx_msg_queue.get(timeout=wait_secs))
+            for i in range(DEVICE_PROC_MAX_BATCH - 1):
+                self.dispatch_message(self.rx_msg_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        self.proc_gateway_tasks()
+
+
+    def proc_gateway_tasks(self):
         # processing per gateway/network
         for key, gateway in self.gateways.items():
-            # queued messages received from gateway, read according to last_rx_msg_obj sequential key
-            new_msgs = {key: value for key, value in gateway['gw_obj'].serial_rx_msg_objects.items() if key > gateway['last_rx_msg_obj']}
-            for key, new_msg in new_msgs.items():
-                try:
-                    if new_msg['message_type'] == gmsg.SMSG_MTRUPDATE_NO_IRMS_DEFN['smsg_type']:
-                        self.proc_meter_update(new_msg, False)
-                    elif new_msg['message_type'] == gmsg.SMSG_MTRUPDATE_WITH_IRMS_DEFN['smsg_type']:
-                        self.proc_meter_update(new_msg, True)
-                    elif new_msg['message_type'] == gmsg.SMSG_MTRREBASE_DEFN['smsg_type']:
-                        self.proc_meter_rebase(new_msg)
-                    elif new_msg['message_type'] == gmsg.SMSG_GWSNAP_DEFN['smsg_type']:
-                        self.proc_gateway_snapshot(new_msg)
-                    elif new_msg['message_type'] == gmsg.SMSG_NODESNAP_DEFN['smsg_type']:
-                        self.proc_node_snapshot(new_msg)
-                    elif new_msg['message_type'] == gmsg.SMSG_NODEDARK_DEFN['smsg_type']:
-                        self.proc_node_dark(new_msg)
-                    elif new_msg['message_type'] == gmsg.SMSG_GPMSG_DEFN['smsg_type']:
-                        self.proc_gp_msg(new_msg)
-                    else:
-                        self.logger.warn("Got unknown message object: " + print(new_msg))
-                except Exception as err:
-                    self.logger.error("Failed to process message object: " + print(new_msg) + "... " + err)
-
-                gateway['last_rx_msg_obj'] = key
-
             if gateway['last_clock_sync_time'] < arrow.utcnow().shift(seconds=-GATEWAY_TIME_SYNC_INTERVAL_SECS).timestamp:
                 gateway['gw_obj'].set_gateway_time()
                 gateway['last_clock_sync_time'] = arrow.utcnow().timestamp
@@ -268,6 +335,11 @@ class MeterDeviceManager:
         sim_meter['value'] = last_meter_value['meter_value'] if last_meter_value is not None else int(start_val)
 
 
+    def get_gateway_tx_stats(self):
+        # outbound serial queue depth and wait times, by gateway uuid
+        return {gateway_uuid: gateway['gw_obj'].get_tx_queue_stats() for gateway_uuid, gateway in self.gateways.items()}
+
+
     def del_meter_sim(self, gateway_uuid, node_uuid):
         if node_uuid in self.gateways[gateway_uuid]['sim_meters']:
             del self.gateways[gateway_uuid]['sim_meters'][node_uuid]
@@ -0,0 +1,261 @@
+'''
+
+================================================================================================================================================================
+Meter Load Simulator
+=====================
+
+Command line script that simulates a gateway with many meter nodes on a pseudo-terminal, for finding the serial and ingest saturation point
+of a meterman host (e.g. a Pi) before adding nodes.  Point a gateway's serial_port at the printed (or --link) device.
+
+Each node sends meter updates of --entries entries every --entries x --interval seconds, staggered across nodes, interleaved on the one
+serial line as a gateway would.  Random events/snapshots can be added with --events.  Commands from the server (S>G:) are answered as the
+gateway would: time set, gateway and node snapshots, and ACKs (or NACKs for unknown nodes) for node settings.
+
+Rate is either real time (--rate realtime) or as fast as the reader takes lines (--rate max), where simulated time runs ahead of the clock.
+--baud caps output at a UART's byte rate, as the PTY itself has no baud limit.  Node ids above 254 are outside the radio's address range
+but are accepted by meterman, so are used for loads beyond one gateway's nodes.
+
+Like meter_file_sim, builds messages with gateway_messages.
+
+Run with --help for more info, e.g.:
+
+    python -m meterman.meter_load_sim --nodes 2000 --rate max --link /tmp/meterman_sim
+
+================================================================================================================================================================
+
+'''
+
+import argparse
+import heapq
+import os
+import select
+import tty
+from random import randint, uniform
+from time import monotonic, sleep, time
+
+from meterman import gateway_messages as gmsg
+
+REPORT_SECS = 5
+COMMAND_POLL_SECS = 0.1
+NODE_SNAPSHOT_MAX_NODES = 10        # nodes per NOSNAP message when all nodes are requested
+ALL_NODES_ID = '254'
+
+
+class MeterLoadSim:
+
+    def __init__(self, master_fd, network_id='0.0.1.1', gateway_id='1', num_nodes=1000, interval=15, entries=7, read_min=0, read_max=10,
+                 irms=False, event_rate=0, real_time=True, baud=0):
+        self.master_fd = master_fd
+        self.network_id = network_id
+        self.gateway_id = gateway_id
+        self.entries = entries
+        self.read_min = read_min
+        self.read_max = read_max
+        self.irms = irms
+        self.event_rate = event_rate        # approx secs between random events per node, 0 for none
+        self.real_time = real_time
+        self.byte_secs = 10.0 / baud if baud > 0 else 0.0   # 8N1 framing
+        self.when_booted = int(time())
+        self.cmd_partial = b''
+        self.next_write_time = monotonic()
+        self.stats = {'lines': 0, 'bytes': 0, 'entries': 0, 'events': 0, 'cmds': 0, 'acks': 0, 'nacks': 0}
+
+        # nodes keyed by node id (str, as in messages), with a heap of (due time, node id) giving the next node to send
+        self.sim_time = time()
+        self.nodes = {}
+        self.due_nodes = []
+        for i in range(num_nodes):
+            node_id = str(i + 2)
+            due_time = self.sim_time + uniform(0, interval * entries)
+            self.nodes[node_id] = {'interval': interval, 'finish': int(due_time) - (interval * entries), 'meter_value': randint(0, 100000),
+                                   'puck_led_rate': 1, 'puck_led_time': 100}
+            heapq.heappush(self.due_nodes, (due_time, node_id))
+
+
+    def write_line(self, message):
+        # writes message as gateway would, paced to baud if set.  Blocks while the reader's PTY buffer is full.
+        data = (gmsg.SMSG_RX_PREFIX + message + '\r\n').encode('latin1')
+        if self.byte_secs > 0:
+            sleep(max(0.0, self.next_write_time - monotonic()))
+            self.next_write_time = max(self.next_write_time, monotonic() - 1.0) + len(data) * self.byte_secs
+        self.stats['lines'] += 1
+        self.stats['bytes'] += len(data)
+        while len(data) > 0:
+            data = data[os.write(self.master_fd, data):]
+
+
+    def get_meter_update_msg(self, node_id):
+        node = self.nodes[node_id]
+        start_timestamp, start_meter_value = node['finish'], node['meter_value']
+        meter_entries = []
+        for i in range(self.entries):
+            entry_value = randint(self.read_min, self.read_max)
+            if self.irms:
+                meter_entries.append(gmsg.SMSG_MTRUPDATE_WITH_IRMS_DEFN['obj_detail_defn'](node['interval'], entry_value, round(uniform(0.1, 20.0), 1)))
+            else:
+                meter_entries.append(gmsg.SMSG_MTRUPDATE_NO_IRMS_DEFN['obj_detail_defn'](node['interval'], entry_value))
+            node['finish'] += node['interval']
+            node['meter_value'] += entry_value
+        self.stats['entries'] += self.entries
+
+        if self.irms:
+            return gmsg.meter_update_with_irms_msg(node_id, start_timestamp, start_meter_value, meter_entries)
+        return gmsg.meter_update_no_irms_msg(node_id, start_timestamp, start_meter_value, meter_entries)
+
+
+    def get_node_snapshot_msg(self, node_ids):
+        detail_recs = []
+        for node_id in node_ids:
+            node = self.nodes[node_id]
+            detail_recs.append({'node_id': node_id, 'batt_voltage': 4500, 'up_time': int(self.sim_time) - self.when_booted, 'sleep_time': 0,
+                                'free_ram': 600, 'when_last_seen': node['finish'], 'last_clock_drift': 0, 'meter_interval': node['interval'],
+                                'meter_impulses_per_kwh': 1000, 'last_meter_entry_finish': node['finish'], 'last_meter_value': node['meter_value'],
+                                'last_rms_current': 0, 'puck_led_rate': node['puck_led_rate'], 'puck_led_time': node['puck_led_time'],
+                                'last_rssi_at_gateway': -60})
+        return gmsg.get_message_str(gmsg.SMSG_NODESNAP_DEFN, detail_recs=detail_recs)
+
+
+    def proc_command(self, message_str):
+        # responds to a command from the server as the gateway would
+        self.stats['cmds'] += 1
+        msg_obj = gmsg.get_message_obj(message_str, None, self.gateway_id, self.network_id)
+        message_type = msg_obj['message_type']
+        rec = msg_obj.get('HEADER_1')
+        node = self.nodes.get(rec.node_id) if rec is not None and hasattr(rec, 'node_id') else None
+
+        if message_type == gmsg.SMSG_SETTIME_DEFN['smsg_type']:
+            self.write_line(gmsg.set_gateway_time_ack_msg())
+        elif message_type == gmsg.SMSG_GETGWSNAP_DEFN['smsg_type']:
+            self.write_line(gmsg.gateway_snapshot_msg(self.gateway_id, self.when_booted, 500, int(self.sim_time), 'INFO', 'CHANGE_ME_PLEASE',
+                                                      self.network_id, 13))
+        elif message_type == gmsg.SMSG_GETNODESNAP_DEFN['smsg_type']:
+            if rec.node_id == ALL_NODES_ID:
+                node_ids = list(self.nodes.keys())
+                for i in range(0, len(node_ids), NODE_SNAPSHOT_MAX_NODES):
+                    self.write_line(self.get_node_snapshot_msg(node_ids[i:i + NODE_SNAPSHOT_MAX_NODES]))
+            elif node is not None:
+                self.write_line(self.get_node_snapshot_msg([rec.node_id]))
+            else:
+                self.write_line(gmsg.get_node_snapshot_nack_msg(rec.node_id))
+                self.stats['nacks'] += 1
+                return
+        elif message_type in [gmsg.SMSG_SETGITR_DEFN['smsg_type'], gmsg.SMSG_SETMTRVAL_DEFN['smsg_type'],
+                              gmsg.SMSG_SETMTRINT_DEFN['smsg_type'], gmsg.SMSG_SETPLED_DEFN['smsg_type']]:
+            if node is None:
+                self.write_line(gmsg.get_message_str(gmsg.message_definitions[message_type + '_NACK'], header={'node_id': rec.node_id}))
+                self.stats['nacks'] += 1
+                return
+            if message_type == gmsg.SMSG_SETMTRVAL_DEFN['smsg_type']:
+                node['meter_value'] = int(rec.new_meter_value)
+            elif message_type == gmsg.SMSG_SETMTRINT_DEFN['smsg_type']:
+                node['interval'] = int(rec.new_meter_interval)
+            elif message_type == gmsg.SMSG_SETPLED_DEFN['smsg_type']:
+                node['puck_led_rate'], node['puck_led_time'] = rec.new_puck_led_rate, rec.new_puck_led_time
+            self.write_line(gmsg.get_message_str(gmsg.message_definitions[message_type + '_ACK'], header={'node_id': rec.node_id}))
+        else:
+            return
+
+        self.stats['acks'] += 1
+
+
+    def proc_commands(self, timeout=0.0):
+        # reads and answers any commands waiting from the server, waiting up to timeout secs for the first
+        while len(select.select([self.master_fd], [], [], timeout)[0]) > 0:
+            timeout = 0.0
+            lines = (self.cmd_partial + os.read(self.master_fd, 4096)).split(b'\n')
+            self.cmd_partial = lines.pop()
+            for line in lines:
+                message_str = line.strip().decode('latin1')
+                if message_str.startswith(gmsg.SMSG_TX_PREFIX):
+                    try:
+                        self.proc_command(message_str[len(gmsg.SMSG_TX_PREFIX):])
+                    except Exception as err:
+                        print('Failed to process command {0}: {1}'.format(message_str, err))
+
+
+    def send_next(self):
+        # sends the next due node's meter update (and maybe a random event), waiting for it in real time mode
+        due_time, node_id = self.due_nodes[0]
+        if self.real_time:
+            while time() < due_time:
+                self.proc_commands(timeout=min(COMMAND_POLL_SECS, max(0.0, due_time - time())))
+        self.sim_time = due_time
+
+        heapq.heapreplace(self.due_nodes, (due_time + self.nodes[node_id]['interval'] * self.entries, node_id))
+        self.write_line(self.get_meter_update_msg(node_id))
+
+        if self.event_rate > 0 and uniform(0, self.event_rate) < self.nodes[node_id]['interval'] * self.entries:
+            self.write_line(gmsg.get_random_gateway_event_msg(node_id))
+            self.stats['events'] += 1
+
+
+    def run(self, secs=0, report_secs=REPORT_SECS):
+        # runs for secs (0 for until interrupted), printing rates every report_secs
+        time_start = monotonic()
+        last_report_time, last_stats = time_start, dict(self.stats)
+        try:
+            while secs == 0 or monotonic() - time_start < secs:
+                self.send_next()
+                self.proc_commands()
+                if monotonic() - last_report_time >= report_secs:
+                    self.print_stats(monotonic() - last_report_time, last_stats)
+                    last_report_time, last_stats = monotonic(), dict(self.stats)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        self.print_stats(monotonic() - time_start)
+
+
+    def print_stats(self, elapsed, last_stats=None):
+        deltas = {key: value - (last_stats[key] if last_stats else 0) for key, value in self.stats.items()}
+        print('load_sim: secs={0:.1f}, lines/sec={1:.0f}, bytes/sec={2:.0f}, entries/sec={3:.0f}, events={4}, cmds={5}, acks={6}, nacks={7}'.format(
+            elapsed, deltas['lines'] / elapsed, deltas['bytes'] / elapsed, deltas['entries'] / elapsed, deltas['events'], deltas['cmds'],
+            deltas['acks'], deltas['nacks']), flush=True)
+
+
+def open_sim_pty(link=None):
+    # returns (master_fd, slave_fd, slave_path) for a raw pseudo-terminal pair, with optional symlink to slave
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    tty.setraw(slave_fd)
+    slave_path = os.ttyname(slave_fd)
+    if link is not None:
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(slave_path, link)
+    return master_fd, slave_fd, slave_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates a gateway with many meter nodes on a pseudo-terminal.")
+    parser.add_argument("--nodes", help="Number of nodes to simulate, with ids from 2.  Defaults to 1000.", type=int, default=1000)
+    parser.add_argument("--network_id", help="Network Id to simulate (octets - 0.0.0.0).  Defaults to 0.0.1.1.", type=str, default="0.0.1.1")
+    parser.add_argument("--gateway_id", help="Gateway Id to simulate.  Defaults to 1.", type=str, default="1")
+    parser.add_argument("--interval", help="Interval for meter entries in seconds.  Defaults to 15.", type=int, default=15)
+    parser.add_argument("--entries", help="Entries per meter update message.  Defaults to 7.", type=int, default=7)
+    parser.add_argument("--read_min", help="Min value for entry generator in Wh.  Defaults to 0.", type=int, default=0)
+    parser.add_argument("--read_max", help="Max value for entry generator in Wh.  Defaults to 10.", type=int, default=10)
+    parser.add_argument('--irms', help="Send meter updates with RMS current (MUPC).  Defaults to false.", action='store_true')
+    parser.add_argument('--events', help="Send random event/snapshot messages.  Defaults to false.", action='store_true')
+    parser.add_argument("--event_rate", help="Approx period in seconds between random events per node.  Defaults to 3600.", type=int, default=3600)
+    parser.add_argument("--rate", help="realtime, or max to send as fast as the reader takes lines.  Defaults to realtime.", type=str,
+                        default='realtime', choices=['realtime', 'max'])
+    parser.add_argument("--baud", help="Cap output at this serial baud rate (0 for no cap).  Defaults to 0.", type=int, default=0)
+    parser.add_argument("--secs", help="Seconds to run (0 to run until Ctrl+C).  Defaults to 0.", type=int, default=0)
+    parser.add_argument("--link", help="Path of symlink to create to the pseudo-terminal, e.g. for gateway serial_port config.", type=str,
+                        default=None)
+    args = parser.parse_args()
+
+    master_fd, slave_fd, slave_path = open_sim_pty(args.link)
+    print('Simulating {0} nodes on {1}{2}'.format(args.nodes, slave_path, ' (' + args.link + ')' if args.link else ''), flush=True)
+
+    load_sim = MeterLoadSim(master_fd, network_id=args.network_id, gateway_id=args.gateway_id, num_nodes=args.nodes, interval=args.interval,
+                            entries=args.entries, read_min=args.read_min, read_max=args.read_max, irms=args.irms,
+                            event_rate=args.event_rate if args.events else 0, real_time=(args.rate == 'realtime'), baud=args.baud)
+    load_sim.run(secs=args.secs)
+
+    if args.link is not None and os.path.islink(args.link):
+        os.remove(args.link)
+
+
+if __name__ == '__main__':
+    main()
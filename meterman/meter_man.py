@@ -14,11 +14,13 @@ not device and data handling; communication with these is async
 
 '''
 
+import atexit
+import signal
+import sys
 from time import sleep
 
 from meterman import app_base as base
 from meterman import meter_device_manager as mdev_mgr
-from meterman import meter_man_api
 from uptime import boottime
 
 from meterman import meter_data_manager as mdata_mgr
@@ -36,19 +38,26 @@ class MeterMan:
         self.data_mgr = mdata_mgr.MeterDataManager(db_file=base.db_file, log_file=base.log_file)
         self.device_mgr = mdev_mgr.MeterDeviceManager(self, log_file=base.log_file)
 
+        atexit.register(self.shutdown)     # commits queued DB writes on exit (incl. SIGTERM, see main)
+
         self.when_server_booted = boottime()
         self.simulate_meter = True
 
         rest_api_config = base.config['RestApi']
         if rest_api_config is not None and rest_api_config.getboolean('run_rest_api'):
+            from meterman import meter_man_api     # imported here so that tools reusing MeterMan (e.g. meter_replay) don't need api/viz packages
             self.api_ctrl = meter_man_api.ApiCtrl(self, rest_api_config.getint('flask_port'), rest_api_config['user'],
                                                   rest_api_config['password'], rest_api_config.getboolean('access_lan_only'),
                                                   log_file=base.log_file)
             self.api_ctrl.run()
 
 
-    def proc_meter_update(self, node_uuid, meter_entries):
-        self.data_mgr.proc_meter_update(node_uuid, meter_entries)
+    def proc_meter_update(self, node_uuid, meter_entries, trace=None):
+        self.data_mgr.proc_meter_update(node_uuid, meter_entries, trace=trace)
+
+
+    def proc_meter_update_columns(self, node_uuids, columns):
+        self.data_mgr.proc_meter_update_columns(node_uuids, columns)
 
 
     def proc_meter_rebase(self, node_uuid, entry_timestamp, meter_value):
@@ -83,17 +92,31 @@ class MeterMan:
         self.device_mgr.proc_device_messages()
 
 
+    def run_device_proc(self):
+        # runs device processing until shutdown
+        if self.device_mgr.async_engine is not None:
+            self.device_mgr.async_engine.run()      # blocks, driving all gateways from one event loop
+        else:
+            while True:
+                self.do_device_proc()           # blocks waiting for device messages
+
+
     def register_node(self, node_uuid):
         pass
 
 
+    def shutdown(self):
+        if self.data_mgr.db_mgr is not None:
+            self.logger.info('Shutting down, closing DB')
+            self.data_mgr.close_db()
+
+
 def main():
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))    # exit normally (running atexit handlers) when stopped as a service
     meter_man = MeterMan()
     sleep(2)    # wait for meterman startup
 
-    while True:
-        meter_man.do_device_proc()
-        sleep(0.5)
+    meter_man.run_device_proc()
 
 if __name__ == '__main__':
     main()
@@ -3,14 +3,17 @@
 import ipaddress
 import threading
 import arrow
-from flask import Flask, make_response, jsonify, request
+from flask import Flask, Response, make_response, jsonify, request
 from flask_httpauth import HTTPBasicAuth
 from flask_restful import reqparse, Api, Resource
 import json
 from meterman import meter_db as db, app_base as base, viz_data
+from meterman import meter_metrics as metrics
+from meterman import meter_analytics
 
 MAX_REQ_ITEMS = 100000
 DEF_REQ_ITEMS = 100
+STREAM_CHUNK_ITEMS = 500        # items per chunk of streamed responses
 REQ_WILDCARDS = {'all', '*'}
 
 api_user = ''
@@ -56,6 +59,23 @@ def unauthorized():
     return make_response(jsonify({'error': 'Unauthorized access'}), 403)
 
 
+def stream_json_result(request_args, result_key, items):
+    # Generates JSON of {'request': request_args, 'result': {result_key: [items]}} a chunk of items (dicts) at a time, so that large
+    # results are sent as they are read rather than built in memory.  Keys are sorted, as by jsonify.
+    yield '{{"request": {0}, "result": {{{1}: ['.format(json.dumps(request_args, sort_keys=True), json.dumps(result_key))
+    chunk = []
+    separator = ''
+    for item in items:
+        chunk.append(json.dumps(item, sort_keys=True))
+        if len(chunk) >= STREAM_CHUNK_ITEMS:
+            yield separator + ', '.join(chunk)
+            chunk = []
+            separator = ', '
+    if len(chunk) > 0:
+        yield separator + ', '.join(chunk)
+    yield ']}}\n'
+
+
 def validate_utc_ts(utc_ts):
     try:
         return base.MIN_TIME <= arrow.get(utc_ts).timestamp <= base.MAX_TIME
@@ -99,15 +119,10 @@ class MeterEntries(Resource):
         if not request_valid:
             return make_response(jsonify({'status': 'Bad Request', 'errors': request_bad_messages}), 400)
 
-        meter_entries = meter_man.data_mgr.get_meter_entries(node_uuid, time_from=time_from, time_to=time_to,
-                                                                    limit_count=item_limit)
-
-        if meter_entries is None:
-            return jsonify({'request': {'node_uuid': node_uuid, 'item_limit': item_limit, 'time_from': time_from, 'time_to': time_to},
-                    'result': {'meter_entries': None}})
-        else:
-            return jsonify({'request': {'node_uuid': node_uuid, 'item_limit': item_limit, 'time_from': time_from, 'time_to': time_to},
-                    'result': {'meter_entries': meter_entries}})
+        # streamed, as up to MAX_REQ_ITEMS entries
+        meter_entries = meter_man.data_mgr.iter_meter_entries(node_uuid, time_from=time_from, time_to=time_to, limit_count=item_limit)
+        return Response(stream_json_result({'node_uuid': node_uuid, 'item_limit': item_limit, 'time_from': time_from, 'time_to': time_to},
+                                           'meter_entries', (entry._asdict() for entry in meter_entries)), mimetype='application/json')
 
 api.add_resource(MeterEntries, '/meterentries/<node_uuid>')
 
@@ -121,10 +136,13 @@ class MeterConsumption(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('time_from', type=int, help='start time as epoch UTC, default is none')
         parser.add_argument('time_to', type=int, help='finish time as epoch UTC, default is none')
+        parser.add_argument('period', type=str, help='one of: {}, for consumption per period (of each node, for all), default is '
+                                                     'none'.format(', '.join(meter_analytics.ANALYTICS_PERIODS)))
         args = parser.parse_args()
 
         time_from = args['time_from']
         time_to = args['time_to']
+        period = args['period'].lower() if args['period'] is not None else None
 
         request_valid = True
         request_bad_messages = []
@@ -134,18 +152,29 @@ class MeterConsumption(Resource):
             request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid time_from.  Must be valid UNIX epoch timestamp '
                                         'on or before time_to, and between {0} and {1}.'.format(base.MIN_TIME, base.MAX_TIME)})
 
-        if time_to is not None and (validate_utc_ts(time_to) is False or time_to < time_from):
+        if time_to is not None and (validate_utc_ts(time_to) is False or (time_from is not None and time_to < time_from)):
             request_valid = False
             request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid time_to.  Must be valid UNIX epoch timestamp '
                                         'on or after time_from, and between {0} and {1}.'.format(base.MIN_TIME, base.MAX_TIME)})
 
-        if node_uuid is None:
+        if period is not None and period not in meter_analytics.ANALYTICS_PERIODS:
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid period.  Must be one of: {}.'.format(
+                                        ', '.join(meter_analytics.ANALYTICS_PERIODS))})
+
+        if node_uuid is None and period is None:
             request_valid = False
             request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Node UUID required.'})
 
         if not request_valid:
             return make_response(jsonify({'status': 'Bad Request', 'errors': request_bad_messages}), 400)
 
+        if period is not None:
+            # long ranges run on the analytical store, if it holds them (see meter_analytics)
+            meter_consumption = meter_man.data_mgr.get_meter_period_consumption(node_uuid, period, time_from=time_from, time_to=time_to)
+            return jsonify({'request': {'node_uuid': node_uuid, 'time_from': time_from, 'time_to': time_to, 'period': period},
+                            'result': {'meter_consumption': meter_consumption}})
+
         mc = meter_man.data_mgr.get_meter_consumption(node_uuid, time_from=time_from, time_to=time_to)
 
         logger.debug('Got consumption request for node {} from {} to {}.  Returned {} Wh, with calc breakdown... {}'.format(node_uuid, time_from, time_to,
@@ -162,6 +191,108 @@ class MeterConsumption(Resource):
 api.add_resource(MeterConsumption, '/meterconsumption/<node_uuid>')
 
 
+class MeterLoads(Resource):
+    # load percentiles of a node, or each node, routed as consumption per period
+    @auth.login_required
+    def get(self, node_uuid):
+        if node_uuid.lower() in REQ_WILDCARDS:
+            node_uuid = None
+        parser = reqparse.RequestParser()
+        parser.add_argument('time_from', type=int, help='start time as epoch UTC, default is none')
+        parser.add_argument('time_to', type=int, help='finish time as epoch UTC, default is none')
+        parser.add_argument('percentiles', type=str, help='comma separated percentiles of load, default is {}'.format(
+                            ','.join(str(percentile) for percentile in meter_analytics.DEF_LOAD_PERCENTILES)))
+        args = parser.parse_args()
+
+        time_from = args['time_from']
+        time_to = args['time_to']
+
+        request_valid = True
+        request_bad_messages = []
+
+        if time_from is not None and validate_utc_ts(time_from) is False:
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid time_from.  Must be valid UNIX epoch timestamp '
+                                        'on or before time_to, and between {0} and {1}.'.format(base.MIN_TIME, base.MAX_TIME)})
+
+        if time_to is not None and (validate_utc_ts(time_to) is False or (time_from is not None and time_to < time_from)):
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid time_to.  Must be valid UNIX epoch timestamp '
+                                        'on or after time_from, and between {0} and {1}.'.format(base.MIN_TIME, base.MAX_TIME)})
+
+        percentiles = meter_analytics.DEF_LOAD_PERCENTILES
+        if args['percentiles'] is not None:
+            try:
+                percentiles = [int(percentile) for percentile in args['percentiles'].split(',')]
+            except ValueError:
+                percentiles = None
+            if percentiles is None or any(not 0 <= percentile <= 100 for percentile in percentiles):
+                request_valid = False
+                request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid percentiles.  Must be whole numbers from 0 to '
+                                            '100, comma separated.'})
+
+        if not request_valid:
+            return make_response(jsonify({'status': 'Bad Request', 'errors': request_bad_messages}), 400)
+
+        meter_loads = meter_man.data_mgr.get_meter_load_percentiles(node_uuid, time_from=time_from, time_to=time_to, percentiles=percentiles)
+
+        return jsonify({'request': {'node_uuid': node_uuid, 'time_from': time_from, 'time_to': time_to, 'percentiles': list(percentiles)},
+                        'result': {'meter_loads': meter_loads}})
+
+api.add_resource(MeterLoads, '/meterloads/<node_uuid>')
+
+
+ROLLUP_BUCKETS = {'hour': db.RollupBucket.HOUR, 'day': db.RollupBucket.DAY, 'local_day': db.RollupBucket.LOCAL_DAY}
+
+class MeterRollups(Resource):
+    # consumption per hour or day, from rollups kept as entries are written
+    @auth.login_required
+    def get(self, node_uuid):
+        if node_uuid.lower() in REQ_WILDCARDS:
+            node_uuid = None
+        parser = reqparse.RequestParser()
+        parser.add_argument('bucket', type=str, help='one of: {}, default is day'.format(', '.join(ROLLUP_BUCKETS.keys())))
+        parser.add_argument('time_from', type=int, help='start time as epoch UTC, default is none')
+        parser.add_argument('time_to', type=int, help='finish time as epoch UTC, default is none')
+        args = parser.parse_args()
+
+        bucket = args['bucket'].lower() if args['bucket'] is not None else 'day'
+        time_from = args['time_from']
+        time_to = args['time_to']
+
+        request_valid = True
+        request_bad_messages = []
+
+        if bucket not in ROLLUP_BUCKETS:
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid bucket.  Must be one of: {}.'.format(
+                                        ', '.join(ROLLUP_BUCKETS.keys()))})
+
+        if time_from is not None and validate_utc_ts(time_from) is False:
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid time_from.  Must be valid UNIX epoch timestamp '
+                                        'on or before time_to, and between {0} and {1}.'.format(base.MIN_TIME, base.MAX_TIME)})
+
+        if time_to is not None and (validate_utc_ts(time_to) is False or (time_from is not None and time_to < time_from)):
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Invalid time_to.  Must be valid UNIX epoch timestamp '
+                                        'on or after time_from, and between {0} and {1}.'.format(base.MIN_TIME, base.MAX_TIME)})
+
+        if node_uuid is None:
+            request_valid = False
+            request_bad_messages.append({'api_error': 'Invalid request', 'message': 'Node UUID required.'})
+
+        if not request_valid:
+            return make_response(jsonify({'status': 'Bad Request', 'errors': request_bad_messages}), 400)
+
+        meter_rollups = meter_man.data_mgr.get_meter_rollups(node_uuid, ROLLUP_BUCKETS[bucket], time_from=time_from, time_to=time_to)
+
+        return jsonify({'request': {'node_uuid': node_uuid, 'bucket': bucket, 'time_from': time_from, 'time_to': time_to},
+                        'result': {'meter_rollups': meter_rollups}})
+
+api.add_resource(MeterRollups, '/meterrollups/<node_uuid>')
+
+
 class GatewaySnapshots(Resource):
     @auth.login_required
     def get(self, gateway_uuid):
@@ -478,6 +609,8 @@ class MeterDataUpload(Resource):
                             help='Meter data in CSV or JSON format.')
         parser.add_argument('lift_later_reads', type=bool,
                             help='Whether to lift later reads.')
+        parser.add_argument('lift_background', type=bool,
+                            help='Whether to lift later reads in the background, with progress at /meterdata/lift/<node_uuid>.')
 
         args = parser.parse_args()
 
@@ -489,6 +622,7 @@ class MeterDataUpload(Resource):
         gen_entry_count = args['gen_entry_count']
         meter_data = args['meter_data']
         lift_later_reads = args['lift_later_reads']
+        lift_background = args['lift_background']
 
         meter_entries = []
 
@@ -552,19 +686,32 @@ class MeterDataUpload(Resource):
         if not request_valid:
             return make_response(jsonify({'status': 'Bad Request', 'errors': request_bad_messages}), 400)
 
-        meter_man.data_mgr.upsert_synth_meter_updates(node_uuid=node_uuid, overwrite_time_from=time_from, overwrite_time_to=time_to, meter_entries=meter_entries,
-                                                            rebase_first=True, lift_later=lift_later_reads)
+        lift_status = meter_man.data_mgr.upsert_synth_meter_updates(node_uuid=node_uuid, overwrite_time_from=time_from, overwrite_time_to=time_to,
+                                                                    meter_entries=meter_entries, rebase_first=True, lift_later=lift_later_reads,
+                                                                    lift_background=lift_background)
 
         return jsonify(
             {'request': {'operation': operation.lower(), 'node_uuid': node_uuid, 'time_from': time_from, 'time_to': time_to,
                          'gen_start_meter_value':gen_start_meter_value, 'gen_entry_value':gen_entry_value,
                          'gen_interval_length': gen_interval_length, 'gen_entry_count':gen_entry_count,
-                         'lift_later_reads':lift_later_reads},
-             'result': {operation.lower(): 'OK.  Data uploaded and prior reads in range marked as deleted.'}})
+                         'lift_later_reads':lift_later_reads, 'lift_background': lift_background},
+             'result': {operation.lower(): 'OK.  Data uploaded and prior reads in range marked as deleted.', 'lift_later': lift_status}})
 
 api.add_resource(MeterDataUpload, '/meterdata/upload/<operation>/<node_uuid>')
 
 
+class MeterDataLift(Resource):
+    # progress of the latest lift of later reads (from an upload with lift_later_reads) of a node, or of each
+    @auth.login_required
+    def get(self, node_uuid):
+        if node_uuid.lower() in REQ_WILDCARDS:
+            node_uuid = None
+
+        return jsonify({'request': {'node_uuid': node_uuid}, 'result': meter_man.data_mgr.get_lift_status(node_uuid)})
+
+api.add_resource(MeterDataLift, '/meterdata/lift/<node_uuid>')
+
+
 class MeterDataPlotter(Resource):
     @auth.login_required
     def get(self, node_uuid):
@@ -601,6 +748,19 @@ class MeterDataPlotter(Resource):
 api.add_resource(MeterDataPlotter, '/meterdata/plot/<node_uuid>')
 
 
+class Metrics(Resource):
+    # ingest counters and latency histograms in Prometheus text format, for scraping
+    @auth.login_required
+    def get(self):
+        if meter_man.device_mgr is not None:
+            metrics.collect_device_metrics(meter_man.device_mgr)
+        response = make_response(metrics.get_metrics_text())
+        response.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return response
+
+api.add_resource(Metrics, '/metrics')
+
+
 class ApiCtrl:
 
     def __init__(self, meter_man_obj, port=8000, user='rest_user', password='change_me_please', lan_only=False, log_file=base.log_file):
@@ -0,0 +1,214 @@
+'''
+
+================================================================================================================================================================
+meter_metrics.py
+=====================
+
+Process-wide counters, gauges and histograms for meterman, rendered in the Prometheus text exposition format (version 0.0.4) by the REST
+API's /metrics endpoint.  Has no client library dependency.
+
+Ingest latency is traced per message: each message object from a gateway carries a 'trace' dict of monotonic timestamps, set as the
+message passes each point below.  When the device manager has dispatched the message, observe_trace() records the time between points as
+per-stage latency histograms.
+
+    serial_read -> parsed -> dequeued -> db_write_start -> db_commit      (DB points for meter updates only)
+                                      -> dispatched
+
+With write-behind (meter_db_writer), meter updates are committed after dispatch: the trace goes with the write, marked db_queued, and the
+writer sets db_write_start and db_commit as its batch is committed and records the db_write stage then.  The dispatch stage (which would
+include the wait for the batch) is not recorded for them; the writer's own lag histogram (db_write_lag_seconds) covers that.
+
+================================================================================================================================================================
+
+'''
+
+import threading
+from time import monotonic
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRIC_PREFIX = 'meterman_'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_ROWS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Trace points, as keys of a message's trace dict
+TRACE_SERIAL_READ = 'serial_read'
+TRACE_PARSED = 'parsed'
+TRACE_DEQUEUED = 'dequeued'
+TRACE_DB_QUEUED = 'db_queued'           # write-behind only, see above
+TRACE_DB_WRITE_START = 'db_write_start'
+TRACE_DB_COMMIT = 'db_commit'
+TRACE_DISPATCHED = 'dispatched'
+
+# Latency stages, as (from, to) trace points
+TRACE_STAGES = {'parse': (TRACE_SERIAL_READ, TRACE_PARSED),
+                'queue': (TRACE_PARSED, TRACE_DEQUEUED),
+                'dispatch': (TRACE_DEQUEUED, TRACE_DB_WRITE_START),
+                'db_write': (TRACE_DB_WRITE_START, TRACE_DB_COMMIT),
+                'total': (TRACE_SERIAL_READ, TRACE_DISPATCHED)}
+
+registry = []       # all metrics, in order of exposition
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(label_names, label_values, extra_labels=()):
+    labels = list(zip(label_names, label_values)) + list(extra_labels)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+class Metric:
+
+    def __init__(self, name, help_text, metric_type, label_names=()):
+        self.name = METRIC_PREFIX + name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.values = {}            # by tuple of label values
+        self.lock = threading.Lock()
+        registry.append(self)
+
+
+    def get_sample_lines(self, label_values, value):
+        return ['{0}{1} {2}'.format(self.name, format_labels(self.label_names, label_values), format_value(value))]
+
+
+    def get_text_lines(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} {1}'.format(self.name, self.metric_type)]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.extend(self.get_sample_lines(label_values, value))
+        return lines
+
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+
+class Counter(Metric):
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, 'counter', label_names)
+
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def set(self, value, labels=()):
+        # for counts kept elsewhere (e.g. gateway line counts), collected at scrape time
+        with self.lock:
+            self.values[labels] = value
+
+
+class Gauge(Metric):
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, 'gauge', label_names)
+
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    # values are [bucket counts..., sum, count] per label values, with bucket counts non-cumulative until rendered
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, 'histogram', label_names)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            hist_values = self.values.get(labels)
+            if hist_values is None:
+                hist_values = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            bucket_idx = len(self.buckets)
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    bucket_idx = i
+                    break
+            hist_values[bucket_idx] += 1
+            hist_values[-2] += value
+            hist_values[-1] += 1
+
+
+    def get_sample_lines(self, label_values, hist_values):
+        lines = []
+        cumulative_count = 0
+        for i, bucket in enumerate(self.buckets + (float('inf'),)):
+            cumulative_count += hist_values[i]
+            lines.append('{0}_bucket{1} {2}'.format(self.name, format_labels(self.label_names, label_values, [('le', format_value(bucket))]),
+                                                    cumulative_count))
+        lines.append('{0}_sum{1} {2}'.format(self.name, format_labels(self.label_names, label_values), format_value(hist_values[-2])))
+        lines.append('{0}_count{1} {2}'.format(self.name, format_labels(self.label_names, label_values), hist_values[-1]))
+        return lines
+
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------------------
+#  METRICS
+# --------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+ingest_stage_seconds = Histogram('ingest_stage_seconds', 'Latency of message ingest stages, from serial read to DB commit.', ['stage'])
+messages_total = Counter('messages_total', 'Messages dispatched by the device manager.', ['message_type'])
+meter_entries_total = Counter('meter_entries_total', 'Meter entries received in meter updates.')
+rx_msg_queue_dropped_total = Counter('rx_msg_queue_dropped_total', 'Messages dropped as the device manager receive queue was full.', ['gateway_uuid'])
+rx_msg_queue_depth = Gauge('rx_msg_queue_depth', 'Messages waiting in the device manager receive queue.')
+serial_rx_lines_total = Counter('serial_rx_lines_total', 'Lines read from gateway serial ports.', ['gateway_uuid'])
+serial_tx_queue_depth = Gauge('serial_tx_queue_depth', 'Commands waiting in gateway outbound queues.', ['gateway_uuid'])
+serial_tx_msgs_total = Counter('serial_tx_msgs_total', 'Commands written to gateways.', ['gateway_uuid'])
+serial_tx_writes_total = Counter('serial_tx_writes_total', 'Serial writes to gateways (commands are batched into writes).', ['gateway_uuid'])
+serial_tx_wait_seconds_avg = Gauge('serial_tx_wait_seconds_avg', 'Average time commands waited in gateway outbound queues.', ['gateway_uuid'])
+serial_tx_wait_seconds_max = Gauge('serial_tx_wait_seconds_max', 'Longest time a command waited in a gateway outbound queue.', ['gateway_uuid'])
+db_write_queue_rows = Gauge('db_write_queue_rows', 'Rows queued for the DB writer thread (write-behind).')
+db_flushes_total = Counter('db_flushes_total', 'Transactions committed by the DB writer thread.')
+db_flush_rows = Histogram('db_flush_rows', 'Rows committed per DB writer transaction.', buckets=FLUSH_ROWS_BUCKETS)
+db_flush_seconds = Histogram('db_flush_seconds', 'Time to write and commit a DB writer transaction.')
+db_write_lag_seconds = Histogram('db_write_lag_seconds', 'Time from a write being queued for the DB writer to its commit.')
+
+
+def observe_trace(trace, stages=None):
+    # Records latency of each stage (of stages, or all) for which both trace points were set.  For a write-behind message, stages ending at
+    # DB points are left to the DB writer, which records them once committed.
+    for stage, (trace_from, trace_to) in TRACE_STAGES.items():
+        if stages is None and TRACE_DB_QUEUED in trace and trace_to in (TRACE_DB_WRITE_START, TRACE_DB_COMMIT):
+            continue
+        if (stages is None or stage in stages) and trace_from in trace and trace_to in trace:
+            ingest_stage_seconds.observe(trace[trace_to] - trace[trace_from], (stage,))
+
+
+def set_trace_point(msg_obj, trace_point, when=None):
+    # sets trace point on message object if it is being traced (i.e. came from a gateway)
+    trace = msg_obj.get('trace')
+    if trace is not None:
+        trace[trace_point] = monotonic() if when is None else when
+
+
+def collect_device_metrics(device_mgr):
+    # updates metrics kept by gateways and the device manager, called before rendering
+    rx_msg_queue_depth.set(device_mgr.rx_msg_queue.qsize())
+    for gateway_uuid, gateway in device_mgr.gateways.items():
+        serial_rx_lines_total.set(gateway['gw_obj'].rx_line_count, (gateway_uuid,))
+    for gateway_uuid, tx_stats in device_mgr.get_gateway_tx_stats().items():
+        serial_tx_queue_depth.set(tx_stats['depth'], (gateway_uuid,))
+        serial_tx_msgs_total.set(tx_stats['msg_count'], (gateway_uuid,))
+        serial_tx_writes_total.set(tx_stats['write_count'], (gateway_uuid,))
+        serial_tx_wait_seconds_avg.set(tx_stats['wait_avg'], (gateway_uuid,))
+        serial_tx_wait_seconds_max.set(tx_stats['wait_max'], (gateway_uuid,))
+
+
+def get_metrics_text():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.get_text_lines())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+'''
+
+================================================================================================================================================================
+Meter Replay
+=====================
+
+Command line script that replays captured gateway serial traffic (G>S: lines) through the message parser, MeterDeviceManager and
+MeterDataManager into a database, as fast as the pipeline allows.  Used to backfill a fresh database from archived captures and to measure
+end-to-end ingest throughput without hardware.
+
+Accepts lines in any of these forms, mixed:
+
+    2017-12-11 10:00:00 - gateway - DEBUG - Got serial data: G>S:MUP_;2,MUP_,1496842913,18829393;15,1;15,5     (meterman log)
+    1512986400,G>S:MUP_;2,MUP_,1496842913,18829393;15,1;15,5                                                   (UTC epoch prefix)
+    G>S:MUP_;2,MUP_,1496842913,18829393;15,1;15,5                                                              (e.g. meter_file_sim --serial)
+
+Receipt times from log timestamps (local time) or epoch prefixes are kept as the message's when_received; bare lines are stamped with the
+time of replay.  Other lines are skipped.
+
+Run with --help for more info, e.g.:
+
+    python -m meterman.meter_replay --db_file /temp/backfill.db --batch 500 capture1.log capture2.log
+
+================================================================================================================================================================
+
+'''
+
+import argparse
+import logging
+import re
+from time import monotonic
+
+import arrow
+
+from meterman import app_base as base
+from meterman import gateway_messages as gmsg
+from meterman import meter_data_manager as mdata_mgr
+from meterman import meter_device_manager as mdev_mgr
+from meterman import meter_man as mman
+
+LOG_LINE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - .*?(' + gmsg.SMSG_RX_PREFIX + r'.*?)\s*$')
+EPOCH_LINE_PATTERN = re.compile(r'^(\d{9,11})[,\s]+(' + gmsg.SMSG_RX_PREFIX + r'.*?)\s*$')
+LOG_TIME_FORMAT = 'YYYY-MM-DD HH:mm:ss'
+METER_UPDATE_PREFIXES = (gmsg.SMSG_RX_PREFIX + gmsg.SMSG_MTRUPDATE_NO_IRMS_DEFN['smsg_type'] + gmsg.SMSG_RS,
+                         gmsg.SMSG_RX_PREFIX + gmsg.SMSG_MTRUPDATE_WITH_IRMS_DEFN['smsg_type'] + gmsg.SMSG_RS)
+
+
+class ReplayMeterMan(mman.MeterMan):
+    # MeterMan without app init, REST API or gateways - device manager only receives messages passed to dispatch_message()
+
+    def __init__(self, db_file=base.db_file, log_file=base.log_file):
+        self.logger = base.get_logger(logger_name='meter_replay', log_file=log_file)
+        self.data_mgr = mdata_mgr.MeterDataManager(db_file=db_file, log_file=log_file)
+        self.device_mgr = mdev_mgr.MeterDeviceManager(self, log_file=log_file, with_gateways=False)
+
+
+class MeterReplay:
+
+    def __init__(self, network_id, gateway_id, db_file=base.db_file, log_file=base.log_file, batch_size=0):
+        self.meter_man = ReplayMeterMan(db_file=db_file, log_file=log_file)
+        self.device_mgr = self.meter_man.device_mgr
+        self.network_id = network_id
+        self.gateway_id = gateway_id
+        self.gateway_uuid = self.device_mgr.get_node_uuid(network_id, gateway_id)
+        self.batch_size = batch_size        # if > 0, consecutive meter updates are stored in batches of this many lines via decoded columns
+        self.meter_update_batch = []
+        self.last_log_time_str = None
+        self.last_log_time = None
+        self.stats = {'lines': 0, 'msgs': 0, 'skipped': 0}
+
+
+    def parse_line(self, line):
+        # returns (when_received, message_str) for a captured line, when_received is None if line has no timestamp
+        if line.startswith(gmsg.SMSG_RX_PREFIX):
+            return None, line.strip()
+
+        match = EPOCH_LINE_PATTERN.match(line)
+        if match:
+            return int(match.group(1)), match.group(2)
+
+        match = LOG_LINE_PATTERN.match(line)
+        if match:
+            # many lines share a log timestamp, so keep the last one parsed
+            if match.group(1) != self.last_log_time_str:
+                self.last_log_time = arrow.get(match.group(1), LOG_TIME_FORMAT).replace(tzinfo='local').timestamp
+                self.last_log_time_str = match.group(1)
+            return self.last_log_time, match.group(2)
+
+        return None, None
+
+
+    def flush_meter_updates(self):
+        if len(self.meter_update_batch) > 0:
+            self.device_mgr.proc_meter_update_columns(self.network_id, self.gateway_uuid, gmsg.get_meter_update_columns(self.meter_update_batch))
+            self.meter_update_batch = []
+
+
+    def replay_message(self, message_str, when_received=None):
+        if self.batch_size > 0 and message_str.startswith(METER_UPDATE_PREFIXES):
+            self.meter_update_batch.append(message_str)
+            if len(self.meter_update_batch) >= self.batch_size:
+                self.flush_meter_updates()
+            return
+
+        self.flush_meter_updates()      # keep order with other messages
+        msg_obj = gmsg.get_message_obj(message_str, self.gateway_uuid, self.gateway_id, self.network_id, when_received=when_received)
+        self.device_mgr.dispatch_message(msg_obj)
+
+
+    def replay_lines(self, lines):
+        for line in lines:
+            self.stats['lines'] += 1
+            when_received, message_str = self.parse_line(line)
+            if message_str is None:
+                self.stats['skipped'] += 1
+                continue
+            try:
+                self.replay_message(message_str, when_received)
+                self.stats['msgs'] += 1
+            except Exception as err:
+                self.stats['skipped'] += 1
+                self.meter_man.logger.warn('Skipped line {0}: {1}'.format(self.stats['lines'], err))
+
+        self.flush_meter_updates()
+        return self.stats
+
+
+    def close(self):
+        self.meter_man.data_mgr.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays captured gateway serial traffic into a database as fast as possible.")
+    parser.add_argument("files", help="Capture files (meterman logs, epoch-prefixed or bare G>S: lines).", nargs='+')
+    parser.add_argument("--db_file", help="Database file to write to.  Defaults to " + base.db_file, type=str, default=base.db_file)
+    parser.add_argument("--log_file", help="Log file.  Defaults to " + base.log_file, type=str, default=base.log_file)
+    parser.add_argument("--log_level", help="Log level for replay.  Defaults to WARNING.", type=str, default='WARNING')
+    parser.add_argument("--network_id", help="Network Id of gateway that captured traffic.  Defaults to 0.0.1.1.", type=str, default="0.0.1.1")
+    parser.add_argument("--gateway_id", help="Id of gateway that captured traffic.  Defaults to 1.", type=str, default="1")
+    parser.add_argument("--batch", help="Store meter updates in batches of this many lines (0 to store per message).  Defaults to 0.", type=int,
+                        default=0)
+    args = parser.parse_args()
+
+    base.log_level = args.log_level.upper()
+    replay = MeterReplay(args.network_id, args.gateway_id, db_file=args.db_file, log_file=args.log_file, batch_size=args.batch)
+    for logger_name in ['meter_replay', 'device_mgr', 'data_mgr', 'db_mgr']:
+        logging.getLogger(logger_name).setLevel(base.log_level)
+
+    time_start = monotonic()
+    for file_name in args.files:
+        with open(file_name, 'r', encoding='latin1') as replay_file:
+            stats = replay.replay_lines(replay_file)
+    elapsed = monotonic() - time_start
+    replay.close()
+
+    print('replay: lines={0}, msgs={1}, skipped={2}, secs={3:.2f}, msgs/sec={4:.0f}'.format(
+        stats['lines'], stats['msgs'], stats['skipped'], elapsed, stats['msgs'] / elapsed if elapsed > 0 else 0.0))
+
+
+if __name__ == '__main__':
+    main()
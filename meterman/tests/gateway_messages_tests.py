@@ -54,4 +54,32 @@ def test_make_set_node_puck_led_msg():
 
 def test_meter_update_to_transfer_obj():
     res = gmsg.get_message_obj('MTRUPDATE;2,MUP;1483228800,100000;10,1;10,5;10,3')
-    print(res)
\ No newline at end of file
+    print(res)
+
+def test_precompiled_layout_matches_attrib_parse():
+    for message_str in ['G>S:MUP_;2,MUP_,1483228800,100000;10,1;10,5;10,3', 'G>S:MUPC;2,MUPC,1483228800,100000;10,1,10.2;10,5,10.7;',
+                        'G>S:NOSNAP;2,4500,15000,20000,600,1483228800,500,5,1000,1483228800,3050,0.1,100,1000,-70',
+                        'G>S:GWSNAP;1,1483228800,577,1483228800,DEBUG,CHANGE_ME_PLEASE,0.0.1.1,13', 'G>S:SGITR_ACK;2', 'G>S:GTIME']:
+        res = gmsg.get_message_obj(message_str, 'uuid', '1', '0.0.1.1')
+        msg_in_records = list(filter(None, message_str.replace(gmsg.SMSG_RX_PREFIX, '').split(gmsg.SMSG_RS)))
+        assert res == gmsg.get_message_obj_by_attrib(msg_in_records, 'uuid', '1', '0.0.1.1', res['when_received'])
+
+
+def test_precompiled_layout_detail_fields():
+    res = gmsg.get_message_obj('G>S:MUPC;2,MUPC,1483228800,100000;10,1,10.2;10,5,10.7', 'uuid', '1', '0.0.1.1')
+    assert res['header_count'] == 1 and res['detail_count'] == 2
+    assert res['HEADER_1'].node_id == '2'
+    assert res['DETAIL_3'] == ('10', '5', '10.7')
+
+
+def test_meter_update_columns():
+    res = gmsg.get_meter_update_columns('G>S:MUP_;2,MUP_,1483228800,100000;10,1;10,5;10,3\r\n'
+                                        'G>S:GTIME\r\n'
+                                        'G>S:MUPC;3,MUPC,1483228800,500;15,2,10.2;15,4,10.7;\r\n')
+    # start times and meter values accumulate from header as in MeterDeviceManager.proc_meter_update
+    assert list(res.node_ids) == [2, 2, 2, 3, 3]
+    assert list(res.when_starts) == [1483228811, 1483228821, 1483228831, 1483228816, 1483228831]
+    assert list(res.entry_intervals) == [10, 10, 10, 15, 15]
+    assert list(res.entry_values) == [1, 5, 3, 2, 4]
+    assert list(res.meter_values) == [100001, 100006, 100009, 502, 506]
+    assert list(res.spot_rms_currents)[3:] == [10.2, 10.7]
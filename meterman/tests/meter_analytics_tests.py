@@ -0,0 +1,108 @@
+import glob
+import os
+import shutil
+
+from meterman import app_base as base
+import pytest as pt
+
+from meterman import meter_analytics as analytics
+from meterman import meter_db as db
+
+TEST_DB_FILE = base.temp_path + "/meter_analytics_test.db"
+NODE_UUIDS = ["99.99.99.99.1", "99.99.99.99.2"]
+TIME_START = 1514764800         # 2018-01-01 00:00 UTC
+
+
+def remove_test_db():
+    for db_file in glob.glob(TEST_DB_FILE[:-3] + '*'):
+        if os.path.isdir(db_file):
+            shutil.rmtree(db_file)
+        else:
+            os.remove(db_file)
+
+
+@pt.fixture(scope="function")
+def db_mgr():
+    # hourly entries over 3 months for two nodes, the second rising twice as fast, with a rebase to 0 in February and a deleted entry
+    remove_test_db()
+    fixt_db_mgr = db.DBManager(TEST_DB_FILE, shard_by_month=True)
+    entries = []
+    for node_idx, node_uuid in enumerate(NODE_UUIDS):
+        for i in range(90 * 24):
+            when_start = TIME_START + (i * 3600)
+            meter_value = (i * (node_idx + 1) * 10) if i < 40 * 24 else ((i - (40 * 24)) * (node_idx + 1) * 10)
+            entries.append((node_uuid, when_start, db.get_entry_nonce("MUP"), when_start, "MUP", (node_idx + 1) * 10 + (i % 5), 3600, meter_value,
+                            "NORM"))
+        entries.append((node_uuid, TIME_START + (40 * 86400), db.get_entry_nonce("MREB"), TIME_START + (40 * 86400), "MREB", 0, 0, 0, "NORM"))
+    entries.append((NODE_UUIDS[0], TIME_START + 1800, db.get_entry_nonce("MUP"), TIME_START + 1800, "MUP", 999, 3600, 999, "DEL"))
+    fixt_db_mgr.write_meter_entries(entries)
+    yield fixt_db_mgr
+    fixt_db_mgr.conn_close()
+    remove_test_db()
+
+
+def get_normal_entries(db_mgr, node_uuid=None, time_from=None, time_to=None):
+    return db_mgr.iter_node_meter_entries(node_uuid, rec_status="NORM", time_from=time_from, time_to=time_to)
+
+
+def test_period_consumption_as_rollups(db_mgr):
+    days = analytics.get_entries_period_consumption(get_normal_entries(db_mgr), 'day')
+    for node_uuid in NODE_UUIDS:
+        rollups = db_mgr.get_meter_rollups(node_uuid, db.RollupBucket.DAY)
+        assert [(row['period_start'], row['consumption'], row['sample_count']) for row in days if row['node_uuid'] == node_uuid] == \
+            [(row['bucket_start'], row['consumption'], row['sample_count']) for row in rollups]
+
+    # months from February, the first entry rising from the last of January
+    time_from = TIME_START + (31 * 86400)
+    months = analytics.get_entries_period_consumption(get_normal_entries(db_mgr, time_from=analytics.get_lookback_from(time_from)), 'month', time_from)
+    assert [(row['node_uuid'], row['period_start'], row['consumption'], row['sample_count']) for row in months] == \
+        [(NODE_UUIDS[0], time_from, 10 * ((28 * 24) - 1), 28 * 24), (NODE_UUIDS[0], time_from + (28 * 86400), 10 * 31 * 24, 31 * 24),
+         (NODE_UUIDS[1], time_from, 20 * ((28 * 24) - 1), 28 * 24), (NODE_UUIDS[1], time_from + (28 * 86400), 20 * 31 * 24, 31 * 24)]
+    years = analytics.get_entries_period_consumption(get_normal_entries(db_mgr, NODE_UUIDS[1]), 'year')
+    assert [(row['period_start'], row['sample_count']) for row in years] == [(TIME_START, 90 * 24)]
+
+
+def test_load_percentiles(db_mgr):
+    loads = analytics.get_entries_load_percentiles(get_normal_entries(db_mgr, time_to=TIME_START + (5 * 3600) - 1), (0, 50, 90, 100))
+    assert loads == [{'node_uuid': NODE_UUIDS[0], 'sample_count': 5, 'load_p0': 10.0, 'load_p50': 12.0, 'load_p90': 13.6, 'load_p100': 14.0},
+                     {'node_uuid': NODE_UUIDS[1], 'sample_count': 5, 'load_p0': 20.0, 'load_p50': 22.0, 'load_p90': 23.6, 'load_p100': 24.0}]
+
+
+def test_analytics_store(db_mgr):
+    pt.importorskip('duckdb')
+    store = analytics.MeterAnalytics(db_mgr)
+    now = TIME_START + (95 * 86400)         # January and February finalized, March not
+    assert store.get_export_months(now) == [201801, 201802]
+    steps = []
+    while True:
+        step = store.export_next(now)
+        if step is None:
+            break
+        steps.append(step)
+    assert steps == [(201801, (31 * 24 * 2) + 1), (201802, (28 * 24 * 2) + 2)]
+
+    # long ranges of exported months run on the store, with the same results as on SQLite
+    time_from = TIME_START + (10 * 86400)
+    time_to = TIME_START + (59 * 86400) - 1
+    assert store.is_covered(time_from, time_to)
+    assert not store.is_covered(time_from, time_from + 86400)
+    assert not store.is_covered(time_from, time_to + 86400)
+    for period in analytics.ANALYTICS_PERIODS:
+        assert store.get_period_consumption(None, period, time_from, time_to) == analytics.get_entries_period_consumption(
+            get_normal_entries(db_mgr, time_from=analytics.get_lookback_from(time_from), time_to=time_to), period, time_from)
+    sqlite_loads = analytics.get_entries_load_percentiles(get_normal_entries(db_mgr, NODE_UUIDS[0], time_from, time_to))
+    store_loads = store.get_load_percentiles(NODE_UUIDS[0], time_from, time_to)
+    assert [sorted(loads) for loads in store_loads] == [sorted(loads) for loads in sqlite_loads]
+    assert all(store_loads[0][key] == pt.approx(value) for key, value in sqlite_loads[0].items() if key != 'node_uuid')
+
+    # a change to an exported month leaves it stale until exported again
+    db_mgr.update_meter_entry(NODE_UUIDS[0], TIME_START + (31 * 86400), db.get_entry_nonce("MUP"), None, None, None, None, None, "DEL")
+    assert not store.is_covered(time_from, time_to)
+    assert store.export_next(now) == (201802, (28 * 24 * 2) + 2)
+    assert store.is_covered(time_from, time_to)
+
+    # manifest is kept across restarts
+    store.close()
+    store = analytics.MeterAnalytics(db_mgr)
+    assert store.is_covered(time_from, time_to)
+    store.close()
@@ -3,7 +3,7 @@ import string
 import time
 import os
 
-from meterman import app_base as base, meter_db as db, meter_data_manager as mdm
+from meterman import app_base as base, meter_db as db, meter_data_manager as mdm, gateway_messages as gmsg
 import pytest as pt
 
 
@@ -169,3 +169,51 @@ def test_consumption_with_multiple_rebases_none_upfront(data_mgr):
     # consumption should be 1250 - 1100 + 20 == 170Wh; starting at 1005 as there is no baseline read
     assert data_mgr.get_meter_consumption(node_uuid) == 170
     data_mgr.db_mgr.delete_all_meter_entries(node_uuid)
+
+
+def test_proc_meter_update_columns(data_mgr):
+    node_uuid = "99.99.99.99.3"
+    columns = gmsg.get_meter_update_columns('G>S:MUP_;3,MUP_,{0},1000;60,5;60,5;60,5'.format(base.MIN_TIME))
+    data_mgr.proc_meter_update_columns([node_uuid] * len(columns.node_ids), columns)
+
+    row = data_mgr.db_mgr.get_last_mup(node_uuid, time_from=None, time_to=None)
+    assert row['when_start'] == base.MIN_TIME + 1 + 180
+    assert row['meter_value'] == 1015
+    assert data_mgr.db_mgr.get_node_meter_entries_count(node_uuid) == 3
+
+
+def test_upsert_synth_lift_later(data_mgr, monkeypatch):
+    node_uuid = "99.99.99.99.4"
+    monkeypatch.setattr(db, 'CORRECTION_WINDOW_SECS', 3600)     # several windows
+    data_mgr.db_mgr.write_meter_entries([(node_uuid, base.MIN_TIME + (i * 900), db.get_entry_nonce('MUP'), base.MIN_TIME + (i * 900), 'MUP', 5, 900,
+                                          1000 + (5 * i), 'NORM') for i in range(20)])
+
+    # later entries continue from the last synthetic entry, keeping their differences
+    synth_entries = [{'when_start': base.MIN_TIME + (i * 900), 'entry_value': 10, 'entry_interval_length': 900, 'meter_value': 2000 + (10 * i)}
+                     for i in range(4)]
+    status = data_mgr.upsert_synth_meter_updates(node_uuid, base.MIN_TIME, base.MIN_TIME + 2700, synth_entries, lift_later=True)
+    assert status['shift'] == 2030 + 5 - 1020 and status['entry_count'] == 16 and status['state'] == 'done'
+    entries = data_mgr.db_mgr.get_node_meter_entries(node_uuid, entry_type='MUP', rec_status='NORM', limit_count=None)
+    assert [row['meter_value'] for row in entries] == [2030 + (5 * i) for i in range(1, 17)]
+    assert data_mgr.get_meter_consumption(node_uuid)['meter_consumption'] == 2110 - 2000
+
+    # in the background
+    synth_entries[-1]['meter_value'] = 3000
+    status = data_mgr.upsert_synth_meter_updates(node_uuid, base.MIN_TIME, base.MIN_TIME + 2700, synth_entries, lift_later=True, lift_background=True)
+    assert status['state'] == 'running'
+    for lift_thread in data_mgr.lift_threads:
+        lift_thread.join()
+    assert data_mgr.get_lift_status(node_uuid)[0]['state'] == 'done'
+    assert data_mgr.db_mgr.get_last_mup(node_uuid, time_from=None, time_to=None)['meter_value'] == 3000 + (5 * 16)
+
+    # errors other than the DB's (e.g. an unreadable archive file) fail the lift rather than end its thread
+    def fail_shift(*args):
+        raise OSError('archive file missing')
+    monkeypatch.setattr(data_mgr.db_mgr, 'shift_meter_values', fail_shift)
+    synth_entries[-1]['meter_value'] = 4000
+    status = data_mgr.upsert_synth_meter_updates(node_uuid, base.MIN_TIME, base.MIN_TIME + 2700, synth_entries, lift_later=True, lift_background=True)
+    for lift_thread in data_mgr.lift_threads:
+        lift_thread.join()
+    assert data_mgr.get_lift_status(node_uuid)[0]['state'] == 'failed'
+    assert data_mgr.upsert_synth_meter_updates(node_uuid, base.MIN_TIME, base.MIN_TIME + 2700, synth_entries, lift_later=True)['state'] == 'failed'
+    data_mgr.db_mgr.delete_all_meter_entries(node_uuid)
@@ -0,0 +1,117 @@
+import glob
+import os
+import shutil
+import time
+
+from meterman import app_base as base
+import pytest as pt
+
+from meterman import meter_db as db
+from meterman import meter_db_maint as db_maint
+
+TEST_DB_FILE = base.temp_path + "/meter_db_maint_test.db"
+NODE_UUID = "99.99.99.99.1"
+
+
+@pt.fixture(scope="function")
+def db_mgr():
+    fixt_db_mgr = db.DBManager(TEST_DB_FILE, shard_by_month=True)
+    yield fixt_db_mgr
+    fixt_db_mgr.conn_close()
+    for db_file in glob.glob(TEST_DB_FILE[:-3] + '*'):
+        if os.path.isdir(db_file):
+            shutil.rmtree(db_file)
+        else:
+            os.remove(db_file)
+
+
+def test_downsample_tiers(db_mgr):
+    maint = db_maint.DBMaintainer(db_mgr, raw_days=0)
+    assert maint.get_downsample_tiers() == []
+    maint.close()
+
+    now = 1520000000       # 2018-03-02 14:13:20 UTC
+    maint = db_maint.DBMaintainer(db_mgr, raw_days=7, fine_months=1, interval_mins=60)
+    assert maint.get_downsample_tiers(now) == [(db.DOWNSAMPLE_5MIN_SECS, now - (7 * 86400)), (db.DOWNSAMPLE_HOUR_SECS, 1517443200)]
+    maint.close()
+
+
+def test_background_downsampling(db_mgr):
+    # 15 sec entries over two days, across a month end, are downsampled to hourly in the background (but the first, which the rest rise from)
+    time_start = 1517356800     # 2018-01-31 00:00 UTC
+    db_mgr.write_meter_entries([(NODE_UUID, time_start + (i * 15), 'AA', time_start + (i * 15), "MUP", 1, 15, i, "NORM") for i in range(11520)])
+    maint = db_maint.DBMaintainer(db_mgr, raw_days=7, fine_months=1, interval_mins=60)
+    for i in range(100):
+        if db_mgr.get_node_meter_entries_count(NODE_UUID) == 49:
+            break
+        time.sleep(0.1)
+    maint.close()
+
+    entries = db_mgr.get_node_meter_entries(NODE_UUID, limit_count=None)
+    assert len(entries) == 49
+    assert [(row['entry_value'], row['duration']) for row in entries[:2]] == [(1, 15), (239, 3585)]
+    assert all(row['entry_value'] == 240 and row['duration'] == 3600 for row in entries[2:])
+    assert entries[-1]['meter_value'] == 11519
+
+
+def test_background_archiving(db_mgr):
+    # entries are downsampled, then archived, with the same entries read back
+    time_start = 1517356800
+    db_mgr.write_meter_entries([(NODE_UUID, time_start + (i * 15), 'AA', time_start + (i * 15), "MUP", 1, 15, i, "NORM") for i in range(11520)])
+    maint = db_maint.DBMaintainer(db_mgr, raw_days=7, fine_months=1, archive_months=2, interval_mins=60)
+    for i in range(100):
+        if db_mgr.archive_range == (time_start, time_start + (2 * 86400)):
+            break
+        time.sleep(0.1)
+    maint.close()
+
+    with db_mgr.read_connection() as connection:
+        assert list(db_mgr.iter_table_meter_entries(connection, NODE_UUID, None, None, None, None, None)) == []
+    entries = db_mgr.get_node_meter_entries(NODE_UUID, limit_count=None)
+    assert len(entries) == 49 and entries[-1]['meter_value'] == 11519
+    assert db_mgr.get_meter_entry(NODE_UUID, is_first=False)['when_start'] == time_start + (47 * 3600)
+
+
+def test_background_analytics_export(db_mgr):
+    # finalized months are exported to the analytical store
+    analytics = pt.importorskip('meterman.meter_analytics')
+    pt.importorskip('duckdb')
+    time_start = 1517356800
+    db_mgr.write_meter_entries([(NODE_UUID, time_start + (i * 900), 'AA', time_start + (i * 900), "MUP", 1, 900, i, "NORM") for i in range(192)])
+    store = analytics.MeterAnalytics(db_mgr)
+    maint = db_maint.DBMaintainer(db_mgr, analytics=store, interval_mins=60)
+    for i in range(100):
+        if 201802 in store.manifest:
+            break
+        time.sleep(0.1)
+    maint.close()
+
+    assert store.manifest[201801]['rows'] == 96 and store.manifest[201802]['rows'] == 96
+    assert store.get_period_consumption(NODE_UUID, 'month', time_start - (30 * 86400), time_start + (30 * 86400)) == \
+        [{'node_uuid': NODE_UUID, 'period_start': 1514764800, 'consumption': 95, 'sample_count': 96},
+         {'node_uuid': NODE_UUID, 'period_start': time_start + 86400, 'consumption': 96, 'sample_count': 96}]
+    store.close()
+
+
+def get_free_pages(db_mgr):
+    with db_mgr.write_lock:
+        return sum(db_mgr.connection.execute('PRAGMA {0}.freelist_count'.format(schema)).fetchone()[0] for schema in db_mgr.get_file_schemas())
+
+
+def test_idle_vacuum(db_mgr):
+    # free pages are released once the DB is idle, not while it is being written
+    time_start = 1517356800
+    db_mgr.write_meter_entries([(NODE_UUID, time_start + (i * 15), 'AA', time_start + (i * 15), "MUP", 1, 15, i, "NORM") for i in range(5760)])
+    db_mgr.purge_meter_entries_in_range(NODE_UUID, time_start, time_start + 86400)
+    free_pages = get_free_pages(db_mgr)
+    assert free_pages > 0
+
+    maint = db_maint.DBMaintainer(db_mgr, interval_mins=60, idle_secs=0.5)
+    time.sleep(0.2)
+    assert get_free_pages(db_mgr) == free_pages
+    for i in range(30):
+        if get_free_pages(db_mgr) == 0:
+            break
+        time.sleep(0.1)
+    maint.close()
+    assert get_free_pages(db_mgr) == 0
@@ -0,0 +1,191 @@
+import glob
+import os
+
+from meterman import app_base as base
+import pytest as pt
+
+from meterman import meter_db as db
+from meterman import meter_db_migrations as db_migrations
+
+TEST_DB_FILE = base.temp_path + "/meter_db_migrations_test.db"
+NODE_UUID = "99.99.99.99.1"
+CURRENT_VERSION = max([db_migrations.SCHEMA_BASE_VERSION] + [migration.version for migration in db_migrations.MIGRATIONS])
+
+
+class AddEntryRate(db_migrations.Migration):
+    version = CURRENT_VERSION + 1
+    description = 'Add meter_entry.entry_rate'
+    backfill_meter_set = 'entry_rate = entry_value * 3600 / duration'
+
+    def migrate_main(self, db_mgr, cursor):
+        cursor.execute('ALTER TABLE main.meter_entry ADD COLUMN entry_rate INTEGER')
+
+    def migrate_shard(self, db_mgr, cursor, schema):
+        cursor.execute('ALTER TABLE {0}.meter_entry ADD COLUMN entry_rate INTEGER'.format(schema))
+
+
+class AddBadIndex(db_migrations.Migration):
+    version = CURRENT_VERSION + 2
+    description = 'Index on missing column'
+
+    def migrate_main(self, db_mgr, cursor):
+        cursor.execute('CREATE INDEX main.idx_bad ON meter_entry (entry_rate)')
+        cursor.execute('CREATE INDEX main.idx_bad_2 ON meter_entry (no_such_column)')
+
+
+def remove_test_db():
+    for db_file in glob.glob(TEST_DB_FILE[:-3] + '*'):
+        os.remove(db_file)
+
+
+@pt.fixture(scope="function")
+def db_mgr():
+    remove_test_db()
+    fixt_db_mgr = db.DBManager(TEST_DB_FILE, shard_by_month=True)
+    month_start = db.get_shard_month_start(201801)
+    fixt_db_mgr.write_meter_entries([(NODE_UUID, month_start + (i * 900), 'AA', month_start + (i * 900), "MUP", 5, 900, 5 * i, "NORM")
+                                     for i in range(6000)])      # over 3 months
+    yield fixt_db_mgr
+    fixt_db_mgr.conn_close()
+    remove_test_db()
+
+
+def get_versions(db_mgr):
+    with db_mgr.write_lock:
+        return [db_migrations.get_schema_version(db_mgr, schema) for schema in db_mgr.get_file_schemas()]
+
+
+def test_migrate_with_backfill(db_mgr, monkeypatch):
+    migrations = [AddEntryRate()]
+    assert get_versions(db_mgr) == [CURRENT_VERSION] * 4
+
+    # dry run changes nothing
+    assert db_migrations.get_migration_report(db_mgr, 1000, migrations) == [(CURRENT_VERSION + 1, 'Add meter_entry.entry_rate', 4, 6000, 6)]
+    assert get_versions(db_mgr) == [CURRENT_VERSION] * 4
+
+    assert db_migrations.migrate(db_mgr, migrations) == 1
+    assert get_versions(db_mgr) == [CURRENT_VERSION + 1] * 4
+    assert db_migrations.migrate(db_mgr, migrations) == 0
+
+    # backfill in chunks, resuming from where it stopped
+    assert db_migrations.run_backfill_chunk(db_mgr, 1000, migrations) == 1000
+    assert db_migrations.get_migration_report(db_mgr, 1000, migrations) == [(CURRENT_VERSION + 1, 'Add meter_entry.entry_rate', 0, 5000, 5)]
+    chunk_counts = []
+    while True:
+        chunk_rows = db_migrations.run_backfill_chunk(db_mgr, 1000, migrations)
+        if chunk_rows is None:
+            break
+        chunk_counts.append(chunk_rows)
+    assert sum(chunk_counts) == 5000 and max(chunk_counts) <= 1000 and chunk_counts[-1] == 0
+    entries = db_mgr.get_node_meter_entries(NODE_UUID, limit_count=None)
+    assert len(entries) == 6000 and all(row['entry_rate'] == 20 for row in entries)
+    assert db_migrations.get_migration_report(db_mgr, 1000, migrations) == []
+
+    # new shards are created migrated
+    monkeypatch.setattr(db_migrations, 'MIGRATIONS', db_migrations.MIGRATIONS + migrations)
+    db_mgr.write_meter_entry(NODE_UUID, 1530403200, 'AA', 1530403200, "MUP", 5, 900, 30005, "NORM")
+    assert get_versions(db_mgr) == [CURRENT_VERSION + 1] * 5
+
+
+def test_failed_migration_rolls_back(db_mgr):
+    with pt.raises(db.sqlite3.Error):
+        db_migrations.migrate(db_mgr, [AddEntryRate(), AddBadIndex()])
+    assert get_versions(db_mgr)[0] == CURRENT_VERSION + 1
+    with db_mgr.write_lock:
+        index_names = [row[0] for row in db_mgr.connection.execute("SELECT name FROM main.sqlite_master WHERE type = 'index'").fetchall()]
+    assert 'idx_bad' not in index_names
+
+
+def get_file_schema(db_file):
+    connection = db.sqlite3.connect(db_file)
+    schema = (connection.execute('PRAGMA journal_mode').fetchone()[0], connection.execute('PRAGMA user_version').fetchone()[0],
+              sorted(connection.execute('SELECT type, name, sql FROM sqlite_master').fetchall()))
+    connection.close()
+    return schema
+
+
+def test_dry_run_read_only():
+    # a file from before versioning, with indexes since dropped
+    remove_test_db()
+    connection = db.sqlite3.connect(TEST_DB_FILE)
+    connection.execute('CREATE TABLE meter_entry (node_uuid TEXT NOT NULL, when_start_raw INTEGER NOT NULL, when_start_raw_nonce TEXT NOT NULL, '
+                       'when_start INTEGER NOT NULL, duration INTEGER NOT NULL, entry_type TEXT NOT NULL, entry_value INTEGER NOT NULL, '
+                       'meter_value INTEGER NOT NULL, rec_status TEXT NOT NULL, PRIMARY KEY (node_uuid, when_start_raw, when_start_raw_nonce))')
+    connection.execute('CREATE INDEX idx_meter_entry_node_uuid ON meter_entry (node_uuid)')
+    connection.execute('CREATE INDEX idx_meter_entry_entry_type ON meter_entry (entry_type)')
+    connection.execute('CREATE TABLE node_snapshot ({0}, PRIMARY KEY (node_uuid, when_received))'.format(', '.join(db.NODE_SNAPSHOT_COLUMNS)))
+    connection.execute('CREATE INDEX idx_node_snapshot_network_id ON node_snapshot (network_id)')
+    connection.execute('CREATE TABLE sys_param (name TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (name))')
+    connection.executemany('INSERT INTO meter_entry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(NODE_UUID, 1514764800 + (i * 900), 'AA', 1514764800 + (i * 900), 900, "MUP", 5, 5 * i, "NORM") for i in range(10)])
+    connection.commit()
+    connection.close()
+    file_schema = get_file_schema(TEST_DB_FILE)
+
+    db_mgr = db.DBManager(TEST_DB_FILE, read_only=True)
+    assert [(version, file_count, backfill_rows) for version, description, file_count, backfill_rows, backfill_chunks in
+            db_migrations.get_migration_report(db_mgr)] == [(2, 1, 0), (3, 1, 10), (4, 1, 0)]
+    db_mgr.conn_close()
+    assert get_file_schema(TEST_DB_FILE) == file_schema
+    remove_test_db()
+
+
+def test_derive_entry_nonces(db_mgr):
+    migrations = [db_migrations.DeriveEntryNonces()]
+    month_start = db.get_shard_month_start(201801)
+    # the same updates received twice, and a rebase, before the migration; an update written after it
+    db_mgr.write_meter_entries([(NODE_UUID, month_start + (i * 900), 'BB', month_start + (i * 900), "MUP", 5, 900, 5 * i, "NORM") for i in range(3)] +
+                               [(NODE_UUID, month_start, 'CC', month_start, "MREB", 0, 0, 0, "NORM"),
+                                (NODE_UUID, month_start + 2700, db.get_entry_nonce("MUP"), month_start + 2700, "MUP", 5, 900, 15, "NORM")])
+
+    row_count = 0
+    while True:
+        chunk_rows = db_migrations.run_backfill_chunk(db_mgr, 1000, migrations)
+        if chunk_rows is None:
+            break
+        row_count += chunk_rows
+    assert row_count == 6005
+
+    entries = db_mgr.get_node_meter_entries(NODE_UUID, limit_count=None)
+    assert len(entries) == 6005
+    key_nonces = {}
+    for row in entries:
+        key_nonces.setdefault(row['when_start_raw'], set()).add(row['when_start_raw_nonce'])
+    assert key_nonces[month_start] == {'MUP.0', 'MUP.1', 'MREB.0'}
+    assert key_nonces[month_start + 900] == key_nonces[month_start + 2700] == {'MUP.0', 'MUP.1'}
+    assert all(nonces == {'MUP.0'} for when_start_raw, nonces in key_nonces.items() if when_start_raw > month_start + 2700)
+
+    # entries received again are now skipped
+    assert db_mgr.write_meter_entries([(NODE_UUID, month_start + (i * 900), db.get_entry_nonce("MUP"), month_start + (i * 900), "MUP", 5, 900, 5 * i,
+                                        "NORM") for i in range(10)]) == 10
+
+
+def test_delta_node_snapshots(db_mgr):
+    migrations = [db_migrations.DeltaNodeSnapshots()]
+    time_start = 1514764800
+    # snapshots from before the migration, as full rows
+    full_rows = [(node_uuid, time_start + (i * 900), '0.0.1.1', 2, 1, 4000 - (i // 50), i * 900, 900, 700, time_start + (i * 900) - 5, 1, 15, 1000,
+                  time_start + (i * 900) - 20, 5000 + (i * 7), 0.5, 100, 50, -56, "NORM") for node_uuid in (NODE_UUID, "99.99.99.99.2") for i in range(150)]
+    full_rows[10] = full_rows[10][:14] + (None,) + full_rows[10][15:]     # a keyframe, as is the row after it (restarting the run)
+    with db_mgr.write_lock:
+        db_mgr.connection.execute('CREATE TABLE node_snapshot_full AS SELECT {0} FROM node_snapshot'.format(', '.join(db.NODE_SNAPSHOT_COLUMNS)))
+        db_mgr.connection.executemany('INSERT INTO node_snapshot_full VALUES ({0})'.format(', '.join(['?'] * len(db.NODE_SNAPSHOT_COLUMNS))), full_rows)
+        db_mgr.connection.execute('DELETE FROM sys_param WHERE name = ?', (db_migrations.BACKFILL_PARAM_FORMAT.format(4),))
+        db_mgr.commit()
+    assert db_migrations.get_migration_report(db_mgr, 100, migrations) == [(4, migrations[0].description, 0, 300, 3)]
+
+    # read from either table while the backfill runs
+    assert db_migrations.run_backfill_chunk(db_mgr, 100, migrations) == 100
+    assert [tuple(row) for row in db_mgr.get_node_snapshots(limit_count=None)] == full_rows
+    chunk_counts = []
+    while True:
+        chunk_rows = db_migrations.run_backfill_chunk(db_mgr, 100, migrations)
+        if chunk_rows is None:
+            break
+        chunk_counts.append(chunk_rows)
+    assert chunk_counts == [100, 100, 0]
+    with db_mgr.write_lock:
+        assert db_mgr.connection.execute('SELECT COUNT(*) FROM node_snapshot WHERE is_keyframe = 1').fetchone()[0] == 7
+        assert len(db_mgr.connection.execute("SELECT name FROM sqlite_master WHERE name = 'node_snapshot_full'").fetchall()) == 0
+    assert [tuple(row) for row in db_mgr.get_node_snapshots(limit_count=None)] == full_rows
+    assert tuple(db_mgr.get_node_snapshots(NODE_UUID)[0]) == full_rows[149]
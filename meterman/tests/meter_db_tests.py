@@ -1,3 +1,4 @@
+import glob
 import random
 import string
 import time
@@ -9,6 +10,10 @@ import pytest as pt
 from meterman import meter_db as db
 
 TEST_DB_FILE = base.temp_path + "/meter_data_test.db"
+TEST_PLAN_DB_FILE = base.temp_path + "/meter_plan_test.db"
+TEST_SHARD_DB_FILE = base.temp_path + "/meter_shard_test.db"
+TEST_ROLLUP_DB_FILE = base.temp_path + "/meter_rollup_test.db"
+TEST_SNAPSHOT_DB_FILE = base.temp_path + "/meter_snapshot_test.db"
 
 
 @pt.fixture(scope="session")
@@ -63,3 +68,447 @@ def test_10_inserts(db_mgr):
     for i in range(10):
         test_insert_random_read(db_mgr)
         time.sleep(1)
+
+
+def test_write_meter_entries(db_mgr):
+    node_uuid = "99.99.99.99.4"
+    when_start = int(time.time())
+    entry_rows = [(node_uuid, when_start + (i * 15), 'AA', when_start + (i * 15), "MUPS", 5, 15, 5 * (i + 1), "NORM") for i in range(30)]
+    assert db_mgr.write_meter_entries(entry_rows) == 0
+    assert db_mgr.get_node_meter_entries_count(node_uuid) == 30
+
+    # existing keys are skipped and counted, new entries in the batch are still written
+    entry_rows.append((node_uuid, when_start + (30 * 15), 'AA', when_start + (30 * 15), "MUPS", 5, 15, 155, "NORM"))
+    assert db_mgr.write_meter_entries(entry_rows) == 30
+    assert db_mgr.get_node_meter_entries_count(node_uuid) == 31
+    assert db_mgr.get_last_mup(node_uuid, time_from=None, time_to=None)['meter_value'] == 155
+
+
+def test_wal_read_pool(db_mgr):
+    assert db_mgr.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    with db_mgr.read_connection() as connection:
+        assert connection is not db_mgr.connection
+        with pt.raises(db.sqlite3.OperationalError):
+            connection.execute('DELETE FROM meter_entry')
+
+    # committed writes are visible to pooled readers
+    node_uuid = "99.99.99.99.5"
+    db_mgr.write_meter_entry(node_uuid, 1500000000, 'AA', 1500000000, "MUPS", 5, 15, 5, "NORM")
+    assert db_mgr.get_node_meter_entries_count(node_uuid) == 1
+    assert db_mgr.read_conn_count <= db.DB_READ_POOL_SIZE
+
+
+def get_query_plans(query_func):
+    # runs query_func against a DB reading on the writer connection, returns EXPLAIN QUERY PLAN details of each statement it executed
+    plan_db_mgr = db.DBManager(TEST_PLAN_DB_FILE, read_pool_size=0)
+    plan_db_mgr.write_meter_entries([("99.99.99.99.1", 1500000000 + (i * 60), 'AA', 1500000000 + (i * 60), "MUPS", 5, 60, 5 * i, "NORM")
+                                     for i in range(100)])
+    statements = []
+    plan_db_mgr.connection.set_trace_callback(statements.append)
+    query_func(plan_db_mgr)
+    plan_db_mgr.connection.set_trace_callback(None)
+
+    plans = [' / '.join(row['detail'] for row in plan_db_mgr.connection.execute('EXPLAIN QUERY PLAN ' + statement))
+             for statement in statements if statement.startswith('SELECT')]
+    plan_db_mgr.conn_close()
+    os.remove(TEST_PLAN_DB_FILE)
+    return plans
+
+
+@pt.mark.parametrize("query_func,index_name", [
+    (lambda plan_db_mgr: plan_db_mgr.get_first_mup("99.99.99.99.1", 1500000000, 1500003000), 'idx_meter_entry_node_status_type_start'),
+    (lambda plan_db_mgr: plan_db_mgr.get_last_rebase("99.99.99.99.1", None, None), 'idx_meter_entry_node_status_type_start'),
+    (lambda plan_db_mgr: plan_db_mgr.get_node_meter_entries("99.99.99.99.1", entry_type="MUPS", rec_status="NORM", time_from=1500000000,
+                                                            time_to=1500003000), 'idx_meter_entry_node_status_type_start'),
+    (lambda plan_db_mgr: plan_db_mgr.get_node_meter_entries("99.99.99.99.1", time_from=1500000000, time_to=1500003000), 'idx_meter_entry_node_start'),
+    (lambda plan_db_mgr: plan_db_mgr.get_node_meter_entries("99.99.99.99.1", limit_count=100000), 'idx_meter_entry_node_start'),
+    (lambda plan_db_mgr: plan_db_mgr.get_node_meter_entries(time_from=1500000000, time_to=1500003000), 'idx_meter_entry_when_start'),
+    (lambda plan_db_mgr: plan_db_mgr.get_node_meter_entries_count("99.99.99.99.1", entry_type="MUPS", rec_status="NORM"),
+     'idx_meter_entry_node_status_type_start'),
+])
+def test_meter_entry_query_plans(query_func, index_name):
+    # meter entry queries seek on the index for their shape, with no table scans or sorts of meter entries
+    plans = get_query_plans(query_func)
+    assert len(plans) > 0
+    for plan in plans:
+        assert index_name in plan
+        assert 'SCAN meter_entry' not in plan
+        if 'UNION ALL' not in plan:     # first/last entry merges one row per entry type
+            assert 'TEMP B-TREE' not in plan
+
+
+def remove_shard_test_db():
+    for db_file in glob.glob(TEST_SHARD_DB_FILE[:-3] + '*'):
+        os.remove(db_file)
+
+
+def get_shard_test_entries(node_uuid, month, count, entry_type="MUPS"):
+    month_start = db.get_shard_month_start(month)
+    return [(node_uuid, month_start + (i * 3600), 'AA', month_start + (i * 3600), entry_type, 5, 3600, 5 * i, "NORM") for i in range(count)]
+
+
+def test_meter_entry_shards():
+    remove_shard_test_db()
+    shard_db_mgr = db.DBManager(TEST_SHARD_DB_FILE, shard_by_month=True)
+    node_uuid = "99.99.99.99.6"
+    months = [db.add_shard_months(201711, i) for i in range(12)]
+    assert months[2] == 201801
+    for month in months:
+        assert shard_db_mgr.write_meter_entries(get_shard_test_entries(node_uuid, month, 10)) == 0
+    assert shard_db_mgr.shard_months == tuple(months)
+    assert all(os.path.isfile(shard_db_mgr.get_shard_file(month)) for month in months)
+    assert len(shard_db_mgr.conn_shards[shard_db_mgr.connection]) == db.DB_SHARD_MAX_ATTACHED
+
+    # counts and unbounded queries read all shards, more than can be attached at once
+    assert shard_db_mgr.get_node_meter_entries_count(node_uuid) == 120
+    assert len(shard_db_mgr.get_node_meter_entries(node_uuid, limit_count=None)) == 120
+    assert shard_db_mgr.get_first_mup(node_uuid)['when_start'] == db.get_shard_month_start(months[0])
+    assert shard_db_mgr.get_last_mup(node_uuid, None, None)['when_start'] == db.get_shard_month_start(months[-1]) + (9 * 3600)
+
+    # latest entries are taken from the newest shards, across shards
+    rows = shard_db_mgr.get_node_meter_entries(node_uuid, limit_count=15)
+    assert [row['when_start'] for row in rows] == sorted((row['when_start'] for row in rows), reverse=True)
+    assert len(rows) == 15 and rows[-1]['when_start'] == db.get_shard_month_start(months[-2]) + (5 * 3600)
+
+    # ranged queries and updates read only overlapping shards
+    with shard_db_mgr.read_connection() as connection:
+        assert sum(shard_db_mgr.get_meter_entry_tables(connection, db.get_shard_month_start(201712), db.get_shard_month_start(201801)), []) == \
+               ['meter_201712.meter_entry', 'meter_201801.meter_entry']
+    rows = shard_db_mgr.get_node_meter_entries(node_uuid, time_from=db.get_shard_month_start(201712) + 3600,
+                                               time_to=db.get_shard_month_start(201801) + 3600, limit_count=None)
+    assert len(rows) == 11
+    shard_db_mgr.update_meter_entries_in_range(node_uuid, db.get_shard_month_start(201712), db.get_shard_month_start(201801) + 3600,
+                                               new_rec_status=db.RecStatus.DELETED)
+    assert shard_db_mgr.get_node_meter_entries_count(node_uuid, rec_status="DEL") == 12
+
+    # an entry whose start is moved to another month moves shard
+    shard_db_mgr.update_meter_entry(node_uuid, db.get_shard_month_start(201711), 'AA', db.get_shard_month_start(201802), None, None, None, None, None)
+    assert len(shard_db_mgr.get_node_meter_entries(node_uuid, time_from=db.get_shard_month_start(201802), time_to=db.get_shard_month_start(201802),
+                                                   limit_count=None)) == 2
+    shard_db_mgr.purge_meter_entry(node_uuid, db.get_shard_month_start(201711), 'AA')
+    assert shard_db_mgr.get_node_meter_entries_count(node_uuid) == 119
+
+    # retention drops whole shards
+    assert shard_db_mgr.drop_meter_entry_shards(db.get_shard_month_start(201801) + 3600) == [201711, 201712]
+    assert not os.path.isfile(shard_db_mgr.get_shard_file(201711))
+    assert shard_db_mgr.get_node_meter_entries_count(node_uuid) == 100
+    shard_db_mgr.conn_close()
+    remove_shard_test_db()
+
+
+def test_meter_entry_shards_move_existing():
+    # entries in an unsharded DB move to shards when opened sharded
+    remove_shard_test_db()
+    node_uuid = "99.99.99.99.7"
+    unsharded_db_mgr = db.DBManager(TEST_SHARD_DB_FILE)
+    unsharded_db_mgr.write_meter_entries(get_shard_test_entries(node_uuid, 201801, 10) + get_shard_test_entries(node_uuid, 201802, 10))
+    unsharded_db_mgr.conn_close()
+
+    shard_db_mgr = db.DBManager(TEST_SHARD_DB_FILE, shard_by_month=True)
+    assert shard_db_mgr.shard_months == (201801, 201802)
+    assert shard_db_mgr.connection.execute('SELECT COUNT(*) FROM main.meter_entry').fetchone()[0] == 0
+    assert shard_db_mgr.get_node_meter_entries_count(node_uuid) == 20
+    shard_db_mgr.conn_close()
+
+    # shards are found when reopened
+    shard_db_mgr = db.DBManager(TEST_SHARD_DB_FILE, shard_by_month=True)
+    assert shard_db_mgr.shard_months == (201801, 201802)
+    assert shard_db_mgr.get_node_meter_entries_count(node_uuid) == 20
+    shard_db_mgr.conn_close()
+    remove_shard_test_db()
+
+
+def get_rollup_test_entries(node_uuid, time_start):
+    # entries every 10 mins for 30 hours rising 10 each, with a rebase to 1000 at hour 10 that later entries rise from
+    entry_rows = []
+    for i in range(180):
+        meter_value = (i * 10) if i < 60 else 1000 + ((i - 59) * 10)
+        entry_rows.append((node_uuid, time_start + (i * 600), 'AA', time_start + (i * 600), "MUP", 10, 600, meter_value, "NORM"))
+    entry_rows.append((node_uuid, time_start + 36000, 'RB', time_start + 36000, "MREB", 0, 0, 1000, "NORM"))
+    return entry_rows
+
+
+def get_rollup_values(rollup_db_mgr, node_uuid, bucket_type):
+    return [(row['bucket_start'], row['consumption'], row['sample_count']) for row in rollup_db_mgr.get_meter_rollups(node_uuid, bucket_type)]
+
+
+def get_rollup_rows(rollup_db_mgr, node_uuid, bucket_type):
+    return [(row['bucket_start'], row['consumption'], row['sample_count'], row['min_entry_value'], row['max_entry_value'])
+            for row in rollup_db_mgr.get_meter_rollups(node_uuid, bucket_type)]
+
+
+def test_meter_rollups():
+    if os.path.isfile(TEST_ROLLUP_DB_FILE):
+        os.remove(TEST_ROLLUP_DB_FILE)
+    rollup_db_mgr = db.DBManager(TEST_ROLLUP_DB_FILE, rollup_tz='Australia/Sydney')
+    node_uuid = "99.99.99.99.8"
+    time_start = 1514764800     # 2018-01-01 00:00 UTC, 11:00 in Sydney
+    entry_rows = get_rollup_test_entries(node_uuid, time_start)
+    for i in range(0, len(entry_rows), 6):
+        rollup_db_mgr.write_meter_entries(entry_rows[i:i + 6])
+
+    # rebase is not consumption, first entry has none to rise from
+    hours = get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR)
+    assert hours == [(time_start, 50, 6)] + [(time_start + (hour * 3600), 60, 6) for hour in range(1, 30)]
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.DAY) == [(time_start, 1430, 144), (time_start + 86400, 360, 36)]
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.LOCAL_DAY) == [(time_start - 39600, 770, 78), (time_start + 46800, 1020, 102)]
+
+    # incremental rollups match a rebuild, and skipped duplicates are not counted again
+    rollup_db_mgr.write_meter_entries(entry_rows[:6])
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR) == hours
+    rollup_db_mgr.rebuild_rollups()
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR) == hours
+
+    # deleted entries are not counted, so their consumption is in the next entry's bucket
+    rollup_db_mgr.update_meter_entries_in_range(node_uuid, time_start + (5 * 3600), time_start + (6 * 3600) - 1, new_rec_status=db.RecStatus.DELETED)
+    hours = get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR)
+    assert (time_start + (5 * 3600)) not in [hour[0] for hour in hours]
+    assert (time_start + (6 * 3600), 120, 6) in hours
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.DAY)[0] == (time_start, 1430, 138)
+
+    # an entry written out of order is counted from the entry before it
+    rollup_db_mgr.write_meter_entry(node_uuid, time_start + (5 * 3600), 'LT', time_start + (5 * 3600), "MUP", 10, 600, 300, "NORM")
+    hours = get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR)
+    assert (time_start + (5 * 3600), 10, 1) in hours and (time_start + (6 * 3600), 110, 6) in hours
+    rollup_db_mgr.rebuild_rollups(node_uuid)
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR) == hours
+
+    # an entry written again with replace overwrites the one with its key, and is counted once
+    rollup_db_mgr.write_meter_entry(node_uuid, time_start + (5 * 3600), 'LT', time_start + (5 * 3600), "MUP", 20, 600, 310, "NORM", replace=True)
+    hours = get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR)
+    assert (time_start + (5 * 3600), 20, 1) in hours and (time_start + (6 * 3600), 100, 6) in hours
+    rollup_db_mgr.rebuild_rollups(node_uuid)
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.HOUR) == hours
+
+    rollup_db_mgr.delete_all_meter_entries(node_uuid)
+    assert get_rollup_values(rollup_db_mgr, node_uuid, db.RollupBucket.DAY) == []
+    rollup_db_mgr.conn_close()
+    os.remove(TEST_ROLLUP_DB_FILE)
+
+
+def test_downsample_meter_entries():
+    if os.path.isfile(TEST_ROLLUP_DB_FILE):
+        os.remove(TEST_ROLLUP_DB_FILE)
+    ds_db_mgr = db.DBManager(TEST_ROLLUP_DB_FILE)
+    node_uuid = "99.99.99.99.7"
+    time_start = 1514764800
+    # entries every 15 secs for 2 hours rising 1 each, with a rebase to 1000 at 70.5 mins, and a deleted entry
+    entry_rows = [(node_uuid, time_start + (i * 15), 'AA', time_start + (i * 15), "MUP", 1, 15, i if i < 282 else 1000 + (i - 281), "NORM")
+                  for i in range(480)]
+    entry_rows.append((node_uuid, time_start + 4230, 'RB', time_start + 4230, "MREB", 0, 0, 1000, "NORM"))
+    entry_rows.append((node_uuid, time_start + 4200, 'DL', time_start + 4200, "MUP", 99, 15, 99, "DEL"))
+    ds_db_mgr.write_meter_entries(entry_rows)
+    consumption = ds_db_mgr.get_last_mup(node_uuid, None, None)['meter_value']
+    hour_consumptions = [row[:2] for row in get_rollup_values(ds_db_mgr, node_uuid, db.RollupBucket.HOUR)]
+
+    # 5 minute buckets, the first entry kept for the rest to rise from, the rebase's bucket split around it, and only entries before
+    # time_before downsampled
+    assert ds_db_mgr.downsample_meter_entries(db.DOWNSAMPLE_5MIN_SECS, time_start + 7200 - 1) == (time_start + 6900, 435)
+    assert ds_db_mgr.downsample_meter_entries(db.DOWNSAMPLE_5MIN_SECS, time_start + 7200 - 1) is None
+    entries = ds_db_mgr.get_node_meter_entries(node_uuid, rec_status="NORM", time_to=time_start + 6899, limit_count=None)
+    assert [(row['when_start'] - time_start, row['entry_type'], row['entry_value'], row['duration'], row['meter_value']) for row in entries[:3]] == \
+        [(0, "MUP", 1, 15, 0), (15, "MUP", 19, 285, 19), (300, "MUP", 20, 300, 39)]
+    assert sorted((row['when_start'] - time_start, row['entry_type'], row['entry_value'], row['meter_value']) for row in entries[15:18]) == \
+        [(4200, "MUP", 2, 281), (4230, "MREB", 0, 1000), (4230, "MUP", 18, 1018)]
+    assert ds_db_mgr.get_last_mup(node_uuid, None, None)['meter_value'] == consumption
+    assert ds_db_mgr.get_node_meter_entries_count(node_uuid, rec_status="DEL") == 1
+
+    # rollups are refreshed, with consumption unchanged
+    rollups = [get_rollup_rows(ds_db_mgr, node_uuid, bucket_type) for bucket_type in (db.RollupBucket.HOUR, db.RollupBucket.DAY)]
+    assert [row[:2] for row in rollups[0]] == hour_consumptions
+    ds_db_mgr.rebuild_rollups(node_uuid)
+    assert [get_rollup_rows(ds_db_mgr, node_uuid, bucket_type) for bucket_type in (db.RollupBucket.HOUR, db.RollupBucket.DAY)] == rollups
+
+    # then hourly, rebase still kept
+    ds_db_mgr.downsample_meter_entries(db.DOWNSAMPLE_HOUR_SECS, time_start + 7200)
+    entries = ds_db_mgr.get_node_meter_entries(node_uuid, rec_status="NORM", limit_count=None)
+    assert sorted((row['when_start'] - time_start, row['entry_type'], row['entry_value'], row['meter_value']) for row in entries) == \
+        [(0, "MUP", 1, 0), (15, "MUP", 239, 239), (3600, "MUP", 42, 281), (4230, "MREB", 0, 1000), (4230, "MUP", 198, 1198)]
+    rollups = get_rollup_rows(ds_db_mgr, node_uuid, db.RollupBucket.HOUR)
+    assert [row[:2] for row in rollups] == hour_consumptions
+    ds_db_mgr.rebuild_rollups(node_uuid)
+    assert get_rollup_rows(ds_db_mgr, node_uuid, db.RollupBucket.HOUR) == rollups
+    ds_db_mgr.conn_close()
+    os.remove(TEST_ROLLUP_DB_FILE)
+
+
+def test_incremental_vacuum():
+    remove_shard_test_db()
+    vac_db_mgr = db.DBManager(TEST_SHARD_DB_FILE, shard_by_month=True)
+    node_uuid = "99.99.99.99.6"
+    vac_db_mgr.write_meter_entries(get_shard_test_entries(node_uuid, 201801, 600) + get_shard_test_entries(node_uuid, 201802, 600))
+    vac_db_mgr.purge_meter_entries_in_range(node_uuid, 0, int(time.time()))
+    assert [vac_db_mgr.connection.execute('PRAGMA {0}.auto_vacuum'.format(schema)).fetchone()[0] for schema in vac_db_mgr.get_file_schemas()] == [2, 2, 2]
+
+    # freed pages are released a slice at a time
+    vac_db_mgr.connection.execute('PRAGMA meter_201801.wal_checkpoint(TRUNCATE)')
+    shard_size = os.path.getsize(vac_db_mgr.get_shard_file(201801))
+    slice_pages = [vac_db_mgr.incremental_vacuum(10)]
+    while slice_pages[-1] > 0:
+        slice_pages.append(vac_db_mgr.incremental_vacuum(10))
+    assert len(slice_pages) > 2 and max(slice_pages) == 10
+    assert sum(vac_db_mgr.connection.execute('PRAGMA {0}.freelist_count'.format(schema)).fetchone()[0] for schema in vac_db_mgr.get_file_schemas()) == 0
+    vac_db_mgr.connection.execute('PRAGMA meter_201801.wal_checkpoint(TRUNCATE)')
+    assert os.path.getsize(vac_db_mgr.get_shard_file(201801)) < shard_size
+    vac_db_mgr.optimize()
+    vac_db_mgr.conn_close()
+    remove_shard_test_db()
+
+
+def test_iter_node_meter_entries():
+    # streamed reads give the same entries, in the same order, as get_node_meter_entries, across shards and fetch batches
+    remove_shard_test_db()
+    iter_db_mgr = db.DBManager(TEST_SHARD_DB_FILE, shard_by_month=True)
+    node_uuid = "99.99.99.99.6"
+    iter_db_mgr.write_meter_entries(get_shard_test_entries(node_uuid, 201801, 700) + get_shard_test_entries(node_uuid, 201802, 700))
+    for limit_count in (None, 15, 1200):
+        rows = iter_db_mgr.get_node_meter_entries(node_uuid, limit_count=limit_count)
+        entries = list(iter_db_mgr.iter_node_meter_entries(node_uuid, limit_count=limit_count))
+        assert [entry._asdict() for entry in entries] == [dict(row) for row in rows]
+    entries = list(iter_db_mgr.iter_node_meter_entries(node_uuid, time_from=db.get_shard_month_start(201802), time_to=None))
+    assert len(entries) == 700 and entries[0].when_start == db.get_shard_month_start(201802)
+    assert list(iter_db_mgr.iter_node_meter_entries("99.99.99.99.7")) == []
+    iter_db_mgr.conn_close()
+    remove_shard_test_db()
+
+
+def test_archive_meter_entries():
+    # archived entries are read back by the same queries, merged with those still in meter_entry
+    remove_shard_test_db()
+    arc_db_mgr = db.DBManager(TEST_SHARD_DB_FILE, shard_by_month=True)
+    node_uuids = ["99.99.99.99.6", "99.99.99.99.7"]
+    jan_start = db.get_shard_month_start(201801)
+    feb_start = db.get_shard_month_start(201802)
+    for node_uuid in node_uuids:
+        arc_db_mgr.write_meter_entries(get_shard_test_entries(node_uuid, 201801, 100, "MUP") + get_shard_test_entries(node_uuid, 201802, 10, "MUP") +
+                                       [(node_uuid, jan_start + 1800, 'AA', jan_start + 1800, "MREB", 0, 0, 1000, "NORM")])
+
+    def get_results(node_uuid):
+        return ([dict(row) for row in arc_db_mgr.get_node_meter_entries(node_uuid, limit_count=None)],
+                [dict(row) for row in arc_db_mgr.get_node_meter_entries(node_uuid, limit_count=15)],
+                [dict(row) for row in arc_db_mgr.get_node_meter_entries(node_uuid, time_from=jan_start + 7200, time_to=feb_start + 7200, limit_count=None)],
+                [entry._asdict() for entry in arc_db_mgr.iter_node_meter_entries(node_uuid)],
+                arc_db_mgr.get_node_meter_entries_count(node_uuid), arc_db_mgr.get_node_meter_entries_count(node_uuid, entry_type="MREB"),
+                dict(arc_db_mgr.get_first_mup(node_uuid)), dict(arc_db_mgr.get_last_mup(node_uuid, None, jan_start + 86400)),
+                dict(arc_db_mgr.get_first_rebase(node_uuid, None, None)),
+                [dict(row) for row in arc_db_mgr.get_meter_rollups(node_uuid, db.RollupBucket.DAY)])
+
+    results = [get_results(node_uuid) for node_uuid in node_uuids]
+    steps = []
+    while True:
+        step = arc_db_mgr.archive_meter_entries(feb_start)
+        if step is None:
+            break
+        steps.append(step)
+    assert steps == [(jan_start + (day * 86400) + 86400, [50, 48, 48, 48, 8][day]) for day in range(5)]
+    assert arc_db_mgr.connection.execute('SELECT COUNT(*) FROM {0}'.format(arc_db_mgr.get_write_table(jan_start))).fetchone()[0] == 0
+    assert arc_db_mgr.archive.find_months() == [201801]
+    assert [get_results(node_uuid) for node_uuid in node_uuids] == results
+    arc_db_mgr.rebuild_rollups()
+    assert [get_results(node_uuid)[-1] for node_uuid in node_uuids] == [result[-1] for result in results]
+
+    # a late entry for an archived day is merged into its block when next archived
+    arc_db_mgr.write_meter_entries([(node_uuids[0], jan_start + 900, 'AA', jan_start + 900, "MUP", 1, 900, 1, "NORM")])
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[0]) == 112
+    assert arc_db_mgr.archive_meter_entries(feb_start) == (jan_start + 86400, 1)
+    assert arc_db_mgr.connection.execute('SELECT entry_count FROM meter_archive_block WHERE node_uuid = ? AND day_start = ?',
+                                         (node_uuids[0], jan_start)).fetchone()[0] == 26
+
+    # and an entry received again after its day was archived is kept once
+    arc_db_mgr.write_meter_entries([(node_uuids[0], jan_start + 900, 'AA', jan_start + 900, "MUP", 1, 900, 1, "NORM")])
+    assert arc_db_mgr.archive_meter_entries(feb_start) == (jan_start + 86400, 1)
+    assert arc_db_mgr.connection.execute('SELECT entry_count FROM meter_archive_block WHERE node_uuid = ? AND day_start = ?',
+                                         (node_uuids[0], jan_start)).fetchone()[0] == 26
+
+    # edits restore the days they touch to meter_entry, with the fields they were archived with
+    arc_db_mgr.update_meter_entries_in_range(node_uuids[0], jan_start + 86400, jan_start + 86400 + 3600, new_rec_status=db.RecStatus.DELETED)
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[0], rec_status="DEL") == 2
+    assert arc_db_mgr.connection.execute('SELECT COUNT(*) FROM {0}'.format(arc_db_mgr.get_write_table(jan_start))).fetchone()[0] == 24
+    restored_rows = arc_db_mgr.connection.execute('SELECT * FROM {0} WHERE node_uuid = ? ORDER BY when_start'.format(arc_db_mgr.get_write_table(jan_start)),
+                                                  (node_uuids[0],)).fetchall()
+    archived_rows = [row for row in results[0][0] if jan_start + 86400 <= row['when_start'] < jan_start + (2 * 86400)]
+    assert len(restored_rows) == len(archived_rows) == 24
+    for restored_row, archived_row in zip(restored_rows, archived_rows):
+        assert (restored_row['when_start_raw'], restored_row['when_start_raw_nonce'], restored_row['when_start']) == \
+            (archived_row['when_start_raw'], archived_row['when_start_raw_nonce'], archived_row['when_start'])
+        assert restored_row['duration'] == archived_row['duration'] == 3600
+        assert restored_row['entry_type'] == archived_row['entry_type'] == "MUP"
+        assert restored_row['entry_value'] == archived_row['entry_value'] == 5
+        assert restored_row['meter_value'] == archived_row['meter_value']
+    arc_db_mgr.purge_meter_entry(node_uuids[1], jan_start + (50 * 3600), 'AA')
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[1]) == 110
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[0]) == 112
+    last_jan_value = arc_db_mgr.get_last_mup(node_uuids[0], None, feb_start - 1)['meter_value']
+    # shifts restore the archived days of their window, a week from the first entry
+    assert arc_db_mgr.shift_meter_values(node_uuids[0], jan_start + (2 * 86400), feb_start - 1, 100) == (jan_start + (9 * 86400) - 1, 52)
+    assert arc_db_mgr.shift_meter_values(node_uuids[0], jan_start + (9 * 86400), feb_start - 1, 100) is None
+    assert arc_db_mgr.get_last_mup(node_uuids[0], None, feb_start - 1)['meter_value'] == last_jan_value + 100
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[0]) == 112
+
+    # retention drops archive files with shards
+    arc_db_mgr.delete_all_meter_entries(node_uuids[1])
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[1]) == 0
+    arc_db_mgr.drop_meter_entry_shards(feb_start)
+    assert arc_db_mgr.archive.find_months() == []
+    assert arc_db_mgr.get_node_meter_entries_count(node_uuids[0]) == 10
+    arc_db_mgr.conn_close()
+    remove_shard_test_db()
+
+
+def get_snapshot_test_values(node_uuid, i):
+    # (node_uuid, when_received, ...) of a node's i'th 15 minute snapshot: up time rising, battery dropping every 10th, RMS current varying
+    time_start = 1514764800
+    return (node_uuid, time_start + (i * 900), '0.0.1.1', 2, 1, 4000 - (i // 10), i * 900, 900, 700, time_start + (i * 900) - 5, 1, 15, 1000,
+            time_start + (i * 900) - 20, 5000 + (i * 7), 0.5 * (i % 3), 100, 50, -56, "NORM")
+
+
+def test_node_snapshot_deltas(monkeypatch):
+    if os.path.isfile(TEST_SNAPSHOT_DB_FILE):
+        os.remove(TEST_SNAPSHOT_DB_FILE)
+    monkeypatch.setattr(db, 'NODE_SNAPSHOT_KEYFRAME_ROWS', 10)
+    snap_db_mgr = db.DBManager(TEST_SNAPSHOT_DB_FILE)
+    node_uuids = ["99.99.99.99.8", "99.99.99.99.9"]
+    expected = {node_uuid: [get_snapshot_test_values(node_uuid, i) for i in range(25)] for node_uuid in node_uuids}
+    for i in range(25):
+        if i == 13:
+            continue    # written out of order below
+        for node_uuid in node_uuids:
+            snap_db_mgr.write_node_snapshot(*expected[node_uuid][i])
+    snap_db_mgr.write_node_snapshot(*expected[node_uuids[0]][13])
+    snap_db_mgr.write_node_snapshot(*expected[node_uuids[1]][13])
+    snap_db_mgr.write_node_snapshot(*expected[node_uuids[1]][13])      # already exists, ignored
+
+    # keyframes every 10 (the one after the out of order snapshot too), unchanged fields of others NULL
+    with snap_db_mgr.write_lock:
+        rows = snap_db_mgr.connection.execute('SELECT when_received, is_keyframe, network_id, node_id, batt_voltage_mv, up_time FROM node_snapshot '
+                                              'WHERE node_uuid = ? ORDER BY when_received', (node_uuids[0],)).fetchall()
+    assert [row[0] for row in rows if row[1] == 1] == [expected[node_uuids[0]][i][1] for i in (0, 10, 13, 14, 21)]
+    assert tuple(rows[5][2:]) == (None, None, None, 900)
+
+    # reconstructed the same, whatever the runs read
+    assert [tuple(row) for row in snap_db_mgr.get_node_snapshots(node_uuids[0], limit_count=None)] == expected[node_uuids[0]]
+    assert [tuple(row) for row in snap_db_mgr.get_node_snapshots(limit_count=None)] == expected[node_uuids[0]] + expected[node_uuids[1]]
+    assert [tuple(row) for row in snap_db_mgr.get_node_snapshots(node_uuids[1], limit_count=3)] == expected[node_uuids[1]][24:21:-1]
+    assert [tuple(row) for row in snap_db_mgr.get_node_snapshots(node_uuids[1], time_from=expected[node_uuids[1]][8][1],
+                                                                 time_to=expected[node_uuids[1]][11][1], limit_count=None)] == expected[node_uuids[1]][8:12]
+    rows = snap_db_mgr.get_node_snapshots(limit_count=4)
+    assert [(row['node_uuid'], row['when_received']) for row in rows] == [(node_uuid, expected[node_uuid][i][1]) for i in (24, 23) for node_uuid in node_uuids]
+    assert len(snap_db_mgr.get_node_snapshots(node_uuids[0], network_id='0.0.1.2', limit_count=None)) == 0
+
+    # state reloads from the DB
+    snap_db_mgr.node_snapshot_state = {}
+    snap_db_mgr.write_node_snapshot(*get_snapshot_test_values(node_uuids[0], 25))
+    assert tuple(snap_db_mgr.get_node_snapshots(node_uuids[0])[0]) == get_snapshot_test_values(node_uuids[0], 25)
+
+    # a field changing to or from NULL (not expressible as a delta) is a keyframe
+    nulled = [get_snapshot_test_values(node_uuids[0], i) for i in range(26, 29)]
+    nulled[1] = nulled[1][:14] + (None,) + nulled[1][15:]
+    for values in nulled:
+        snap_db_mgr.write_node_snapshot(*values)
+    with snap_db_mgr.write_lock:
+        rows = snap_db_mgr.connection.execute('SELECT is_keyframe FROM node_snapshot WHERE node_uuid = ? AND when_received > ? ORDER BY when_received',
+                                              (node_uuids[0], nulled[0][1])).fetchall()
+    assert [row[0] for row in rows] == [1, 1]
+    assert [tuple(row) for row in snap_db_mgr.get_node_snapshots(node_uuids[0], limit_count=3)] == nulled[::-1]
+    snap_db_mgr.conn_close()
+    os.remove(TEST_SNAPSHOT_DB_FILE)
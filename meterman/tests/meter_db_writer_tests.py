@@ -0,0 +1,125 @@
+import os
+import time
+
+from meterman import app_base as base
+import pytest as pt
+
+from meterman import meter_db as db
+from meterman import meter_db_writer as db_writer
+from meterman import meter_metrics as metrics
+
+TEST_DB_FILE = base.temp_path + "/meter_db_writer_test.db"
+NODE_UUID = "99.99.99.99.1"
+
+
+@pt.fixture(scope="function")
+def db_mgr():
+    fixt_db_mgr = db.DBManager(TEST_DB_FILE)
+    yield fixt_db_mgr
+    fixt_db_mgr.conn_close()
+    os.remove(TEST_DB_FILE)
+
+
+def get_entry_row(i, nonce='AA'):
+    return (NODE_UUID, 1500000000 + (i * 60), nonce, 1500000000 + (i * 60), db.EntryType.METER_UPDATE.value, 5, 60, 5 * i, db.RecStatus.NORMAL.value)
+
+
+def test_flush_on_rows(db_mgr):
+    writer = db_writer.DBWriter(db_mgr, flush_ms=60000, flush_rows=10)
+    for i in range(25):
+        writer.write_meter_entry(*get_entry_row(i))
+    time.sleep(0.2)
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 20     # two full batches, five rows waiting
+    assert writer.get_stats()['flush_count'] == 2
+    assert writer.get_stats()['queued_rows'] == 5
+
+    assert writer.flush()
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 25
+    writer.close()
+
+
+def test_flush_on_time(db_mgr):
+    writer = db_writer.DBWriter(db_mgr, flush_ms=50, flush_rows=1000)
+    writer.write_meter_entries([get_entry_row(i) for i in range(3)])
+    writer.write_node_event(NODE_UUID, 1500000000, db.NodeEventType.BOOT.value, 'BOOT')
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 0
+    time.sleep(0.3)
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 3
+    assert len(db_mgr.get_node_events(NODE_UUID)) == 1
+
+    stats = writer.get_stats()
+    assert stats['flush_count'] == 1 and stats['last_flush_rows'] == 4 and stats['max_lag_secs'] >= 0.05
+    writer.close()
+
+
+def test_close_commits_queued_writes(db_mgr):
+    writer = db_writer.DBWriter(db_mgr, flush_ms=60000, flush_rows=1000)
+    for i in range(100):
+        writer.write_meter_entries([get_entry_row(i)])
+    writer.close()
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 100
+
+    # writes after close are written directly
+    writer.write_meter_entries([get_entry_row(100)])
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 101
+
+
+def test_failed_write_skipped(db_mgr):
+    writer = db_writer.DBWriter(db_mgr, flush_ms=60000, flush_rows=1000)
+    writer.write_meter_entries([get_entry_row(0)])
+    writer.write_gateway_snapshot('0.0.1.1.1', 1500000000, '0.0.1.1', 1, 1500000000, 1000, 1500000000, 'INFO', 13, db.RecStatus.NORMAL.value)
+    writer.write_gateway_snapshot('0.0.1.1.1', 1500000000, '0.0.1.1', 1, 1500000000, 1000, 1500000000, 'INFO', 13, db.RecStatus.NORMAL.value)
+    writer.write_meter_entries([get_entry_row(0), get_entry_row(1)])
+    writer.close()
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 2
+    assert len(db_mgr.get_gateway_snapshots('0.0.1.1.1')) == 1
+
+
+
+def test_failed_flush_dequeues_rows(db_mgr, monkeypatch):
+    writer = db_writer.DBWriter(db_mgr, flush_ms=60000, flush_rows=1000)
+    monkeypatch.setattr(db_mgr, 'write_meter_entries', lambda meter_entries: 1 / 0)
+    writer.write_meter_entries([get_entry_row(i) for i in range(3)])
+    assert writer.flush()
+    assert writer.get_stats()['queued_rows'] == 0 and writer.get_stats()['flush_count'] == 0
+    monkeypatch.undo()
+
+    writer.write_meter_entries([get_entry_row(3)])
+    writer.close()
+    assert writer.get_stats()['queued_rows'] == 0
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 1
+
+
+def test_failed_flush_on_close_logged(db_mgr, monkeypatch):
+    # a write queued behind close (as by a thread racing it) that fails to flush is logged and dropped, not raised in the writer thread
+    writer = db_writer.DBWriter(db_mgr, flush_ms=60000, flush_rows=1000)
+    write_meter_entries = db_mgr.write_meter_entries
+    monkeypatch.setattr(db_mgr, 'write_meter_entries', lambda meter_entries: write_meter_entries(meter_entries) if len(meter_entries) == 1 else 1 / 0)
+    errors = []
+    monkeypatch.setattr(writer.logger, 'error', errors.append)
+    with db_mgr.write_lock:         # holds the writer's first flush until all are queued
+        writer.write_meter_entries([get_entry_row(0)])
+        writer.write_queue.put((db_writer.WRITE_CLOSE, None, 0, time.monotonic(), None))
+        writer.write_meter_entries([get_entry_row(1), get_entry_row(2)])
+    writer.run_thread.join()
+    assert errors == ['Failed to write batch of 2 rows on close: division by zero']
+    assert db_mgr.get_node_meter_entries_count(NODE_UUID) == 1
+    assert writer.get_stats()['queued_rows'] == 0
+
+def test_trace_db_points(db_mgr):
+    metrics.ingest_stage_seconds.clear()
+    writer = db_writer.DBWriter(db_mgr, flush_ms=60000, flush_rows=1000)
+    trace = {metrics.TRACE_SERIAL_READ: 0.0, metrics.TRACE_PARSED: 0.0, metrics.TRACE_DEQUEUED: 0.0}
+    writer.write_meter_entries([get_entry_row(0)], trace)
+    assert metrics.TRACE_DB_QUEUED in trace and metrics.TRACE_DB_COMMIT not in trace
+
+    # dispatched before the commit, so the DB stages are left to the writer
+    trace[metrics.TRACE_DISPATCHED] = trace[metrics.TRACE_DB_QUEUED]
+    metrics.observe_trace(trace)
+    assert writer.flush()
+    assert trace[metrics.TRACE_DB_QUEUED] <= trace[metrics.TRACE_DB_WRITE_START] <= trace[metrics.TRACE_DB_COMMIT]
+    text_lines = metrics.ingest_stage_seconds.get_text_lines()
+    assert 'meterman_ingest_stage_seconds_count{stage="db_write"} 1' in text_lines
+    assert 'meterman_ingest_stage_seconds_count{stage="total"} 1' in text_lines
+    assert not any('stage="dispatch"' in line for line in text_lines)
+    writer.close()
@@ -1,3 +1,7 @@
+import os
+import threading
+import time
+
 from meterman import gateway_messages as gmsg
 import pytest as pt
 
@@ -37,4 +41,71 @@ def test_meter_update_msg(fixt_gateway):
 
 
     # assert res == 'MTRUPDATE;{0},MUP;{1},{2};{3},{4};{5},{6};{7},{8};{9},{10};{11},{12};{13},{14}'.format(
-    #                     2, BASE_TIME, 100000, 15, 10, 15, 10, 15, 10, 15, 10, 15, 10, 15, 10)
\ No newline at end of file
+    #                     2, BASE_TIME, 100000, 15, 10, 15, 10, 15, 10, 15, 10, 15, 10, 15, 10)
+
+class StubMeterMan:
+    def __init__(self):
+        self.meter_updates = []
+
+    def register_node(self, node_uuid):
+        pass
+
+    def proc_meter_update(self, node_uuid, meter_entries, trace=None):
+        self.meter_updates.append((node_uuid, meter_entries))
+
+
+@pt.fixture
+def pty_dev_mgr():
+    master_fd, slave_fd = os.openpty()
+    meter_man = StubMeterMan()
+    gateway_config = {'network_id': '9.9.9.99', 'gateway_id': '1', 'label': 'Test Gateway', 'serial_port': os.ttyname(slave_fd), 'serial_baud': '9600'}
+    dev_mgr = devmgr.MeterDeviceManager(meter_man, gateway_config)
+    yield dev_mgr, meter_man, master_fd
+    dev_mgr.gateways['9.9.9.99.1']['gw_obj'].serial_conn.close()
+    os.close(master_fd)
+    os.close(slave_fd)
+
+
+def test_rx_queue_handoff_in_order(pty_dev_mgr):
+    dev_mgr, meter_man, master_fd = pty_dev_mgr
+    for meter_value in range(100, 112):
+        os.write(master_fd, 'G>S:MUP_;2,MUP_,{0},{1};15,1;15,5\r\n'.format(BASE_TIME, meter_value).encode('latin1'))
+
+    time_start = time.monotonic()
+    while len(meter_man.meter_updates) < 12 and time.monotonic() - time_start < 5:
+        dev_mgr.proc_device_messages(wait_secs=0.1)
+
+    assert [entries[-1]['meter_value'] for node_uuid, entries in meter_man.meter_updates] == list(range(106, 118))
+    assert dev_mgr.rx_msg_queue.empty()
+
+
+def test_async_engine_dispatch_in_order():
+    master_fds, slave_fds, gateway_configs = [], [], []
+    for gateway_id in ['1', '2']:
+        master_fd, slave_fd = os.openpty()
+        master_fds.append(master_fd)
+        slave_fds.append(slave_fd)
+        gateway_configs.append({'network_id': '9.9.9.99', 'gateway_id': gateway_id, 'label': 'Test Gateway', 'serial_port': os.ttyname(slave_fd),
+                                'serial_baud': '9600'})
+    meter_man = StubMeterMan()
+    dev_mgr = devmgr.MeterDeviceManager(meter_man, gateway_configs, device_engine=devmgr.DEVICE_ENGINE_ASYNCIO)
+    engine_thread = threading.Thread(target=dev_mgr.async_engine.run)
+    engine_thread.start()
+
+    for meter_value in range(100, 106):
+        for master_fd in master_fds:
+            os.write(master_fd, 'G>S:MUP_;2,MUP_,{0},{1};15,1;15,5\r\n'.format(BASE_TIME, meter_value).encode('latin1'))
+
+    time_start = time.monotonic()
+    while len(meter_man.meter_updates) < 12 and time.monotonic() - time_start < 5:
+        time.sleep(0.05)
+
+    dev_mgr.async_engine.stop()
+    engine_thread.join(5)
+    for gateway in dev_mgr.gateways.values():
+        gateway['gw_obj'].serial_conn.close()
+    for fd in master_fds + slave_fds:
+        os.close(fd)
+
+    assert not engine_thread.is_alive()
+    assert sorted(entries[-1]['meter_value'] for node_uuid, entries in meter_man.meter_updates) == sorted(list(range(106, 112)) * 2)
@@ -0,0 +1,47 @@
+import logging
+import os
+import queue
+
+import pytest as pt
+
+from meterman import meter_device_gateway as gway
+from meterman import meter_load_sim as mls
+
+
+@pt.fixture(scope="function")
+def sim_gateway():
+    master_fd, slave_fd, slave_path = mls.open_sim_pty()
+    load_sim = mls.MeterLoadSim(master_fd, num_nodes=50, real_time=False)
+    gateway = gway.MeterDeviceGateway(None, '0.0.1.1', '1', label='Test Gateway', serial_port=slave_path, serial_baud=115200, log_file=os.devnull,
+                                      rx_msg_queue=queue.Queue())
+    gateway.logger.setLevel(logging.WARNING)
+    yield load_sim, gateway
+    gateway.serial_conn.close()
+    os.close(master_fd)
+    os.close(slave_fd)
+
+
+def test_load_sim_meter_updates_and_acks(sim_gateway):
+    load_sim, gateway = sim_gateway
+    gateway.set_node_meter_value('5', 42)
+    gateway.set_node_meter_interval('300', 30)
+    gateway.get_node_snapshot()
+
+    load_sim.run(secs=1, report_secs=60)
+
+    assert load_sim.stats['acks'] == 2 and load_sim.stats['nacks'] == 1
+    msg_types = {}
+    last_meter_values = {}
+    while not gateway.rx_msg_queue.empty():
+        msg_obj = gateway.rx_msg_queue.get()
+        msg_types[msg_obj['message_type']] = msg_types.get(msg_obj['message_type'], 0) + 1
+        if msg_obj['message_type'] == 'MUP_':
+            # each update continues from the node's previous one
+            header = msg_obj['HEADER_1']
+            if header.node_id in last_meter_values and header.node_id != '5':
+                assert int(header.last_entry_meter_value) == last_meter_values[header.node_id]
+            last_meter_values[header.node_id] = int(header.last_entry_meter_value) + sum(
+                int(value.entry_value) for key, value in msg_obj.items() if key.startswith('DETAIL'))
+
+    assert msg_types['MUP_'] >= 50
+    assert msg_types['NOSNAP'] == 5
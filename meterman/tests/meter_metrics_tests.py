@@ -0,0 +1,63 @@
+import os
+
+from meterman import app_base as base
+import pytest as pt
+
+from meterman import meter_metrics as metrics
+from meterman import meter_replay as mreplay
+
+TEST_DB_FILE = base.temp_path + "/meter_metrics_test.db"
+
+
+@pt.fixture(scope="function")
+def replay():
+    for metric in metrics.registry:
+        metric.clear()
+    fixt_replay = mreplay.MeterReplay('0.0.1.1', '1', db_file=TEST_DB_FILE)
+    yield fixt_replay
+    fixt_replay.close()
+    os.remove(TEST_DB_FILE)
+
+
+def test_histogram_text():
+    hist = metrics.Histogram('test_seconds', 'Test histogram.', ['stage'], buckets=(0.1, 1.0))
+    metrics.registry.remove(hist)
+    hist.observe(0.05, ('a',))
+    hist.observe(0.5, ('a',))
+    hist.observe(5, ('a',))
+    assert hist.get_text_lines() == ['# HELP meterman_test_seconds Test histogram.',
+                                     '# TYPE meterman_test_seconds histogram',
+                                     'meterman_test_seconds_bucket{stage="a",le="0.1"} 1',
+                                     'meterman_test_seconds_bucket{stage="a",le="1.0"} 2',
+                                     'meterman_test_seconds_bucket{stage="a",le="+Inf"} 3',
+                                     'meterman_test_seconds_sum{stage="a"} 5.55',
+                                     'meterman_test_seconds_count{stage="a"} 3']
+
+
+def test_label_escaping():
+    assert metrics.format_labels(['name'], ['a"b\\c\n']) == '{name="a\\"b\\\\c\\n"}'
+    assert metrics.format_labels([], []) == ''
+
+
+def test_trace_meter_update(replay):
+    msg_obj = mreplay.gmsg.get_message_obj('G>S:MUP_;2,MUP_,1496842913,1000;15,1;15,5', replay.gateway_uuid, '1', '0.0.1.1')
+    msg_obj['trace'] = {metrics.TRACE_SERIAL_READ: 0.0, metrics.TRACE_PARSED: 0.0}
+    replay.device_mgr.dispatch_message(msg_obj)
+
+    trace = msg_obj['trace']
+    assert trace[metrics.TRACE_SERIAL_READ] <= trace[metrics.TRACE_PARSED] <= trace[metrics.TRACE_DEQUEUED] <= \
+        trace[metrics.TRACE_DB_WRITE_START] <= trace[metrics.TRACE_DB_COMMIT] <= trace[metrics.TRACE_DISPATCHED]
+
+    text = metrics.get_metrics_text()
+    for stage in metrics.TRACE_STAGES:
+        assert 'meterman_ingest_stage_seconds_count{{stage="{0}"}} 1\n'.format(stage) in text
+    assert 'meterman_messages_total{message_type="MUP_"} 1\n' in text
+    assert 'meterman_meter_entries_total 2\n' in text
+
+
+def test_untraced_message(replay):
+    # e.g. replayed messages carry no trace, so are counted but not timed
+    replay.replay_lines(['G>S:MUP_;2,MUP_,1496842913,1000;15,1;15,5'])
+    text = metrics.get_metrics_text()
+    assert 'meterman_messages_total{message_type="MUP_"} 1\n' in text
+    assert 'meterman_ingest_stage_seconds_count' not in text
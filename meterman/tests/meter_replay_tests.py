@@ -0,0 +1,40 @@
+import os
+
+from meterman import app_base as base
+import pytest as pt
+
+from meterman import meter_replay as mreplay
+
+TEST_DB_FILE = base.temp_path + "/meter_replay_test.db"
+
+REPLAY_LINES = ['2017-12-11 10:00:00 - gateway - DEBUG - Got serial data: G>S:MUP_;2,MUP_,1496842913,1000;15,1;15,5\n',
+                '1512986400,G>S:NOSNAP;2,4500,15000,20000,600,1496842913,500,5,1000,1496842913,3050,0.1,100,1000,-70\n',
+                'G>S:MUP_;2,MUP_,1496842943,1006;15,2\r\n',
+                'not a message\n']
+
+
+@pt.fixture(scope="function", params=[0, 10])
+def replay(request):
+    fixt_replay = mreplay.MeterReplay('0.0.1.1', '1', db_file=TEST_DB_FILE, batch_size=request.param)
+    yield fixt_replay
+    fixt_replay.close()
+    os.remove(TEST_DB_FILE)
+
+
+def test_parse_line(replay):
+    assert replay.parse_line(REPLAY_LINES[1])[0] == 1512986400
+    assert replay.parse_line(REPLAY_LINES[2]) == (None, 'G>S:MUP_;2,MUP_,1496842943,1006;15,2')
+    assert replay.parse_line(REPLAY_LINES[3]) == (None, None)
+    when_received, message_str = replay.parse_line(REPLAY_LINES[0])
+    assert message_str == 'G>S:MUP_;2,MUP_,1496842913,1000;15,1;15,5'
+    assert when_received == mreplay.arrow.get('2017-12-11 10:00:00').replace(tzinfo='local').timestamp
+
+
+def test_replay_lines(replay):
+    stats = replay.replay_lines(REPLAY_LINES)
+    assert stats == {'lines': 4, 'msgs': 3, 'skipped': 1}
+
+    db_mgr = replay.meter_man.data_mgr.db_mgr
+    assert db_mgr.get_node_meter_entries_count('0.0.1.1.2') == 3
+    assert db_mgr.get_last_mup('0.0.1.1.2', time_from=None, time_to=None)['meter_value'] == 1008
+    assert db_mgr.get_node_snapshots('0.0.1.1.2')[0]['when_received'] == 1512986400
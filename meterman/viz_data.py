@@ -12,14 +12,14 @@ def output_plot(node_uuid, plot_output_file, data_mgr=None, db_file=None):
     if data_mgr is None:
         data_mgr = mdata_mgr.MeterDataManager(db_file=db_file, log_file='/dev/null')
 
-    # Get all meter entries and prep dataframe
-    meter_entries = data_mgr.get_meter_entries(node_uuid=node_uuid, entry_type=None, rec_status=db.RecStatus.NORMAL.value, time_from=None, time_to=None, limit_count=None)
+    # Get all meter entries and prep dataframe, read straight into it
+    meter_entries = data_mgr.iter_meter_entries(node_uuid=node_uuid, entry_type=None, rec_status=db.RecStatus.NORMAL.value, time_from=None, time_to=None, limit_count=None)
+    df = pd.DataFrame.from_records(meter_entries, columns=db.METER_ENTRY_COLUMNS)
 
-    if len(meter_entries) == 0:
+    if len(df) == 0:
         print('No Data.  Exiting...')
         return
 
-    df = pd.DataFrame.from_records(meter_entries)
     df['when_finish_dt_utc'] = pd.to_datetime(df['when_start'] + df['duration'], unit='s').dt.tz_localize('UTC')
     # df.set_index(['when_finish_dt_utc', 'node_uuid', 'entry_type', 'when_start_raw_nonce'])
     df['when_start_dt_local'] = pd.to_datetime(df['when_start'], unit='s').dt.tz_localize('UTC').dt.tz_convert('Australia/Melbourne').dt.tz_localize(None) # hack given bokeh bug
@@ -16,4 +16,7 @@ setup(name='meterman',
     install_requires=[
         'arrow', 'flask', 'flask_httpauth', 'flask_restful', 'ipaddress', 'uptime', 'pytest', 'argparse', 'pyserial', 'bokeh', 'pandas'
     ],
+    extras_require={
+        'analytics': ['duckdb']
+    },
     zip_safe=True)
\ No newline at end of file